@@ -0,0 +1,549 @@
+"""
+End-to-end benchmark of the segmentation pipeline.
+
+Runs the stages of a segmentation on synthetic CT volumes of several sizes, with the stand-in model of
+standin_model.py (no download, no GPU) or with the real models:
+
+    input_export          hand-off of the input voxels to the runner (volumeio.export_array, as exportVolumeNode)
+    input_conversion      conversion of the input to NRRD (as the DICOM and input caches)
+    prediction            nnunet_runner.py in a subprocess, split into its progress stages (prediction/load, ...)
+    prediction_import     mapping of the prediction and detection of its labels (as convert_prediction_to_segmentation)
+    segment_naming        names of the segments from the dataset.json of the model
+    segmentation_export   segmentation file in the default format (see segio)
+
+Every stage reports its wall time, peak resident memory and bytes read/written. The results are written as
+JSON, and compared to a stored baseline with --baseline: a stage slower or bigger than the baseline by more
+than the tolerance is flagged as a regression and the script exits with status 1. The volumes and the
+stand-in weights are drawn from fixed seeds, so two runs on the same machine measure the same work.
+
+Usage (with the Python environment of the runner: torch, nnunetv2, SimpleITK):
+    python Benchmarks/pipeline_benchmark.py --sizes small medium --output results.json
+    python Benchmarks/pipeline_benchmark.py --output new.json --baseline results.json --tolerance 0.15
+    python Benchmarks/pipeline_benchmark.py --compare results.json new.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import threading
+import subprocess
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+MODULE_DIR = os.path.join(BENCHMARKS_DIR, "..", "LungSegmentation")
+RUNNER_PATH = os.path.join(MODULE_DIR, "Resources", "scripts", "nnunet_runner.py")
+if MODULE_DIR not in sys.path:
+    sys.path.insert(0, MODULE_DIR)
+
+BENCHMARK_VERSION = 1
+SEED = 0
+
+# Synthetic volumes (z, y, x), 1 mm voxels
+SIZES = {
+    "small": (64, 128, 128),
+    "medium": (128, 256, 256),
+    "large": (256, 384, 384),
+}
+DEFAULT_SIZES = ("small", "medium")
+
+# A stage is a regression if it is slower (or uses more memory) than the baseline by more than the tolerance,
+# and by more than these absolute amounts (measurement noise of the short stages)
+DEFAULT_TOLERANCE = 0.15
+MIN_SECONDS_DIFFERENCE = 0.05
+MIN_RSS_DIFFERENCE = 32 * 1024 ** 2
+
+PACKAGES = ("numpy", "torch", "nnunetv2", "nnUNet_package", "SimpleITK", "dynamic_network_architectures", "psutil")
+
+
+############################################################### MEASUREMENTS ###############################################################
+
+def current_rss():
+    """
+    Returns:
+        int: Resident memory of this process in bytes, None if it cannot be read.
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss():
+    """
+    Returns:
+        int: Peak resident memory of this process since it started in bytes, None if it cannot be read.
+    """
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return getattr(psutil.Process().memory_info(), "peak_wset", None)
+    except ImportError:
+        return None
+
+
+def io_counters():
+    """
+    Returns:
+        tuple: (bytes read, bytes written) by this process since it started, including the page cache,
+            (None, None) if they cannot be read.
+    """
+    try:
+        import psutil
+        counters = psutil.Process().io_counters()
+        return (getattr(counters, "read_chars", counters.read_bytes), getattr(counters, "write_chars", counters.write_bytes))
+    except (ImportError, AttributeError, NotImplementedError):
+        pass
+    try:
+        values = {}
+        with open("/proc/self/io", "r") as f:
+            for line in f:
+                key, value = line.split(":")
+                values[key] = int(value)
+        return values["rchar"], values["wchar"]
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+class StageMeter:
+    """
+    Measures the wall time, peak resident memory (sampled in a thread) and I/O of a stage run in this process.
+    """
+    def __init__(self, interval=0.01):
+        """
+        Args:
+            interval (float): Time in seconds between two memory samples.
+        Returns:
+            None
+        """
+        self.interval = interval
+        self.result = None
+        self._peak = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            rss = current_rss()
+            if rss is not None:
+                self._peak = max(self._peak or 0, rss)
+
+    def __enter__(self):
+        self._peak = current_rss()
+        self._io = io_counters()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self._start
+        self._stop.set()
+        self._thread.join()
+        rss = current_rss()
+        if rss is not None:
+            self._peak = max(self._peak or 0, rss)
+        read, written = io_counters()
+        self.result = {
+            "seconds": round(seconds, 4),
+            "peak_rss_bytes": self._peak,
+            "bytes_read": read - self._io[0] if read is not None else None,
+            "bytes_written": written - self._io[1] if written is not None else None,
+        }
+
+
+def run_child(argv):
+    """
+    Entry point of the subprocess running nnunet_runner.py: runs the runner, then writes its peak memory and
+    I/O (which are lost once the process exits) to a JSON file.
+
+    Args:
+        argv (list): Path of the JSON file, then the arguments of the runner.
+    Returns:
+        None
+    """
+    import runpy
+
+    result_path, runner_args = argv[0], argv[1:]
+    sys.argv = [RUNNER_PATH] + runner_args
+    sys.path.insert(0, os.path.dirname(RUNNER_PATH))
+    try:
+        runpy.run_path(RUNNER_PATH, run_name="__main__")
+    finally:
+        read, written = io_counters()
+        with open(result_path, "w") as f:
+            json.dump({"peak_rss_bytes": peak_rss(), "bytes_read": read, "bytes_written": written}, f)
+
+
+def run_runner(runner_args, log_path):
+    """
+    Runs nnunet_runner.py with --progress in a subprocess and measures it.
+
+    Args:
+        runner_args (list): Arguments of the runner.
+        log_path (str): File receiving the output of the runner that is not a progress event.
+    Returns:
+        dict: Measurements of the whole prediction, and "stages" with the wall time of every progress stage.
+    Raises:
+        RuntimeError: If the runner fails.
+    """
+    result_path = log_path + ".measure.json"
+    command = [sys.executable, os.path.abspath(__file__), "--child", result_path] + runner_args + ["--progress"]
+
+    stage_starts = []
+    start = time.perf_counter()
+    with open(log_path, "w") as log:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=log, text=True)
+        for line in process.stdout:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                log.write(line)
+                continue
+            if event.get("event") == "progress" and (not stage_starts or stage_starts[-1][0] != event["stage"]):
+                stage_starts.append((event["stage"], time.perf_counter() - start))
+        status = process.wait()
+    seconds = time.perf_counter() - start
+    if status != 0:
+        raise RuntimeError(f"nnunet_runner.py failed with status {status}, see {log_path}")
+
+    with open(result_path, "r") as f:
+        result = json.load(f)
+    os.remove(result_path)
+
+    # A stage lasts until the next one starts; process startup and imports until the first event
+    stages = {"startup": round(stage_starts[0][1] if stage_starts else seconds, 4)}
+    for (name, begin), (_, end) in zip(stage_starts, stage_starts[1:] + [(None, seconds)]):
+        stages[name] = round(stages.get(name, 0.0) + end - begin, 4)
+    return {"seconds": round(seconds, 4), **result, "stages": stages}
+
+
+############################################################### PIPELINE ###############################################################
+
+def synthetic_volume(shape, seed=SEED):
+    """
+    Synthetic thorax CT in Hounsfield units: a body cylinder, two lungs, a trachea and noise.
+
+    Args:
+        shape (tuple): (z, y, x).
+        seed (int): Seed of the noise.
+    Returns:
+        np.ndarray: The volume (int16).
+    """
+    import numpy as np
+
+    z, y, x = (np.linspace(-1.0, 1.0, n, dtype=np.float32) for n in shape)
+    z, y, x = z[:, None, None], y[None, :, None], x[None, None, :]
+    volume = np.full(shape, -1000.0, dtype=np.float32)
+    volume[np.broadcast_to((x / 0.85) ** 2 + (y / 0.7) ** 2 <= 1.0, shape)] = 40.0
+    for side in (-0.4, 0.4):
+        lung = ((x - side) / 0.3) ** 2 + (y / 0.45) ** 2 + (z / 0.85) ** 2 <= 1.0
+        volume[lung] = -850.0
+    trachea = ((x / 0.05) ** 2 + ((y + 0.2) / 0.05) ** 2 <= 1.0) & (z > 0.3)
+    volume[trachea] = -1000.0
+    volume += np.random.default_rng(seed).normal(0.0, 20.0, shape).astype(np.float32)
+    return volume.astype(np.int16)
+
+
+def run_case(name, shape, case_dir, models_dir, configuration, preset, threads=None, fold_processes=1):
+    """
+    Runs all the stages of the pipeline on a synthetic volume.
+
+    Args:
+        name (str): Name of the size.
+        shape (tuple): (z, y, x) of the volume.
+        case_dir (str): Working folder of the case (created).
+        models_dir (str): Models folder given to the runner.
+        configuration (tuple): (animal, mode, structure).
+        preset (str): Speed preset of the runner.
+        threads (int): Threads of the runner, all the cores if None.
+        fold_processes (int): Processes predicting the folds in parallel (see nnunet_folds.py).
+    Returns:
+        dict: Measurements of every stage.
+    """
+    import numpy as np
+    from LungSegmentationLib import volumeio, segio
+
+    os.makedirs(case_dir, exist_ok=True)
+    volume = synthetic_volume(shape)
+    geometry = {"spacing": [1.0, 1.0, 1.0], "origin": [0.0, 0.0, 0.0], "direction": [1, 0, 0, 0, 1, 0, 0, 0, 1]}
+    stages = {}
+
+    meter = StageMeter()
+    with meter:
+        header_path = volumeio.export_array(volume, geometry, os.path.join(case_dir, "input_volume.json"))
+    stages["input_export"] = meter.result
+
+    with meter:
+        volumeio.write_nrrd(os.path.join(case_dir, "input_volume.nrrd"), volume, geometry)
+    stages["input_conversion"] = meter.result
+    del volume
+
+    animal, mode, structure = configuration
+    output_dir = os.path.join(case_dir, "prediction")
+    context_file = os.path.join(case_dir, "nnunet_context.json")
+    runner_args = ["--input", header_path, "--output", output_dir, "--models_dir", models_dir,
+                   "--animal", animal, "--mode", mode, "--structure", structure, "--tmp_file", context_file,
+                   "--output_format", "raw", "--preset", preset]
+    if threads:
+        runner_args += ["--threads", str(threads)]
+    if fold_processes > 1:
+        runner_args += ["--fold_processes", str(fold_processes)]
+    prediction = run_runner(runner_args, os.path.join(case_dir, "runner.log"))
+    for stage, seconds in prediction.pop("stages").items():
+        stages[f"prediction/{stage}"] = {"seconds": seconds}
+    stages["prediction"] = prediction
+
+    prediction_path = os.path.join(output_dir, "001.json")
+    with meter:
+        array, header = volumeio.map_volume(prediction_path)
+        labels = segio.present_labels(array)
+        # The widget copies the voxels into the label map node
+        label_map = np.array(array)
+        del array
+    stages["prediction_import"] = meter.result
+
+    with meter:
+        label_names = segio.read_label_names(context_file)
+        colors = np.random.default_rng(SEED).random((len(labels), 3))
+        segments = [{"id": f"Segment_{label}", "name": segio.label_name(label_names, label), "label": label,
+                     "color": tuple(color)} for label, color in zip(labels, colors)]
+    stages["segment_naming"] = meter.result
+
+    with meter:
+        segio.write_segmentation(segio.segmentation_file_path(case_dir, name), label_map, header, segments)
+    stages["segmentation_export"] = meter.result
+    volumeio.remove_volume(prediction_path)
+
+    return {"shape": list(shape), "labels": labels, "stages": stages}
+
+
+def merge_repeats(runs):
+    """
+    Merges the repeated runs of a case: median wall time and bytes, maximum peak memory.
+
+    Args:
+        runs (list): Results of run_case.
+    Returns:
+        dict: Merged result.
+    """
+    import statistics
+
+    merged = {key: value for key, value in runs[0].items() if key != "stages"}
+    merged["repeats"] = len(runs)
+    merged["stages"] = {}
+    for stage in runs[0]["stages"]:
+        values = [run["stages"][stage] for run in runs if stage in run["stages"]]
+        result = {}
+        for key in values[0]:
+            samples = [value[key] for value in values if value.get(key) is not None]
+            if not samples:
+                result[key] = None
+            elif key == "peak_rss_bytes":
+                result[key] = max(samples)
+            else:
+                result[key] = statistics.median(samples)
+        merged["stages"][stage] = result
+    return merged
+
+
+def environment():
+    """
+    Returns:
+        dict: Machine, Python and package versions, and revision of the module.
+    """
+    from importlib.metadata import version, PackageNotFoundError
+
+    packages = {}
+    for package in PACKAGES:
+        try:
+            packages[package] = version(package)
+        except PackageNotFoundError:
+            packages[package] = None
+    try:
+        revision = subprocess.run(["git", "rev-parse", "HEAD"], cwd=BENCHMARKS_DIR, capture_output=True, text=True,
+                                  timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        revision = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "packages": packages,
+        "revision": revision,
+    }
+
+
+def run(sizes, workdir, models_dir=None, configuration=None, preset="fast", repeats=1, threads=None, standin=True,
+        fold_processes=1, standin_folds=1):
+    """
+    Runs the benchmark.
+
+    Args:
+        sizes (list): Names of SIZES.
+        workdir (str): Working folder of the cases.
+        models_dir (str): Models folder, <workdir>/models if None.
+        configuration (tuple): (animal, mode, structure), standin_model.DEFAULT_CONFIGURATION if None.
+        preset (str): Speed preset of the runner.
+        repeats (int): Number of runs of every case.
+        threads (int): Threads of the runner, all the cores if None.
+        standin (bool): Installs the stand-in model for the configuration (the real model is used otherwise).
+        fold_processes (int): Processes predicting the folds in parallel (see nnunet_folds.py).
+        standin_folds (int): Folds of the stand-in model (all used by the "ensemble" preset).
+    Returns:
+        dict: The results.
+    """
+    from standin_model import DEFAULT_CONFIGURATION, install_standin_model
+
+    configuration = tuple(configuration or DEFAULT_CONFIGURATION)
+    models_dir = models_dir or os.path.join(workdir, "models")
+    if standin:
+        install_standin_model(models_dir, configuration, standin_folds)
+
+    cases = {}
+    for name in sizes:
+        runs = []
+        for repeat in range(repeats):
+            case_dir = os.path.join(workdir, f"{name}_{repeat}")
+            runs.append(run_case(name, SIZES[name], case_dir, models_dir, configuration, preset, threads, fold_processes))
+            shutil.rmtree(case_dir, ignore_errors=True)
+        cases[name] = merge_repeats(runs)
+        print(f"{name}: " + ", ".join(f"{stage} {result['seconds']:.2f} s"
+                                      for stage, result in cases[name]["stages"].items() if "/" not in stage))
+
+    return {
+        "benchmark_version": BENCHMARK_VERSION,
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "environment": environment(),
+        "settings": {"sizes": list(sizes), "configuration": list(configuration), "model": "standin" if standin else "real",
+                     "preset": preset, "repeats": repeats, "threads": threads, "fold_processes": fold_processes,
+                     "standin_folds": standin_folds if standin else None, "seed": SEED},
+        "cases": cases,
+    }
+
+
+############################################################### COMPARISON ###############################################################
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares the wall time and the peak memory of every stage to a baseline.
+
+    Args:
+        results (dict): Results of run.
+        baseline (dict): Stored results of run.
+        tolerance (float): Relative increase above which a stage is a regression.
+    Returns:
+        list: One dict per case, stage and metric: "case", "stage", "metric", "baseline", "value", "ratio" and
+            "status" ("regression", "improvement" or "ok").
+    """
+    metrics = (("seconds", MIN_SECONDS_DIFFERENCE), ("peak_rss_bytes", MIN_RSS_DIFFERENCE))
+    rows = []
+    for case, case_results in results.get("cases", {}).items():
+        baseline_stages = baseline.get("cases", {}).get(case, {}).get("stages", {})
+        for stage, values in case_results["stages"].items():
+            if stage not in baseline_stages:
+                continue
+            for metric, min_difference in metrics:
+                value, reference = values.get(metric), baseline_stages[stage].get(metric)
+                if value is None or not reference:
+                    continue
+                status = "ok"
+                if value > reference * (1 + tolerance) and value - reference > min_difference:
+                    status = "regression"
+                elif value < reference * (1 - tolerance) and reference - value > min_difference:
+                    status = "improvement"
+                rows.append({"case": case, "stage": stage, "metric": metric, "baseline": reference, "value": value,
+                             "ratio": round(value / reference, 3), "status": status})
+    return rows
+
+
+def print_comparison(rows):
+    """
+    Prints the result of compare.
+
+    Args:
+        rows (list): Result of compare.
+    Returns:
+        int: Number of regressions.
+    """
+    print(f"{'case':<8} {'stage':<28} {'metric':<15} {'baseline':>14} {'value':>14} {'ratio':>7}  status")
+    for row in rows:
+        scale, unit = (1, "s") if row["metric"] == "seconds" else (1024 ** 2, "MB")
+        print(f"{row['case']:<8} {row['stage']:<28} {row['metric']:<15} "
+              f"{row['baseline'] / scale:>11.2f} {unit:<2} {row['value'] / scale:>11.2f} {unit:<2} "
+              f"{row['ratio']:>7.2f}  {row['status'].upper() if row['status'] == 'regression' else row['status']}")
+    regressions = sum(row["status"] == "regression" for row in rows)
+    print(f"{regressions} regression(s)")
+    return regressions
+
+
+def load_results(path):
+    """
+    Returns:
+        dict: Results stored as JSON.
+    """
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "--child":
+        run_child(argv[1:])
+        return 0
+
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the segmentation pipeline")
+    parser.add_argument("--sizes", nargs="+", default=list(DEFAULT_SIZES), choices=list(SIZES), help="Volume sizes")
+    parser.add_argument("--repeats", type=int, default=1, help="Runs of every case (median time, maximum memory)")
+    parser.add_argument("--preset", default="fast", choices=["fast", "balanced", "accurate", "ensemble"], help="Speed preset")
+    parser.add_argument("--threads", type=int, default=None, help="Threads of the runner (all the cores by default)")
+    parser.add_argument("--fold_processes", type=int, default=1, help="Processes predicting the folds in parallel")
+    parser.add_argument("--standin_folds", type=int, default=1, help="Folds of the stand-in model (used by --preset ensemble)")
+    parser.add_argument("--workdir", default=None, help="Working folder (a temporary folder by default)")
+    parser.add_argument("--models_dir", default=None, help="Models folder (<workdir>/models by default)")
+    parser.add_argument("--configuration", nargs=3, default=None, metavar=("ANIMAL", "MODE", "STRUCTURE"),
+                        help="Configuration to run (the stand-in model is registered for it)")
+    parser.add_argument("--real_model", action="store_true", help="Use the real model of the configuration")
+    parser.add_argument("--output", default=None, help="JSON file receiving the results")
+    parser.add_argument("--baseline", default=None, help="Stored results to compare with")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Relative increase flagged as regression")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "RESULTS"), help="Compare two stored results and exit")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return 1 if print_comparison(compare(load_results(args.compare[1]), load_results(args.compare[0]), args.tolerance)) else 0
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="lungseg_benchmark_")
+    try:
+        results = run(args.sizes, workdir, args.models_dir, args.configuration, args.preset, args.repeats, args.threads,
+                      standin=not args.real_model, fold_processes=args.fold_processes, standin_folds=args.standin_folds)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+        print(f"Results saved to {args.output}")
+
+    if args.baseline:
+        return 1 if print_comparison(compare(results, load_results(args.baseline), args.tolerance)) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,210 @@
+"""
+Tiny stand-in nnUNetv2 model for the benchmarks.
+
+The model is a small PlainConvUNet (3 stages, 4 to 16 features, 32^3 patches) with random weights drawn
+from a fixed seed: it needs no download and no GPU, and goes through exactly the same code as the real
+models (nnUNetPredictor, preprocessing, sliding window, resampling, export). Its predictions are not
+meaningful, but they are reproducible. The model is registered in the local_models.json of the models
+folder (see nnunet_engine.resolve_local_model), so that nnunet_runner.py uses it for the configuration
+given to install_standin_model.
+
+Usage:
+    python Benchmarks/standin_model.py --models_dir /tmp/benchmark_models
+"""
+import os
+import json
+import argparse
+
+STANDIN_MODEL_NAME = "Dataset999_Standin"
+TRAINER_FOLDER = "nnUNetTrainer__nnUNetPlans__3d_fullres"
+CONFIGURATION = "3d_fullres"
+SEED = 0
+
+PATCH_SIZE = [32, 32, 32]
+SPACING = [1.0, 1.0, 1.0]
+FEATURES_PER_STAGE = [4, 8, 16]
+LABELS = {"background": 0, "lungs": 1, "airways": 2, "vessels": 3}
+
+# Configuration registered by default (accepted by the arguments of nnunet_runner.py)
+DEFAULT_CONFIGURATION = ("rabbit", "invivo", "parenchyma")
+
+
+def make_plans():
+    """
+    Returns:
+        dict: plans.json of the stand-in model, with the architecture keys of both the old (< 2.4) and the new
+            nnUNetv2 plans formats.
+    """
+    n_stages = len(FEATURES_PER_STAGE)
+    kernel_sizes = [[3, 3, 3]] * n_stages
+    strides = [[1, 1, 1]] + [[2, 2, 2]] * (n_stages - 1)
+    intensity = {"max": 1000.0, "mean": -400.0, "median": -500.0, "min": -1024.0,
+                 "percentile_00_5": -1000.0, "percentile_99_5": 400.0, "std": 400.0}
+    return {
+        "dataset_name": STANDIN_MODEL_NAME,
+        "plans_name": "nnUNetPlans",
+        "original_median_spacing_after_transp": SPACING,
+        "original_median_shape_after_transp": [64, 128, 128],
+        "image_reader_writer": "SimpleITKIO",
+        "transpose_forward": [0, 1, 2],
+        "transpose_backward": [0, 1, 2],
+        "configurations": {
+            CONFIGURATION: {
+                "data_identifier": "nnUNetPlans_3d_fullres",
+                "preprocessor_name": "DefaultPreprocessor",
+                "batch_size": 2,
+                "patch_size": PATCH_SIZE,
+                "median_image_size_in_voxels": [64, 128, 128],
+                "spacing": SPACING,
+                "normalization_schemes": ["CTNormalization"],
+                "use_mask_for_norm": [False],
+                "resampling_fn_data": "resample_data_or_seg_to_shape",
+                "resampling_fn_seg": "resample_data_or_seg_to_shape",
+                "resampling_fn_data_kwargs": {"is_seg": False, "order": 3, "order_z": 0, "force_separate_z": None},
+                "resampling_fn_seg_kwargs": {"is_seg": True, "order": 1, "order_z": 0, "force_separate_z": None},
+                "resampling_fn_probabilities": "resample_data_or_seg_to_shape",
+                "resampling_fn_probabilities_kwargs": {"is_seg": False, "order": 1, "order_z": 0, "force_separate_z": None},
+                "architecture": {
+                    "network_class_name": "dynamic_network_architectures.architectures.unet.PlainConvUNet",
+                    "arch_kwargs": {
+                        "n_stages": n_stages,
+                        "features_per_stage": FEATURES_PER_STAGE,
+                        "conv_op": "torch.nn.modules.conv.Conv3d",
+                        "kernel_sizes": kernel_sizes,
+                        "strides": strides,
+                        "n_conv_per_stage": [1] * n_stages,
+                        "n_conv_per_stage_decoder": [1] * (n_stages - 1),
+                        "conv_bias": True,
+                        "norm_op": "torch.nn.modules.instancenorm.InstanceNorm3d",
+                        "norm_op_kwargs": {"eps": 1e-05, "affine": True},
+                        "dropout_op": None,
+                        "dropout_op_kwargs": None,
+                        "nonlin": "torch.nn.LeakyReLU",
+                        "nonlin_kwargs": {"inplace": True},
+                    },
+                    "_kw_requires_import": ["conv_op", "norm_op", "dropout_op", "nonlin"],
+                },
+                # Plans format of nnUNetv2 < 2.4
+                "UNet_class_name": "PlainConvUNet",
+                "UNet_base_num_features": FEATURES_PER_STAGE[0],
+                "unet_max_num_features": FEATURES_PER_STAGE[-1],
+                "n_conv_per_stage_encoder": [1] * n_stages,
+                "n_conv_per_stage_decoder": [1] * (n_stages - 1),
+                "num_pool_per_axis": [n_stages - 1] * 3,
+                "pool_op_kernel_sizes": strides,
+                "conv_kernel_sizes": kernel_sizes,
+                "batch_dice": True,
+            }
+        },
+        "experiment_planner_used": "ExperimentPlanner",
+        "label_manager": "LabelManager",
+        "foreground_intensity_properties_per_channel": {"0": intensity},
+    }
+
+
+def make_dataset_json():
+    """
+    Returns:
+        dict: dataset.json of the stand-in model.
+    """
+    return {
+        "channel_names": {"0": "CT"},
+        "labels": LABELS,
+        "numTraining": 1,
+        "file_ending": ".nrrd",
+    }
+
+
+def build_network(plans, dataset_json):
+    """
+    Builds the network of the stand-in model the way nnUNetPredictor does.
+
+    Args:
+        plans (dict): Result of make_plans.
+        dataset_json (dict): Result of make_dataset_json.
+    Returns:
+        torch.nn.Module: The network, with random weights.
+    """
+    from nnunetv2.utilities.plans_handling.plans_handler import PlansManager
+    from nnunetv2.utilities.label_handling.label_handling import determine_num_input_channels
+    from nnunetv2.training.nnUNetTrainer.nnUNetTrainer import nnUNetTrainer
+
+    plans_manager = PlansManager(plans)
+    configuration = plans_manager.get_configuration(CONFIGURATION)
+    channels = determine_num_input_channels(plans_manager, configuration, dataset_json)
+    if hasattr(configuration, "network_arch_class_name"):
+        # nnUNetv2 >= 2.4
+        return nnUNetTrainer.build_network_architecture(
+            configuration.network_arch_class_name,
+            configuration.network_arch_init_kwargs,
+            configuration.network_arch_init_kwargs_req_import,
+            channels,
+            plans_manager.get_label_manager(dataset_json).num_segmentation_heads,
+            enable_deep_supervision=False,
+        )
+    return nnUNetTrainer.build_network_architecture(plans_manager, dataset_json, configuration, channels,
+                                                    enable_deep_supervision=False)
+
+
+def install_standin_model(models_dir, configuration=DEFAULT_CONFIGURATION, folds=1):
+    """
+    Writes the stand-in model in the models folder (if not already there) and registers it for a configuration.
+
+    Args:
+        models_dir (str): Models folder given to nnunet_runner.py.
+        configuration (tuple): (animal, mode, structure) resolved to the stand-in model.
+        folds (int): Number of folds written (fold_0, fold_1...), each with its own random weights.
+    Returns:
+        str: Trained model folder of the stand-in model.
+    """
+    import torch
+
+    model_path = os.path.join(models_dir, STANDIN_MODEL_NAME, TRAINER_FOLDER)
+    plans = make_plans()
+    dataset_json = make_dataset_json()
+    for fold in range(max(1, int(folds))):
+        checkpoint_path = os.path.join(model_path, f"fold_{fold}", "checkpoint_final.pth")
+        if os.path.exists(checkpoint_path):
+            continue
+        os.makedirs(os.path.dirname(checkpoint_path), exist_ok=True)
+        for name, content in (("plans.json", plans), ("dataset.json", dataset_json)):
+            with open(os.path.join(model_path, name), "w") as f:
+                json.dump(content, f, indent=4)
+
+        torch.manual_seed(SEED + fold)
+        network = build_network(plans, dataset_json)
+        torch.save({
+            "network_weights": network.state_dict(),
+            "trainer_name": "nnUNetTrainer",
+            "init_args": {"plans": plans, "configuration": CONFIGURATION, "fold": fold,
+                          "dataset_json": dataset_json, "device": "cpu"},
+            "inference_allowed_mirroring_axes": (0, 1, 2),
+        }, checkpoint_path)
+
+    registry_path = os.path.join(models_dir, "local_models.json")
+    registry = {}
+    if os.path.exists(registry_path):
+        with open(registry_path, "r") as f:
+            registry = json.load(f)
+    animal, mode, structure = configuration
+    registry.setdefault(animal, {}).setdefault(mode, {})[structure] = {
+        "model_path": os.path.relpath(model_path, models_dir),
+        "fold": 0,
+    }
+    with open(registry_path, "w") as f:
+        json.dump(registry, f, indent=4)
+    return model_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Installs the stand-in nnUNetv2 model of the benchmarks")
+    parser.add_argument("--models_dir", required=True, help="Models folder given to nnunet_runner.py")
+    parser.add_argument("--folds", type=int, default=1, help="Number of folds of the stand-in model")
+    parser.add_argument("--configuration", nargs=3, default=list(DEFAULT_CONFIGURATION),
+                        metavar=("ANIMAL", "MODE", "STRUCTURE"), help="Configuration resolved to the stand-in model")
+    args = parser.parse_args(argv)
+    print(f"Stand-in model installed in {install_standin_model(args.models_dir, tuple(args.configuration), args.folds)}")
+
+
+if __name__ == "__main__":
+    main()
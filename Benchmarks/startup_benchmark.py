@@ -0,0 +1,164 @@
+"""
+Startup benchmark of the LungSegmentation module.
+
+Measures the time spent importing LungSegmentation.py and building (setup) its widget, with the
+dependency check it includes, and fails if the total exceeds a budget. The slowest imports are listed, in the style of
+python -X importtime (cumulative time of each module, children included).
+
+Usage (the module must be in the additional module paths of Slicer):
+    Slicer --no-splash --no-main-window --python-script Benchmarks/startup_benchmark.py -- --budget 1.5
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import importlib
+import importlib.abc
+
+MODULE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "LungSegmentation")
+
+# Default budget in seconds for importing the module and building its widget
+DEFAULT_BUDGET = 1.5
+
+
+class ImportTimer(importlib.abc.MetaPathFinder):
+    """
+    Meta path finder recording the cumulative execution time of every module imported while it is installed.
+    """
+    def __init__(self):
+        self.times = {}
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                    spec.loader = TimedLoader(spec.loader, fullname, self.times)
+                return spec
+        return None
+
+    def __enter__(self):
+        sys.meta_path.insert(0, self)
+        return self
+
+    def __exit__(self, *exc):
+        sys.meta_path.remove(self)
+
+
+class TimedLoader(importlib.abc.Loader):
+    """
+    Wraps a loader to time the execution of the module.
+    """
+    def __init__(self, loader, fullname, times):
+        self.loader = loader
+        self.fullname = fullname
+        self.times = times
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        start = time.perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.times[self.fullname] = time.perf_counter() - start
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+
+def forget_module():
+    """
+    Removes the module from sys.modules so that it is imported again (Slicer already imported it at startup).
+    """
+    for name in list(sys.modules):
+        if name == "LungSegmentation" or name.startswith("LungSegmentationLib"):
+            del sys.modules[name]
+
+
+def run(budget, top):
+    """
+    Runs the benchmark.
+
+    Args:
+        budget (float): Maximum time in seconds for the import and the widget setup.
+        top (int): Number of slow imports to list.
+    Returns:
+        dict: The results.
+    """
+    import qt
+    import slicer
+
+    if MODULE_DIR not in sys.path:
+        sys.path.insert(0, MODULE_DIR)
+    forget_module()
+    modules_before = set(sys.modules)
+
+    start = time.perf_counter()
+    with ImportTimer() as timer:
+        module = importlib.import_module("LungSegmentation")
+    import_seconds = time.perf_counter() - start
+    new_modules = sorted(set(sys.modules) - modules_before)
+
+    start = time.perf_counter()
+    parent = slicer.qMRMLWidget()
+    parent.setLayout(qt.QVBoxLayout())
+    parent.setMRMLScene(slicer.mrmlScene)
+    widget = module.LungSegmentationWidget(parent)
+    widget.setup()
+    setup_seconds = time.perf_counter() - start
+    widget.cleanup()
+
+    total = import_seconds + setup_seconds
+    slowest = sorted(timer.times.items(), key=lambda item: item[1], reverse=True)[:top]
+    return {
+        "import_seconds": round(import_seconds, 4),
+        "setup_seconds": round(setup_seconds, 4),
+        "dependency_check_seconds": round(widget.dependency_check_seconds, 4),
+        "total_seconds": round(total, 4),
+        "budget_seconds": budget,
+        "within_budget": total <= budget,
+        "new_modules": new_modules,
+        "slowest_imports": [{"module": name, "seconds": round(seconds, 4)} for name, seconds in slowest],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Startup benchmark of the LungSegmentation module")
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET, help="Budget in seconds for import + widget setup")
+    parser.add_argument("--top", type=int, default=15, help="Number of slow imports to list")
+    parser.add_argument("--output", help="Optional JSON file receiving the results")
+    args = parser.parse_args(argv)
+
+    results = run(args.budget, args.top)
+
+    print("import time: self+children [s] | module")
+    for entry in results["slowest_imports"]:
+        print(f"{entry['seconds']:>12.4f} | {entry['module']}")
+    print(f"{len(results['new_modules'])} modules loaded by the import")
+    print(f"Import: {results['import_seconds']:.3f} s, widget setup: {results['setup_seconds']:.3f} s "
+          f"(dependency check: {results['dependency_check_seconds']:.3f} s), "
+          f"total: {results['total_seconds']:.3f} s (budget {args.budget:.3f} s)")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+    if not results["within_budget"]:
+        print("FAILED: the startup budget is exceeded.")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    status = main(sys.argv[1:])
+    try:
+        import slicer
+        slicer.util.exit(status)
+    except ImportError:
+        sys.exit(status)
@@ -1,29 +1,22 @@
 import os
-import re
-import site
-import textwrap
 import qt
-import sys
 import vtk
-import slicer
-import platform
-import subprocess
-import shutil
-import zipfile
 import json
-import tarfile
-import logging
-import urllib
+import time
+import shutil
 import slicer
+import logging
 import tempfile
 import threading
-import importlib.util
-from typing import Optional
+from contextlib import contextmanager
+from collections import deque
 from slicer.ScriptedLoadableModule import *
-import importlib.resources as resources
-from importlib.metadata import version, PackageNotFoundError
-from packaging.requirements import Requirement
-from qt import QTimer, QTreeView, QFileSystemModel, QPushButton, QFileDialog, QMessageBox, Signal, QObject
+from qt import Signal, QObject
+from LungSegmentationLib import volumeio
+from LungSegmentationLib.dependencies import DependencyManifest, REQUIRED_PACKAGES, check_dependencies, find_updates
+
+# Heavier parts of LungSegmentationLib (worker client, DICOM conversion, caches, pip installer) are imported
+# where they are first used, to keep the loading of the module fast when Slicer starts.
 
 
 ###################################################### Object for signals to know if the segmentation is finished or if there is an error ######################################################
@@ -37,9 +30,25 @@ class SegmentationSignals(QObject):
     Returns:
         None
     """
-    finished = Signal(bool)
-    error = Signal(str)
-    progress = Signal(int)
+    jobChanged = Signal(int)    # Id of the job whose state or progress changed
+    previewReady = Signal(int)  # Id of the job whose low-resolution preview is ready
+    slabReady = Signal(int, int, int)  # Id of the job, first and last + 1 slices of its streamed label map that are written
+    surfaceReady = Signal()     # Surfaces built in the background are waiting in surface_results
+
+class DependencySignals(QObject):
+    """
+    Signals of the background dependency update check
+
+    Args:
+        None
+    Returns:
+        None
+    """
+    updatesAvailable = Signal(str)
+    updatesInstalled = Signal(str)  # JSON of the packages updated by "Check for updates", or of the pip error
+
+# Columns of the queue view
+JOB_TABLE_COLUMNS = ["Job", "Input", "Model", "Status", "Stage", "Memory", "Time"]
 
 ###################################################### Main class of the module ######################################################
 
@@ -83,26 +92,29 @@ class LungSegmentationWidget(ScriptedLoadableModuleWidget):
         """
         ScriptedLoadableModuleWidget.__init__(self, parent)
 
-        self.timer = qt.QTimer()
-        self.timer.setInterval(500)
-        self.timer.timeout.connect(self.updateProgressBar)
-
-        self.progressValue = 0
-        self.progressDuration = 6 * 60  
-        self.elapsedSeconds = 0
-
         self.signals = SegmentationSignals()
-        self.signals.finished.connect(self.on_segmentation_finished)
-        self.signals.error.connect(self.on_segmentation_error)
+        self.signals.jobChanged.connect(self.on_job_changed)
+        self.signals.previewReady.connect(self.on_job_preview)
+        self.signals.slabReady.connect(self.on_job_slab)
+        self.signals.surfaceReady.connect(self.on_surfaces_ready)
 
-        self.input_path = None              # Path to the input file
-        self.input_node = None              # Input volume node
-        self.models_dir = None              # Folder containing the downloaded models
-        self.structure_to_segment = None    # Structure to segment
-        self.tmp_file = None                # Temporary file to store the path of the dataset json 
-        self.name = None                    # Name of the future prediction
+        self.dependencySignals = DependencySignals()
+        self.dependencySignals.updatesAvailable.connect(self.on_updates_available)
+        self.dependencySignals.updatesInstalled.connect(self.on_updates_installed)
 
-        self.convertedInputToDelete = None  # For future deletion
+        self.input_node = None              # Input volume node
+        self.logic = LungSegmentationLogic()  # Input preparation, inference, import and metrics of the segmentations
+
+        self.job_queue = None               # Queue of the segmentation jobs, each with its own working directory
+        self.max_concurrent_jobs = None     # Number of jobs running at the same time, from the CPU cores and RAM by default
+        self.jobs_succeeded = 0             # Jobs finished successfully since the queue was last idle
+        self.memory_budget = None           # Memory in bytes shared by the running jobs, from the physical memory by default
+        self.bypass_result_cache = False    # Always run the model, even if the prediction is cached
+        self.surface_builder = None         # Background builder of the closed surfaces, started on the first import
+        self.surface_results = deque()      # (node ID, segment ID, surface, final) built and not attached yet
+        self.surface_priorities = None      # Keyword of the segment names -> build priority, surfaces.DEFAULT_SEGMENT_PRIORITIES if None
+        self.setup_seconds = None           # Time spent in setup, dependency check included (see Benchmarks/startup_benchmark.py)
+        self.dependency_check_seconds = None  # Time spent checking the installed dependencies in setup
 
     def setup(self):
         """
@@ -113,6 +125,7 @@ class LungSegmentationWidget(ScriptedLoadableModuleWidget):
         Returns:
             None
         """
+        setupStart = time.perf_counter()
         self.install_dependencies_if_needed()
         ScriptedLoadableModuleWidget.setup(self)
 
@@ -134,74 +147,192 @@ class LungSegmentationWidget(ScriptedLoadableModuleWidget):
         self.ui.browseInputButton.clicked.connect(lambda: self.openDialog("input"))
         self.ui.browseOutputButton.clicked.connect(lambda: self.openDialog("output"))
         self.ui.pushButtonSegmentation.clicked.connect(self.onSegmentationButtonClicked)
+        self.ui.checkUpdatesButton.clicked.connect(self.check_for_updates)
+        self.ui.cancelPendingJobsButton.clicked.connect(self.cancel_pending_jobs)
+        self.ui.cancelSelectedJobButton.clicked.connect(self.cancel_selected_job)
+        self.ui.clearFinishedJobsButton.clicked.connect(self.clear_finished_jobs)
+
+        # Speed presets, described with the measurements of nnunet_runner.py --compare_presets if available
+        from LungSegmentationLib.presets import PRESETS, DEFAULT_PRESET
+        self.ui.speedPresetComboBox.addItems(list(PRESETS))
+        self.ui.speedPresetComboBox.setCurrentText(DEFAULT_PRESET)
+        self.ui.speedPresetComboBox.setToolTip(self.describe_presets())
+
+        # Output format of the saved segmentations
+        from LungSegmentationLib.segio import SEGMENTATION_FORMATS, DEFAULT_SEGMENTATION_FORMAT
+        self.ui.segmentationFormatComboBox.addItems(list(SEGMENTATION_FORMATS))
+        self.ui.segmentationFormatComboBox.setCurrentText(DEFAULT_SEGMENTATION_FORMAT)
+        self.ui.segmentationFormatComboBox.setToolTip(
+            "\n".join(f"{name}: {options['description']}" for name, options in SEGMENTATION_FORMATS.items()))
+
+        # Job queue
+        self.ui.maxConcurrentJobsSpinBox.setValue(self.get_job_queue().max_concurrent)
+        self.ui.maxConcurrentJobsSpinBox.valueChanged.connect(self.get_job_queue().set_max_concurrent)
+        if self.get_job_queue().memory_budget:
+            self.ui.memoryBudgetSpinBox.setValue(self.get_job_queue().memory_budget / 1024 ** 3)
+        self.ui.memoryBudgetSpinBox.valueChanged.connect(self.on_memory_budget_changed)
+        self.ui.axialSliceBatchSpinBox.setValue(self.logic.slice_batch or 0)
+        self.ui.axialSliceBatchSpinBox.valueChanged.connect(self.on_slice_batch_changed)
+        self.ui.streamMemorySpinBox.setValue((self.logic.stream_memory_bytes or 0) / 1024 ** 3)
+        self.ui.streamMemorySpinBox.valueChanged.connect(self.on_stream_memory_changed)
+        self.ui.jobsTableWidget.setColumnCount(len(JOB_TABLE_COLUMNS))
+        self.ui.jobsTableWidget.setHorizontalHeaderLabels(JOB_TABLE_COLUMNS)
+        self.ui.jobsTableWidget.horizontalHeader().setStretchLastSection(True)
+
+        # Helper Collections (structure checkboxes only, not the options)
+        self.allCheckBoxes = [cb for cb in uiWidget.findChildren(qt.QCheckBox) if str(cb.objectName).startswith("checkBox")]
+
+        self.setup_seconds = time.perf_counter() - setupStart
+        logging.debug(f"LungSegmentation setup: {self.setup_seconds * 1000:.1f} ms "
+                      f"(dependency check: {self.dependency_check_seconds * 1000:.1f} ms)")
+
+    def cleanup(self):
+        """
+        Called when the application closes the module: cancels the pending jobs and stops the inference workers.
+
+        Args:
+            None
+        Returns:
+            None
+        """
+        if self.job_queue is not None:
+            self.job_queue.cancel_pending()
+        self.logic.stop()
+        if self.surface_builder is not None:
+            self.surface_builder.stop()
+            self.surface_builder = None
+
+    def get_dependency_manifest(self):
+        """
+        Returns the manifest of the verified package versions, stored in the Slicer user settings folder.
 
-        # Helper Collections
-        self.allCheckBoxes = uiWidget.findChildren(qt.QCheckBox)
+        Args:
+            None
+        Returns:
+            DependencyManifest: The manifest.
+        """
+        settings_dir = os.path.dirname(slicer.app.slicerUserSettingsFilePath)
+        return DependencyManifest(os.path.join(settings_dir, "LungSegmentation", "dependencies.json"))
 
     def install_dependencies_if_needed(self):
         """
-        Checks if the required dependencies are installed and up to date.
-        If not, it installs or updates them using pip and prompts the user to restart Slicer if necessary.
+        Checks locally (dependency manifest or importlib.metadata, no network) that the required dependencies are installed.
+        Only the missing ones are installed with pip, then the user is prompted to restart Slicer.
+        Upgrades are not done here: see check_for_updates and start_background_update_check.
+
+        Args:
+            None
+        
+        Returns:
+            None
+        """
+        manifest = self.get_dependency_manifest()
+        result = check_dependencies(manifest)
+        self.dependency_check_seconds = result["seconds"]
+        logging.debug(f"LungSegmentation dependency check: {result['seconds'] * 1000:.1f} ms "
+                      f"({'dependency manifest' if result['cached'] else 'installed package versions'})")
+
+        if result["unsatisfied"]:
+            print(f"Installing missing dependencies: {result['unsatisfied']}...")
+            self.pip_install_and_restart_if_changed(result["unsatisfied"])
+
+        if manifest.update_check_due():
+            self.start_background_update_check(manifest)
+
+    def pip_install_and_restart_if_changed(self, packages_to_install, upgrade=False):
+        """
+        Installs packages with pip and prompts the user to restart Slicer if any version changed.
 
-        The function first checks the current versions of the required packages, then attempts to install or update them.
-        After installation, it checks if any versions have changed. If so, it prompts the user to restart Slicer to apply the changes.
+        Args:
+            packages_to_install (list): Requirements to install.
+            upgrade (bool): Upgrades the packages (and the build tools) to their latest version.
         
-        If everything is up to date, it simply continues without requiring a restart.
+        Returns:
+            None
+        """
+        from LungSegmentationLib.installer import install_and_restart_if_changed
+
+        install_and_restart_if_changed(packages_to_install, self.get_dependency_manifest(), upgrade)
+
+    def check_for_updates(self):
+        """
+        Function called by the "Check for updates" button: upgrades the dependencies with pip in a background
+        thread, so that Slicer stays responsive; on_updates_installed is called when pip is done.
 
         Args:
             None
-        
         Returns:
             None
         """
+        from LungSegmentationLib.installer import pip_install
 
-        packages_to_install = [
-            "python-gdcm==3.0.21", 
-            "nnUNet_package", 
-            "dicom2nifti"
-        ]
+        print(f"Checking for updates for : {REQUIRED_PACKAGES}...")
+        self.ui.checkUpdatesButton.setEnabled(False)
+        slicer.util.showStatusMessage("LungSegmentation: updating the dependencies...")
+        manifest = self.get_dependency_manifest()
 
-        # Check current versions before installation to determine if a restart will be needed afterward
-        versions_before = {}
-        for pkg in packages_to_install:
-            clean_name = pkg.split("==")[0]
+        def worker():
             try:
-                versions_before[clean_name] = version(clean_name)
-            except PackageNotFoundError:
-                versions_before[clean_name] = None
+                changed = pip_install(REQUIRED_PACKAGES, manifest, upgrade=True)
+                find_updates(manifest)
+                result = {"changed": changed}
+            except Exception as e:
+                result = {"error": str(e)}
+            self.dependencySignals.updatesInstalled.emit(json.dumps(result))
 
-        print(f"Checking for updates for : {packages_to_install}...")
+        threading.Thread(target=worker, daemon=True).start()
 
-        try:
-            # Tool for silent installation with pip in Slicer
-            slicer.util.pip_install(["-q", "--upgrade", "setuptools", "wheel", "scikit-build"])
-            slicer.util.pip_install(["-q", "--upgrade"] + packages_to_install)
-            
-            importlib.invalidate_caches()
-
-            # Verify the actual changes
-            needs_restart = False
-            for pkg in packages_to_install:
-                clean_name = pkg.split("==")[0]
-                try:
-                    version_after = version(clean_name)
-                    if versions_before.get(clean_name) != version_after:
-                        needs_restart = True
-                        print(f"-> {clean_name} updated : {versions_before.get(clean_name)} -> {version_after}")
-                except PackageNotFoundError:
-                    needs_restart = True 
-            
-            if needs_restart:
-                msg = "All dependencies have been installed or updated. \n Please restart 3D Slicer to apply the changes."
-                print(msg)
-                slicer.util.messageBox(msg)
-                slicer.util.mainWindow().close()
-                sys.exit(0)
-            else:
-                print("Everything is up to date. No restart needed.")
-            
-        except Exception as e:
-            slicer.util.errorDisplay(f"Erreur lors de l'installation : {str(e)}")
+    def on_updates_installed(self, text):
+        """
+        Function called when the upgrade started by check_for_updates is done: prompts the user to restart
+        Slicer if a package changed.
+
+        Args:
+            text (str): JSON with the "changed" packages or the pip "error".
+        Returns:
+            None
+        """
+        from LungSegmentationLib.installer import restart_if_changed
+
+        self.ui.checkUpdatesButton.setEnabled(True)
+        slicer.util.showStatusMessage("")
+        result = json.loads(text)
+        if "error" in result:
+            slicer.util.errorDisplay(f"Erreur lors de l'installation : {result['error']}")
+            return
+        restart_if_changed(result["changed"])
+
+    def start_background_update_check(self, manifest):
+        """
+        Looks for dependency updates on PyPI in a background thread, with a short network timeout.
+        It is started at most once per UPDATE_CHECK_INTERVAL, and only reports the updates: installing them
+        is left to the "Check for updates" button.
+
+        Args:
+            manifest (DependencyManifest): Manifest recording the check.
+        Returns:
+            None
+        """
+        def worker():
+            updates = find_updates(manifest)
+            if updates:
+                text = ", ".join(f"{name} {installed} -> {latest}" for name, (installed, latest) in updates.items())
+                self.dependencySignals.updatesAvailable.emit(text)
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    def on_updates_available(self, text):
+        """
+        Function called when the background check found dependency updates.
+
+        Args:
+            text (str): Description of the updates.
+        Returns:
+            None
+        """
+        msg = f"LungSegmentation: updates available ({text}). Use 'Check for updates' to install them."
+        print(msg)
+        slicer.util.showStatusMessage(msg, 10000)
         
     def openDialog(self, which):
         """
@@ -298,7 +429,7 @@ class LungSegmentationWidget(ScriptedLoadableModuleWidget):
 
     def handleDICOMSelection(self):
         """
-        Selects a DICOM folder, loads the first file into the viewer, without immediate conversion.
+        Selects a DICOM folder, converts its series to NRRD (or reuses the cached conversion) and loads it into the viewer.
 
         Args:
             None
@@ -313,12 +444,13 @@ class LungSegmentationWidget(ScriptedLoadableModuleWidget):
         if not dicomDir:
             return None
 
-        dcmFiles = [os.path.join(dicomDir, f) for f in os.listdir(dicomDir) if f.lower().endswith(".dcm")]
-        if not dcmFiles:
-            qt.QMessageBox.critical(slicer.util.mainWindow(), "Error", "No DICOM file found.")
+        try:
+            convertedPath = self.logic.get_dicom_converter().convert(dicomDir)
+        except Exception as e:
+            qt.QMessageBox.critical(slicer.util.mainWindow(), "Error", str(e))
             return None
 
-        node = self.safeLoadVolume(dcmFiles[0])
+        node = self.safeLoadVolume(convertedPath)
         if not node:
             qt.QMessageBox.critical(slicer.util.mainWindow(), "Error", "Failed to load DICOM file.")
             return None
@@ -326,53 +458,6 @@ class LungSegmentationWidget(ScriptedLoadableModuleWidget):
         return dicomDir
 
     
-    def prepareInputForSegmentation(self, inputPath):
-        """
-        Checks and prepares the input path for segmentation.
-        If necessary, converts to .nrrd and returns the converted path.
-
-        Args:
-            inputPath (str): Path to the input file or folder.
-        
-        Returns:
-            str: Path to the .nrrd file ready for segmentation.
-        """
-        inputPath = inputPath.strip()
-        if not inputPath or not os.path.exists(inputPath):
-            raise RuntimeError("Invalid input path.")
-
-        ext = os.path.splitext(inputPath)[1].lower()
-        is_dir = os.path.isdir(inputPath)
-
-        if is_dir:
-            # DICOM folder
-            dcmFiles = [os.path.join(inputPath, f) for f in os.listdir(inputPath) if f.lower().endswith(".dcm")]
-            if not dcmFiles:
-                raise RuntimeError("No DICOM file found in the folder.")
-            success, volumeNode = slicer.util.loadVolume(dcmFiles[0], returnNode=True)
-            if not success:
-                raise RuntimeError("Error loading DICOM volume.")
-            convertedPath = os.path.join(slicer.app.temporaryPath, "converted_from_dicom.nrrd")
-            slicer.util.saveNode(volumeNode, convertedPath)
-            self.convertedInputToDelete = convertedPath
-            return convertedPath
-
-        elif ext in [".mha", ".nii", ".nii.gz"]:
-            # Image file to convert
-            success, volumeNode = slicer.util.loadVolume(inputPath, returnNode=True)
-            if not success:
-                raise RuntimeError("Error loading image.")
-            convertedPath = os.path.join(slicer.app.temporaryPath, "converted_from_image.nrrd")
-            slicer.util.saveNode(volumeNode, convertedPath)
-            self.convertedInputToDelete = convertedPath
-            return convertedPath
-
-        elif ext == ".nrrd":
-            return inputPath
-
-        else:
-            raise RuntimeError("Unsupported format. Please select a .nrrd, .mha, .nii file, or a DICOM folder.")
-
     def _get_active_checkbox_name(self):
         """
         Helper: Returns the lowercased objectName of the currently checked box.
@@ -438,7 +523,38 @@ class LungSegmentationWidget(ScriptedLoadableModuleWidget):
         Returns:
             str: "parenchyma", "airways", "vascular", "lobes", "parenchymaairways", "all"
         """
-        name = self._get_active_checkbox_name()
+        return self._structure_from_name(self._get_active_checkbox_name())
+
+    def check_structures(self):
+        """
+        Checks the structures to segment: the structures of all the checked boxes of the same animal and mode
+        as the active one. They are segmented in one job that preprocesses the input once.
+
+        Args:
+            None
+        Returns:
+            list: The structures, without duplicates.
+        """
+        mode, animal = self.check_mode(), self.check_animal()
+        structures = []
+        for cb in self.allCheckBoxes:
+            name = str(cb.objectName).lower()
+            if not cb.isChecked() or (mode and mode not in name) or (animal and animal not in name):
+                continue
+            structure = self._structure_from_name(name)
+            if structure and structure not in structures:
+                structures.append(structure)
+        return structures
+
+    def _structure_from_name(self, name):
+        """
+        Helper: Returns the structure of a checkbox name, None if there is none.
+
+        Args:
+            name (str): The lowercased name of a checkbox.
+        Returns:
+            str: "parenchyma", "airways", "vascular", "lobes", "parenchymaairways", "all"
+        """
         if not name:
             return None
         
@@ -479,271 +595,1504 @@ class LungSegmentationWidget(ScriptedLoadableModuleWidget):
         # Check if it is Pig or Rabbit
         animal = self.check_animal()
 
-        # Check the structure to segment
-        self.structure_to_segment = self.check_structure()
+        # Check the structure(s) to segment: several checked structures are segmented in one job
+        structures = self.check_structures()
+        structure = structures if len(structures) > 1 else self.check_structure()
+
+        bypass_cache = self.ui.bypassResultCacheCheckBox.isChecked()
+        preset = self.ui.speedPresetComboBox.currentText
+        crop = self.ui.cropRoiCheckBox.isChecked()
+        preview = self.ui.previewCheckBox.isChecked()
         
-        print("\nStarting segmentation...")
+        print("\nQueuing segmentation...")
 
+        inputText = self.ui.inputLineEdit.text
+        workdir = self.logic.create_job_workdir()
+        conversionStart = time.perf_counter()
         try:
-            self.input_path = self.prepareInputForSegmentation(self.ui.inputLineEdit.text)
+            input_path, temporary = self.logic.prepareInputForSegmentation(inputText, workdir)
         except Exception as e:
+            shutil.rmtree(workdir, ignore_errors=True)
             qt.QMessageBox.critical(slicer.util.mainWindow(), "Input Error", str(e))
             return
 
-        output_path = self.ui.outputLineEdit.text
-
-        if not os.path.isfile(self.input_path) or not self.input_path.endswith('.nrrd'):
+        if not os.path.isfile(input_path) or not (input_path.endswith('.nrrd') or volumeio.is_volume_header(input_path)):
+            self.logic.release_cached_input(input_path)
+            shutil.rmtree(workdir, ignore_errors=True)
             qt.QMessageBox.critical(slicer.util.mainWindow(), "File Error", "Please select a valid NRRD input file.")
             return
 
-        extension_dir = os.path.dirname(__file__)
-        self.models_dir = os.path.join(extension_dir, "models")
+        self.submit_job(animal, mode, structure, input_path, self.ui.outputLineEdit.text, workdir,
+                        converted_input=input_path if temporary else None, bypass_cache=bypass_cache,
+                        label=os.path.basename(inputText.strip().rstrip("/\\")), preset=preset, crop=crop,
+                        preview=preview, conversion_seconds=time.perf_counter() - conversionStart)
+    
+
+    def get_job_queue(self):
+        """
+        Returns the queue of the segmentation jobs, creating it if needed.
 
-        self.ui.progressBar.setVisible(True)
-        self.ui.progressBar.setValue(0)
-        self.progressValue = 0
-        self.elapsedSeconds = 0
+        Args:
+            None
+        Returns:
+            JobQueue: The queue.
+        """
+        if self.job_queue is None:
+            from LungSegmentationLib.jobqueue import JobQueue, default_max_concurrent_jobs
+            from LungSegmentationLib.memory import default_memory_budget
+            max_concurrent = self.max_concurrent_jobs or default_max_concurrent_jobs()
+            memory_budget = self.memory_budget or default_memory_budget()
+            self.job_queue = JobQueue(self.run_job, max_concurrent, on_change=lambda job: self.signals.jobChanged.emit(job.id),
+                                      memory_budget=memory_budget)
+        return self.job_queue
+
+    def describe_presets(self):
+        """
+        Describes the speed presets, with their speedup and Dice against "accurate" when they were measured
+        on a reference case (nnunet_runner.py --compare_presets writes presets_report.json in the models folder).
+
+        Args:
+            None
+        Returns:
+            str: Description of the presets.
+        """
+        from LungSegmentationLib.presets import PRESETS, REPORT_FILE_NAME
 
-        qt.QTimer.singleShot(0, self.timer.start)
+        lines = []
+        for name, settings in PRESETS.items():
+            lines.append(f"{name}: tile step {settings['tile_step_size']}, mirroring {'on' if settings['use_mirroring'] else 'off'}, "
+                         f"{settings['folds']} fold(s)")
 
-        self.start_segmentation(mode, output_path, animal)
-    
+        report_path = os.path.join(self.logic.models_dir, REPORT_FILE_NAME)
+        if os.path.exists(report_path):
+            try:
+                with open(report_path, "r") as f:
+                    report = json.load(f)
+            except (OSError, ValueError):
+                report = {}
+            for configuration, entry in report.items():
+                lines.append(f"\nMeasured on {configuration}:")
+                for name, result in entry["presets"].items():
+                    lines.append(f"  {name}: x{result['speedup']:.2f} faster, Dice {result['dice']:.3f}")
+        else:
+            lines.append("\nRun nnunet_runner.py --compare_presets on a reference case to measure the speedup and Dice of each preset.")
+        return "\n".join(lines)
 
-    def start_segmentation(self, mode, output_path, animal):
+    def on_slice_batch_changed(self, value):
         """
-        Function that starts the segmentation process in the background.
-        
-        It calls the nnunet_runner.py script with the segmentation parameters.
-        It waits for the process to finish, then emits the finished signal if everything goes well,
-        or the error signal if a problem occurs.
-        
+        Changes the number of slices per slab of the axial predictions, used by the next jobs.
+        Larger slabs are predicted faster, smaller ones are shown sooner.
+
         Args:
-            mode (str): Segmentation mode (In vivo, Ex vivo)
-            input_path (str): Path to the input file
-            output_path (str): Path to the output folder
-            animal (str): Name of the animal
+            value (int): Slices per slab, 0 to predict the whole volume at once.
         Returns:
             None
         """
-        def worker():
-            """
-            Worker function that starts the segmentation process in the background.
-            
-            It calls the nnunet_runner.py script with the segmentation parameters.
-            It waits for the process to finish, then emits the finished signal if everything goes well,
-            or the error signal if a problem occurs.
-
-            Args:
-                None
-            Returns:
-                None
-            """
-            try:
-                from pathlib import Path
-                module_dir = os.path.dirname(__file__)
-                runner_path = os.path.join(module_dir, "Resources", "scripts", "nnunet_runner.py")
-
-                # Temporary file to store the path of the dataset json
-                self.tmp_file = os.path.join(tempfile.gettempdir(), "nnunet_context.json")
-                if os.path.exists(self.tmp_file):
-                    os.remove(self.tmp_file)
-                
-                cmd = [
-                    sys.executable, str(runner_path),
-                    "--mode", mode,
-                    "--structure", self.structure_to_segment,
-                    "--input", self.input_path,
-                    "--output", output_path,
-                    "--models_dir", self.models_dir,
-                    "--animal", animal,
-                    "--tmp_file", self.tmp_file
-                ]
-                subprocess.run(cmd, text=True)
-                self.signals.finished.emit(True)
-            except subprocess.CalledProcessError as e:
-                self.signals.error.emit(str(e))
+        self.logic.slice_batch = int(value) or None
 
-        threading.Thread(target=worker, daemon=True).start()
+    def on_stream_memory_changed(self, value):
+        """
+        Changes the memory ceiling of the predictions streamed slab by slab, used by the next single-structure jobs.
 
+        Args:
+            value (float): Ceiling in GB, 0 to predict the whole volume at once.
+        Returns:
+            None
+        """
+        self.logic.stream_memory_bytes = int(value * 1024 ** 3) or None
 
-    def on_segmentation_error(self, error_message):
+    def on_memory_budget_changed(self, value):
         """
-        Function called in case of an error during segmentation.
-        It stops the timer, updates the progress bar and displays an error message.
-        
+        Function called when the memory budget is changed in the Jobs section.
+
         Args:
-            error_message (str): Error message to display.
+            value (float): Memory budget in GB, 0 for no limit.
         Returns:
             None
         """
-        self.timer.stop()
-        self.ui.progressBar.setVisible(False)
-        slicer.util.errorDisplay(f"Error during segmentation :\n{error_message}")
+        self.memory_budget = int(value * 1024 ** 3) or None
+        self.get_job_queue().set_memory_budget(self.memory_budget)
+
+    def submit_job(self, animal, mode, structure, input_path, output_path, workdir, converted_input=None,
+                   bypass_cache=False, label=None, preset=None, crop=True, preview=False, conversion_seconds=None):
+        """
+        Adds a segmentation to the job queue. It starts as soon as a slot is free (see maxConcurrentJobsSpinBox)
+        and its estimated peak memory fits in the memory budget next to the running jobs.
 
+        Args:
+            animal (str): Name of the animal
+            mode (str): Segmentation mode (In vivo, Ex vivo)
+            structure (str or list): Structure to segment, or several structures sharing the preprocessing of the input
+            input_path (str): Input of the runner (.nrrd or volume header)
+            output_path (str): Path to the output folder
+            workdir (str): Working directory of the job (see create_job_workdir)
+            converted_input (str): Input converted for this job only, deleted after the job
+            bypass_cache (bool): Runs the model even if the prediction is cached
+            label (str): Description of the input in the queue view
+            preset (str): Speed preset ("fast", "balanced", "accurate" or "ensemble"), the default preset if None
+            crop (bool): Runs the inference on the region of interest of the input only
+            preview (bool): Shows a low-resolution preview in the scene before the full prediction (single structure only)
+            conversion_seconds (float): Time spent preparing the input, reported in the metrics of the job
+        Returns:
+            SegmentationJob: The job.
+        """
+        job = self.logic.create_job(animal, mode, structure, input_path, output_path, workdir, converted_input,
+                                    bypass_cache, label, preset, crop, preview, conversion_seconds)
+        print(f"Job {job.id} queued: {animal} | {mode} | {job.structure} | {job.label}")
+        return self.get_job_queue().submit(job)
 
-    def on_segmentation_finished(self, success):
+    def run_job(self, job):
         """
-        Function called when segmentation is finished.
-        It stops the timer, updates the progress bar and displays a success message.
-        
+        Runs a segmentation job in a background thread of the job queue (see LungSegmentationLogic.run_job).
+        The progress is shown in the queue view, and the preview (or the slabs of a streamed prediction) in the scene
+        (see on_job_preview and on_job_slab).
+        The prediction is imported in the scene afterwards, on the GUI thread (see on_job_changed).
+
         Args:
-            success (bool): Indicates whether the segmentation was successful or not.
+            job (SegmentationJob): The job.
         Returns:
             None
         """
-        self.timer.stop()
-        self.ui.progressBar.setValue(100)
-        self.ui.progressBar.setVisible(False)
+        from LungSegmentationLib.presets import default_threads
 
-        if success:
-            self.load_prediction(self.ui.outputLineEdit.text)
-            slicer.util.infoDisplay("Segmentation finished successfully.")
-        
-    def updateProgressBar(self):
+        # The CPU cores are shared by the running jobs
+        self.logic.run_job(job, default_threads(self.get_job_queue().max_concurrent),
+                           on_progress=lambda event: self.on_job_progress(job, event),
+                           on_preview=lambda: self.signals.previewReady.emit(job.id),
+                           on_slab=lambda start, stop: self.signals.slabReady.emit(job.id, start, stop))
+
+    def on_job_progress(self, job, event):
         """
-        Updates the progress bar every second.
-        If the progress duration is exceeded, the bar is blocked at 99% until segmentation is finished.
+        Records a progress event of the runner in the job and notifies the GUI thread.
 
         Args:
+            job (SegmentationJob): The job.
+            event (dict): Progress event (see nnunet_progress.py).
+        Returns:
             None
+        """
+        text = event["stage"]
+        if event["stage"] == "predict":
+            # A streamed prediction counts its slabs
+            streamed = self.logic.stream_memory_bytes or (job.mode == "axial" and self.logic.slice_batch)
+            unit = "slabs" if streamed and not job.is_multi_structure() else "tiles"
+            text += f" {event['done']}/{event['total']} {unit}"
+        if event.get("eta") is not None:
+            text += f", ETA {event['eta']:.0f} s"
+        job.percent = int(event["percent"])
+        job.stage = text
+        self.get_job_queue().notify(job)
+
+    def on_job_changed(self, job_id):
+        """
+        Function called on the GUI thread when a job is queued, starts, progresses or ends.
+        It updates the queue view and the progress bar, imports the finished predictions and reports the errors.
+
+        Args:
+            job_id (int): Id of the job.
         Returns:
             None
         """
-        if self.elapsedSeconds >= self.progressDuration:
-            self.ui.progressBar.setValue(99)
+        queue = self.get_job_queue()
+        job = queue.get(job_id)
+        if job is None:
             return
-        
-        self.elapsedSeconds += 1
-        progress = int((self.elapsedSeconds / self.progressDuration) * 99)
-        self.ui.progressBar.setValue(progress)
+        self.update_job_row(job)
 
-
-    def load_prediction(self, output_path):
+        if job.status == job.DONE:
+            importStart = time.perf_counter()
+            save_threads = []
+            try:
+                self.load_prediction(job, save_threads)
+                self.jobs_succeeded += 1
+            except Exception as e:
+                slicer.util.errorDisplay(f"Error while importing the segmentation :\n{e}")
+            finally:
+                job.stage_seconds["import"] = round(time.perf_counter() - importStart, 3)
+                self.logic.record_job_metrics(job, queue.max_concurrent)
+                # The files are still being written from the prediction of the job
+                self.logic.cleanup_job_after(job, save_threads)
+        elif job.status == job.FAILED:
+            self.remove_preview(job)
+            self.logic.record_job_metrics(job, queue.max_concurrent)
+            self.logic.cleanup_job(job)
+            slicer.util.errorDisplay(f"Error during segmentation :\n{job.error}")
+        elif job.status == job.CANCELLED:
+            self.remove_preview(job)
+            self.logic.record_job_metrics(job, queue.max_concurrent)
+            self.logic.cleanup_job(job)
+
+        self.update_progress_bar()
+
+        if job.is_finished() and queue.is_idle():
+            succeeded, self.jobs_succeeded = self.jobs_succeeded, 0
+            if succeeded:
+                slicer.util.infoDisplay(f"{succeeded} segmentation(s) finished successfully.")
+
+    def on_job_preview(self, job_id):
         """
-        Loads the prediction generated by nnUNet into Slicer.
+        Function called on the GUI thread when the low-resolution preview of a running job is ready.
+        The preview is shown as a segmentation node, replaced in place by the full prediction (see load_prediction).
 
         Args:
-            output_path (str): Path to the output folder where the prediction is saved.
+            job_id (int): Id of the job.
         Returns:
             None
         """
-        prediction_path = os.path.join(output_path, "001.nrrd")
-        if not os.path.exists(prediction_path):
-            qt.QMessageBox.warning(slicer.util.mainWindow(), "Error", "No prediction found to load.")
+        job = self.get_job_queue().get(job_id)
+        if job is None or job.status != job.RUNNING or not job.preview_path or not os.path.exists(job.preview_path):
             return
-        else:
-            seg_name = self.structure_to_segment
-            self.convert_prediction_to_segmentation(prediction_path, output_path, seg_name)
-                
-    def convert_prediction_to_segmentation(self, prediction_path, output_path, segmentation_name):
+        try:
+            segmentationNode = self.logic.convert_prediction_to_segmentation(job.preview_path, None,
+                                                                             f"{job.structure}_preview", job.context_file)
+            job.preview_node_id = segmentationNode.GetID()
+        except Exception as e:
+            print(f"Job {job.id}: cannot show the preview: {e}")
+
+    def on_job_slab(self, job_id, start, stop):
         """
-        Converts an nnUNet prediction (.nrrd) to Slicer segmentation
-        while strictly maintaining the same geometry.
+        Function called on the GUI thread when slices of the streamed prediction of a running job are written.
+        They are shown in one segmentation node, updated in place slab by slab and replaced by the full
+        prediction (see load_prediction), so that the finished slices can be browsed during the prediction.
 
         Args:
-            prediction_path (str): Path to the prediction file (.nrrd).
-            output_path (str): Output folder to save the segmentation.
-            segmentation_name (str): Name to give to the segmentation. 
+            job_id (int): Id of the job.
+            start (int): First slice (z) of the slab.
+            stop (int): Slice after the last one.
         Returns:
-            str: Path to the saved segmentation file.
+            None
         """
+        job = self.get_job_queue().get(job_id)
+        if job is None or job.status != job.RUNNING or not job.streamed_path or not os.path.exists(job.streamed_path):
+            return
+        segmentationNode = slicer.mrmlScene.GetNodeByID(job.preview_node_id) if job.preview_node_id else None
+        try:
+            segmentationNode = self.logic.update_streamed_segmentation(job, segmentationNode, start, stop)
+            job.preview_node_id = segmentationNode.GetID()
+        except Exception as e:
+            print(f"Job {job.id}: cannot show the slices {start}:{stop}: {e}")
 
-        # Load the prediction as a labelmap
-        labelmapNode = slicer.util.loadLabelVolume(prediction_path)
-        labelmapNode.SetName(segmentation_name + "_labelmap")
-
-        # Create a segmentation node
-        segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", segmentation_name)
-        segmentationNode.CreateDefaultDisplayNodes()
-        
-        # Force the same geometry
-        segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(labelmapNode)
+    def remove_preview(self, job):
+        """
+        Removes the preview segmentation of a job that did not finish.
 
-        # Import the labelmap without modifying size
-        slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapNode, segmentationNode)
+        Args:
+            job (SegmentationJob): The job.
+        Returns:
+            None
+        """
+        if job.preview_node_id:
+            node = slicer.mrmlScene.GetNodeByID(job.preview_node_id)
+            if node is not None:
+                slicer.mrmlScene.RemoveNode(node)
+            job.preview_node_id = None
 
-        # Check and rename segments according to the label_map
-        segment_ids = vtk.vtkStringArray()
-        segmentationNode.GetSegmentation().GetSegmentIDs(segment_ids)
+    def update_job_row(self, job):
+        """
+        Shows a job in the queue view, adding its row if needed.
 
-        slicer.mrmlScene.RemoveNode(labelmapNode)
+        Args:
+            job (SegmentationJob): The job.
+        Returns:
+            None
+        """
+        table = self.ui.jobsTableWidget
+        row = None
+        for r in range(table.rowCount):
+            if table.item(r, 0) is not None and table.item(r, 0).text() == str(job.id):
+                row = r
+                break
+        if row is None:
+            row = table.rowCount
+            table.insertRow(row)
+
+        status = job.status
+        if job.status == job.RUNNING:
+            status = f"{job.status} {job.percent}%"
+        elif job.status == job.FAILED:
+            status = f"{job.status}: {job.error}"
+        memory = f"~{job.estimated_memory / 1024 ** 3:.1f} GB" if job.estimated_memory else ""
+        if job.peak_memory:
+            memory += f" (peak {job.peak_memory / 1024 ** 3:.1f} GB)"
+        values = [str(job.id), job.label, f"{job.animal} {job.mode} {job.structure} ({job.preset or 'default'})", status,
+                  job.stage if job.status == job.RUNNING else "", memory, f"{job.elapsed():.0f} s"]
+        for column, value in enumerate(values):
+            table.setItem(row, column, qt.QTableWidgetItem(value))
+
+    def refresh_jobs_table(self):
+        """
+        Rebuilds the queue view from the job queue.
 
-        with open(self.tmp_file, 'r') as f:
-            data = json.load(f)
-        dataset_json_path = data["dataset_json_path"]
+        Args:
+            None
+        Returns:
+            None
+        """
+        self.ui.jobsTableWidget.setRowCount(0)
+        for job in self.get_job_queue().jobs():
+            self.update_job_row(job)
 
-        # Load the model's dataset.json
-        with open(dataset_json_path, "r") as f:
-            dataset = json.load(f)
+    def cancel_pending_jobs(self):
+        """
+        Function called by the "Cancel pending" button.
 
-        raw_label_map = dataset.get("labels", {})
-        label_map = {int(v): k for k, v in raw_label_map.items() if int(v) > 0}
+        Args:
+            None
+        Returns:
+            None
+        """
+        cancelled = self.get_job_queue().cancel_pending()
+        print(f"{len(cancelled)} pending job(s) cancelled.")
 
-        for i in range(segment_ids.GetNumberOfValues()):
-            segment_id = segment_ids.GetValue(i)
-            segment = segmentationNode.GetSegmentation().GetSegment(segment_id)
-            label_index = i + 1
-            name = label_map.get(label_index, f"Class_{label_index}")
-            segment.SetName(name)
+    def cancel_selected_job(self):
+        """
+        Function called by the "Cancel selected" button: cancels the job selected in the queue view,
+        pending or running (a running job is stopped, its preview is removed).
 
-        displayNode = segmentationNode.GetDisplayNode()
-        if displayNode:
-            displayNode.SetVisibility(False)
+        Args:
+            None
+        Returns:
+            None
+        """
+        table = self.ui.jobsTableWidget
+        row = table.currentRow()
+        if row < 0 or table.item(row, 0) is None:
+            return
+        job_id = int(table.item(row, 0).text())
+        if self.get_job_queue().cancel(job_id):
+            print(f"Job {job_id} cancelled.")
 
-        segmentation_path = os.path.join(output_path, segmentation_name + ".nrrd")
-        slicer.util.saveNode(segmentationNode, segmentation_path)
-        os.remove(prediction_path)
+    def clear_finished_jobs(self):
+        """
+        Function called by the "Clear finished" button: removes the finished jobs from the queue view.
 
-        # Clean up temporary converted input if any
-        if self.convertedInputToDelete and os.path.exists(self.convertedInputToDelete):
-            try:
-                os.remove(self.convertedInputToDelete)
-            except Exception as e:
-                print(f"Error deleting converted input: {e}")
-            finally:
-                self.convertedInputToDelete = None
+        Args:
+            None
+        Returns:
+            None
+        """
+        self.get_job_queue().clear_finished()
+        self.refresh_jobs_table()
 
-    def run_automated_task(self, volumeNode, animal, mode="invivo", structure="all"):
+    def update_progress_bar(self):
         """
-        Main function to run the automated segmentation task with given parameters.
-        It prepares the input, configures paths, and starts the segmentation process.
+        Shows the average progress of the pending and running jobs, and hides the progress bar when the queue is idle.
 
         Args:
-            volumeNode (vtkMRMLScalarVolumeNode): The input volume node to segment.
-            animal (str): The animal type ("pig", "rat", "rabbit").
-            mode (str): The segmentation mode ("invivo", "exvivo", "axial").
-            structure (str): The structure to segment ("parenchyma", "airways", "vascular", "lobes", "parenchymaairways", "all").
+            None
         Returns:
             None
         """
-        print(f"Animal : {animal} | Mode : {mode} | Structure : {structure}")
+        active = [job for job in self.get_job_queue().jobs() if not job.is_finished()]
+        if not active:
+            self.ui.progressBar.setVisible(False)
+            return
+
+        running = [job for job in active if job.status == job.RUNNING]
+        self.ui.progressBar.setVisible(True)
+        self.ui.progressBar.setValue(int(sum(job.percent for job in active) / len(active)))
+        text = f"{len(running)} running, {len(active) - len(running)} pending"
+        if len(running) == 1 and running[0].stage:
+            text = f"{running[0].stage} - {text}"
+        self.ui.progressBar.setFormat(f"%p% - {text}")
+
+
+    def load_prediction(self, job, save_threads=None):
+        """
+        Loads the prediction generated by nnUNet for a job into Slicer.
+
+        Args:
+            job (SegmentationJob): The finished job.
+            save_threads (list): Receives the threads writing the segmentation files in the background, optional.
+        Returns:
+            None
+        """
+        prediction_path = job.prediction_path or os.path.join(job.prediction_dir, "001.nrrd")
+        if not job.is_multi_structure() and not os.path.exists(prediction_path):
+            self.remove_preview(job)
+            qt.QMessageBox.warning(slicer.util.mainWindow(), "Error", "No prediction found to load.")
+            return
+
+        # The full prediction replaces the preview in place
+        previewNode = slicer.mrmlScene.GetNodeByID(job.preview_node_id) if job.preview_node_id else None
+        job.preview_node_id = None
+        self.logic.import_job(job, previewNode, save_threads=save_threads, **self.import_options())
+
+    def import_options(self):
+        """
+        Returns:
+            dict: Options of the import of the predictions chosen in the Options section ("save", "segmentation_format"
+                and "on_label_map", see LungSegmentationLogic.import_job).
+        """
+        return {
+            "save": self.ui.saveSegmentationsCheckBox.isChecked(),
+            "segmentation_format": self.ui.segmentationFormatComboBox.currentText,
+            "on_label_map": self.build_surfaces_in_background if self.ui.backgroundSurfacesCheckBox.isChecked() else None,
+        }
+                
+    def get_surface_builder(self):
+        """
+        Returns:
+            SurfaceBuilder: Background builder of the closed surfaces, created on first use.
+        """
+        if self.surface_builder is None:
+            from LungSegmentationLib.surfaces import SurfaceBuilder
+            self.surface_builder = SurfaceBuilder(self.on_surface_built)
+        return self.surface_builder
+
+    def build_surfaces_in_background(self, segmentationNode, array, ijk_to_ras, segments):
+        """
+        Builds the closed surfaces of the segments of a segmentation node in the background (see surfaces.py),
+        so that turning on the 3D display does not convert them on the main thread. A coarse surface is shown
+        for every segment first, then refined with the smoothing and decimation of the options.
+
+        Args:
+            segmentationNode (vtkMRMLSegmentationNode): The segmentation node.
+            array (np.ndarray): Its label map in (z, y, x) order, not modified afterwards.
+            ijk_to_ras (list): 4x4 IJK to RAS matrix of the label map.
+            segments (list): Segments of the node ("id", "name", "label").
+        Returns:
+            None
+        """
+        settings = {
+            "smoothing": self.ui.surfaceSmoothingSpinBox.value,
+            "decimation": self.ui.surfaceDecimationSpinBox.value,
+        }
+        # A conversion requested later by Slicer uses the same parameters
+        segmentation = segmentationNode.GetSegmentation()
+        segmentation.SetConversionParameter("Smoothing factor", str(settings["smoothing"]))
+        segmentation.SetConversionParameter("Decimation factor", str(settings["decimation"]))
+        self.get_surface_builder().submit(segmentationNode.GetID(), array, ijk_to_ras, segments, settings,
+                                          self.surface_priorities)
+
+    def on_surface_built(self, node_id, segment_id, surface, final):
+        """
+        Function called on the builder thread for every surface built: the surface is attached on the GUI thread.
+
+        Args:
+            node_id (str): ID of the segmentation node.
+            segment_id (str): ID of the segment.
+            surface (vtkPolyData): The surface, in RAS.
+            final (bool): False for a coarse surface, replaced later.
+        Returns:
+            None
+        """
+        self.surface_results.append((node_id, segment_id, surface, final))
+        self.signals.surfaceReady.emit()
+
+    def on_surfaces_ready(self):
+        """
+        Function called on the GUI thread when surfaces were built in the background: they are added to their
+        segments as closed-surface representations, replacing the coarse ones.
+
+        Args:
+            None
+        Returns:
+            None
+        """
+        representationName = slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()
+        modified = {}
+        while self.surface_results:
+            node_id, segment_id, surface, final = self.surface_results.popleft()
+            segmentationNode = slicer.mrmlScene.GetNodeByID(node_id)
+            if segmentationNode is None:
+                # Removed from the scene: its remaining surfaces are not needed
+                self.get_surface_builder().cancel(node_id)
+                continue
+            segment = segmentationNode.GetSegmentation().GetSegment(segment_id)
+            if segment is None:
+                continue
+            segment.AddRepresentation(representationName, surface)
+            modified[node_id] = segmentationNode
+        for segmentationNode in modified.values():
+            # Updates the 3D display of the node
+            segmentationNode.GetSegmentation().InvokeEvent(slicer.vtkSegmentation.RepresentationModified)
+
+    def run_automated_task(self, volumeNode, animal, mode="invivo", structure="all", bypass_cache=False, preset=None,
+                           crop=True, preview=False):
+        """
+        Main function to run the automated segmentation task with given parameters.
+        It exports the input into a new job folder and queues the segmentation: several calls can be made in a row,
+        the jobs do not share any state. Scripts without the widget use LungSegmentationLogic.segment instead.
+
+        Args:
+            volumeNode (vtkMRMLScalarVolumeNode): The input volume node to segment.
+            animal (str): The animal type ("pig", "rat", "rabbit").
+            mode (str): The segmentation mode ("invivo", "exvivo", "axial").
+            structure (str or list): The structure to segment ("parenchyma", "airways", "vascular", "lobes", "parenchymaairways", "all"),
+                or a list of structures segmented in one job, the input being preprocessed once for all their models.
+            bypass_cache (bool): Runs the model even if the prediction is cached.
+            preset (str): Speed preset ("fast", "balanced", "accurate", "ensemble"), the default preset if None.
+            crop (bool): Runs the inference on the region of interest of the volume only.
+            preview (bool): Shows a low-resolution preview before the full prediction.
+        Returns:
+            SegmentationJob: The queued job.
+        """
+        print(f"Animal : {animal} | Mode : {mode} | Structure : {structure}")
         
-        self.structure_to_segment = structure
         self.input_node = volumeNode
         
-        # Create a temporary directory to store the converted input and output results
-        temp_dir = tempfile.mkdtemp(prefix=f"AutoSeg_{animal}_")
-        self.input_path = os.path.join(temp_dir, "input_volume.nrrd")
-        slicer.util.saveNode(volumeNode, self.input_path)
-        self.convertedInputToDelete = self.input_path
+        # Job folder storing the converted input and output results
+        workdir = self.logic.create_job_workdir()
+        os.makedirs(os.path.join(workdir, "input"), exist_ok=True)
+        conversionStart = time.perf_counter()
+        input_path = self.logic.exportVolumeNode(volumeNode, os.path.join(workdir, "input", "input_volume.json"))
+        conversion_seconds = time.perf_counter() - conversionStart
 
         # Directory to store results
-        output_path = os.path.join(temp_dir, "output")
+        output_path = os.path.join(workdir, "output")
         os.makedirs(output_path, exist_ok=True)
         
         # UI updates
         self.ui.outputLineEdit.setText(output_path)
 
-        # Finding the models directory
-        extension_dir = os.path.dirname(__file__)
-        self.models_dir = os.path.join(extension_dir, "models")
+        # Queue the segmentation
+        return self.submit_job(animal, mode, structure, input_path, output_path, workdir, converted_input=input_path,
+                               bypass_cache=bypass_cache, label=volumeNode.GetName(), preset=preset, crop=crop,
+                               preview=preview, conversion_seconds=conversion_seconds)
 
-        # Progress bar initialization
-        self.ui.progressBar.setVisible(True)
-        self.ui.progressBar.setValue(0)
-        self.progressValue = 0
-        self.elapsedSeconds = 0
-        qt.QTimer.singleShot(0, self.timer.start)
 
-        # Start the segmentation
-        self.start_segmentation(mode, output_path, animal)
\ No newline at end of file
+###################################################### Segmentation logic, usable without the widget ######################################################
+
+class LungSegmentationLogic(ScriptedLoadableModuleLogic):
+    """
+    Segmentation logic of the module: input preparation, inference in warm workers, caches, import of the
+    predictions with named segments, saving and metrics. It does not depend on the widget: the widget queues
+    its jobs through it, and scripts or a headless Slicer (see Resources/scripts/slicer_batch.py) call segment.
+    """
+    def __init__(self, models_dir=None):
+        """
+        Logic constructor
+
+        Args:
+            models_dir (str): Folder containing the downloaded models, the models folder of the module if None.
+        Returns:
+            None
+        """
+        ScriptedLoadableModuleLogic.__init__(self)
+        from LungSegmentationLib.presets import DEFAULT_SLICE_BATCH
+
+        self.models_dir = models_dir or os.path.join(os.path.dirname(__file__), "models")  # Folder containing the downloaded models
+        self.worker_pool = None             # Warm inference workers, one per running job, started on the first segmentation
+        self.use_shared_memory = False      # Hand the input voxels to the runner in shared memory instead of a raw file
+        self.dicom_converter = None         # DICOM series to NRRD converter, with its cache
+        self.dicom_cache_max_bytes = 4 * 1024 ** 3  # Disk budget of the converted DICOM series cache
+        self.input_cache = None             # Cache of the converted image inputs
+        self.input_cache_max_bytes = 4 * 1024 ** 3  # Disk budget of the converted input cache
+        self.input_cache_key_mode = "fast"  # "fast" (path + size + mtime) or "content" (hash of the file)
+        self.result_cache = None            # Cache of the predictions
+        self.result_cache_max_bytes = 2 * 1024 ** 3  # Disk budget of the prediction cache
+        self.metrics_aggregate_path = None  # Prometheus file aggregating the metrics of the jobs, in the temporary folder if None
+        self.slice_batch = DEFAULT_SLICE_BATCH  # Slices per slab of the axial predictions, None for the whole volume at once
+        self.stream_memory_bytes = None     # Memory ceiling of the single-structure predictions streamed slab by slab, None for the whole volume at once
+        self.metrics_aggregate = None
+
+    def segment(self, input, animal, mode="invivo", structure="all", output_path=None, preset=None, crop=True,
+                bypass_cache=False, load=True, segmentation_format=None, threads=None, on_progress=None):
+        """
+        Segments a volume synchronously: prepares the input, runs the model in a warm inference worker (or restores
+        the cached prediction), imports the prediction as a segmentation node with named segments and writes the
+        segmentation file before returning. Several calls can be made in a row, the workers stay loaded.
+
+        Args:
+            input (str or vtkMRMLScalarVolumeNode): Volume node, or path of a .nrrd, .mha, .nii file or DICOM folder.
+            animal (str): The animal type ("pig", "rat", "rabbit").
+            mode (str): The segmentation mode ("invivo", "exvivo", "axial").
+            structure (str or list): The structure to segment, or a list of structures segmented in one job.
+            output_path (str): Folder receiving the segmentation files and the metrics file, the job folder if None.
+            preset (str): Speed preset ("fast", "balanced", "accurate", "ensemble"), the default preset if None.
+            crop (bool): Runs the inference on the region of interest of the volume only.
+            bypass_cache (bool): Runs the model even if the prediction is cached.
+            load (bool): Keeps the segmentation nodes in the scene; if False they are removed once their file is written.
+            segmentation_format (str): Format of the segmentation files (see segio.SEGMENTATION_FORMATS), the default if None.
+            threads (int): Intra-op threads of the inference, the preset value if None.
+            on_progress (callable): Called with every progress event of the runner (see nnunet_progress.py), optional.
+        Returns:
+            vtkMRMLSegmentationNode or str: The segmentation node, or the path of the segmentation file if load is False.
+                For a list of structures, a dict structure -> node or path.
+        Raises:
+            Exception: Any error of the input preparation, the prediction or the import.
+        """
+        from LungSegmentationLib import segio
+        from LungSegmentationLib.jobqueue import SegmentationJob
+
+        segmentation_format = segmentation_format or segio.DEFAULT_SEGMENTATION_FORMAT
+        workdir = self.create_job_workdir()
+        conversionStart = time.perf_counter()
+        try:
+            if isinstance(input, str):
+                label = os.path.basename(input.strip().rstrip("/\\"))
+                input_path, temporary = self.prepareInputForSegmentation(input, workdir)
+            else:
+                label = input.GetName()
+                os.makedirs(os.path.join(workdir, "input"), exist_ok=True)
+                input_path = self.exportVolumeNode(input, os.path.join(workdir, "input", "input_volume.json"))
+                temporary = True
+        except Exception:
+            shutil.rmtree(workdir, ignore_errors=True)
+            raise
+        output_path = output_path or os.path.join(workdir, "output")
+        os.makedirs(output_path, exist_ok=True)
+
+        job = self.create_job(animal, mode, structure, input_path, output_path, workdir,
+                              converted_input=input_path if temporary else None, bypass_cache=bypass_cache, label=label,
+                              preset=preset, crop=crop, conversion_seconds=time.perf_counter() - conversionStart)
+        print(f"Job {job.id} started: {animal} | {mode} | {job.structure} | {job.label}")
+        job.status = SegmentationJob.RUNNING
+        job.start_time = time.time()
+        try:
+            self.run_job(job, threads, on_progress)
+            # The files are written before returning, so the import stage includes the export
+            importStart = time.perf_counter()
+            nodes = self.import_job(job, segmentation_format=segmentation_format, background_save=False)
+            job.stage_seconds["import"] = round(time.perf_counter() - importStart, 3)
+            job.status = SegmentationJob.DONE
+        except Exception as e:
+            job.status = SegmentationJob.FAILED
+            job.error = str(e)
+            raise
+        finally:
+            job.end_time = time.time()
+            self.record_job_metrics(job)
+            self.cleanup_job(job)
+
+        results = nodes
+        if not load:
+            results = {}
+            for name, node in nodes.items():
+                slicer.mrmlScene.RemoveNode(node)
+                results[name] = segio.segmentation_file_path(output_path, name, segmentation_format)
+        return results if job.is_multi_structure() else results[job.structure]
+
+    def stop(self):
+        """
+        Stops the inference workers. They are started again by the next segmentation.
+
+        Args:
+            None
+        Returns:
+            None
+        """
+        if self.worker_pool is not None:
+            self.worker_pool.stop()
+            self.worker_pool = None
+
+    def get_dicom_converter(self):
+        """
+        Returns the DICOM series converter, creating it if needed.
+        Converted series are cached in the Slicer temporary folder.
+
+        Args:
+            None
+        Returns:
+            DicomSeriesConverter: The converter.
+        """
+        if self.dicom_converter is None:
+            cache_dir = os.path.join(slicer.app.temporaryPath, "LungSegmentation", "dicom_cache")
+            from LungSegmentationLib.dicomseries import DicomSeriesConverter
+            self.dicom_converter = DicomSeriesConverter(cache_dir, self.dicom_cache_max_bytes)
+        return self.dicom_converter
+
+    def get_input_cache(self):
+        """
+        Returns the cache of the converted image inputs, creating it if needed.
+
+        Args:
+            None
+        Returns:
+            ConvertedInputCache: The cache.
+        """
+        if self.input_cache is None:
+            cache_dir = os.path.join(slicer.app.temporaryPath, "LungSegmentation", "input_cache")
+            from LungSegmentationLib.inputcache import ConvertedInputCache
+            self.input_cache = ConvertedInputCache(cache_dir, self.input_cache_max_bytes, self.input_cache_key_mode)
+        return self.input_cache
+
+    def exportVolumeNode(self, volumeNode, headerPath):
+        """
+        Hands the voxels of a volume node over to the runner as raw uncompressed data and a JSON header
+        (or a shared memory block if use_shared_memory is set), instead of writing and parsing an image file.
+
+        Args:
+            volumeNode (vtkMRMLScalarVolumeNode): Volume to export.
+            headerPath (str): Path of the JSON header to write.
+        Returns:
+            str: Path of the header, to use as runner input.
+        """
+        directions = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASDirectionMatrix(directions)
+        geometry = volumeio.ras_to_lps_geometry(
+            volumeNode.GetOrigin(),
+            volumeNode.GetSpacing(),
+            [[directions.GetElement(r, c) for c in range(3)] for r in range(3)]
+        )
+        return volumeio.export_array(slicer.util.arrayFromVolume(volumeNode), geometry, headerPath, self.use_shared_memory)
+
+    def removeConvertedInput(self, path):
+        """
+        Deletes a converted input: an exported volume (header and voxels) or an image file.
+
+        Args:
+            path (str): Path of the converted input.
+        Returns:
+            None
+        """
+        if volumeio.is_volume_header(path):
+            volumeio.remove_volume(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def release_cached_input(self, path):
+        """
+        Releases the cache entry of an input pinned by prepareInputForSegmentation, if the path is one.
+
+        Args:
+            path (str): Input of the job.
+        Returns:
+            None
+        """
+        for cache in (self.dicom_converter, self.input_cache):
+            if cache is not None and cache.release(path):
+                return
+
+    def prepareInputForSegmentation(self, inputPath, workdir):
+        """
+        Checks and prepares the input path for segmentation.
+        If necessary, loads the volume and exports it for the runner (see exportVolumeNode) and returns the header path.
+
+        Args:
+            inputPath (str): Path to the input file or folder.
+            workdir (str): Working directory of the job, receiving the inputs that are not cached.
+        
+        Returns:
+            tuple: (path to the .nrrd file or volume header ready for segmentation, True if it must be deleted after the job)
+                A converted input kept in a cache is pinned, so that the eviction does not delete it while the job
+                is queued or running, until release_cached_input is called (see cleanup_job).
+        """
+        inputPath = inputPath.strip()
+        if not inputPath or not os.path.exists(inputPath):
+            raise RuntimeError("Invalid input path.")
+
+        lowerPath = inputPath.lower()
+        is_dir = os.path.isdir(inputPath)
+
+        if is_dir:
+            # DICOM folder: the converted series stays in the cache for the next segmentations
+            return self.get_dicom_converter().convert(inputPath, pin=True), False
+
+        elif lowerPath.endswith((".mha", ".nii", ".nii.gz")):
+            # Image file to convert
+            def convert(directory):
+                success, volumeNode = slicer.util.loadVolume(inputPath, returnNode=True)
+                if not success:
+                    raise RuntimeError("Error loading image.")
+                return os.path.basename(self.exportVolumeNode(volumeNode, os.path.join(directory, "converted_from_image.json")))
+
+            if self.use_shared_memory:
+                # Shared memory blocks are not cached: export to the job folder and delete after the run
+                directory = os.path.join(workdir, "input")
+                os.makedirs(directory, exist_ok=True)
+                return os.path.join(directory, convert(directory)), True
+
+            # The converted volume stays in the cache for the next segmentations
+            return self.get_input_cache().get_or_convert(inputPath, convert, pin=True), False
+
+        elif lowerPath.endswith(".nrrd"):
+            return inputPath, False
+
+        else:
+            raise RuntimeError("Unsupported format. Please select a .nrrd, .mha, .nii file, or a DICOM folder.")
+
+    def get_worker_pool(self):
+        """
+        Returns the pool of warm inference workers, creating it if needed.
+        The worker processes themselves are started by the first requests and then kept alive,
+        so that torch and the loaded models are reused by the next segmentations.
+
+        Args:
+            None
+        Returns:
+            RunnerWorkerPool: Pool of inference workers.
+        """
+        if self.worker_pool is None:
+            module_dir = os.path.dirname(__file__)
+            runner_path = os.path.join(module_dir, "Resources", "scripts", "nnunet_runner.py")
+            from LungSegmentationLib.workerclient import RunnerWorkerPool
+            self.worker_pool = RunnerWorkerPool(runner_path, self.models_dir)
+        return self.worker_pool
+
+    def create_job_workdir(self):
+        """
+        Creates the working directory of a new job.
+
+        Args:
+            None
+        Returns:
+            str: Path of the directory.
+        """
+        jobs_dir = os.path.join(slicer.app.temporaryPath, "LungSegmentation", "jobs")
+        os.makedirs(jobs_dir, exist_ok=True)
+        return tempfile.mkdtemp(prefix="job_", dir=jobs_dir)
+
+    def create_job(self, animal, mode, structure, input_path, output_path, workdir, converted_input=None,
+                   bypass_cache=False, label=None, preset=None, crop=True, preview=False, conversion_seconds=None):
+        """
+        Creates a segmentation job, with the estimation of its peak memory (see memory.estimate_job_memory).
+
+        Args:
+            animal (str): Name of the animal
+            mode (str): Segmentation mode (In vivo, Ex vivo)
+            structure (str or list): Structure to segment, or several structures sharing the preprocessing of the input
+            input_path (str): Input of the runner (.nrrd or volume header)
+            output_path (str): Path to the output folder
+            workdir (str): Working directory of the job (see create_job_workdir)
+            converted_input (str): Input converted for this job only, deleted after the job
+            bypass_cache (bool): Runs the model even if the prediction is cached
+            label (str): Description of the input in the queue view
+            preset (str): Speed preset ("fast", "balanced", "accurate" or "ensemble"), the default preset if None
+            crop (bool): Runs the inference on the region of interest of the input only
+            preview (bool): Makes a low-resolution preview before the full prediction (single structure only)
+            conversion_seconds (float): Time spent preparing the input, reported in the metrics of the job
+        Returns:
+            SegmentationJob: The job.
+        """
+        from LungSegmentationLib.jobqueue import SegmentationJob
+
+        job = SegmentationJob(animal, mode, structure, input_path, output_path, workdir, bypass_cache, label, preset,
+                               crop, preview)
+        job.preview = preview and not job.is_multi_structure()
+        job.converted_input = converted_input
+        # Inputs from prepareInputForSegmentation that are not temporary may be pinned in a cache
+        job.cached_input = None if converted_input else input_path
+        if conversion_seconds is not None:
+            job.stage_seconds["conversion"] = round(conversion_seconds, 3)
+
+        from LungSegmentationLib.memory import estimate_job_memory
+        from LungSegmentationLib.models import resolve_folds
+        from LungSegmentationLib.presets import preset_settings
+        from LungSegmentationLib.resultcache import find_trained_model
+        try:
+            folds = preset_settings(preset)["folds"]
+            estimates = []
+            for s in job.structures:
+                entry, model_path = find_trained_model(self.models_dir, animal, mode, s)
+                fold_count = len(resolve_folds(model_path, entry["fold"], folds)) if model_path else 1
+                # The worker of a job predicts the folds of the ensemble itself, without fold processes
+                estimates.append(estimate_job_memory(input_path, model_path, fold_count, fold_processes=1))
+            # The models of a multi-structure job run one after the other: the largest one sets the peak
+            estimate = max(estimates, key=lambda e: e["bytes"] or 0)
+            job.estimated_memory = estimate["bytes"]
+        except Exception as e:
+            print(f"Job {job.id}: could not estimate the memory of the job: {e}")
+
+        if job.estimated_memory and self.stream_memory_bytes and not job.is_multi_structure():
+            # A streamed prediction stays within its ceiling (see nnunet_stream.py)
+            job.estimated_memory = min(job.estimated_memory, self.stream_memory_bytes)
+        if job.estimated_memory:
+            print(f"Job {job.id}: estimated peak memory {job.estimated_memory / 1024 ** 3:.1f} GB "
+                  f"({estimate['voxels']} voxels, patch {estimate['patch_size']}, {estimate['num_classes']} classes)")
+        return job
+
+    def get_result_cache(self):
+        """
+        Returns the cache of the predictions, creating it if needed.
+
+        Args:
+            None
+        Returns:
+            PredictionResultCache: The cache.
+        """
+        if self.result_cache is None:
+            cache_dir = os.path.join(slicer.app.temporaryPath, "LungSegmentation", "result_cache")
+            from LungSegmentationLib.resultcache import PredictionResultCache
+            self.result_cache = PredictionResultCache(cache_dir, self.result_cache_max_bytes)
+        return self.result_cache
+
+    def run_job(self, job, threads=None, on_progress=None, on_preview=None, on_slab=None):
+        """
+        Runs a segmentation job, synchronously (in a background thread of the job queue for the widget).
+        
+        It sends the segmentation parameters to an inference worker (nnunet_runner.py --worker) and waits
+        for the prediction. If the same input was already predicted with the same model and parameters,
+        the cached prediction is used instead (unless the job bypasses the cache).
+        With job.preview, a low-resolution prediction is made first and on_preview is called once it is written.
+        In axial mode, the 2D model predicts the volume slab by slab of self.slice_batch slices instead of making a
+        preview: job.streamed_path is filled in place and on_slab is called with the slices of every written slab.
+        The same happens with self.stream_memory_bytes, with slabs that fit in that memory.
+        The prediction is imported in the scene afterwards (see import_job).
+        
+        Args:
+            job (SegmentationJob): The job.
+            threads (int): Intra-op threads of the job, the preset value if None.
+            on_progress (callable): Called with every progress event of the runner (see nnunet_progress.py), optional.
+            on_preview (callable): Called without argument when job.preview_path is written, optional.
+            on_slab (callable): Called with (first slice, last slice + 1) of every slab written to job.streamed_path
+                (see update_streamed_segmentation), optional.
+        Returns:
+            None
+        Raises:
+            Exception: Any error of the prediction, reported by the job queue.
+        """
+        from LungSegmentationLib.resultcache import volume_digest, model_identity
+
+        result_cache = None if job.bypass_cache else self.get_result_cache()
+        from LungSegmentationLib.presets import preset_settings
+
+        settings = preset_settings(job.preset, threads, job.crop)
+        if job.is_multi_structure():
+            self.run_multi_structure_job(job, settings, result_cache, on_progress)
+            return
+        params = {"animal": job.animal, "mode": job.mode, "structure": job.structure, "preset": settings["preset"],
+                  "crop": settings["crop"]}
+
+        if result_cache is not None:
+            lookupStart = time.perf_counter()
+            input_digest = volume_digest(job.input_path)
+            key = result_cache.key(input_digest, model_identity(self.models_dir, job.animal, job.mode, job.structure,
+                                                                 settings["folds"]), params)
+            restored = result_cache.restore(key, job.prediction_dir)
+            job.stage_seconds["cache_lookup"] = round(time.perf_counter() - lookupStart, 3)
+            if restored is not None:
+                print(f"Job {job.id}: prediction found in the result cache: {result_cache.stats()}")
+                job.cache_hit = True
+                job.prediction_path, job.dataset_json_path = restored
+                with open(job.context_file, "w") as f:
+                    json.dump({"dataset_json_path": job.dataset_json_path}, f)
+                return
+
+        slice_batch = self.slice_batch if job.mode == "axial" else None
+        stream_memory_bytes = self.stream_memory_bytes
+
+        def on_event(event):
+            if event.get("event") == "slab":
+                if job.streamed_path is None:
+                    # The names of the labels are needed to show the first slab
+                    with open(job.context_file, "w") as f:
+                        json.dump({"dataset_json_path": event["dataset_json_path"]}, f)
+                    job.streamed_path = event["prediction"]
+                if on_slab is not None:
+                    on_slab(event["start"], event["stop"])
+            elif on_progress is not None:
+                on_progress(event)
+
+        with self.job_worker(job) as (client, watchdog):
+            if job.preview and not slice_batch and not stream_memory_bytes:
+                try:
+                    preview = client.preview(job.animal, job.mode, job.structure, job.input_path, job.prediction_dir,
+                                             job.context_file, on_progress=on_progress,
+                                             preset=settings["preset"], threads=settings["threads"], crop=settings["crop"],
+                                             output_format="raw")
+                    job.preview_path = preview["prediction"]
+                    job.stage_seconds["preview"] = preview.get("total_seconds")
+                    if on_preview is not None:
+                        on_preview()
+                except Exception as e:
+                    if job.cancel_requested or watchdog.exceeded:
+                        raise
+                    print(f"Job {job.id}: no preview: {e}")
+
+            # The label map comes back as raw voxels mapped by the import (see convert_prediction_to_segmentation)
+            response = client.predict(job.animal, job.mode, job.structure, job.input_path, job.prediction_dir,
+                                      job.context_file, on_progress=on_event,
+                                      preset=settings["preset"], threads=settings["threads"], crop=settings["crop"],
+                                      output_format="raw", slice_batch=slice_batch,
+                                      stream_memory_bytes=stream_memory_bytes)
+        job.prediction_path = response["prediction"]
+        job.dataset_json_path = response["dataset_json_path"]
+        job.roi = response.get("roi")
+        self.record_runner_details(job, response)
+
+        if result_cache is not None:
+            # The model identity is known for sure once the model is downloaded
+            key = result_cache.key(input_digest, model_identity(self.models_dir, job.animal, job.mode, job.structure,
+                                                                 settings["folds"]), params)
+            result_cache.store(key, job.prediction_path, job.dataset_json_path, params)
+
+    def run_multi_structure_job(self, job, settings, result_cache, on_progress=None):
+        """
+        Runs a job segmenting several structures. The cached structures are restored, and the others are
+        predicted in a single worker request, which preprocesses the input once for the models sharing their
+        preprocessing (see nnunet_engine.predict_structures). No preview is made.
+
+        Args:
+            job (SegmentationJob): The job.
+            settings (dict): Preset settings of the job.
+            result_cache (PredictionResultCache): Cache of the predictions, None to bypass it.
+            on_progress (callable): Called with every progress event of the runner, optional.
+        Returns:
+            None
+        """
+        from LungSegmentationLib.resultcache import volume_digest, model_identity
+
+        def cache_key(structure):
+            params = {"animal": job.animal, "mode": job.mode, "structure": structure, "preset": settings["preset"],
+                      "crop": settings["crop"]}
+            identity = model_identity(self.models_dir, job.animal, job.mode, structure, settings["folds"])
+            return result_cache.key(input_digest, identity, params), params
+
+        missing = list(job.structures)
+        if result_cache is not None:
+            lookupStart = time.perf_counter()
+            input_digest = volume_digest(job.input_path)
+            for structure in job.structures:
+                restored = result_cache.restore(cache_key(structure)[0], job.structure_dir(structure))
+                if restored is not None:
+                    job.results[structure] = restored
+                    missing.remove(structure)
+            job.stage_seconds["cache_lookup"] = round(time.perf_counter() - lookupStart, 3)
+            job.cache_hit = not missing
+            if job.results:
+                print(f"Job {job.id}: {', '.join(job.results)} found in the result cache: {result_cache.stats()}")
+
+        if missing:
+            with self.job_worker(job) as (client, watchdog):
+                response = client.predict_structures(job.animal, job.mode, missing, job.input_path, job.prediction_dir,
+                                                     on_progress=on_progress,
+                                                     preset=settings["preset"], threads=settings["threads"],
+                                                     crop=settings["crop"], output_format="raw")
+            self.record_runner_details(job, response)
+            for structure, result in response["predictions"].items():
+                job.results[structure] = (result["prediction"], result["dataset_json_path"])
+                if result_cache is not None:
+                    key, params = cache_key(structure)
+                    result_cache.store(key, result["prediction"], result["dataset_json_path"], params)
+
+        for structure, (prediction_path, dataset_json_path) in job.results.items():
+            with open(os.path.join(job.structure_dir(structure), "nnunet_context.json"), "w") as f:
+                json.dump({"dataset_json_path": dataset_json_path}, f)
+
+    def record_runner_details(self, job, response):
+        """
+        Keeps the stage durations and the details reported by the runner for the metrics of a job.
+
+        Args:
+            job (SegmentationJob): The job.
+            response (dict): Response of the inference worker.
+        Returns:
+            None
+        """
+        for stage, seconds in (response.get("stages") or {}).items():
+            job.stage_seconds[stage] = seconds
+        job.runner_details = {key: response.get(key) for key in
+                              ("input_shape", "input_spacing", "model", "settings", "torch_threads", "peak_rss_bytes")}
+
+    def job_metrics(self, job, max_concurrent=1):
+        """
+        Metrics of a finished job, written to its metrics file next to its output (see telemetry.py).
+
+        Args:
+            job (SegmentationJob): The job.
+            max_concurrent (int): Number of jobs running at the same time.
+        Returns:
+            dict: Status, configuration, input, model identity, stage durations, threads and memory of the job.
+        """
+        from LungSegmentationLib.presets import preset_settings
+        from LungSegmentationLib.resultcache import model_identity
+
+        details = job.runner_details
+        stages = dict(job.stage_seconds)
+        if job.start_time is not None:
+            stages["queue_wait"] = round(job.start_time - job.submitted_time, 3)
+        models = {}
+        for structure in job.structures:
+            try:
+                models[structure] = model_identity(self.models_dir, job.animal, job.mode, structure,
+                                                   preset_settings(job.preset)["folds"])
+            except Exception as e:
+                models[structure] = {"error": str(e)}
+        return {
+            "job": job.id,
+            "status": job.status,
+            "error": job.error,
+            "label": job.label,
+            "configuration": {"animal": job.animal, "mode": job.mode, "structures": job.structures, "preset": job.preset,
+                              "crop": job.crop, "preview": job.preview},
+            "settings": details.get("settings"),
+            "input": {"path": job.input_path, "shape": details.get("input_shape"), "spacing": details.get("input_spacing")},
+            "model": {"runner": details.get("model"), "identity": models},
+            "cache_hit": job.cache_hit,
+            "stages": stages,
+            "total_seconds": round(job.elapsed(), 3),
+            "threads": {"torch": details.get("torch_threads"), "max_concurrent_jobs": max_concurrent},
+            "memory": {"estimated_bytes": job.estimated_memory, "limit_bytes": job.memory_limit,
+                       "peak_rss_bytes": job.peak_memory, "worker_peak_rss_bytes": details.get("peak_rss_bytes")},
+            "submitted_time": job.submitted_time,
+            "start_time": job.start_time,
+            "end_time": job.end_time,
+        }
+
+    def record_job_metrics(self, job, max_concurrent=1):
+        """
+        Writes the metrics of a finished job to a metrics file of its own next to its output (see
+        telemetry.job_metrics_name), and adds them to the Prometheus aggregate of all the jobs (see metrics_aggregate_path).
+
+        Args:
+            job (SegmentationJob): The finished job.
+            max_concurrent (int): Number of jobs running at the same time.
+        Returns:
+            None
+        """
+        from LungSegmentationLib.telemetry import PrometheusAggregate, job_metrics_name, write_metrics
+
+        try:
+            metrics = self.job_metrics(job, max_concurrent)
+            name = job_metrics_name(job.label, job.structure, job.id, job.submitted_time)
+            path = write_metrics(job.output_dir or job.workdir, metrics, name)
+            print(f"Job {job.id}: metrics saved to {path}")
+            if self.metrics_aggregate is None:
+                aggregate_path = self.metrics_aggregate_path or os.path.join(
+                    slicer.app.temporaryPath, "LungSegmentation", "metrics", "lungsegmentation.prom")
+                self.metrics_aggregate = PrometheusAggregate(aggregate_path)
+            self.metrics_aggregate.update(metrics)
+        except Exception as e:
+            print(f"Job {job.id}: cannot save the metrics: {e}")
+
+    @contextmanager
+    def job_worker(self, job):
+        """
+        Gives an inference worker of the pool to a running job. The worker is watched by an RSSWatchdog, which
+        kills it if it grows during the job beyond the memory given to the job (if any), and job.abort kills it when
+        the job is cancelled.
+
+        Args:
+            job (SegmentationJob): The running job.
+        Returns:
+            tuple: (RunnerWorkerClient, RSSWatchdog)
+        """
+        from LungSegmentationLib.memory import RSSWatchdog
+
+        with self.get_worker_pool().client() as client:
+            client.start()
+
+            def on_exceed(used):
+                client.abort(f"The segmentation was stopped: it used {used / 1024 ** 3:.1f} GB of memory, more than its limit "
+                             f"of {job.memory_limit / 1024 ** 3:.1f} GB. Run fewer jobs at the same time or raise the memory budget.")
+
+            # The worker may already hold models of previous jobs: only its growth counts
+            with RSSWatchdog(client.process.pid, job.memory_limit, on_exceed, relative=True) as watchdog:
+                # Cancelling a running job (see JobQueue.cancel) kills its worker, also if it was cancelled before
+                job.set_abort(client.abort)
+                try:
+                    yield client, watchdog
+                finally:
+                    job.set_abort(None)
+                    job.peak_memory = watchdog.peak or None
+
+    def cleanup_job(self, job):
+        """
+        Deletes the temporary files of a finished job: converted input, raw prediction and context file.
+        A converted input kept in a cache is released (see prepareInputForSegmentation).
+        The working directory itself is removed if nothing else is left in it.
+
+        Args:
+            job (SegmentationJob): The job.
+        Returns:
+            None
+        """
+        if job.converted_input:
+            try:
+                self.removeConvertedInput(job.converted_input)
+            except Exception as e:
+                print(f"Error deleting converted input: {e}")
+            job.converted_input = None
+        if job.cached_input:
+            self.release_cached_input(job.cached_input)
+            job.cached_input = None
+        shutil.rmtree(os.path.join(job.workdir, "input"), ignore_errors=True)
+        shutil.rmtree(job.prediction_dir, ignore_errors=True)
+        if os.path.exists(job.context_file):
+            os.remove(job.context_file)
+        if os.path.isdir(job.workdir) and not os.listdir(job.workdir):
+            os.rmdir(job.workdir)
+
+    def cleanup_job_after(self, job, threads):
+        """
+        Cleans up a finished job (see cleanup_job) once the given threads are done, e.g. the background saves
+        that read the raw prediction of the job (see import_job). Without threads, the job is cleaned up at once.
+
+        Args:
+            job (SegmentationJob): The job.
+            threads (list): Threads to wait for.
+        Returns:
+            None
+        """
+        if not threads:
+            self.cleanup_job(job)
+            return
+
+        def cleanup():
+            for thread in threads:
+                thread.join()
+            try:
+                self.cleanup_job(job)
+            except Exception as e:
+                print(f"Job {job.id}: cannot delete the temporary files: {e}")
+
+        threading.Thread(target=cleanup, daemon=True).start()
+
+    def import_job(self, job, segmentationNode=None, save=True, segmentation_format=None, background_save=True,
+                   on_label_map=None, save_threads=None):
+        """
+        Imports the predictions of a finished job into the scene: one segmentation node per structure, named
+        after the structure, with the segments named after the labels of the model.
+
+        Args:
+            job (SegmentationJob): The finished job.
+            segmentationNode (vtkMRMLSegmentationNode): Node replaced by the prediction of a single-structure job
+                (its preview), optional.
+            save (bool): Writes the segmentation files in the output folder of the job.
+            segmentation_format (str): Format of the files (see segio.SEGMENTATION_FORMATS), the default format if None.
+            background_save (bool): Writes the files in a background thread instead of before returning.
+            on_label_map (callable): See convert_prediction_to_segmentation.
+            save_threads (list): Receives the threads writing the files in the background, which read the prediction:
+                the job must not be cleaned up before they are done (see cleanup_job_after).
+        Returns:
+            dict: Structure -> vtkMRMLSegmentationNode.
+        Raises:
+            RuntimeError: If the prediction of a single-structure job is missing.
+        """
+        options = {"save": save, "segmentation_format": segmentation_format, "background_save": background_save,
+                   "on_label_map": on_label_map, "save_threads": save_threads}
+        if job.is_multi_structure():
+            # All the structures of the job are imported together
+            return {structure: self.convert_prediction_to_segmentation(
+                        prediction_path, job.output_dir, structure,
+                        os.path.join(job.structure_dir(structure), "nnunet_context.json"), **options)
+                    for structure, (prediction_path, _) in job.results.items()}
+
+        prediction_path = job.prediction_path or os.path.join(job.prediction_dir, "001.nrrd")
+        if not os.path.exists(prediction_path):
+            raise RuntimeError("No prediction found to load.")
+        return {job.structure: self.convert_prediction_to_segmentation(prediction_path, job.output_dir, job.structure,
+                                                                       job.context_file, segmentationNode, **options)}
+
+    def convert_prediction_to_segmentation(self, prediction_path, output_path, segmentation_name, context_file,
+                                           segmentationNode=None, save=True, segmentation_format=None,
+                                           background_save=True, on_label_map=None, save_threads=None):
+        """
+        Converts an nnUNet prediction to Slicer segmentation
+        while strictly maintaining the same geometry.
+
+        A prediction handed over in memory (volume header and raw voxels, see volumeio) is mapped and copied
+        into the scene directly; a .nrrd prediction (e.g. from the result cache) is loaded. In both cases the
+        segmentation file is written in the chosen format (see segio), in the background unless background_save
+        is False. The prediction is deleted afterwards.
+
+        Args:
+            prediction_path (str): Path to the prediction file (.nrrd or volume header).
+            output_path (str): Output folder to save the segmentation, None to only show it (preview).
+            segmentation_name (str): Name to give to the segmentation. 
+            context_file (str): Context file of the runner, with the dataset json path of the model.
+            segmentationNode (vtkMRMLSegmentationNode): Existing node whose segments are replaced (the preview), optional.
+            save (bool): Writes the segmentation file in output_path.
+            segmentation_format (str): Format of the file (see segio.SEGMENTATION_FORMATS), the default format if None.
+            background_save (bool): Writes the file in a background thread instead of before returning.
+            on_label_map (callable): Called with (segmentation node, label map, 4x4 IJK to RAS matrix, segments) when
+                output_path is given, e.g. to build the surfaces in the background. The label map is not modified afterwards.
+            save_threads (list): Receives the thread writing the file in the background, optional.
+        Returns:
+            vtkMRMLSegmentationNode: The segmentation node.
+        """
+        import numpy as np
+        from LungSegmentationLib import segio
+
+        # Load the prediction as a labelmap
+        in_memory = volumeio.is_volume_header(prediction_path)
+        if in_memory:
+            array, header = volumeio.map_volume(prediction_path)
+            geometry = volumeio.lps_to_ras_geometry(header)
+            labelmapNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+            labelmapNode.SetSpacing(geometry["spacing"])
+            labelmapNode.SetOrigin(geometry["origin"])
+            directions = vtk.vtkMatrix4x4()
+            for r in range(3):
+                for c in range(3):
+                    directions.SetElement(r, c, geometry["directions"][r][c])
+            labelmapNode.SetIJKToRASDirectionMatrix(directions)
+            slicer.util.updateVolumeFromArray(labelmapNode, array)
+        else:
+            labelmapNode = slicer.util.loadLabelVolume(prediction_path)
+            directions = vtk.vtkMatrix4x4()
+            labelmapNode.GetIJKToRASDirectionMatrix(directions)
+            header = volumeio.ras_to_lps_geometry(
+                labelmapNode.GetOrigin(),
+                labelmapNode.GetSpacing(),
+                [[directions.GetElement(r, c) for c in range(3)] for r in range(3)]
+            )
+        labelmapNode.SetName(segmentation_name + "_labelmap")
+
+        # Label values present in the prediction: one segment each, in increasing order
+        labels = segio.present_labels(slicer.util.arrayFromVolume(labelmapNode))
+
+        # Create a segmentation node, or reuse the preview node
+        replacing = segmentationNode is not None
+        if replacing:
+            segmentationNode.GetSegmentation().RemoveAllSegments()
+            segmentationNode.SetName(segmentation_name)
+        else:
+            segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", segmentation_name)
+            segmentationNode.CreateDefaultDisplayNodes()
+        
+        # Force the same geometry
+        segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(labelmapNode)
+
+        # Import the labelmap without modifying size
+        slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapNode, segmentationNode)
+
+        # Check and rename segments according to the label_map
+        segment_ids = vtk.vtkStringArray()
+        segmentationNode.GetSegmentation().GetSegmentIDs(segment_ids)
+
+        if not in_memory:
+            # The voxels are saved after the node is removed
+            array = slicer.util.arrayFromVolume(labelmapNode).copy()
+        ijkToRAS = vtk.vtkMatrix4x4()
+        labelmapNode.GetIJKToRASMatrix(ijkToRAS)
+        slicer.mrmlScene.RemoveNode(labelmapNode)
+
+        # Names of the labels in the model's dataset.json
+        label_names = segio.read_label_names(context_file)
+
+        segments = []
+        for i in range(segment_ids.GetNumberOfValues()):
+            segment_id = segment_ids.GetValue(i)
+            segment = segmentationNode.GetSegmentation().GetSegment(segment_id)
+            label_index = labels[i] if i < len(labels) else i + 1
+            name = segio.label_name(label_names, label_index)
+            segment.SetName(name)
+            segments.append({"id": segment_id, "name": name, "label": label_index, "color": segment.GetColor()})
+
+        save = output_path is not None and save
+        if output_path is not None:
+            # A replaced preview keeps the visibility chosen by the user
+            displayNode = segmentationNode.GetDisplayNode()
+            if displayNode and not replacing:
+                displayNode.SetVisibility(False)
+            if on_label_map is not None:
+                # The mapped voxels of a prediction handed over in memory are deleted after the import
+                on_label_map(segmentationNode, np.array(array) if in_memory else array,
+                             [[ijkToRAS.GetElement(r, c) for c in range(4)] for r in range(4)], segments)
+
+        if save:
+            segmentation_format = segmentation_format or segio.DEFAULT_SEGMENTATION_FORMAT
+            segmentation_path = segio.segmentation_file_path(output_path, segmentation_name, segmentation_format)
+            thread = self.save_segmentation(array, header, segments, segmentation_path, segmentation_format,
+                                            prediction_path, background_save)
+            if background_save and save_threads is not None:
+                save_threads.append(thread)
+        elif in_memory:
+            del array
+            volumeio.remove_volume(prediction_path)
+        else:
+            os.remove(prediction_path)
+        return segmentationNode
+
+    def update_streamed_segmentation(self, job, segmentationNode=None, start=0, stop=None):
+        """
+        Shows slices of the label map streamed by the runner for a running job (see run_job) in a segmentation
+        node, created at the first slab with one empty segment per label of the model. Only the slices of the
+        slab are written to the segments, so that an update does not cost more as the volume fills up.
+
+        Args:
+            job (SegmentationJob): Running job, with streamed_path.
+            segmentationNode (vtkMRMLSegmentationNode): Node showing the previous slabs, None for the first slab.
+            start (int): First slice (z) of the slab.
+            stop (int): Slice after the last one, the last slice of the volume if None.
+        Returns:
+            vtkMRMLSegmentationNode: The segmentation node.
+        """
+        import numpy as np
+        from vtk.util import numpy_support
+        from LungSegmentationLib import segio
+
+        array, header = volumeio.map_volume(job.streamed_path)
+        stop = array.shape[0] if stop is None else stop
+        geometry = volumeio.lps_to_ras_geometry(header)
+        ijkToRAS = vtk.vtkMatrix4x4()
+        for r in range(3):
+            for c in range(3):
+                ijkToRAS.SetElement(r, c, geometry["directions"][r][c] * geometry["spacing"][c])
+            ijkToRAS.SetElement(r, 3, geometry["origin"][r])
+
+        if segmentationNode is None:
+            segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", f"{job.structure}_preview")
+            segmentationNode.CreateDefaultDisplayNodes()
+            # Geometry of the whole label map, so that the slabs are written without resampling
+            reference = slicer.vtkOrientedImageData()
+            reference.SetExtent(0, array.shape[2] - 1, 0, array.shape[1] - 1, 0, array.shape[0] - 1)
+            reference.SetImageToWorldMatrix(ijkToRAS)
+            segmentationNode.GetSegmentation().SetConversionParameter(
+                slicer.vtkSegmentationConverter.GetReferenceImageGeometryParameterName(),
+                slicer.vtkSegmentationConverter.SerializeImageGeometry(reference))
+            for label, name in sorted(segio.read_label_names(job.context_file).items()):
+                segmentationNode.GetSegmentation().AddEmptySegment(f"label_{label}", name)
+
+        # Mask of one label over the slab, written to its segment
+        slab = slicer.vtkOrientedImageData()
+        slab.SetExtent(0, array.shape[2] - 1, 0, array.shape[1] - 1, start, stop - 1)
+        slab.SetImageToWorldMatrix(ijkToRAS)
+        slab.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+        mask = numpy_support.vtk_to_numpy(slab.GetPointData().GetScalars()).reshape(stop - start, *array.shape[1:])
+        rows = np.array(array[start:stop])
+        del array
+
+        segment_ids = vtk.vtkStringArray()
+        segmentationNode.GetSegmentation().GetSegmentIDs(segment_ids)
+        for i in range(segment_ids.GetNumberOfValues()):
+            segment_id = segment_ids.GetValue(i)
+            np.equal(rows, int(segment_id.rsplit("_", 1)[1]), out=mask, casting="unsafe")
+            slab.Modified()
+            slicer.vtkSlicerSegmentationsModuleLogic.SetBinaryLabelmapToSegment(
+                slab, segmentationNode, segment_id, slicer.vtkSlicerSegmentationsModuleLogic.MODE_REPLACE, slab.GetExtent())
+        return segmentationNode
+
+    def save_segmentation(self, array, header, segments, segmentation_path, segmentation_format, prediction_path,
+                          background=True):
+        """
+        Writes a segmentation file from the label map of a prediction, by default in a background thread so that
+        the import is not delayed by the disk. The export time and the file size are printed, and the prediction
+        is deleted afterwards.
+
+        Args:
+            array (np.ndarray): Label map of the prediction (mapped if handed over in memory).
+            header (dict): Its geometry in LPS (volume header of a prediction handed over in memory).
+            segments (list): Segments of the segmentation node ("id", "name", "label", "color").
+            segmentation_path (str): Path of the segmentation file.
+            segmentation_format (str): Format of the file (see segio.SEGMENTATION_FORMATS).
+            prediction_path (str): Volume header or .nrrd file of the prediction.
+            background (bool): Writes the file in a background thread instead of before returning.
+        Returns:
+            dict: Result of segio.write_segmentation when written before returning, otherwise the started
+                threading.Thread, done once the prediction is deleted.
+        Raises:
+            Exception: Any error writing the file, when written before returning.
+        """
+        from LungSegmentationLib import segio
+
+        paths = [prediction_path]
+        if volumeio.is_volume_header(prediction_path):
+            paths.append(os.path.join(os.path.dirname(prediction_path), header["data"]))
+
+        def save():
+            nonlocal array
+            try:
+                result = segio.write_segmentation(segmentation_path, array, header, segments, segmentation_format)
+                print(f"Segmentation saved to {segmentation_path} ({segmentation_format}): "
+                      f"{result['bytes'] / 1024 ** 2:.1f} MB in {result['seconds']:.2f} s")
+                return result
+            except Exception as e:
+                if not background:
+                    raise
+                print(f"Error saving the segmentation {segmentation_path}: {e}")
+            finally:
+                # The mapping must be released before the raw file is removed (Windows)
+                array = None
+                for path in paths:
+                    if os.path.exists(path):
+                        os.remove(path)
+
+        if background:
+            thread = threading.Thread(target=save, daemon=True)
+            thread.start()
+            return thread
+        return save()
@@ -0,0 +1,3 @@
+"""
+Helpers of the LungSegmentation module that do not depend on the Slicer GUI.
+"""
@@ -0,0 +1,207 @@
+"""
+Dependency checks of the module.
+
+Opening the module only checks locally, with importlib.metadata, that the required packages are installed;
+pip is run only if one of them is missing. Upgrades are done on request ("Check for updates"), and a
+background check against PyPI, limited to one every UPDATE_CHECK_INTERVAL seconds and with a short
+network timeout, reports the available updates. The installed versions and the date of the last update
+check are kept in a small JSON manifest, with a fingerprint of the site-packages folders: as long as
+installing or removing a package did not change it, the versions of the manifest are used without
+querying importlib.metadata.
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+
+REQUIRED_PACKAGES = [
+    "python-gdcm==3.0.21",
+    "nnUNet_package",
+    "dicom2nifti",
+]
+BUILD_PACKAGES = ["setuptools", "wheel", "scikit-build"]
+
+UPDATE_CHECK_INTERVAL = 7 * 24 * 3600
+PYPI_TIMEOUT = 3.0
+PYPI_URL = "https://pypi.org/pypi/{name}/json"
+
+
+def split_requirement(requirement):
+    """
+    Returns:
+        tuple: (package name, pinned version or None) of a "name" or "name==version" requirement.
+    """
+    name, _, pinned = requirement.partition("==")
+    return name.strip(), pinned.strip() or None
+
+
+def installed_versions(requirements=REQUIRED_PACKAGES):
+    """
+    Returns:
+        dict: Package name -> installed version, or None if the package is not installed.
+    """
+    from importlib.metadata import version, PackageNotFoundError
+
+    versions = {}
+    for requirement in requirements:
+        name, _ = split_requirement(requirement)
+        try:
+            versions[name] = version(name)
+        except PackageNotFoundError:
+            versions[name] = None
+    return versions
+
+
+def unsatisfied_requirements(versions, requirements=REQUIRED_PACKAGES):
+    """
+    Args:
+        versions (dict): Result of installed_versions.
+        requirements (list): Requirements to check.
+    Returns:
+        list: Requirements that are missing or installed with another version than the pinned one.
+    """
+    unsatisfied = []
+    for requirement in requirements:
+        name, pinned = split_requirement(requirement)
+        installed = versions.get(name)
+        if installed is None or (pinned is not None and installed != pinned):
+            unsatisfied.append(requirement)
+    return unsatisfied
+
+
+def environment_fingerprint(paths=None):
+    """
+    Fingerprint of the folders packages are installed in. pip creates or removes a dist-info folder in
+    site-packages for every install, upgrade or removal, which changes the modification time of the folder.
+
+    Args:
+        paths (list): Import paths, sys.path if None.
+    Returns:
+        str: Digest of the site-packages folders and their modification times.
+    """
+    digest = hashlib.sha1(sys.version.encode("utf-8"))
+    for path in sys.path if paths is None else paths:
+        if os.path.basename(path) not in ("site-packages", "dist-packages"):
+            continue
+        try:
+            digest.update(f"{path}:{os.stat(path).st_mtime_ns}".encode("utf-8"))
+        except OSError:
+            pass
+    return digest.hexdigest()
+
+
+class DependencyManifest:
+    """
+    JSON file with the last verified package versions, the last update check and its result.
+    """
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Path of the manifest, loaded if it exists.
+        Returns:
+            None
+        """
+        self.path = path
+        self.data = {"versions": {}, "environment": None, "last_update_check": 0, "available_updates": {}}
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    self.data.update(json.load(f))
+            except (OSError, ValueError):
+                pass
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f, indent=4)
+        os.replace(tmp_path, self.path)
+
+    def update_check_due(self, interval=UPDATE_CHECK_INTERVAL):
+        """
+        Returns:
+            bool: True if the last update check is older than the interval.
+        """
+        return time.time() - self.data.get("last_update_check", 0) >= interval
+
+
+def check_dependencies(manifest, paths=None):
+    """
+    Fast local check of the required packages, without network access. The versions of the manifest are
+    used if they satisfy the requirements and the site-packages folders did not change since they were
+    verified; otherwise the installed versions are read with importlib.metadata and recorded.
+
+    Args:
+        manifest (DependencyManifest): Manifest updated with the installed versions.
+        paths (list): Import paths of the fingerprint, sys.path if None.
+    Returns:
+        dict: "unsatisfied" requirements, "changed" (versions differ from the manifest), "cached" (the manifest
+            was used) and "seconds" spent.
+    """
+    start = time.perf_counter()
+    fingerprint = environment_fingerprint(paths)
+    cached = manifest.data.get("versions") or {}
+    if cached and manifest.data.get("environment") == fingerprint and not unsatisfied_requirements(cached):
+        return {"unsatisfied": [], "changed": False, "cached": True, "seconds": time.perf_counter() - start}
+
+    versions = installed_versions()
+    changed = versions != cached
+    if changed or manifest.data.get("environment") != fingerprint:
+        manifest.data["versions"] = versions
+        manifest.data["environment"] = fingerprint
+        manifest.save()
+    return {
+        "unsatisfied": unsatisfied_requirements(versions),
+        "changed": changed,
+        "cached": False,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def latest_versions(requirements=REQUIRED_PACKAGES, timeout=PYPI_TIMEOUT):
+    """
+    Queries PyPI for the latest version of the unpinned packages.
+
+    Args:
+        requirements (list): Requirements to check; pinned ones are skipped.
+        timeout (float): Network timeout in seconds per package.
+    Returns:
+        dict: Package name -> latest version. Packages that could not be queried are omitted.
+    """
+    import urllib.request
+
+    latest = {}
+    for requirement in requirements:
+        name, pinned = split_requirement(requirement)
+        if pinned is not None:
+            continue
+        try:
+            with urllib.request.urlopen(PYPI_URL.format(name=name), timeout=timeout) as response:
+                latest[name] = json.load(response)["info"]["version"]
+        except Exception:
+            pass
+    return latest
+
+
+def find_updates(manifest, timeout=PYPI_TIMEOUT):
+    """
+    Compares the installed versions with PyPI and records the check in the manifest.
+    Safe to call offline: unreachable packages are simply not reported.
+
+    Args:
+        manifest (DependencyManifest): Manifest to update.
+        timeout (float): Network timeout in seconds per package.
+    Returns:
+        dict: Package name -> (installed version, latest version) for the packages with an update.
+    """
+    versions = installed_versions()
+    updates = {
+        name: (versions.get(name), latest)
+        for name, latest in latest_versions(timeout=timeout).items()
+        if versions.get(name) != latest
+    }
+    manifest.data["last_update_check"] = time.time()
+    manifest.data["available_updates"] = updates
+    manifest.save()
+    return updates
@@ -0,0 +1,302 @@
+"""
+DICOM series loading for the segmentation input.
+
+The files of a folder are grouped by SeriesInstanceUID and sorted along the slice normal, the slices
+are decoded in parallel (pydicom, with the python-gdcm handler for compressed transfer syntaxes) and
+the volume is written as an uncompressed NRRD. pydicom is installed with dicom2nifti, which decodes
+through it as well; dicom2nifti itself is not used, since it converts a whole series on one thread and
+reorients it to a NIfTI file instead of returning the slices. Converted series are kept in a DiskCache keyed by the
+series UID and the size/mtime of its files, so that segmenting the same series again skips the conversion.
+"""
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from LungSegmentationLib.diskcache import DiskCache
+from LungSegmentationLib import volumeio
+
+CONVERTED_FILE_NAME = "volume.nrrd"
+DICOM_EXTENSIONS = (".dcm", ".ima")
+# DICOM Part 10 files start with a 128-byte preamble followed by this prefix
+DICOM_PREFIX_OFFSET = 128
+DICOM_PREFIX = b"DICM"
+DICOMDIR_FILE_NAME = "DICOMDIR"
+
+
+def default_workers():
+    """
+    Returns:
+        int: Number of threads used to read the DICOM files.
+    """
+    return min(8, os.cpu_count() or 1)
+
+
+def is_dicom_file(path):
+    """
+    Returns:
+        bool: True if the file has the DICOM Part 10 prefix, or a .dcm/.ima extension (files without preamble).
+            DICOMDIR index files are not counted.
+    """
+    if os.path.basename(path).upper() == DICOMDIR_FILE_NAME:
+        return False
+    if path.lower().endswith(DICOM_EXTENSIONS):
+        return True
+    try:
+        with open(path, "rb") as f:
+            f.seek(DICOM_PREFIX_OFFSET)
+            return f.read(len(DICOM_PREFIX)) == DICOM_PREFIX
+    except OSError:
+        return False
+
+
+def contains_dicom(directory):
+    """
+    Returns:
+        bool: True if a file of the folder (not recursively) is a DICOM file.
+    """
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return False
+    return any(os.path.isfile(os.path.join(directory, name)) and is_dicom_file(os.path.join(directory, name))
+               for name in names if not name.startswith("."))
+
+
+def _read_slice_header(path):
+    """
+    Reads the header of a DICOM file.
+
+    Returns:
+        dict: Series UID and geometry of the slice, or None if the file is not a DICOM image.
+    """
+    import pydicom
+    from pydicom.errors import InvalidDicomError
+
+    try:
+        ds = pydicom.dcmread(path, stop_before_pixels=True)
+    except (InvalidDicomError, OSError):
+        return None
+    if "ImagePositionPatient" not in ds or "ImageOrientationPatient" not in ds or "PixelSpacing" not in ds:
+        return None
+
+    stat = os.stat(path)
+    return {
+        "path": path,
+        "series_uid": str(ds.get("SeriesInstanceUID", "")),
+        "position": [float(v) for v in ds.ImagePositionPatient],
+        "orientation": [float(v) for v in ds.ImageOrientationPatient],
+        "pixel_spacing": [float(v) for v in ds.PixelSpacing],
+        "slice_thickness": float(ds.get("SliceThickness", 0) or 0),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def scan_series(directory, max_workers=None):
+    """
+    Reads the headers of all the files of a folder (not recursively) and groups the DICOM images by series.
+
+    Args:
+        directory (str): Folder to scan.
+        max_workers (int): Number of reading threads.
+    Returns:
+        dict: Series UID -> list of slice headers sorted along the slice normal.
+    """
+    paths = [os.path.join(directory, f) for f in sorted(os.listdir(directory))
+             if os.path.isfile(os.path.join(directory, f))]
+
+    with ThreadPoolExecutor(max_workers=max_workers or default_workers()) as pool:
+        headers = [h for h in pool.map(_read_slice_header, paths) if h is not None]
+
+    series = {}
+    for header in headers:
+        series.setdefault(header["series_uid"], []).append(header)
+
+    for slices in series.values():
+        normal = _slice_normal(slices[0]["orientation"])
+        slices.sort(key=lambda h: sum(p * n for p, n in zip(h["position"], normal)))
+    return series
+
+
+def _slice_normal(orientation):
+    row, col = orientation[:3], orientation[3:]
+    return [
+        row[1] * col[2] - row[2] * col[1],
+        row[2] * col[0] - row[0] * col[2],
+        row[0] * col[1] - row[1] * col[0],
+    ]
+
+
+def series_key(series_uid, slices):
+    """
+    Returns:
+        str: Cache key of a series, which changes if any of its files is replaced or modified.
+    """
+    digest = hashlib.sha1(series_uid.encode("utf-8"))
+    for header in slices:
+        digest.update(f"{os.path.basename(header['path'])}:{header['size']}:{header['mtime_ns']}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def series_geometry(slices):
+    """
+    Computes the LPS geometry of a sorted series.
+
+    Args:
+        slices (list): Sorted slice headers.
+    Returns:
+        dict: "spacing", "origin" and "direction" as expected by volumeio.
+    """
+    orientation = slices[0]["orientation"]
+    row, col = orientation[:3], orientation[3:]
+    normal = _slice_normal(orientation)
+
+    if len(slices) > 1:
+        distances = sorted(
+            abs(sum((b - a) * n for a, b, n in zip(s0["position"], s1["position"], normal)))
+            for s0, s1 in zip(slices[:-1], slices[1:])
+        )
+        slice_spacing = distances[len(distances) // 2]
+    else:
+        slice_spacing = slices[0]["slice_thickness"] or 1.0
+
+    # PixelSpacing is (spacing between rows, spacing between columns) = (y, x)
+    row_spacing, column_spacing = slices[0]["pixel_spacing"]
+    return {
+        "spacing": [column_spacing, row_spacing, slice_spacing],
+        "origin": list(slices[0]["position"]),
+        "direction": [row[0], col[0], normal[0], row[1], col[1], normal[1], row[2], col[2], normal[2]],
+    }
+
+
+def _decode_slice(path):
+    """
+    Decodes the pixels of a slice and applies the rescale slope/intercept.
+    """
+    import pydicom
+
+    ds = pydicom.dcmread(path)
+    pixels = ds.pixel_array
+    slope = float(ds.get("RescaleSlope", 1) or 1)
+    intercept = float(ds.get("RescaleIntercept", 0) or 0)
+    return pixels, slope, intercept
+
+
+def rescaled_dtype(decoded):
+    """
+    Chooses the voxel type of a series from its rescaled values: int16 if they are integers that fit in it
+    (e.g. CT in HU), int32 for larger integers (e.g. unsigned 16-bit micro-CT above 32767), float32 otherwise.
+
+    Args:
+        decoded (list): (pixels, slope, intercept) of every slice.
+    Returns:
+        np.dtype: The voxel type.
+    """
+    import numpy as np
+
+    if not all(slope == 1 and float(intercept).is_integer() for _, slope, intercept in decoded):
+        return np.dtype(np.float32)
+    low = min(int(pixels.min()) + int(intercept) for pixels, _, intercept in decoded)
+    high = max(int(pixels.max()) + int(intercept) for pixels, _, intercept in decoded)
+    for dtype in (np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return np.dtype(dtype)
+    return np.dtype(np.float32)
+
+
+def load_series(slices, max_workers=None):
+    """
+    Decodes the slices of a series in parallel and stacks them.
+
+    Args:
+        slices (list): Sorted slice headers.
+        max_workers (int): Number of decoding threads.
+    Returns:
+        np.ndarray: Volume in (z, y, x) order, of the type given by rescaled_dtype.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers or default_workers()) as pool:
+        decoded = list(pool.map(_decode_slice, [h["path"] for h in slices]))
+    return stack_slices(decoded)
+
+
+def stack_slices(decoded):
+    """
+    Applies the rescale slope/intercept of decoded slices and stacks them.
+
+    Args:
+        decoded (list): (pixels, slope, intercept) of every slice.
+    Returns:
+        np.ndarray: Volume in (z, y, x) order, of the type given by rescaled_dtype.
+    """
+    import numpy as np
+
+    dtype = rescaled_dtype(decoded)
+    volume = np.empty((len(decoded), *decoded[0][0].shape), dtype=dtype)
+    for z, (pixels, slope, intercept) in enumerate(decoded):
+        if dtype.kind == "i":
+            volume[z] = pixels.astype(np.int64) + int(intercept)
+        else:
+            volume[z] = pixels * slope + intercept
+    return volume
+
+
+class DicomSeriesConverter:
+    """
+    Converts DICOM series to NRRD through a size-bounded LRU cache.
+    """
+    def __init__(self, cache_dir, max_bytes, max_workers=None):
+        """
+        Args:
+            cache_dir (str): Folder of the cache.
+            max_bytes (int): Disk budget of the cache in bytes.
+            max_workers (int): Number of reading/decoding threads.
+        Returns:
+            None
+        """
+        self.cache = DiskCache(cache_dir, max_bytes)
+        self.max_workers = max_workers
+
+    def convert(self, directory, series_uid=None, pin=False):
+        """
+        Returns the NRRD of a series of a folder, converting it only if it is not already cached.
+
+        Args:
+            directory (str): DICOM folder.
+            series_uid (str): Series to convert. By default, the series with the most slices.
+            pin (bool): Keeps the converted series out of the eviction until release is called
+                (e.g. while a job uses it).
+        Returns:
+            str: Path to the converted .nrrd.
+        Raises:
+            RuntimeError: If the folder contains no DICOM image or not the requested series.
+        """
+        series = scan_series(directory, self.max_workers)
+        if not series:
+            raise RuntimeError("No DICOM file found in the folder.")
+
+        if series_uid is None:
+            series_uid = max(series, key=lambda uid: len(series[uid]))
+            if len(series) > 1:
+                print(f"{len(series)} DICOM series found, using {series_uid} ({len(series[series_uid])} slices)")
+        elif series_uid not in series:
+            raise RuntimeError(f"DICOM series {series_uid} not found in the folder.")
+
+        slices = series[series_uid]
+
+        def write_entry(entry_dir):
+            volume = load_series(slices, self.max_workers)
+            volumeio.write_nrrd(os.path.join(entry_dir, CONVERTED_FILE_NAME), volume, series_geometry(slices))
+
+        entry_dir, hit = self.cache.get_or_create(series_key(series_uid, slices), write_entry, pin)
+        print(f"DICOM series {'found in the cache' if hit else 'converted'}: {entry_dir}")
+        return os.path.join(entry_dir, CONVERTED_FILE_NAME)
+
+    def release(self, converted_path):
+        """
+        Releases a converted series pinned by convert.
+
+        Returns:
+            bool: True if the converted series belonged to this cache and was pinned.
+        """
+        return self.cache.release(converted_path)
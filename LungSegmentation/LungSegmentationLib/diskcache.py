@@ -0,0 +1,237 @@
+"""
+Size-bounded LRU cache of files on disk.
+
+Every entry is a folder named after its key. An index.json file in the cache folder records the size
+and the last access time of every entry; when the total size exceeds the budget, the least recently
+used entries are deleted. Entries in use (e.g. the input of a queued or running job) are pinned and never
+evicted until they are released; the pins are kept in memory by the process that owns the cache.
+"""
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+
+INDEX_FILE_NAME = "index.json"
+
+
+def folder_size(path):
+    """
+    Returns:
+        int: Total size in bytes of the files in a folder.
+    """
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class DiskCache:
+    """
+    LRU cache of folders with a disk budget. Keys must be valid folder names (e.g. hex digests).
+    """
+    def __init__(self, directory, max_bytes):
+        """
+        Args:
+            directory (str): Folder of the cache, created if needed.
+            max_bytes (int): Disk budget in bytes.
+        Returns:
+            None
+        """
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self._pins = {}                     # Key -> number of users of the entry, not evicted while > 0
+        self._lock = threading.RLock()
+
+        os.makedirs(directory, exist_ok=True)
+        self._index_path = os.path.join(directory, INDEX_FILE_NAME)
+        self._index = self._load_index()
+
+    def _load_index(self):
+        """
+        Loads the index and drops the entries whose folder no longer exists.
+        """
+        index = {}
+        if os.path.exists(self._index_path):
+            try:
+                with open(self._index_path, "r") as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                index = {}
+        return {key: entry for key, entry in index.items() if os.path.isdir(os.path.join(self.directory, key))}
+
+    def _save_index(self):
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._index, f, indent=4)
+        os.replace(tmp_path, self._index_path)
+
+    def entry_path(self, key):
+        """
+        Returns:
+            str: Folder of an entry (it may not exist).
+        """
+        return os.path.join(self.directory, key)
+
+    def lookup(self, key, pin=False):
+        """
+        Returns the folder of an entry and marks it as recently used.
+
+        Args:
+            key (str): Key of the entry.
+            pin (bool): Pins the entry until release is called.
+        Returns:
+            str: Folder of the entry, or None on a cache miss.
+        """
+        with self._lock:
+            path = self.entry_path(key)
+            if key not in self._index or not os.path.isdir(path):
+                self._index.pop(key, None)
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._index[key]["last_access"] = time.time()
+            if pin:
+                self._pins[key] = self._pins.get(key, 0) + 1
+            self._save_index()
+            return path
+
+    def store(self, key, write_entry, pin=False):
+        """
+        Creates an entry. The files are written to a temporary folder first, so that a failed or
+        concurrent write never leaves a partial entry. If the entry was created meanwhile (e.g. by a
+        concurrent job), the existing one is kept, since it may already be in use.
+
+        Args:
+            key (str): Key of the entry.
+            write_entry (callable): Function called with the folder to fill.
+            pin (bool): Pins the entry until release is called.
+        Returns:
+            str: Folder of the entry.
+        """
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self.directory)
+        try:
+            write_entry(tmp_dir)
+            size = folder_size(tmp_dir)
+            with self._lock:
+                path = self.entry_path(key)
+                if key in self._index and os.path.isdir(path):
+                    self._index[key]["last_access"] = time.time()
+                else:
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    os.replace(tmp_dir, path)
+                    self._index[key] = {"size": size, "created": time.time(), "last_access": time.time()}
+                if pin:
+                    self._pins[key] = self._pins.get(key, 0) + 1
+                self._evict(keep=key)
+                self._save_index()
+            return path
+        finally:
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def get_or_create(self, key, write_entry, pin=False):
+        """
+        Returns the folder of an entry, creating it with write_entry on a cache miss.
+
+        Args:
+            key (str): Key of the entry.
+            write_entry (callable): Function called with the folder to fill.
+            pin (bool): Pins the entry until release is called.
+        Returns:
+            tuple: (folder of the entry, True on a cache hit).
+        """
+        path = self.lookup(key, pin)
+        if path is not None:
+            return path, True
+        return self.store(key, write_entry, pin), False
+
+    def key_of(self, path):
+        """
+        Returns:
+            str: Key of the entry containing a path, None if the path is not in the cache.
+        """
+        relative = os.path.relpath(os.path.abspath(path), os.path.abspath(self.directory))
+        if relative == os.curdir or relative.startswith(os.pardir):
+            return None
+        return relative.split(os.sep)[0]
+
+    def release(self, path_or_key):
+        """
+        Releases a pin taken by lookup, store or get_or_create. The entry can be evicted again once all
+        its pins are released.
+
+        Args:
+            path_or_key (str): Key of the entry, or a path inside it.
+        Returns:
+            bool: True if a pin of the entry was released.
+        """
+        with self._lock:
+            key = path_or_key if path_or_key in self._pins else self.key_of(path_or_key)
+            if key not in self._pins:
+                return False
+            self._pins[key] -= 1
+            if self._pins[key] <= 0:
+                del self._pins[key]
+                self._evict()
+                self._save_index()
+            return True
+
+    def is_pinned(self, key):
+        """
+        Returns:
+            bool: True if the entry is in use.
+        """
+        with self._lock:
+            return key in self._pins
+
+    def remove(self, key):
+        """
+        Deletes an entry, even if it is pinned.
+
+        Args:
+            key (str): Key of the entry.
+        Returns:
+            None
+        """
+        with self._lock:
+            self._index.pop(key, None)
+            shutil.rmtree(self.entry_path(key), ignore_errors=True)
+            self._save_index()
+
+    def _evict(self, keep=None):
+        """
+        Deletes the least recently used entries until the cache fits in its budget.
+        The entry given in keep and the pinned entries are never deleted, even if they exceed the budget.
+        """
+        total = sum(entry["size"] for entry in self._index.values())
+        for key in sorted(self._index, key=lambda k: self._index[k]["last_access"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep or key in self._pins:
+                continue
+            total -= self._index.pop(key)["size"]
+            shutil.rmtree(self.entry_path(key), ignore_errors=True)
+
+    def stats(self):
+        """
+        Returns:
+            dict: Number of entries, pinned entries, bytes used, budget and hit/miss counts.
+        """
+        with self._lock:
+            return {
+                "entries": len(self._index),
+                "pinned": len(self._pins),
+                "bytes": sum(entry["size"] for entry in self._index.values()),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,109 @@
+"""
+Cache of the converted segmentation inputs (.mha, .nii, .nii.gz...).
+
+Every input is converted once into an entry of a DiskCache, keyed either by its path, size and
+modification time (fast key) or by a hash of its content. Re-segmenting the same scan, for example
+with another structure, reuses the converted volume, and concurrent jobs never share a converted file.
+"""
+import os
+import hashlib
+
+from LungSegmentationLib.diskcache import DiskCache
+
+KEY_MODES = ("fast", "content")
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def fast_key(path):
+    """
+    Returns:
+        str: Key built from the absolute path, the size and the modification time of a file.
+    """
+    stat = os.stat(path)
+    return hashlib.sha1(f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8")).hexdigest()
+
+
+def content_key(path):
+    """
+    Returns:
+        str: SHA-1 of the content of a file.
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ConvertedInputCache:
+    """
+    Converted inputs stored in a size-bounded LRU DiskCache.
+    """
+    def __init__(self, cache_dir, max_bytes, key_mode="fast"):
+        """
+        Args:
+            cache_dir (str): Folder of the cache.
+            max_bytes (int): Disk budget in bytes.
+            key_mode (str): "fast" (path + size + mtime) or "content" (hash of the file).
+        Returns:
+            None
+        """
+        if key_mode not in KEY_MODES:
+            raise ValueError(f"Unknown cache key mode: {key_mode}. Use one of {KEY_MODES}.")
+        self.cache = DiskCache(cache_dir, max_bytes)
+        self.key_mode = key_mode
+
+    def key(self, path):
+        """
+        Returns:
+            str: Cache key of an input file.
+        """
+        return content_key(path) if self.key_mode == "content" else fast_key(path)
+
+    def get_or_convert(self, path, convert, pin=False):
+        """
+        Returns the converted version of an input, converting it on a cache miss.
+
+        Args:
+            path (str): Input file.
+            convert (callable): Function called with the entry folder on a cache miss; it writes the
+                converted input there and returns its file name.
+            pin (bool): Keeps the converted input out of the eviction until release is called
+                (e.g. while a job uses it).
+        Returns:
+            str: Path of the converted input.
+        """
+        converted = {}
+
+        def write_entry(entry_dir):
+            name = convert(entry_dir)
+            with open(os.path.join(entry_dir, "converted_name"), "w") as f:
+                f.write(name)
+            converted["name"] = name
+
+        entry_dir, hit = self.cache.get_or_create(self.key(path), write_entry, pin)
+        if hit:
+            with open(os.path.join(entry_dir, "converted_name"), "r") as f:
+                converted["name"] = f.read().strip()
+
+        stats = self.cache.stats()
+        print(f"Converted input cache {'hit' if hit else 'miss'} for {os.path.basename(path)} "
+              f"(hits: {stats['hits']}, misses: {stats['misses']}, "
+              f"{stats['bytes'] / 1024 ** 2:.0f} / {stats['max_bytes'] / 1024 ** 2:.0f} MB)")
+        return os.path.join(entry_dir, converted["name"])
+
+    def release(self, converted_path):
+        """
+        Releases a converted input pinned by get_or_convert.
+
+        Returns:
+            bool: True if the converted input belonged to this cache and was pinned.
+        """
+        return self.cache.release(converted_path)
+
+    def stats(self):
+        """
+        Returns:
+            dict: Statistics of the underlying DiskCache.
+        """
+        return self.cache.stats()
@@ -0,0 +1,101 @@
+"""
+Installation of the dependencies with pip inside Slicer.
+
+Only loaded when a dependency is missing or when the user asks for updates, so that
+opening the module does not pay for it. pip_install runs pip in a subprocess and does not touch
+the GUI, so that upgrades can run in a background thread; restart_if_changed is called on the GUI thread.
+"""
+import sys
+import shutil
+import importlib
+import subprocess
+
+import slicer
+
+from LungSegmentationLib.dependencies import BUILD_PACKAGES, environment_fingerprint, installed_versions
+
+
+def python_executable():
+    """
+    Returns:
+        str: Python interpreter of Slicer (PythonSlicer), used to run pip.
+    """
+    return shutil.which("PythonSlicer") or sys.executable
+
+
+def pip_install(packages_to_install, manifest, upgrade=False):
+    """
+    Installs packages with pip in a subprocess. Safe to call from a background thread.
+
+    Args:
+        packages_to_install (list): Requirements to install.
+        manifest (DependencyManifest): Manifest updated with the new versions.
+        upgrade (bool): Upgrades the packages (and the build tools) to their latest version.
+    Returns:
+        dict: Package name -> (version before, version after) for the packages installed or updated.
+    Raises:
+        RuntimeError: If pip fails.
+    """
+    # Check current versions before installation to determine if a restart will be needed afterward
+    versions_before = installed_versions(packages_to_install)
+
+    commands = [["-q", "--upgrade"] + BUILD_PACKAGES, ["-q", "--upgrade"] + packages_to_install] if upgrade \
+        else [["-q"] + packages_to_install]
+    for arguments in commands:
+        result = subprocess.run([python_executable(), "-m", "pip", "install"] + arguments,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(result.stdout.strip() or f"pip exited with code {result.returncode}")
+
+    importlib.invalidate_caches()
+
+    # Verify the actual changes
+    versions_after = installed_versions(packages_to_install)
+    changed = {}
+    for name, version_after in versions_after.items():
+        if version_after is None or versions_before.get(name) != version_after:
+            changed[name] = (versions_before.get(name), version_after)
+            print(f"-> {name} updated : {versions_before.get(name)} -> {version_after}")
+
+    manifest.data["versions"] = installed_versions()
+    manifest.data["environment"] = environment_fingerprint()
+    manifest.save()
+    return changed
+
+
+def restart_if_changed(changed):
+    """
+    Prompts the user to restart Slicer if pip installed or updated a package. Called on the GUI thread.
+
+    Args:
+        changed (dict): Result of pip_install.
+    Returns:
+        None
+    """
+    if changed:
+        msg = "All dependencies have been installed or updated. \n Please restart 3D Slicer to apply the changes."
+        print(msg)
+        slicer.util.messageBox(msg)
+        slicer.util.mainWindow().close()
+        sys.exit(0)
+    else:
+        print("Everything is up to date. No restart needed.")
+
+
+def install_and_restart_if_changed(packages_to_install, manifest, upgrade=False):
+    """
+    Installs packages with pip and prompts the user to restart Slicer if any version changed.
+
+    Args:
+        packages_to_install (list): Requirements to install.
+        manifest (DependencyManifest): Manifest updated with the new versions.
+        upgrade (bool): Upgrades the packages (and the build tools) to their latest version.
+    Returns:
+        None
+    """
+    try:
+        changed = pip_install(packages_to_install, manifest, upgrade)
+    except Exception as e:
+        slicer.util.errorDisplay(f"Erreur lors de l'installation : {str(e)}")
+        return
+    restart_if_changed(changed)
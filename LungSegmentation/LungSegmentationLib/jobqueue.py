@@ -0,0 +1,380 @@
+"""
+Queue of segmentation jobs.
+
+Every job has its own working directory (converted input, raw prediction, context file), so that
+several segmentations can be queued or run at the same time without sharing any state. Jobs are
+started in submission order, at most max_concurrent at a time; each running job uses its own
+inference worker (see workerclient.RunnerWorkerPool). A running job is cancelled through the abort
+function set by its runner, at once or as soon as the runner sets it.
+
+With a memory budget, a job starts only if its estimated peak memory (see memory.py) fits next to the
+running jobs, and a job that would not fit even alone is refused. A running job may use its estimate
+plus MEMORY_LIMIT_MARGIN (within the free budget), which leaves room for the next jobs.
+"""
+import os
+import time
+import itertools
+import threading
+from collections import deque
+
+from LungSegmentationLib.memory import available_memory_bytes
+
+# Memory taken by a running job (inference worker with torch, a loaded model and the volumes), used to
+# choose the default number of concurrent jobs
+JOB_MEMORY_BYTES = 6 * 1024 ** 3
+# CPU cores given to each running job
+JOB_CPU_CORES = 4
+# Share of its estimated memory a running job may use beyond the estimate before it is stopped
+MEMORY_LIMIT_MARGIN = 0.25
+
+
+def default_max_concurrent_jobs():
+    """
+    Number of jobs that can run at the same time on this machine, from its CPU cores and available memory.
+
+    Returns:
+        int: Number of concurrent jobs, at least 1.
+    """
+    limit = max(1, (os.cpu_count() or 1) // JOB_CPU_CORES)
+    memory = available_memory_bytes()
+    if memory is not None:
+        limit = min(limit, max(1, memory // JOB_MEMORY_BYTES))
+    return int(limit)
+
+
+class SegmentationJob:
+    """
+    One segmentation: its parameters, working directory and state.
+    """
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    _ids = itertools.count(1)
+
+    def __init__(self, animal, mode, structure, input_path, output_dir, workdir, bypass_cache=False, label=None,
+                 preset=None, crop=True, preview=False):
+        """
+        Args:
+            animal (str): Animal to segment.
+            mode (str): Segmentation mode.
+            structure (str or list): Structure to segment, or several structures predicted in one pass.
+            input_path (str): Input of the runner (.nrrd or volume header).
+            output_dir (str): Folder receiving the final segmentation.
+            workdir (str): Working directory of the job, created if needed.
+            bypass_cache (bool): Runs the model even if the prediction is cached.
+            label (str): Short description of the input shown in the queue view.
+            preset (str): Speed preset of the inference (see presets.py), the default preset if None.
+            crop (bool): Runs the inference on the region of interest only (see nnunet_roi.py).
+            preview (bool): Shows a low-resolution preview before the full prediction.
+        Returns:
+            None
+        """
+        self.id = next(SegmentationJob._ids)
+        self.animal = animal
+        self.mode = mode
+        self.structures = list(structure) if isinstance(structure, (list, tuple)) else [structure]
+        self.structure = "+".join(self.structures)
+        self.input_path = input_path
+        self.output_dir = output_dir
+        self.workdir = workdir
+        self.bypass_cache = bypass_cache
+        self.label = label or os.path.basename(input_path)
+        self.preset = preset
+        self.crop = crop
+        self.preview = preview
+        os.makedirs(workdir, exist_ok=True)
+
+        self.converted_input = None     # Input converted for this job only, deleted after the job
+        self.cached_input = None        # Input pinned in a cache of converted inputs, released after the job
+        self.estimated_memory = None    # Estimated peak memory in bytes (see memory.estimate_job_memory)
+        self.memory_limit = None        # Memory the job may use, given when it starts
+        self.peak_memory = None         # Peak memory of the inference worker during the job
+        self.roi = None                 # Region of interest the inference ran on, None if not cropped
+        self.preview_path = None        # Low-resolution preview of the prediction
+        self.preview_node_id = None     # Segmentation node showing the preview, replaced by the final result
+        self.streamed_path = None       # Label map written slab by slab by the runner (axial mode), shown as the preview
+        self.abort = None               # Set by the runner of the job: stops the running job with a reason
+        self.cancel_requested = False   # Set by JobQueue.cancel, also before the runner set its abort function
+        self.status = SegmentationJob.PENDING
+        self.percent = 0
+        self.stage = ""
+        self.error = None
+        self.prediction_path = None
+        self.dataset_json_path = None
+        self.results = {}               # Structure -> (prediction path, dataset json path) of a multi-structure job
+        self.stage_seconds = {}         # Stage -> seconds spent in it (conversion, cache lookup, runner stages, import)
+        self.runner_details = {}        # Input shape/spacing, model, threads and memory reported by the runner
+        self.cache_hit = False          # True if the prediction(s) came from the result cache only
+        self.submitted_time = time.time()
+        self.start_time = None
+        self.end_time = None
+
+    @property
+    def context_file(self):
+        """
+        Context file of the runner, receiving the dataset json path of the model.
+        """
+        return os.path.join(self.workdir, "nnunet_context.json")
+
+    @property
+    def prediction_dir(self):
+        """
+        Output folder of the runner.
+        """
+        return os.path.join(self.workdir, "prediction")
+
+    def set_abort(self, abort):
+        """
+        Sets (or clears, with None) the abort function of the running job. If the job was cancelled before
+        its runner could be stopped, the function is called at once.
+
+        Args:
+            abort (callable): Stops the running job with a reason, or None.
+        Returns:
+            None
+        """
+        self.abort = abort
+        if abort is not None and self.cancel_requested:
+            abort("The job was cancelled.")
+
+    def is_multi_structure(self):
+        return len(self.structures) > 1
+
+    def structure_dir(self, structure):
+        """
+        Output folder of the runner for one structure of a multi-structure job.
+        """
+        return os.path.join(self.prediction_dir, structure)
+
+    def is_finished(self):
+        return self.status in (SegmentationJob.DONE, SegmentationJob.FAILED, SegmentationJob.CANCELLED)
+
+    def elapsed(self):
+        """
+        Returns:
+            float: Running time of the job in seconds, 0 if it has not started.
+        """
+        if self.start_time is None:
+            return 0.0
+        return (self.end_time or time.time()) - self.start_time
+
+
+class JobQueue:
+    """
+    Runs the submitted jobs in order, at most max_concurrent at a time, each in its own thread.
+    """
+    def __init__(self, run_job, max_concurrent=1, on_change=None, memory_budget=None):
+        """
+        Args:
+            run_job (callable): Runs a job (called with the job in a background thread); raises on failure.
+            max_concurrent (int): Maximum number of running jobs.
+            on_change (callable): Called with a job every time its state changes, from any thread.
+            memory_budget (int): Memory in bytes shared by the running jobs, None for no limit.
+        Returns:
+            None
+        """
+        self.run_job = run_job
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.on_change = on_change
+        self.memory_budget = memory_budget
+        self._jobs = []
+        self._pending = deque()
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def submit(self, job):
+        """
+        Adds a job to the queue and starts it if a slot is free.
+        The job is refused (failed) if its estimated memory exceeds the whole memory budget.
+
+        Args:
+            job (SegmentationJob): The job.
+        Returns:
+            SegmentationJob: The job.
+        """
+        with self._lock:
+            self._jobs.append(job)
+            if self.memory_budget and job.estimated_memory and job.estimated_memory > self.memory_budget:
+                job.status = SegmentationJob.FAILED
+                job.error = (f"The job needs about {job.estimated_memory / 1024 ** 3:.1f} GB of memory, "
+                             f"more than the memory budget of {self.memory_budget / 1024 ** 3:.1f} GB.")
+                job.end_time = time.time()
+            else:
+                self._pending.append(job)
+        self.notify(job)
+        self._dispatch()
+        return job
+
+    def set_max_concurrent(self, max_concurrent):
+        """
+        Changes the number of concurrent jobs. Running jobs are never interrupted.
+        """
+        with self._lock:
+            self.max_concurrent = max(1, int(max_concurrent))
+        self._dispatch()
+
+    def set_memory_budget(self, memory_budget):
+        """
+        Changes the memory budget. It applies to the jobs that have not started yet.
+        """
+        with self._lock:
+            self.memory_budget = memory_budget
+        self._dispatch()
+
+    def reserved_memory(self):
+        """
+        Returns:
+            int: Estimated memory of the running jobs in bytes.
+        """
+        with self._lock:
+            return self._reserved_memory()
+
+    def _reserved_memory(self):
+        return sum(job.estimated_memory or 0 for job in self._jobs if job.status == SegmentationJob.RUNNING)
+
+    def cancel(self, job_id):
+        """
+        Cancels a pending job, or stops a running job through its abort function. A running job whose
+        runner has not set its abort function yet is stopped when it does (see SegmentationJob.set_abort).
+
+        Args:
+            job_id (int): Id of the job.
+        Returns:
+            bool: True if the job is cancelled (a running job is marked cancelled when its thread ends).
+        """
+        with self._lock:
+            job = next((j for j in self._pending if j.id == job_id), None)
+            if job is None:
+                running = next((j for j in self._jobs if j.id == job_id and j.status == SegmentationJob.RUNNING), None)
+                if running is None:
+                    return False
+                running.cancel_requested = True
+                abort = running.abort
+            else:
+                self._pending.remove(job)
+                job.status = SegmentationJob.CANCELLED
+                job.end_time = time.time()
+
+        if job is None:
+            if abort is not None:
+                abort("The job was cancelled.")
+            return True
+        self.notify(job)
+        return True
+
+    def cancel_pending(self):
+        """
+        Cancels all the pending jobs.
+
+        Returns:
+            list: The cancelled jobs.
+        """
+        with self._lock:
+            cancelled = list(self._pending)
+            self._pending.clear()
+            for job in cancelled:
+                job.status = SegmentationJob.CANCELLED
+                job.end_time = time.time()
+        for job in cancelled:
+            self.notify(job)
+        return cancelled
+
+    def clear_finished(self):
+        """
+        Forgets the finished jobs.
+        """
+        with self._lock:
+            self._jobs = [job for job in self._jobs if not job.is_finished()]
+
+    def jobs(self):
+        """
+        Returns:
+            list: The jobs of the queue, in submission order.
+        """
+        with self._lock:
+            return list(self._jobs)
+
+    def get(self, job_id):
+        """
+        Returns:
+            SegmentationJob: The job with this id, None if it is not in the queue.
+        """
+        with self._lock:
+            return next((job for job in self._jobs if job.id == job_id), None)
+
+    def counts(self):
+        """
+        Returns:
+            dict: Number of jobs per status.
+        """
+        counts = {}
+        for job in self.jobs():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return counts
+
+    def is_idle(self):
+        """
+        Returns:
+            bool: True if no job is pending or running.
+        """
+        with self._lock:
+            return not self._pending and self._running == 0
+
+    def notify(self, job):
+        if self.on_change is not None:
+            self.on_change(job)
+
+    def _dispatch(self):
+        """
+        Starts pending jobs while slots are free. The jobs start in order: a job that does not fit
+        in the memory left by the running jobs waits, and so do the jobs behind it.
+        A job is given its estimated memory plus MEMORY_LIMIT_MARGIN, or the free budget if it has no estimate.
+        """
+        started = []
+        with self._lock:
+            while self._pending and self._running < self.max_concurrent:
+                job = self._pending[0]
+                if self.memory_budget:
+                    free = self.memory_budget - self._reserved_memory()
+                    if self._running > 0 and (job.estimated_memory or 0) > free:
+                        break
+                    if job.estimated_memory:
+                        job.memory_limit = min(free, int(job.estimated_memory * (1 + MEMORY_LIMIT_MARGIN)))
+                    else:
+                        job.memory_limit = free
+                self._pending.popleft()
+                job.status = SegmentationJob.RUNNING
+                job.start_time = time.time()
+                self._running += 1
+                started.append(job)
+
+        for job in started:
+            self.notify(job)
+            threading.Thread(target=self._run, args=(job,), daemon=True).start()
+
+    def _run(self, job):
+        """
+        Runs a job in its thread and starts the next one.
+        """
+        try:
+            if job.cancel_requested:
+                raise RuntimeError("The job was cancelled.")
+            self.run_job(job)
+            job.status = SegmentationJob.DONE
+            job.percent = 100
+        except Exception as e:
+            if job.cancel_requested:
+                job.status = SegmentationJob.CANCELLED
+            else:
+                job.status = SegmentationJob.FAILED
+                job.error = str(e)
+        finally:
+            job.end_time = time.time()
+            with self._lock:
+                self._running -= 1
+
+        self.notify(job)
+        self._dispatch()
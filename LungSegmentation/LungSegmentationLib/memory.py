@@ -0,0 +1,312 @@
+"""
+Memory estimation and monitoring of the segmentation jobs.
+
+estimate_peak_memory gives a rough upper bound of the peak resident memory of an nnUNet prediction on the
+CPU, from the size of the input, the patch size of the model and its number of classes. The job queue uses
+it to defer or refuse the jobs that do not fit in the memory budget, and RSSWatchdog aborts a running job
+whose inference worker grows beyond its limit. Inference workers are reused between jobs with their cached
+models, so the growth of the worker during the job is compared with the limit, not its whole memory.
+The folds of an ensemble are counted once each: in the predictor, or in the processes of a fold-parallel
+prediction, which add their own base and logits.
+"""
+import os
+import json
+import threading
+
+GIB = 1024 ** 3
+
+# Python, torch and the network weights of one fold
+BASE_BYTES = 2 * GIB
+# Weights of every other fold of an ensemble loaded in the same predictor
+FOLD_WEIGHTS_BYTES = 256 * 1024 ** 2
+# Python, torch and the weights of its fold in a process of the fold-parallel ensemble (see nnunet_folds.py)
+FOLD_PROCESS_BASE_BYTES = GIB
+# Feature maps of the 3D U-Net for one patch voxel (forward pass on the CPU, all resolutions together)
+ACTIVATION_BYTES_PER_PATCH_VOXEL = 400
+# Used when the model is not downloaded yet
+DEFAULT_PATCH_SIZE = (128, 128, 128)
+DEFAULT_NUM_CLASSES = 4
+# Share of the physical memory given to the segmentation jobs by default
+DEFAULT_BUDGET_FRACTION = 0.75
+
+
+def total_memory_bytes():
+    """
+    Returns:
+        int: Physical memory of the machine in bytes, or None if it cannot be read.
+    """
+    try:
+        import psutil
+        return psutil.virtual_memory().total
+    except ImportError:
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def available_memory_bytes():
+    """
+    Returns:
+        int: Memory available on the machine in bytes, or None if it cannot be read.
+    """
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def default_memory_budget():
+    """
+    Returns:
+        int: Memory budget of the segmentation jobs in bytes, None if the memory of the machine is unknown.
+    """
+    total = total_memory_bytes()
+    return int(total * DEFAULT_BUDGET_FRACTION) if total else None
+
+
+def process_rss_bytes(pid):
+    """
+    Resident memory of a process and of its children (with psutil), or of the process only (/proc on Linux).
+
+    Args:
+        pid (int): Id of the process.
+    Returns:
+        int: Resident memory in bytes, or None if it cannot be read.
+    """
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+
+    if psutil is not None:
+        try:
+            process = psutil.Process(pid)
+            rss = process.memory_info().rss
+            for child in process.children(recursive=True):
+                try:
+                    rss += child.memory_info().rss
+                except psutil.Error:
+                    pass
+            return rss
+        except psutil.Error:
+            return None
+
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def read_image_grid(path):
+    """
+    Reads the shape and the spacing of a segmentation input without loading its voxels.
+
+    Args:
+        path (str): Volume header exported by the widget (.json) or .nrrd file.
+    Returns:
+        tuple: (shape, spacing), or (None, None) for other formats.
+    """
+    if path.lower().endswith(".json"):
+        with open(path, "r") as f:
+            header = json.load(f)
+        return list(header["shape"]), list(header["spacing"])
+
+    if not path.lower().endswith(".nrrd"):
+        return None, None
+
+    fields = {}
+    with open(path, "rb") as f:
+        for raw_line in f:
+            line = raw_line.decode("latin-1").strip()
+            if not line:
+                break
+            if ":" in line and not line.startswith("#"):
+                key, _, value = line.partition(":")
+                fields[key.strip().lower()] = value.lstrip("=").strip()
+
+    if "sizes" not in fields:
+        return None, None
+    shape = [int(v) for v in fields["sizes"].split()]
+    spacing = None
+    if "space directions" in fields:
+        spacing = []
+        for vector in fields["space directions"].split():
+            if vector == "none":
+                continue
+            components = [float(v) for v in vector.strip("()").split(",")]
+            spacing.append(sum(c * c for c in components) ** 0.5)
+    elif "spacings" in fields:
+        spacing = [float(v) for v in fields["spacings"].split() if v.lower() != "nan"]
+    return shape, spacing
+
+
+def read_model_parameters(model_path):
+    """
+    Reads the patch size, target spacing and number of classes of a trained model folder.
+
+    Args:
+        model_path (str): Trained model folder (Trainer__Plans__Config), or None.
+    Returns:
+        dict: "patch_size", "spacing" (None if unknown) and "num_classes", with defaults for the missing values.
+    """
+    parameters = {"patch_size": list(DEFAULT_PATCH_SIZE), "spacing": None, "num_classes": DEFAULT_NUM_CLASSES}
+    if model_path is None:
+        return parameters
+
+    configuration = os.path.basename(model_path).split("__")[-1]
+    try:
+        with open(os.path.join(model_path, "plans.json"), "r") as f:
+            plans = json.load(f)["configurations"][configuration]
+        parameters["patch_size"] = list(plans["patch_size"])
+        parameters["spacing"] = list(plans["spacing"])
+    except (OSError, ValueError, KeyError):
+        pass
+    try:
+        with open(os.path.join(model_path, "dataset.json"), "r") as f:
+            parameters["num_classes"] = len(json.load(f)["labels"])
+    except (OSError, ValueError, KeyError):
+        pass
+    return parameters
+
+
+def estimate_peak_memory(voxel_count, patch_size, num_classes, resampled_voxel_count=None, folds=1, fold_processes=1):
+    """
+    Rough upper bound of the peak memory of a prediction: the input, the preprocessed volume, the logits
+    accumulated over the sliding window, their resampling to the input grid and the segmentation, plus the
+    network activations for one patch and a fixed base for Python, torch and the weights.
+
+    With several fold_processes, the predictor of the parent holds one fold only and every process holds its
+    own base, the activations of a patch, and the logits of its fold in float32 and in its float16 buffer.
+
+    Args:
+        voxel_count (int): Number of voxels of the input.
+        patch_size (sequence): Patch size of the model.
+        num_classes (int): Number of classes of the model, background included.
+        resampled_voxel_count (int): Number of voxels at the spacing of the model, voxel_count by default.
+        folds (int): Folds of the ensemble.
+        fold_processes (int): Processes predicting the folds in parallel (see nnunet_folds.py).
+    Returns:
+        int: Estimated peak memory in bytes.
+    """
+    resampled = resampled_voxel_count or voxel_count
+    patch_voxels = 1
+    for size in patch_size:
+        patch_voxels *= int(size)
+
+    estimate = BASE_BYTES
+    estimate += patch_voxels * ACTIVATION_BYTES_PER_PATCH_VOXEL
+    estimate += voxel_count * 4                     # input, float32
+    estimate += resampled * 4 * 2                   # preprocessed volume and number of predictions per voxel
+    estimate += resampled * num_classes * 4         # logits
+    estimate += voxel_count * num_classes * 4       # logits resampled to the input grid
+    estimate += voxel_count                         # segmentation
+
+    folds = max(1, int(folds))
+    processes = min(max(1, int(fold_processes or 1)), folds)
+    if processes == 1:
+        estimate += (folds - 1) * FOLD_WEIGHTS_BYTES
+    else:
+        estimate += processes * (FOLD_PROCESS_BASE_BYTES + patch_voxels * ACTIVATION_BYTES_PER_PATCH_VOXEL
+                                 + resampled * 4 + resampled * num_classes * (4 + 2))
+    return int(estimate)
+
+
+def estimate_job_memory(input_path, model_path=None, folds=1, fold_processes=1):
+    """
+    Estimates the peak memory of the prediction of an input.
+
+    Args:
+        input_path (str): Input of the runner (.nrrd or volume header).
+        model_path (str): Trained model folder, None if the model is not downloaded yet.
+        folds (int): Folds of the ensemble (see estimate_peak_memory).
+        fold_processes (int): Processes predicting the folds in parallel.
+    Returns:
+        dict: "bytes" (None if the input size is unknown), "voxels", "patch_size" and "num_classes".
+    """
+    parameters = read_model_parameters(model_path)
+    shape, spacing = read_image_grid(input_path)
+    if shape is None:
+        return {"bytes": None, "voxels": None, **parameters}
+
+    voxels = 1
+    for size in shape:
+        voxels *= int(size)
+
+    resampled = voxels
+    if spacing and parameters["spacing"] and len(spacing) == len(parameters["spacing"]):
+        # The product of the spacing ratios does not depend on the axis order
+        for source, target in zip(spacing, parameters["spacing"]):
+            resampled *= float(source) / float(target)
+
+    estimate = estimate_peak_memory(voxels, parameters["patch_size"], parameters["num_classes"], int(resampled), folds,
+                                    fold_processes)
+    return {"bytes": estimate, "voxels": voxels, **parameters}
+
+
+class RSSWatchdog:
+    """
+    Samples the resident memory of a process in a background thread and calls on_exceed once
+    when it crosses the limit. Also records the peak memory seen.
+    """
+    def __init__(self, pid, limit_bytes, on_exceed, interval=0.5, relative=False):
+        """
+        Args:
+            pid (int): Id of the process to watch.
+            limit_bytes (int): Memory limit in bytes, None to only record the peak.
+            on_exceed (callable): Called with the memory compared with the limit when it crosses it.
+            interval (float): Time in seconds between two samples.
+            relative (bool): Compares the growth of the process since start with the limit, instead of its
+                resident memory (e.g. a reused worker that keeps models from the previous jobs).
+        Returns:
+            None
+        """
+        self.pid = pid
+        self.limit_bytes = limit_bytes
+        self.on_exceed = on_exceed
+        self.interval = interval
+        self.relative = relative
+        self.baseline = 0       # Resident memory at start, subtracted from the samples if relative
+        self.peak = 0
+        self.exceeded = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.relative:
+            self.baseline = process_rss_bytes(self.pid) or 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            rss = process_rss_bytes(self.pid)
+            if rss is None:
+                continue
+            self.peak = max(self.peak, rss)
+            used = rss - self.baseline
+            if self.limit_bytes and used > self.limit_bytes and not self.exceeded:
+                self.exceeded = True
+                self.on_exceed(used)
@@ -0,0 +1,67 @@
+"""
+Layout of the trained nnUNet models, shared by the runner and the widget (which inspects the models
+without importing nnUNet_package or torch).
+
+An extracted model archive holds a trained model folder (Dataset/Trainer__Plans__Config) with plans.json,
+dataset.json and one fold_X/checkpoint_final.pth per trained fold.
+"""
+import os
+
+CHECKPOINT_FILE_NAME = "checkpoint_final.pth"
+
+
+def find_trained_model_folder(root, fold=None):
+    """
+    Finds the trained model folder (the folder holding plans.json and dataset.json) in an extracted model archive.
+
+    Args:
+        root (str): Folder of the extracted archive.
+        fold (int or str): Fold of the configuration, used to choose between several trained model folders.
+    Returns:
+        str: Path of the trained model folder.
+    Raises:
+        FileNotFoundError: If the archive holds no trained model folder.
+        ValueError: If it holds several and the fold does not tell them apart.
+    """
+    candidates = sorted(directory for directory, _, files in os.walk(root)
+                        if "plans.json" in files and "dataset.json" in files)
+    if not candidates:
+        raise FileNotFoundError(f"No trained model folder (with plans.json and dataset.json) found in {root}")
+    if len(candidates) > 1 and fold is not None:
+        with_fold = [path for path in candidates if os.path.isdir(os.path.join(path, f"fold_{fold}"))]
+        if with_fold:
+            candidates = with_fold
+    if len(candidates) > 1:
+        raise ValueError(f"Several trained model folders found in {root}: {', '.join(candidates)}")
+    return candidates[0]
+
+
+def checkpoint_path(model_path, fold):
+    """
+    Returns:
+        str: Final checkpoint of a fold of a trained model folder.
+    """
+    return os.path.join(model_path, f"fold_{fold}", CHECKPOINT_FILE_NAME)
+
+
+def resolve_folds(model_path, configured_fold, folds="configured"):
+    """
+    Folds of a model used for the prediction.
+
+    Args:
+        model_path (str): Trained model folder.
+        configured_fold (int or str): Fold of the configuration in models.json.
+        folds (str): "configured" for the configured fold, "all" for every trained fold found in the model folder.
+    Returns:
+        tuple: The folds, as expected by nnUNetPredictor.initialize_from_trained_model_folder.
+    """
+    configured = (configured_fold,)
+    if folds != "all" or not os.path.isdir(model_path):
+        return configured
+
+    found = []
+    for name in sorted(os.listdir(model_path)):
+        if name.startswith("fold_") and os.path.exists(os.path.join(model_path, name, CHECKPOINT_FILE_NAME)):
+            fold = name[len("fold_"):]
+            found.append(int(fold) if fold.isdigit() else fold)
+    return tuple(found) or configured
@@ -0,0 +1,87 @@
+"""
+Speed presets of the inference on the CPU.
+
+A preset sets the sliding window step (a larger step means fewer overlapping tiles), the test-time
+mirroring (8 forward passes per tile in 3D when enabled), the folds of the ensemble and the number of
+intra-op threads of torch. "accurate" is the reference nnUNet setting on the fold of models.json, and the
+default; "ensemble" averages every fold found in the model folder, one prediction per fold, and is only used
+when it is asked for. The speedup and the Dice of the other presets against "accurate" are measured on a
+reference case by nnunet_runner.py --compare_presets.
+"""
+import os
+
+PRESETS = {
+    "fast": {"tile_step_size": 1.0, "use_mirroring": False, "folds": "configured", "threads": None},
+    "balanced": {"tile_step_size": 0.75, "use_mirroring": False, "folds": "configured", "threads": None},
+    "accurate": {"tile_step_size": 0.5, "use_mirroring": True, "folds": "configured", "threads": None},
+    "ensemble": {"tile_step_size": 0.5, "use_mirroring": True, "folds": "all", "threads": None},
+}
+DEFAULT_PRESET = "accurate"
+REFERENCE_PRESET = "accurate"
+
+# Measurements of nnunet_runner.py --compare_presets, stored in the models folder
+REPORT_FILE_NAME = "presets_report.json"
+
+# The preview runs the network at this many times the spacing of the model, with the sliding window of "fast"
+PREVIEW_DOWNSAMPLING = 2.0
+
+# Slices predicted per batch by the axial (2D) models, whose label map is published batch by batch
+DEFAULT_SLICE_BATCH = 16
+
+
+def default_threads(concurrent_jobs=1):
+    """
+    Returns:
+        int: Intra-op threads of a job when the CPU cores are shared by concurrent_jobs jobs.
+    """
+    return max(1, (os.cpu_count() or 1) // max(1, int(concurrent_jobs)))
+
+
+def preset_settings(name, threads=None, crop=True, fold_processes=1, stream_memory_bytes=None, slice_batch=None):
+    """
+    Settings of a preset.
+
+    Args:
+        name (str): Name of the preset, DEFAULT_PRESET if None.
+        threads (int): Intra-op threads, overriding the preset (None: the preset value, or all the cores).
+        crop (bool): Runs the inference on the region of interest only (see nnunet_roi.py).
+        fold_processes (int): Processes predicting the folds of the ensemble in parallel, sharing the threads
+            (see nnunet_folds.py), 1 to predict them one after the other.
+        stream_memory_bytes (int): Memory ceiling of a prediction streamed slab by slab (see nnunet_stream.py),
+            None to predict the whole volume at once.
+        slice_batch (int): Slices predicted per slab of a streamed prediction, whose label map is published slab by
+            slab (see nnunet_stream.py), None to predict the whole volume at once.
+    Returns:
+        dict: "preset", "tile_step_size", "use_mirroring", "folds" ("configured" for the fold of models.json,
+        "all" for every fold found in the model folder), "threads", "crop", "fold_processes",
+        "stream_memory_bytes" and "slice_batch".
+    Raises:
+        ValueError: If the preset does not exist.
+    """
+    name = name or DEFAULT_PRESET
+    if name not in PRESETS:
+        raise ValueError(f"Unknown speed preset: {name} (available: {', '.join(PRESETS)})")
+    settings = dict(PRESETS[name], preset=name, crop=bool(crop), fold_processes=max(1, int(fold_processes or 1)),
+                    stream_memory_bytes=int(stream_memory_bytes) if stream_memory_bytes else None,
+                    slice_batch=max(1, int(slice_batch)) if slice_batch else None)
+    if threads:
+        settings["threads"] = int(threads)
+    if not settings["threads"]:
+        settings["threads"] = default_threads()
+    return settings
+
+
+def preview_settings(settings, downsampling=PREVIEW_DOWNSAMPLING):
+    """
+    Settings of the low-resolution preview of a prediction. The folds, threads and crop of the full
+    prediction are kept so that the preview reuses its loaded predictor.
+
+    Args:
+        settings (dict): Result of preset_settings for the full prediction.
+        downsampling (float): Factor applied to the spacing of the model.
+    Returns:
+        dict: The settings, with "downsampling".
+    """
+    fast = PRESETS["fast"]
+    return dict(settings, tile_step_size=fast["tile_step_size"], use_mirroring=fast["use_mirroring"],
+                downsampling=float(downsampling))
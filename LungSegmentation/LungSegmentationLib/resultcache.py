@@ -0,0 +1,211 @@
+"""
+Cache of the nnUNet predictions.
+
+A prediction is identified by the voxels of the input, the identity of the model (nnUNet_package version,
+model name, folds and checkpoint files of all the folds predicting) and the prediction parameters. When the same case is segmented again
+with the same configuration, the cached label map is imported instead of running the model.
+"""
+import os
+import json
+import shutil
+import hashlib
+import importlib.util
+
+from LungSegmentationLib.diskcache import DiskCache
+from LungSegmentationLib.models import find_trained_model_folder, resolve_folds, checkpoint_path
+from LungSegmentationLib.inputcache import content_key, HASH_CHUNK_SIZE
+from LungSegmentationLib import volumeio
+
+PREDICTION_FILE_NAME = "001.nrrd"
+DATASET_FILE_NAME = "dataset.json"
+METADATA_FILE_NAME = "metadata.json"
+
+
+def volume_digest(path):
+    """
+    Hashes the voxels and the geometry of a segmentation input.
+
+    Args:
+        path (str): Volume header exported by the widget, or image file.
+    Returns:
+        str: SHA-1 of the input.
+    """
+    if not volumeio.is_volume_header(path):
+        return content_key(path)
+
+    array, header = volumeio.map_volume(path)
+    digest = hashlib.sha1(json.dumps({k: header[k] for k in ("shape", "dtype", "spacing", "origin", "direction")},
+                                     sort_keys=True).encode("utf-8"))
+    flat = array.reshape(-1)
+    step = max(1, HASH_CHUNK_SIZE // max(1, array.itemsize))
+    for start in range(0, flat.size, step):
+        digest.update(flat[start:start + step].tobytes())
+    return digest.hexdigest()
+
+
+def find_trained_model(models_dir, animal, mode, structure):
+    """
+    Looks up the model of a configuration in the models.json of nnUNet_package, without importing it (and torch).
+
+    Args:
+        models_dir (str): Directory where the models are stored.
+        animal (str): Animal to segment.
+        mode (str): Segmentation mode.
+        structure (str): Structure to segment.
+    Returns:
+        tuple: (model entry of models.json or None, trained model folder or None if it is not downloaded)
+    """
+    spec = importlib.util.find_spec("nnUNet_package")
+    if spec is None or not spec.submodule_search_locations:
+        return None, None
+    config_path = os.path.join(list(spec.submodule_search_locations)[0], "models.json")
+    try:
+        with open(config_path, "r") as f:
+            model_info = json.load(f)["models"][animal][mode][structure]
+    except (OSError, ValueError, KeyError):
+        return None, None
+
+    # Trained model folder: models_dir/model_name/Dataset/Trainer__Plans__Config/fold_X/checkpoint_final.pth
+    try:
+        model_path = find_trained_model_folder(os.path.join(models_dir, model_info["model_name"]), model_info["fold"])
+    except (OSError, ValueError):
+        return model_info, None
+    return model_info, model_path
+
+
+def model_identity(models_dir, animal, mode, structure, folds="configured"):
+    """
+    Describes the model used for a configuration without importing nnUNet_package (and torch).
+
+    Args:
+        models_dir (str): Directory where the models are stored.
+        animal (str): Animal to segment.
+        mode (str): Segmentation mode.
+        structure (str): Structure to segment.
+        folds (str): Folds of the prediction, as in the preset settings ("configured" or "all", see models.resolve_folds).
+    Returns:
+        dict: nnUNet_package version, model name, configured fold, folds of the prediction and a digest of the
+            size/mtime of their checkpoints ("checkpoint", None if the model is not downloaded).
+    """
+    from importlib.metadata import version, PackageNotFoundError
+
+    identity = {"package_version": None, "model_name": None, "fold": None, "folds": None, "checkpoint": None}
+    try:
+        identity["package_version"] = version("nnUNet_package")
+    except PackageNotFoundError:
+        return identity
+
+    model_info, model_path = find_trained_model(models_dir, animal, mode, structure)
+    if model_info is None:
+        return identity
+    identity["model_name"] = model_info["model_name"]
+    identity["fold"] = model_info["fold"]
+    if model_path is None:
+        return identity
+
+    resolved = resolve_folds(model_path, model_info["fold"], folds)
+    identity["folds"] = [str(fold) for fold in resolved]
+    identity["checkpoint"] = checkpoints_digest(model_path, resolved)
+    return identity
+
+
+def checkpoints_digest(model_path, folds):
+    """
+    Returns:
+        str: Digest of the size and modification time of the checkpoints of the folds, which changes when any
+            of them is retrained or replaced; None if one of them is missing.
+    """
+    digest = hashlib.sha1()
+    for fold in folds:
+        path = checkpoint_path(model_path, fold)
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        digest.update(f"{fold}:{stat.st_size}:{stat.st_mtime_ns};".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class PredictionResultCache:
+    """
+    Predictions stored in a size-bounded LRU DiskCache.
+    """
+    def __init__(self, cache_dir, max_bytes):
+        """
+        Args:
+            cache_dir (str): Folder of the cache.
+            max_bytes (int): Disk budget in bytes.
+        Returns:
+            None
+        """
+        self.cache = DiskCache(cache_dir, max_bytes)
+
+    @staticmethod
+    def key(input_digest, identity, params):
+        """
+        Args:
+            input_digest (str): Result of volume_digest.
+            identity (dict): Result of model_identity.
+            params (dict): Prediction parameters (animal, mode, structure...).
+        Returns:
+            str: Cache key, or None if the model is not identified yet (not downloaded).
+        """
+        if identity.get("checkpoint") is None:
+            return None
+        payload = json.dumps({"input": input_digest, "model": identity, "params": params}, sort_keys=True)
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    def restore(self, key, output_dir):
+        """
+        Copies a cached prediction to an output folder.
+
+        Args:
+            key (str): Cache key.
+            output_dir (str): Folder receiving 001.nrrd.
+        Returns:
+            tuple: (prediction path, cached dataset.json path), or None on a cache miss.
+        """
+        if key is None:
+            return None
+        entry_dir = self.cache.lookup(key)
+        if entry_dir is None:
+            return None
+        os.makedirs(output_dir, exist_ok=True)
+        prediction_path = os.path.join(output_dir, PREDICTION_FILE_NAME)
+        shutil.copyfile(os.path.join(entry_dir, PREDICTION_FILE_NAME), prediction_path)
+        return prediction_path, os.path.join(entry_dir, DATASET_FILE_NAME)
+
+    def store(self, key, prediction_path, dataset_json_path, metadata=None):
+        """
+        Adds a prediction to the cache.
+
+        Args:
+            key (str): Cache key, nothing is stored if None.
+            prediction_path (str): Label map predicted by the runner (.nrrd or volume header).
+            dataset_json_path (str): dataset.json of the model, used to name the segments.
+            metadata (dict): Information saved with the entry.
+        Returns:
+            None
+        """
+        if key is None:
+            return
+
+        def write_entry(entry_dir):
+            if volumeio.is_volume_header(prediction_path):
+                # Label map handed over in memory by the runner
+                array, header = volumeio.map_volume(prediction_path)
+                volumeio.write_nrrd(os.path.join(entry_dir, PREDICTION_FILE_NAME), array, header)
+                del array
+            else:
+                shutil.copyfile(prediction_path, os.path.join(entry_dir, PREDICTION_FILE_NAME))
+            shutil.copyfile(dataset_json_path, os.path.join(entry_dir, DATASET_FILE_NAME))
+            with open(os.path.join(entry_dir, METADATA_FILE_NAME), "w") as f:
+                json.dump(metadata or {}, f, indent=4)
+
+        self.cache.store(key, write_entry)
+
+    def stats(self):
+        """
+        Returns:
+            dict: Statistics of the underlying DiskCache.
+        """
+        return self.cache.stats()
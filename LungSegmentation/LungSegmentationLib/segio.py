@@ -0,0 +1,219 @@
+"""
+Output formats of the saved segmentations.
+
+Slicer saves a segmentation with a single-threaded gzip at its default level, which dominates the export
+of large label maps. The formats below trade file size for export time:
+
+    raw             .nrrd, uncompressed
+    gzip            .nrrd, gzip level 6 on one thread (about what slicer.util.saveNode writes)
+    gzip-fast       .nrrd, gzip level 1 on one thread
+    gzip-parallel   .nrrd, gzip level 6 compressed by blocks on all the cores
+    rle             .seg.rle.npz, run-length encoded runs of every segment (compact sidecar, not read by
+                    Slicer: convert it with rle_to_nrrd)
+
+The .nrrd files have the content of a .seg.nrrd and are read by Slicer as segmentations (segment names,
+colors and label values are stored in the header, see volumeio.segmentation_fields).
+"""
+import os
+import json
+import time
+
+from LungSegmentationLib import volumeio
+
+SEGMENTATION_FORMATS = {
+    "raw": {"encoding": "raw", "description": "Uncompressed: fastest export, largest files"},
+    "gzip": {"encoding": "gzip", "level": 6, "threads": 1, "description": "gzip level 6, one thread (Slicer default)"},
+    "gzip-fast": {"encoding": "gzip", "level": 1, "threads": 1, "description": "gzip level 1, one thread"},
+    "gzip-parallel": {"encoding": "gzip", "level": 6, "threads": None,
+                      "description": "gzip level 6 compressed by blocks on all the cores"},
+    "rle": {"encoding": "rle", "description": "Run-length encoded sidecar (.seg.rle.npz), converted back with rle_to_nrrd"},
+}
+DEFAULT_SEGMENTATION_FORMAT = "gzip-parallel"
+
+RLE_EXTENSION = ".seg.rle.npz"
+
+
+def segmentation_file_path(output_dir, name, segmentation_format=DEFAULT_SEGMENTATION_FORMAT):
+    """
+    Returns:
+        str: Path of the file of a segmentation saved in the given format.
+    """
+    extension = RLE_EXTENSION if SEGMENTATION_FORMATS[segmentation_format]["encoding"] == "rle" else ".nrrd"
+    return os.path.join(output_dir, name + extension)
+
+
+def write_segmentation(path, array, geometry, segments, segmentation_format=DEFAULT_SEGMENTATION_FORMAT):
+    """
+    Saves a label map as a segmentation file.
+
+    Args:
+        path (str): Path of the file (see segmentation_file_path).
+        array (np.ndarray): Label map in (z, y, x) order.
+        geometry (dict): "spacing", "origin" and "direction" in LPS.
+        segments (list): One dict per segment with "id", "name", "label" and "color" (see volumeio.segmentation_fields).
+        segmentation_format (str): One of SEGMENTATION_FORMATS.
+    Returns:
+        dict: "path", "format", "bytes" (size of the file) and "seconds" (export time).
+    Raises:
+        ValueError: If the format does not exist.
+    """
+    if segmentation_format not in SEGMENTATION_FORMATS:
+        raise ValueError(f"Unknown segmentation format: {segmentation_format} "
+                         f"(available: {', '.join(SEGMENTATION_FORMATS)})")
+    options = SEGMENTATION_FORMATS[segmentation_format]
+
+    start = time.perf_counter()
+    if options["encoding"] == "rle":
+        write_rle(path, array, geometry, segments)
+    else:
+        volumeio.write_nrrd(path, array, geometry, volumeio.segmentation_fields(segments, array.shape),
+                            encoding=options["encoding"], level=options.get("level", 1), threads=options.get("threads", 1))
+    return {
+        "path": path,
+        "format": segmentation_format,
+        "bytes": os.path.getsize(path),
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+def present_labels(array):
+    """
+    Returns:
+        list: Label values present in a label map, background (0) excluded, in increasing order.
+    """
+    import numpy as np
+
+    counts = np.bincount(np.asarray(array).ravel().astype(np.int64))
+    return [int(label) for label in np.flatnonzero(counts) if label > 0]
+
+
+def read_label_names(context_file):
+    """
+    Reads the names of the labels of the model used for a prediction.
+
+    Args:
+        context_file (str): Context file of the runner, with the dataset json path of the model.
+    Returns:
+        dict: Label value -> name, background excluded.
+    """
+    with open(context_file, "r") as f:
+        dataset_json_path = json.load(f)["dataset_json_path"]
+    with open(dataset_json_path, "r") as f:
+        dataset = json.load(f)
+    return {int(value): name for name, value in dataset.get("labels", {}).items() if int(value) > 0}
+
+
+def label_name(label_names, label):
+    """
+    Returns:
+        str: Name of a label value (see read_label_names), Class_<value> if the model does not name it.
+    """
+    return label_names.get(label, f"Class_{label}")
+
+
+############################################################### RUN-LENGTH ENCODING ###############################################################
+
+def write_rle(path, array, geometry, segments):
+    """
+    Writes the runs of every segment of a label map: for segment i, "starts_i" and "lengths_i" give the runs of
+    its label value in the flattened (z, y, x) array. The header (shape, dtype, geometry, segments) is stored as JSON
+    in the same uncompressed .npz file.
+
+    Args:
+        path (str): Path of the .seg.rle.npz file.
+        array (np.ndarray): Label map in (z, y, x) order.
+        geometry (dict): "spacing", "origin" and "direction" in LPS.
+        segments (list): Segments of the label map (see write_segmentation).
+    Returns:
+        str: Path of the file.
+    """
+    import numpy as np
+
+    flat = np.ascontiguousarray(array).reshape(-1)
+    # Runs of equal values: a run starts where the value changes
+    boundaries = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    starts = np.concatenate([[0], boundaries]).astype(np.int64)
+    lengths = np.diff(np.concatenate([starts, [flat.size]]))
+    values = flat[starts]
+
+    index_type = np.uint32 if flat.size < 2 ** 32 else np.uint64
+    runs = {}
+    for i, segment in enumerate(segments):
+        selected = values == segment["label"]
+        runs[f"starts_{i}"] = starts[selected].astype(index_type)
+        runs[f"lengths_{i}"] = lengths[selected].astype(index_type)
+
+    header = {
+        "shape": list(array.shape),
+        "dtype": np.dtype(array.dtype).str,
+        **{key: list(geometry[key]) for key in ("spacing", "origin", "direction")},
+        "segments": [{**segment, "color": [float(c) for c in segment["color"]]} for segment in segments],
+    }
+    # np.savez adds .npz to names without it
+    with open(path, "wb") as f:
+        np.savez(f, header=np.frombuffer(json.dumps(header).encode("utf-8"), dtype=np.uint8), **runs)
+    return path
+
+
+def read_rle(path):
+    """
+    Reads a file written by write_rle.
+
+    Args:
+        path (str): Path of the .seg.rle.npz file.
+    Returns:
+        tuple: (label map in (z, y, x) order, header with the geometry and the segments).
+    """
+    import numpy as np
+
+    with np.load(path) as data:
+        header = json.loads(data["header"].tobytes().decode("utf-8"))
+        flat = np.zeros(int(np.prod(header["shape"])), dtype=np.dtype(header["dtype"]))
+        for i, segment in enumerate(header["segments"]):
+            starts = data[f"starts_{i}"].astype(np.int64)
+            ends = starts + data[f"lengths_{i}"].astype(np.int64)
+            # Mark the runs with +1/-1 and integrate to get the mask of the segment
+            marks = np.zeros(flat.size + 1, dtype=np.int32)
+            np.add.at(marks, starts, 1)
+            np.add.at(marks, ends, -1)
+            flat[np.cumsum(marks[:-1]) > 0] = segment["label"]
+    return flat.reshape(header["shape"]), header
+
+
+def rle_to_nrrd(path, output_path=None, segmentation_format="gzip-parallel"):
+    """
+    Converts a run-length encoded sidecar to a segmentation file read by Slicer.
+
+    Args:
+        path (str): Path of the .seg.rle.npz file.
+        output_path (str): Path of the .seg.nrrd file, next to the sidecar by default.
+        segmentation_format (str): NRRD format of SEGMENTATION_FORMATS.
+    Returns:
+        str: Path of the .seg.nrrd file.
+    """
+    array, header = read_rle(path)
+    if output_path is None:
+        output_path = path[:-len(RLE_EXTENSION)] + ".seg.nrrd" if path.endswith(RLE_EXTENSION) else path + ".seg.nrrd"
+    write_segmentation(output_path, array, header, header["segments"], segmentation_format)
+    return output_path
+
+
+def compare_formats(array, geometry, segments, output_dir, name="segmentation"):
+    """
+    Saves a label map in every format and measures the export time and the file size of each.
+
+    Args:
+        array (np.ndarray): Label map in (z, y, x) order.
+        geometry (dict): "spacing", "origin" and "direction" in LPS.
+        segments (list): Segments of the label map.
+        output_dir (str): Folder receiving the files.
+        name (str): Base name of the files.
+    Returns:
+        list: Result of write_segmentation for every format.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    results = []
+    for segmentation_format in SEGMENTATION_FORMATS:
+        path = segmentation_file_path(output_dir, f"{name}_{segmentation_format}", segmentation_format)
+        results.append(write_segmentation(path, array, geometry, segments, segmentation_format))
+    return results
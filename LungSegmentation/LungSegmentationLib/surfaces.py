@@ -0,0 +1,228 @@
+"""
+Closed-surface generation of the segments in the background.
+
+Slicer builds the closed-surface representation of a segmentation on the main thread when the 3D display
+is turned on, which freezes the application for a long time on dense airway and vessel trees. The
+SurfaceBuilder builds the surfaces in a background thread from a copy of the label map, with plain VTK
+filters (discrete flying edges, decimation, windowed sinc smoothing, the same pipeline as Slicer's
+converter). Every segment first gets a coarse surface (downsampled and heavily decimated), then all the
+segments are refined with the configured smoothing and decimation. Within a pass, segments are built in
+order of priority (large and simple structures first by default), so the 3D view becomes usable quickly.
+"""
+import heapq
+import itertools
+import threading
+
+# Settings of the refined surfaces (Slicer's closed surface conversion parameters)
+DEFAULT_SURFACE_SETTINGS = {"smoothing": 0.5, "decimation": 0.3}
+# Settings of the coarse surfaces shown first
+PREVIEW_SURFACE_SETTINGS = {"smoothing": 0.2, "decimation": 0.9, "downsampling": 2}
+
+# Priority of the segments whose name contains a keyword (lower is built first), DEFAULT_PRIORITY otherwise
+DEFAULT_SEGMENT_PRIORITIES = {
+    "lung": 0, "lobe": 0, "parenchyma": 0,
+    "trachea": 1, "airway": 1, "bronch": 1,
+    "arter": 2, "vein": 2, "vessel": 2, "vascular": 2,
+}
+DEFAULT_PRIORITY = 1
+
+
+def segment_priority(name, priorities=None):
+    """
+    Returns:
+        int: Priority of a segment from its name (lower is built first), see DEFAULT_SEGMENT_PRIORITIES.
+    """
+    priorities = DEFAULT_SEGMENT_PRIORITIES if priorities is None else priorities
+    name = name.lower()
+    matches = [priority for keyword, priority in priorities.items() if keyword.lower() in name]
+    return min(matches) if matches else DEFAULT_PRIORITY
+
+
+def build_surface(mask, ijk_to_ras, smoothing=0.5, decimation=0.0, downsampling=1):
+    """
+    Builds the closed surface of a binary mask.
+
+    Args:
+        mask (np.ndarray): Mask in (z, y, x) order.
+        ijk_to_ras (list): 4x4 IJK to RAS matrix of the label map (row-major nested lists).
+        smoothing (float): Smoothing factor between 0 and 1 (as in Slicer).
+        decimation (float): Target reduction of the number of triangles between 0 and 1.
+        downsampling (int): Keeps one voxel out of downsampling along every axis before the extraction.
+    Returns:
+        vtkPolyData: The surface in RAS.
+    """
+    import numpy as np
+    import vtk
+    from vtk.util import numpy_support
+
+    if downsampling > 1:
+        mask = mask[::downsampling, ::downsampling, ::downsampling]
+    # One voxel of padding, so that the surfaces touching the border of the volume are closed
+    mask = np.pad(np.ascontiguousarray(mask, dtype=np.uint8), 1)
+
+    image = vtk.vtkImageData()
+    image.SetDimensions(mask.shape[::-1])
+    image.SetOrigin(-1.0, -1.0, -1.0)
+    image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(mask.ravel(), deep=True, array_type=vtk.VTK_UNSIGNED_CHAR))
+
+    extractor = vtk.vtkDiscreteFlyingEdges3D()
+    extractor.SetInputData(image)
+    extractor.SetValue(0, 1)
+    extractor.ComputeNormalsOff()
+    extractor.ComputeGradientsOff()
+    extractor.ComputeScalarsOff()
+    port = extractor.GetOutputPort()
+
+    if decimation > 0:
+        decimator = vtk.vtkDecimatePro()
+        decimator.SetInputConnection(port)
+        decimator.SetFeatureAngle(60)
+        decimator.SplittingOff()
+        decimator.PreserveTopologyOn()
+        decimator.SetMaximumError(1)
+        decimator.SetTargetReduction(decimation)
+        port = decimator.GetOutputPort()
+
+    if smoothing > 0:
+        smoother = vtk.vtkWindowedSincPolyDataFilter()
+        smoother.SetInputConnection(port)
+        smoother.SetNumberOfIterations(20)
+        smoother.BoundarySmoothingOff()
+        smoother.FeatureEdgeSmoothingOff()
+        smoother.SetFeatureAngle(120.0)
+        smoother.NonManifoldSmoothingOn()
+        smoother.NormalizeCoordinatesOn()
+        smoother.SetPassBand(pow(10.0, -4.0 * smoothing))
+        port = smoother.GetOutputPort()
+
+    # Voxel indices of the downsampled mask to RAS
+    matrix = vtk.vtkMatrix4x4()
+    for r in range(4):
+        for c in range(4):
+            matrix.SetElement(r, c, ijk_to_ras[r][c] * (downsampling if c < 3 else 1))
+    transform = vtk.vtkTransform()
+    transform.SetMatrix(matrix)
+    transformer = vtk.vtkTransformPolyDataFilter()
+    transformer.SetInputConnection(port)
+    transformer.SetTransform(transform)
+
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputConnection(transformer.GetOutputPort())
+    normals.ConsistencyOn()
+    normals.SplittingOff()
+    normals.Update()
+
+    surface = vtk.vtkPolyData()
+    surface.DeepCopy(normals.GetOutput())
+    return surface
+
+
+class SurfaceBuilder:
+    """
+    Background thread building the closed surfaces of segmentations, coarse first then refined.
+    """
+    def __init__(self, on_surface):
+        """
+        Args:
+            on_surface (callable): Called on the builder thread with (key, segment id, vtkPolyData, final)
+                for every surface built; final is False for the coarse surfaces.
+        Returns:
+            None
+        """
+        self.on_surface = on_surface
+        self._tasks = []                 # Heap of (pass, priority, order, generation, task)
+        self._order = itertools.count()
+        self._generations = {}           # Key -> generation of its current build, older tasks are dropped
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def submit(self, key, label_map, ijk_to_ras, segments, settings=None, priorities=None, preview=True):
+        """
+        Queues the surfaces of the segments of a label map, replacing the build of the same key if any.
+
+        Args:
+            key (str): Identifier of the segmentation (e.g. the node ID), given back to on_surface.
+            label_map (np.ndarray): Label map in (z, y, x) order, not modified while the surfaces are built.
+            ijk_to_ras (list): 4x4 IJK to RAS matrix of the label map.
+            segments (list): One dict per segment with "id", "name" and "label".
+            settings (dict): "smoothing" and "decimation" of the refined surfaces, DEFAULT_SURFACE_SETTINGS if None.
+            priorities (dict): Keyword -> priority of the segments, DEFAULT_SEGMENT_PRIORITIES if None.
+            preview (bool): Builds the coarse surfaces of all the segments before the refined ones.
+        Returns:
+            None
+        """
+        settings = dict(DEFAULT_SURFACE_SETTINGS, **(settings or {}))
+        passes = ([PREVIEW_SURFACE_SETTINGS] if preview else []) + [settings]
+        with self._condition:
+            generation = self._generations.get(key, 0) + 1
+            self._generations[key] = generation
+            for index, pass_settings in enumerate(passes):
+                for segment in segments:
+                    task = {
+                        "key": key,
+                        "segment_id": segment["id"],
+                        "label": segment["label"],
+                        "label_map": label_map,
+                        "ijk_to_ras": ijk_to_ras,
+                        "settings": pass_settings,
+                        "final": index == len(passes) - 1,
+                    }
+                    heapq.heappush(self._tasks, (index, segment_priority(segment["name"], priorities),
+                                                 next(self._order), generation, task))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def cancel(self, key):
+        """
+        Drops the surfaces of a segmentation that are not built yet.
+
+        Args:
+            key (str): Identifier given to submit.
+        Returns:
+            None
+        """
+        with self._condition:
+            if key in self._generations:
+                self._generations[key] += 1
+
+    def stop(self):
+        """
+        Drops all the pending surfaces and stops the thread after the current one.
+
+        Args:
+            None
+        Returns:
+            None
+        """
+        with self._condition:
+            self._stopped = True
+            self._tasks.clear()
+            self._condition.notify()
+
+    def _run(self):
+        """
+        Loop of the builder thread.
+        """
+        while True:
+            with self._condition:
+                while not self._tasks and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                _, _, _, generation, task = heapq.heappop(self._tasks)
+                if generation != self._generations.get(task["key"]):
+                    continue
+                if not any(t[4]["key"] == task["key"] for t in self._tasks):
+                    # Last task of the build: the label map is released once it is done
+                    self._generations.pop(task["key"], None)
+
+            try:
+                settings = task["settings"]
+                surface = build_surface(task["label_map"] == task["label"], task["ijk_to_ras"], settings["smoothing"],
+                                        settings["decimation"], settings.get("downsampling", 1))
+                self.on_surface(task["key"], task["segment_id"], surface, task["final"])
+            except Exception as e:
+                print(f"Error building the surface of {task['segment_id']}: {e}")
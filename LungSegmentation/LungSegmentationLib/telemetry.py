@@ -0,0 +1,225 @@
+"""
+Telemetry of the segmentation jobs.
+
+Every job writes its own metrics file next to its output (<input>_<structure>_<time>_job<id>.metrics.json,
+see job_metrics_name): time spent in every stage (conversion, queue wait, model load, preprocessing,
+inference, resampling, export, import), peak resident memory, threads, shape and spacing of the input and
+identity of the model. The jobs are also aggregated in a Prometheus text
+format file (e.g. for the textfile collector of node_exporter), updated after every job:
+
+    lungsegmentation_jobs_total{status="done"} 12
+    lungsegmentation_stage_seconds_sum{stage="predict"} 843.2
+    lungsegmentation_stage_seconds_count{stage="predict"} 12
+    ...
+
+The counters are kept in a JSON file next to the Prometheus file, so that they survive a restart.
+"""
+import os
+import re
+import sys
+import json
+import time
+import tempfile
+import threading
+
+METRICS_FILE_NAME = "metrics.json"
+METRICS_VERSION = 1
+PROMETHEUS_PREFIX = "lungsegmentation"
+
+
+def peak_rss_bytes():
+    """
+    Returns:
+        int: Peak resident memory of this process since it started in bytes, None if it cannot be read.
+    """
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return getattr(psutil.Process().memory_info(), "peak_wset", None)
+    except ImportError:
+        return None
+
+
+def thread_count():
+    """
+    Returns:
+        int: Number of threads of this process (Python threads only if it cannot be read from the system).
+    """
+    try:
+        import psutil
+        return psutil.Process().num_threads()
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("Threads:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return threading.active_count()
+
+
+def _write_atomic(path, text):
+    """
+    Writes a file through a temporary file, so that readers never see it half written. The temporary file
+    is unique to the call, so that threads writing the same file do not share it.
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                    dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def job_metrics_name(label, structure, job_id, submitted_time):
+    """
+    Name of the metrics file of a job, unique to the job, so that the jobs sharing an output folder
+    do not overwrite their metrics.
+
+    Args:
+        label (str): Short description of the input (file or node name).
+        structure (str): Structure(s) of the job.
+        job_id (int): Identifier of the job in this session.
+        submitted_time (float): Time the job was submitted (Unix time).
+    Returns:
+        str: Name to give to write_metrics.
+    """
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(submitted_time))
+    return re.sub(r"[^A-Za-z0-9._+-]+", "_", f"{label}_{structure}_{stamp}_job{job_id}")
+
+
+def write_metrics(directory, metrics, name=None):
+    """
+    Writes the metrics of a job to <name>.metrics.json, or to metrics.json if the folder is the job's own.
+
+    Args:
+        directory (str): Output folder of the job (created if needed).
+        metrics (dict): The metrics.
+        name (str): Prefix of the file name (see job_metrics_name), None for metrics.json.
+    Returns:
+        str: Path of the file.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{name}.{METRICS_FILE_NAME}" if name else METRICS_FILE_NAME)
+    _write_atomic(path, json.dumps({"version": METRICS_VERSION, **metrics}, indent=4))
+    return path
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class PrometheusAggregate:
+    """
+    Aggregate of the metrics of all the jobs, written in the Prometheus text format.
+    """
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Path of the Prometheus file (.prom). The counters are kept in the .json file next to it.
+        Returns:
+            None
+        """
+        self.path = path
+        self.state_path = os.path.splitext(path)[0] + ".json"
+        self._lock = threading.Lock()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"jobs": {}, "stages": {}, "job_seconds": {"sum": 0.0, "count": 0}, "cache_hits": 0,
+                    "peak_rss_bytes_max": 0}
+
+    def update(self, metrics):
+        """
+        Adds the metrics of a finished job and rewrites the Prometheus file.
+
+        Args:
+            metrics (dict): Metrics of the job (see LungSegmentationLogic.job_metrics): "status", "stages",
+                "total_seconds", "cache_hit", "memory" and "end_time".
+        Returns:
+            None
+        """
+        with self._lock:
+            state = self._load_state()
+            status = metrics.get("status", "unknown")
+            state["jobs"][status] = state["jobs"].get(status, 0) + 1
+            for stage, seconds in (metrics.get("stages") or {}).items():
+                if seconds is None:
+                    continue
+                entry = state["stages"].setdefault(stage, {"sum": 0.0, "count": 0})
+                entry["sum"] += seconds
+                entry["count"] += 1
+            if metrics.get("total_seconds") is not None:
+                state["job_seconds"]["sum"] += metrics["total_seconds"]
+                state["job_seconds"]["count"] += 1
+            if metrics.get("cache_hit"):
+                state["cache_hits"] += 1
+            peak = (metrics.get("memory") or {}).get("peak_rss_bytes")
+            if peak:
+                state["last_peak_rss_bytes"] = peak
+                state["peak_rss_bytes_max"] = max(state["peak_rss_bytes_max"], peak)
+            state["last_job_timestamp"] = metrics.get("end_time") or time.time()
+
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            _write_atomic(self.state_path, json.dumps(state, indent=4))
+            _write_atomic(self.path, self.render(state))
+
+    @staticmethod
+    def render(state):
+        """
+        Returns:
+            str: The aggregate in the Prometheus text format.
+        """
+        p = PROMETHEUS_PREFIX
+        lines = [
+            f"# HELP {p}_jobs_total Segmentation jobs finished, by status.",
+            f"# TYPE {p}_jobs_total counter",
+        ]
+        lines += [f'{p}_jobs_total{{status="{_escape(status)}"}} {count}' for status, count in sorted(state["jobs"].items())]
+        lines += [
+            f"# HELP {p}_stage_seconds Time spent in each stage of the segmentation jobs.",
+            f"# TYPE {p}_stage_seconds summary",
+        ]
+        for stage, entry in sorted(state["stages"].items()):
+            lines.append(f'{p}_stage_seconds_sum{{stage="{_escape(stage)}"}} {entry["sum"]:.6f}')
+            lines.append(f'{p}_stage_seconds_count{{stage="{_escape(stage)}"}} {entry["count"]}')
+        lines += [
+            f"# HELP {p}_job_seconds Running time of the segmentation jobs.",
+            f"# TYPE {p}_job_seconds summary",
+            f"{p}_job_seconds_sum {state['job_seconds']['sum']:.6f}",
+            f"{p}_job_seconds_count {state['job_seconds']['count']}",
+            f"# HELP {p}_result_cache_hits_total Jobs served from the prediction cache.",
+            f"# TYPE {p}_result_cache_hits_total counter",
+            f"{p}_result_cache_hits_total {state['cache_hits']}",
+            f"# HELP {p}_job_peak_rss_bytes_max Highest peak resident memory of an inference worker during a job.",
+            f"# TYPE {p}_job_peak_rss_bytes_max gauge",
+            f"{p}_job_peak_rss_bytes_max {state['peak_rss_bytes_max']}",
+        ]
+        if "last_peak_rss_bytes" in state:
+            lines += [
+                f"# HELP {p}_last_job_peak_rss_bytes Peak resident memory of the inference worker during the last job.",
+                f"# TYPE {p}_last_job_peak_rss_bytes gauge",
+                f"{p}_last_job_peak_rss_bytes {state['last_peak_rss_bytes']}",
+            ]
+        if "last_job_timestamp" in state:
+            lines += [
+                f"# HELP {p}_last_job_timestamp_seconds End time of the last job (Unix time).",
+                f"# TYPE {p}_last_job_timestamp_seconds gauge",
+                f"{p}_last_job_timestamp_seconds {state['last_job_timestamp']:.3f}",
+            ]
+        return "\n".join(lines) + "\n"
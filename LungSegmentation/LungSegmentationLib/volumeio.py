@@ -0,0 +1,372 @@
+"""
+Hand-off of in-memory volumes between the widget and the runner.
+
+A volume is stored as raw uncompressed voxels, either in a file next to a small JSON header or in a
+shared memory block, and the header carries the shape, the dtype and the geometry (spacing, origin,
+direction in the LPS convention used by SimpleITK/nnUNet). The runner maps the voxels directly,
+without decompressing or parsing an image file, and hands its label maps back the same way.
+
+Header example (input_volume.json):
+    {"format": "raw", "data": "input_volume.raw", "shape": [z, y, x], "dtype": "int16",
+     "spacing": [sx, sy, sz], "origin": [ox, oy, oz], "direction": [9 values, row-major]}
+"""
+import os
+import json
+import weakref
+
+HEADER_FORMAT_VERSION = 1
+
+NRRD_TYPES = {
+    "int8": "signed char", "uint8": "uchar", "int16": "short", "uint16": "ushort",
+    "int32": "int", "uint32": "uint", "int64": "longlong", "uint64": "ulonglong",
+    "float32": "float", "float64": "double",
+}
+
+# Size of the blocks compressed independently (and in parallel) by write_nrrd with the gzip encoding
+GZIP_BLOCK_BYTES = 4 * 1024 * 1024
+
+# Shared memory blocks created by this process, kept open until remove_volume
+# (on Windows a block disappears as soon as no process has it open)
+_exported_blocks = {}
+
+
+def is_volume_header(path):
+    """
+    Returns:
+        bool: True if the path is a volume header written by export_array.
+    """
+    return bool(path) and path.lower().endswith(".json") and os.path.isfile(path)
+
+
+def ras_to_lps_geometry(origin, spacing, ijk_to_ras_directions):
+    """
+    Converts the geometry of a Slicer volume node (RAS) to the LPS convention of SimpleITK.
+
+    Args:
+        origin (sequence): Origin of the node, in RAS.
+        spacing (sequence): Voxel spacing (i, j, k).
+        ijk_to_ras_directions (sequence): 3x3 matrix whose columns are the directions of the i, j, k axes in RAS.
+    Returns:
+        dict: "spacing", "origin" and "direction" (row-major 3x3) in LPS.
+    """
+    flip = (-1.0, -1.0, 1.0)
+    return {
+        "spacing": [float(s) for s in spacing],
+        "origin": [flip[r] * float(origin[r]) for r in range(3)],
+        "direction": [flip[r] * float(ijk_to_ras_directions[r][c]) for r in range(3) for c in range(3)],
+    }
+
+
+def lps_to_ras_geometry(geometry):
+    """
+    Converts a geometry in the LPS convention (see ras_to_lps_geometry) back to the one of a Slicer volume node.
+
+    Args:
+        geometry (dict): "spacing", "origin" and "direction" (row-major 3x3) in LPS.
+    Returns:
+        dict: "spacing", "origin" (RAS) and "directions" (3x3 matrix whose columns are the i, j, k axes in RAS).
+    """
+    flip = (-1.0, -1.0, 1.0)
+    direction = geometry["direction"]
+    return {
+        "spacing": [float(s) for s in geometry["spacing"]],
+        "origin": [flip[r] * float(geometry["origin"][r]) for r in range(3)],
+        "directions": [[flip[r] * float(direction[r * 3 + c]) for c in range(3)] for r in range(3)],
+    }
+
+
+def export_array(array, geometry, header_path, use_shared_memory=False):
+    """
+    Writes the voxels of a volume as raw data and its header.
+
+    Args:
+        array (np.ndarray): Voxels in (z, y, x) order, as returned by slicer.util.arrayFromVolume.
+        geometry (dict): Result of ras_to_lps_geometry.
+        header_path (str): Path of the JSON header. The raw data is written next to it with the .raw extension.
+        use_shared_memory (bool): Stores the voxels in a shared memory block instead of a file.
+            The block lives until remove_volume is called.
+    Returns:
+        str: Path of the header.
+    """
+    import numpy as np
+
+    array = np.ascontiguousarray(array)
+    header = {
+        "version": HEADER_FORMAT_VERSION,
+        "shape": list(array.shape),
+        "dtype": array.dtype.str,
+        **geometry,
+    }
+
+    if use_shared_memory:
+        from multiprocessing import shared_memory
+        block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        header.update({"format": "shm", "data": block.name})
+        _exported_blocks[block.name] = block
+    else:
+        raw_path = os.path.splitext(header_path)[0] + ".raw"
+        mapped = np.memmap(raw_path, dtype=array.dtype, mode="w+", shape=array.shape)
+        mapped[...] = array
+        mapped.flush()
+        del mapped
+        header.update({"format": "raw", "data": os.path.basename(raw_path)})
+
+    with open(header_path, "w") as f:
+        json.dump(header, f, indent=4)
+    return header_path
+
+
+def create_volume(header_path, shape, dtype, geometry):
+    """
+    Creates an exported volume filled with zeros, to be written in place afterwards (e.g. slab by slab with
+    map_rows) when the whole array does not fit in memory. The raw file is sparse where the filesystem allows it.
+
+    Args:
+        header_path (str): Path of the JSON header. The raw data is created next to it with the .raw extension.
+        shape (sequence): Shape in (z, y, x) order.
+        dtype (np.dtype): Voxel type.
+        geometry (dict): Result of ras_to_lps_geometry.
+    Returns:
+        str: Path of the raw file.
+    """
+    import numpy as np
+
+    dtype = np.dtype(dtype)
+    raw_path = os.path.splitext(header_path)[0] + ".raw"
+    with open(raw_path, "wb") as f:
+        f.truncate(int(np.prod(shape)) * dtype.itemsize)
+    header = {
+        "version": HEADER_FORMAT_VERSION,
+        "shape": [int(n) for n in shape],
+        "dtype": dtype.str,
+        **geometry,
+        "format": "raw",
+        "data": os.path.basename(raw_path),
+    }
+    with open(header_path, "w") as f:
+        json.dump(header, f, indent=4)
+    return raw_path
+
+
+def map_rows(raw_path, dtype, row_shape, start, stop, mode="r+"):
+    """
+    Maps the rows [start, stop) along the first axis of a raw file, without mapping the rest of the file,
+    so that the resident memory stays bounded by the rows being written.
+
+    Args:
+        raw_path (str): Raw file of C-ordered rows.
+        dtype (np.dtype): Type of the values.
+        row_shape (sequence): Shape of one row.
+        start (int): First row.
+        stop (int): Row after the last one.
+        mode (str): "r+" to write the rows, "r" to read them.
+    Returns:
+        np.memmap: The rows, of shape (stop - start, *row_shape).
+    """
+    import numpy as np
+
+    dtype = np.dtype(dtype)
+    row_shape = tuple(int(n) for n in row_shape)
+    row_bytes = int(np.prod(row_shape)) * dtype.itemsize
+    return np.memmap(raw_path, dtype=dtype, mode=mode, offset=start * row_bytes, shape=(stop - start,) + row_shape)
+
+
+def gzip_blocks(data, level=1, threads=1, block_bytes=GZIP_BLOCK_BYTES):
+    """
+    Compresses data as a sequence of independent gzip members, one per block. Their concatenation is a
+    valid gzip stream (as written by pigz), read by zlib, teem/ITK (Slicer) and Python's gzip.
+    zlib releases the GIL, so the blocks are compressed in parallel by a thread pool.
+
+    Args:
+        data (memoryview): Bytes to compress.
+        level (int): zlib compression level (1 fastest, 9 smallest).
+        threads (int): Number of compression threads, all the cores if None.
+        block_bytes (int): Size of the blocks.
+    Returns:
+        iterator: The compressed members, in order.
+    """
+    import zlib
+
+    def compress(start):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return compressor.compress(data[start:start + block_bytes]) + compressor.flush()
+
+    starts = range(0, max(1, len(data)), block_bytes)
+    threads = threads or os.cpu_count() or 1
+    if threads <= 1 or len(starts) == 1:
+        return map(compress, starts)
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    def compress_all():
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            # Bounded look-ahead so that the compressed blocks do not pile up in memory
+            pending = []
+            for start in starts:
+                pending.append(executor.submit(compress, start))
+                if len(pending) >= 2 * threads:
+                    yield pending.pop(0).result()
+            for future in pending:
+                yield future.result()
+    return compress_all()
+
+
+def write_nrrd(path, array, geometry, fields=None, encoding="raw", level=1, threads=1):
+    """
+    Writes a volume as an NRRD file, readable by Slicer and SimpleITK.
+
+    Args:
+        path (str): Path of the .nrrd file.
+        array (np.ndarray): Voxels in (z, y, x) order.
+        geometry (dict): "spacing", "origin" and "direction" in LPS, as returned by ras_to_lps_geometry.
+        fields (dict): Key/value pairs added to the header (e.g. segmentation_fields), optional.
+        encoding (str): "raw" (uncompressed) or "gzip" (see gzip_blocks).
+        level (int): gzip compression level.
+        threads (int): gzip compression threads, all the cores if None.
+    Returns:
+        str: Path of the file.
+    """
+    if encoding not in ("raw", "gzip"):
+        raise ValueError(f"Unsupported NRRD encoding: {encoding}")
+    import numpy as np
+
+    array = np.ascontiguousarray(array)
+    if array.dtype.name not in NRRD_TYPES:
+        raise ValueError(f"Unsupported voxel type for NRRD: {array.dtype}")
+
+    direction = geometry["direction"]
+    spacing = geometry["spacing"]
+    axes = ["(" + ",".join(repr(float(direction[r * 3 + c]) * float(spacing[c])) for r in range(3)) + ")" for c in range(3)]
+
+    header = "\n".join([
+        "NRRD0004",
+        f"type: {NRRD_TYPES[array.dtype.name]}",
+        "dimension: 3",
+        "space: left-posterior-superior",
+        "sizes: " + " ".join(str(n) for n in array.shape[::-1]),
+        "space directions: " + " ".join(axes),
+        "kinds: domain domain domain",
+        f"endian: {'big' if array.dtype.byteorder == '>' else 'little'}",
+        f"encoding: {encoding}",
+        "space origin: (" + ",".join(repr(float(o)) for o in geometry["origin"]) + ")",
+    ] + [f"{key}:={value}" for key, value in (fields or {}).items()])
+    with open(path, "wb") as f:
+        f.write((header + "\n\n").encode("ascii"))
+        if encoding == "raw":
+            array.tofile(f)
+        else:
+            for member in gzip_blocks(memoryview(array.reshape(-1).view(np.uint8)), level, threads):
+                f.write(member)
+    return path
+
+
+def segmentation_fields(segments, shape):
+    """
+    Header fields that make a label map NRRD a Slicer segmentation file (.seg.nrrd, one layer).
+
+    Args:
+        segments (list): One dict per segment with "id", "name", "label" (value in the label map) and
+            "color" (r, g, b between 0 and 1).
+        shape (sequence): Shape of the label map in (z, y, x) order.
+    Returns:
+        dict: The fields, for write_nrrd.
+    """
+    extent = " ".join(f"0 {n - 1}" for n in list(shape)[::-1])
+    fields = {}
+    for index, segment in enumerate(segments):
+        prefix = f"Segment{index}_"
+        fields[prefix + "Color"] = " ".join(repr(float(c)) for c in segment["color"])
+        fields[prefix + "ColorAutoGenerated"] = "0"
+        fields[prefix + "Extent"] = extent
+        fields[prefix + "ID"] = segment["id"]
+        fields[prefix + "LabelValue"] = str(int(segment["label"]))
+        fields[prefix + "Layer"] = "0"
+        fields[prefix + "Name"] = segment["name"]
+        fields[prefix + "NameAutoGenerated"] = "0"
+        fields[prefix + "Tags"] = "|"
+    fields["Segmentation_ContainedRepresentationNames"] = "Binary labelmap|"
+    fields["Segmentation_MasterRepresentation"] = "Binary labelmap"
+    fields["Segmentation_ReferenceImageExtentOffset"] = "0 0 0"
+    return fields
+
+
+def read_header(header_path):
+    """
+    Returns:
+        dict: Content of a volume header.
+    """
+    with open(header_path, "r") as f:
+        return json.load(f)
+
+
+def _attach_shared_memory(name):
+    """
+    Attaches an existing shared memory block without letting the resource tracker of this
+    process destroy it when the process exits: the block belongs to the process that created it.
+    """
+    from multiprocessing import shared_memory, resource_tracker
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 always registers the block
+        block = shared_memory.SharedMemory(name=name)
+        try:
+            resource_tracker.unregister(block._name, "shared_memory")
+        except Exception:
+            pass
+        return block
+
+
+def map_volume(header_path):
+    """
+    Maps the voxels of an exported volume without copying them.
+    The mapping is released when the returned array and all its views are garbage collected.
+
+    Args:
+        header_path (str): Path of the JSON header.
+    Returns:
+        tuple: (read-only array in (z, y, x) order, header dict).
+    """
+    import numpy as np
+
+    header = read_header(header_path)
+    shape = tuple(header["shape"])
+    dtype = np.dtype(header["dtype"])
+
+    if header["format"] == "shm":
+        block = _attach_shared_memory(header["data"])
+        array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        weakref.finalize(array, block.close)
+    else:
+        raw_path = os.path.join(os.path.dirname(os.path.abspath(header_path)), header["data"])
+        array = np.memmap(raw_path, dtype=dtype, mode="r", shape=shape)
+    array.flags.writeable = False
+    return array, header
+
+
+def remove_volume(header_path):
+    """
+    Deletes an exported volume: its header and its raw file or shared memory block.
+
+    Args:
+        header_path (str): Path of the JSON header.
+    Returns:
+        None
+    """
+    if not os.path.exists(header_path):
+        return
+    header = read_header(header_path)
+    if header.get("format") == "shm":
+        from multiprocessing import shared_memory
+        try:
+            block = _exported_blocks.pop(header["data"], None) or shared_memory.SharedMemory(name=header["data"])
+            block.close()
+            block.unlink()
+        except FileNotFoundError:
+            pass
+    else:
+        raw_path = os.path.join(os.path.dirname(os.path.abspath(header_path)), header["data"])
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+    os.remove(header_path)
@@ -0,0 +1,334 @@
+"""
+Client of the warm inference worker (nnunet_runner.py --worker), and pool of workers for concurrent jobs.
+
+The worker is started once and kept alive; requests and responses are exchanged as
+line-delimited JSON over its stdin/stdout pipes.
+"""
+import sys
+import json
+import queue
+import contextlib
+import itertools
+import threading
+import subprocess
+
+
+class RunnerWorkerError(RuntimeError):
+    """
+    Error reported by the worker, or raised when the worker is not reachable.
+    """
+
+
+class RunnerWorkerClient:
+    """
+    Starts the worker process and sends it requests.
+
+    Several threads may send requests at the same time: responses are routed back to the
+    caller by request id. The worker itself handles the requests one after the other.
+    """
+    def __init__(self, runner_path, models_dir, cache_size=2, python_executable=None):
+        """
+        Args:
+            runner_path (str): Path to nnunet_runner.py.
+            models_dir (str): Directory where the models are stored.
+            cache_size (int): Number of models kept in memory by the worker.
+            python_executable (str): Interpreter used to run the worker, sys.executable by default.
+        Returns:
+            None
+        """
+        self.runner_path = runner_path
+        self.models_dir = models_dir
+        self.cache_size = cache_size
+        self.python_executable = python_executable or sys.executable
+
+        self.process = None
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._reader = None
+        self._abort_reason = None
+
+    def is_running(self):
+        """
+        Returns:
+            bool: True if the worker process is alive.
+        """
+        return self.process is not None and self.process.poll() is None
+
+    def start(self, timeout=120):
+        """
+        Starts the worker if it is not running and waits until it is ready.
+
+        Args:
+            timeout (float): Maximum time in seconds to wait for the worker.
+        Returns:
+            None
+        Raises:
+            RunnerWorkerError: If the worker does not start.
+        """
+        with self._lock:
+            if self.is_running():
+                return
+            self._ready.clear()
+            self._abort_reason = None
+            cmd = [
+                self.python_executable, str(self.runner_path),
+                "--worker",
+                "--models_dir", self.models_dir,
+                "--cache_size", str(self.cache_size),
+            ]
+            self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1)
+            self._reader = threading.Thread(target=self._read_loop, args=(self.process,), daemon=True)
+            self._reader.start()
+
+        if not self._ready.wait(timeout) or not self.is_running():
+            self.stop()
+            raise RunnerWorkerError("The inference worker did not start.")
+
+    def _read_loop(self, process):
+        """
+        Reads the messages of the worker and routes them to the waiting requests.
+        """
+        for line in process.stdout:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                message = json.loads(line)
+            except ValueError:
+                print(f"Unexpected output from the inference worker: {line}")
+                continue
+
+            if message.get("event") == "ready":
+                self._ready.set()
+                continue
+
+            with self._lock:
+                waiting = self._pending.get(message.get("id"))
+            if waiting is not None:
+                waiting.put(message)
+
+        # The worker exited: fail every pending request
+        returncode = process.wait()
+        error = self._abort_reason or f"The inference worker exited with code {returncode}."
+        with self._lock:
+            pending = list(self._pending.values())
+        for waiting in pending:
+            waiting.put({"status": "error", "error": error})
+        self._ready.set()
+
+    def request(self, command, timeout=None, on_event=None, **payload):
+        """
+        Sends a request and waits for its response.
+
+        Args:
+            command (str): Command of the request ("predict", "preview", "stats", "ping").
+            timeout (float): Maximum time in seconds to wait for the next message of the worker, None to wait forever.
+            on_event (callable): Called (in the calling thread) with every event of the request, e.g. progress events.
+            **payload: Other fields of the request.
+        Returns:
+            dict: The response.
+        Raises:
+            RunnerWorkerError: If the worker reports an error or does not answer in time.
+        """
+        self.start()
+
+        request_id = next(self._ids)
+        waiting = queue.Queue()
+        with self._lock:
+            self._pending[request_id] = waiting
+
+        try:
+            try:
+                self.process.stdin.write(json.dumps({"id": request_id, "command": command, **payload}) + "\n")
+                self.process.stdin.flush()
+            except (BrokenPipeError, OSError) as e:
+                raise RunnerWorkerError(f"Cannot reach the inference worker: {e}")
+
+            while True:
+                try:
+                    response = waiting.get(timeout=timeout)
+                except queue.Empty:
+                    raise RunnerWorkerError(f"No answer from the inference worker after {timeout} s.")
+                if "event" not in response:
+                    break
+                if on_event is not None:
+                    on_event(response)
+        finally:
+            with self._lock:
+                self._pending.pop(request_id, None)
+
+        if response.get("status") != "ok":
+            raise RunnerWorkerError(response.get("error", "Unknown error in the inference worker."))
+        return response
+
+    def predict(self, animal, mode, structure, input_path, output_dir, tmp_file=None, on_progress=None, preset=None, threads=None,
+                crop=True, output_format="nrrd", slice_batch=None, stream_memory_bytes=None):
+        """
+        Predicts one volume.
+
+        Args:
+            animal (str): Animal to segment.
+            mode (str): Segmentation mode.
+            structure (str): Structure to segment.
+            input_path (str): Path to the input .nrrd.
+            output_dir (str): Output folder of the prediction.
+            tmp_file (str): Context file receiving the dataset json path.
+            on_progress (callable): Called with every progress event (see nnunet_progress.py), and every "slab"
+                event of a streamed prediction.
+            preset (str): Speed preset (see presets.py), the default preset if None.
+            threads (int): Intra-op threads of the worker, all the cores if None.
+            crop (bool): Runs the inference on the region of interest only (see nnunet_roi.py).
+            output_format (str): "nrrd", or "raw" to get the label map as raw voxels and a volume header
+                (see volumeio.map_volume) instead of an NRRD file.
+            slice_batch (int): Predicts the volume slab by slab of this many slices, publishing the label map of
+                every slab (see nnunet_stream.py), None to predict it at once.
+            stream_memory_bytes (int): Predicts the volume slab by slab within this memory (see nnunet_stream.py),
+                None to predict it at once.
+        Returns:
+            dict: The response, with the path of the prediction in "prediction" and the region of interest in "roi".
+        """
+        return self.request("predict", on_event=on_progress, animal=animal, mode=mode, structure=structure,
+                            input=input_path, output=output_dir, tmp_file=tmp_file, preset=preset, threads=threads, crop=crop,
+                            output_format=output_format, slice_batch=slice_batch, stream_memory_bytes=stream_memory_bytes)
+
+    def predict_structures(self, animal, mode, structures, input_path, output_dir, on_progress=None, preset=None, threads=None,
+                           crop=True, output_format="nrrd"):
+        """
+        Predicts several structures of one volume in one request: the input is read and preprocessed once
+        for the models that share their preprocessing. Each prediction is written to output_dir/<structure>/001.nrrd
+        with a context file next to it.
+
+        Args:
+            animal (str): Animal to segment.
+            mode (str): Segmentation mode.
+            structures (list): Structures to segment.
+            input_path (str): Path to the input .nrrd.
+            output_dir (str): Output folder of the predictions.
+            on_progress (callable): Called with every progress event (see nnunet_progress.py).
+            preset (str): Speed preset (see presets.py), the default preset if None.
+            threads (int): Intra-op threads of the worker, all the cores if None.
+            crop (bool): Runs the inference on the region of interest only (see nnunet_roi.py).
+            output_format (str): "nrrd", or "raw" to get the label map as raw voxels and a volume header
+                (see volumeio.map_volume) instead of an NRRD file.
+        Returns:
+            dict: The response, with "prediction" and "dataset_json_path" of every structure in "predictions".
+        """
+        return self.request("predict", on_event=on_progress, animal=animal, mode=mode, structures=list(structures),
+                            input=input_path, output=output_dir, preset=preset, threads=threads, crop=crop,
+                            output_format=output_format)
+
+    def preview(self, animal, mode, structure, input_path, output_dir, tmp_file=None, on_progress=None, preset=None, threads=None,
+                crop=True, output_format="nrrd"):
+        """
+        Predicts a low-resolution preview of one volume (preview.nrrd in output_dir), with the model of the
+        full prediction of the same preset: the model stays loaded for the full prediction that follows.
+        Same arguments and response as predict.
+        """
+        return self.request("preview", on_event=on_progress, animal=animal, mode=mode, structure=structure,
+                            input=input_path, output=output_dir, tmp_file=tmp_file, preset=preset, threads=threads, crop=crop,
+                            output_format=output_format)
+
+    def abort(self, reason):
+        """
+        Kills the worker at once, e.g. when it uses too much memory. The running request fails with
+        the given reason, and the next request starts a new worker.
+
+        Args:
+            reason (str): Error reported to the running request.
+        Returns:
+            None
+        """
+        self._abort_reason = reason
+        process = self.process
+        if process is not None and process.poll() is None:
+            process.kill()
+
+    def stop(self, timeout=10):
+        """
+        Asks the worker to shut down, and kills it if it does not exit in time.
+
+        Args:
+            timeout (float): Time in seconds given to the worker to exit.
+        Returns:
+            None
+        """
+        process = self.process
+        if process is None:
+            return
+        if process.poll() is None:
+            try:
+                process.stdin.write(json.dumps({"id": None, "command": "shutdown"}) + "\n")
+                process.stdin.flush()
+                process.wait(timeout)
+            except (OSError, subprocess.TimeoutExpired):
+                process.kill()
+                process.wait()
+        self.process = None
+
+
+class RunnerWorkerPool:
+    """
+    Inference workers shared by concurrent jobs: a job takes an idle worker, or starts a new one,
+    and gives it back when it is done. The pool grows up to the number of concurrent jobs.
+    """
+    def __init__(self, runner_path, models_dir, cache_size=2, python_executable=None):
+        """
+        Args:
+            runner_path (str): Path to nnunet_runner.py.
+            models_dir (str): Directory where the models are stored.
+            cache_size (int): Number of models kept in memory by each worker.
+            python_executable (str): Interpreter used to run the workers, sys.executable by default.
+        Returns:
+            None
+        """
+        self.runner_path = runner_path
+        self.models_dir = models_dir
+        self.cache_size = cache_size
+        self.python_executable = python_executable
+        self._clients = []
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def client(self):
+        """
+        Context manager lending a worker client for the duration of a job.
+
+        Returns:
+            RunnerWorkerClient: The client.
+        """
+        with self._lock:
+            if self._idle:
+                client = self._idle.pop()
+            else:
+                client = RunnerWorkerClient(self.runner_path, self.models_dir, self.cache_size, self.python_executable)
+                self._clients.append(client)
+        try:
+            yield client
+        finally:
+            with self._lock:
+                self._idle.append(client)
+
+    def size(self):
+        """
+        Returns:
+            int: Number of workers created so far.
+        """
+        with self._lock:
+            return len(self._clients)
+
+    def stop(self, timeout=10):
+        """
+        Stops all the workers.
+
+        Args:
+            timeout (float): Time in seconds given to each worker to exit.
+        Returns:
+            None
+        """
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            client.stop(timeout)
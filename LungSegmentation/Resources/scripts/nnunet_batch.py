@@ -0,0 +1,282 @@
+"""
+Batch mode of nnunet_runner.py.
+
+A batch is a directory of images and DICOM series folders, or a CSV/JSON manifest listing the cases
+(image files or DICOM folders), each with its own animal/mode/structure. DICOM series are converted to
+NRRD in a cache of the output folder before their preprocessing. Cases are grouped by configuration so that every model is loaded once,
+and the reading/preprocessing of the next case runs in a background thread while the current
+case is predicted. The state of every case is written to batch_status.json in the output folder,
+so that an interrupted batch resumes where it stopped.
+"""
+import os
+import csv
+import json
+import time
+import queue
+import threading
+import traceback
+from collections import OrderedDict
+
+from nnunet_engine import PredictorCache, read_case, crop_to_roi, preprocess_case, predict_preprocessed, write_prediction
+from nnunet_roi import paste_segmentation
+from nnunet_worker import write_context
+from LungSegmentationLib.presets import preset_settings
+
+IMAGE_EXTENSIONS = (".nrrd", ".nii", ".nii.gz", ".mha")
+STATUS_FILE_NAME = "batch_status.json"
+# Converted DICOM series, in the output folder
+DICOM_CACHE_DIR_NAME = ".dicom_cache"
+DICOM_CACHE_BYTES = 4 * 1024 ** 3
+
+
+############################################################### MANIFEST ###############################################################
+
+def case_id_from_path(path):
+    """
+    Returns the name of an image file without its extension, or the name of a DICOM folder.
+
+    Args:
+        path (str): Path to the image or DICOM folder.
+    Returns:
+        str: Case identifier.
+    """
+    name = os.path.basename(os.path.normpath(path))
+    if os.path.isdir(path):
+        return name
+    for ext in IMAGE_EXTENSIONS:
+        if name.lower().endswith(ext):
+            return name[:-len(ext)]
+    return os.path.splitext(name)[0]
+
+
+def _manifest_value(entry, key, index):
+    """
+    Returns:
+        str: A field of a manifest entry as a stripped string ("" if missing); numbers (e.g. ids) are accepted.
+    Raises:
+        ValueError: If the field is not a string or a number.
+    """
+    value = entry.get(key)
+    if value is None:
+        return ""
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        raise ValueError(f"Invalid {key} in entry {index + 1} of the manifest: {value!r}")
+    return str(value).strip()
+
+
+def load_manifest(source, animal, mode, structure):
+    """
+    Lists the cases of a batch.
+
+    Args:
+        source (str): Directory of images and DICOM folders, or CSV/JSON manifest. Manifest entries have
+            an "input" (image file or DICOM folder) and optionally "id", "animal", "mode" and "structure";
+            relative inputs are resolved against the folder of the manifest.
+        animal (str): Default animal.
+        mode (str): Default mode.
+        structure (str): Default structure.
+    Returns:
+        list: One dict per case with id, input, animal, mode and structure.
+    Raises:
+        ValueError: If the manifest is not supported, empty, has an invalid entry or duplicate case ids.
+    """
+    from LungSegmentationLib.dicomseries import contains_dicom
+
+    defaults = {"animal": animal, "mode": mode, "structure": structure}
+
+    if os.path.isdir(source):
+        paths = [os.path.join(source, f) for f in sorted(os.listdir(source)) if not f.startswith(".")]
+        entries = [{"input": path} for path in paths
+                   if (os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS))
+                   or (os.path.isdir(path) and contains_dicom(path))]
+        base_dir = source
+    elif source.lower().endswith(".csv"):
+        with open(source, newline="") as f:
+            entries = [row for row in csv.DictReader(f)]
+        base_dir = os.path.dirname(os.path.abspath(source))
+    elif source.lower().endswith(".json"):
+        with open(source, "r") as f:
+            entries = json.load(f)
+        if isinstance(entries, dict):
+            entries = entries.get("cases", [])
+        base_dir = os.path.dirname(os.path.abspath(source))
+    else:
+        raise ValueError(f"Unsupported batch source: {source}. Use a folder, a .csv or a .json manifest.")
+
+    cases = []
+    seen = set()
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            raise ValueError(f"Invalid entry {index + 1} of the manifest: {entry!r}")
+        input_path = _manifest_value(entry, "input", index)
+        if not input_path:
+            continue
+        if not os.path.isabs(input_path):
+            input_path = os.path.join(base_dir, input_path)
+
+        case = {"id": _manifest_value(entry, "id", index) or case_id_from_path(input_path), "input": input_path}
+        for key, default in defaults.items():
+            case[key] = _manifest_value(entry, key, index) or default
+            if not case[key]:
+                raise ValueError(f"No {key} given for case {case['id']}")
+
+        if case["id"] in seen:
+            raise ValueError(f"Duplicate case id in the batch: {case['id']}")
+        seen.add(case["id"])
+        cases.append(case)
+
+    if not cases:
+        raise ValueError(f"No case found in {source}")
+    return cases
+
+
+############################################################### STATUS ###############################################################
+
+class BatchStatus:
+    """
+    Per-case status of a batch, persisted as JSON after every change.
+    """
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Path to the status file, loaded if it already exists.
+        Returns:
+            None
+        """
+        self.path = path
+        self.cases = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.cases = json.load(f).get("cases", {})
+
+    def is_done(self, case_id):
+        """
+        Returns:
+            bool: True if the case was predicted and its prediction is still on disk.
+        """
+        entry = self.cases.get(case_id, {})
+        return entry.get("status") == "done" and os.path.exists(entry.get("prediction", ""))
+
+    def update(self, case_id, **fields):
+        """
+        Updates the status of a case and saves the file.
+
+        Args:
+            case_id (str): Case identifier.
+            **fields: Fields of the status ("status", "prediction", "error", "seconds"...).
+        Returns:
+            None
+        """
+        self.cases.setdefault(case_id, {}).update(fields, updated=time.strftime("%Y-%m-%dT%H:%M:%S"))
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"cases": self.cases}, f, indent=4)
+        os.replace(tmp_path, self.path)
+
+
+############################################################### RUN ###############################################################
+
+def _prefetch(loaded, cases, prefetch_queue, settings=None, dicom_converter=None):
+    """
+    Reads, crops and preprocesses the cases one after the other and hands them to the inference loop.
+    The bounded queue keeps at most its size of preprocessed cases in memory. DICOM folders are converted
+    by dicom_converter first.
+    """
+    for case in cases:
+        try:
+            start = time.perf_counter()
+            input_path = case["input"]
+            if os.path.isdir(input_path):
+                input_path = dicom_converter.convert(input_path)
+            image, properties = read_case(loaded, input_path)
+            image, roi = crop_to_roi(loaded, image, properties, settings)
+            preprocessed = preprocess_case(loaded, image, properties)
+            del image
+            prefetch_queue.put((case, preprocessed, properties, roi, None, time.perf_counter() - start))
+        except Exception as e:
+            traceback.print_exc()
+            prefetch_queue.put((case, None, None, None, e, 0.0))
+    prefetch_queue.put(None)
+
+
+def run_batch(cases, output_dir, models_dir, prefetch=2, resume=True, settings=None):
+    """
+    Predicts all the cases of a batch. Each case is written to output_dir/<case id>/001.nrrd.
+    DICOM folders are converted through a cache in output_dir/.dicom_cache.
+
+    Args:
+        cases (list): Cases returned by load_manifest.
+        output_dir (str): Root output folder.
+        models_dir (str): Directory where the models are stored.
+        prefetch (int): Number of preprocessed cases waiting for inference.
+        resume (bool): Skips the cases already done according to the status file.
+        settings (dict): Speed preset settings (see LungSegmentationLib.presets), the default preset if None.
+    Returns:
+        dict: Number of cases done, skipped and failed.
+    """
+    settings = settings or preset_settings(None)
+    os.makedirs(output_dir, exist_ok=True)
+    status = BatchStatus(os.path.join(output_dir, STATUS_FILE_NAME))
+    summary = {"done": 0, "skipped": 0, "failed": 0}
+
+    # Group the cases by configuration to load every model once
+    groups = OrderedDict()
+    for case in cases:
+        if resume and status.is_done(case["id"]):
+            summary["skipped"] += 1
+            continue
+        status.update(case["id"], status="pending", input=case["input"])
+        groups.setdefault((case["animal"], case["mode"], case["structure"]), []).append(case)
+
+    dicom_converter = None
+    if any(os.path.isdir(case["input"]) for group in groups.values() for case in group):
+        from LungSegmentationLib.dicomseries import DicomSeriesConverter
+        dicom_converter = DicomSeriesConverter(os.path.join(output_dir, DICOM_CACHE_DIR_NAME), DICOM_CACHE_BYTES)
+
+    cache = PredictorCache(models_dir, capacity=1)
+    for (animal, mode, structure), group in groups.items():
+        print(f"Batch: {len(group)} case(s) for {animal} > {mode} > {structure}")
+        try:
+            loaded = cache.get(animal, mode, structure, settings["folds"], settings["fold_processes"])
+        except Exception as e:
+            traceback.print_exc()
+            for case in group:
+                status.update(case["id"], status="failed", error=str(e))
+                summary["failed"] += 1
+            continue
+
+        prefetch_queue = queue.Queue(maxsize=max(1, prefetch))
+        threading.Thread(target=_prefetch, args=(loaded, group, prefetch_queue, settings, dicom_converter),
+                         daemon=True).start()
+
+        while True:
+            item = prefetch_queue.get()
+            if item is None:
+                break
+            case, preprocessed, properties, roi, error, preprocess_seconds = item
+            if error is not None:
+                status.update(case["id"], status="failed", error=str(error))
+                summary["failed"] += 1
+                continue
+
+            status.update(case["id"], status="running")
+            try:
+                start = time.perf_counter()
+                segmentation = paste_segmentation(predict_preprocessed(loaded, preprocessed, settings=settings), roi)
+                case_dir = os.path.join(output_dir, case["id"])
+                prediction_path = write_prediction(loaded, segmentation, properties, case_dir)
+                write_context(os.path.join(case_dir, "nnunet_context.json"), loaded.dataset_json_path)
+                status.update(case["id"], status="done", prediction=prediction_path, error=None, roi=roi,
+                              preprocess_seconds=round(preprocess_seconds, 3),
+                              predict_seconds=round(time.perf_counter() - start, 3))
+                summary["done"] += 1
+                print(f"Batch: {case['id']} done")
+            except Exception as e:
+                traceback.print_exc()
+                status.update(case["id"], status="failed", error=str(e))
+                summary["failed"] += 1
+            finally:
+                del preprocessed
+
+    print(f"Batch finished: {summary['done']} done, {summary['skipped']} skipped, {summary['failed']} failed")
+    return summary
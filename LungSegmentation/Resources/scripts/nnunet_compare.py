@@ -0,0 +1,185 @@
+"""
+Comparison of the speed presets on a reference case (nnunet_runner.py --compare_presets).
+
+The case is read and preprocessed once, then predicted with every preset. The inference time of each
+preset is compared to the reference preset ("accurate"), and so is its segmentation (Dice per label).
+The results are printed and merged into presets_report.json in the models folder, where the widget
+reads them to describe the presets.
+
+The output formats of the saved segmentations are compared the same way (nnunet_runner.py --compare_formats):
+a label map is saved in every format of LungSegmentationLib.segio, and the export time and file size of each
+are printed and written to formats_report.json in the output folder.
+"""
+import os
+import json
+import time
+
+from nnunet_engine import PredictorCache, read_case, crop_to_roi, preprocess_case, predict_preprocessed
+from nnunet_roi import paste_segmentation
+from LungSegmentationLib import volumeio
+from LungSegmentationLib.presets import PRESETS, REFERENCE_PRESET, REPORT_FILE_NAME, preset_settings
+
+
+def dice_scores(reference, segmentation):
+    """
+    Dice coefficient of every label of a reference label map.
+
+    Args:
+        reference (np.ndarray): Reference label map.
+        segmentation (np.ndarray): Label map to evaluate, same shape.
+    Returns:
+        dict: Label -> Dice, and "mean" over the labels (background excluded).
+    """
+    import numpy as np
+
+    scores = {}
+    for label in np.unique(np.concatenate([np.unique(reference), np.unique(segmentation)])):
+        if label == 0:
+            continue
+        ref = reference == label
+        seg = segmentation == label
+        total = int(ref.sum()) + int(seg.sum())
+        scores[str(int(label))] = 2.0 * int(np.logical_and(ref, seg).sum()) / total if total else 1.0
+    scores["mean"] = sum(scores.values()) / len(scores) if scores else 1.0
+    return scores
+
+
+def compare_presets(models_dir, animal, mode, structure, input_path, threads=None):
+    """
+    Predicts a reference case with every preset.
+
+    Args:
+        models_dir (str): Directory where the models are stored.
+        animal (str): Animal to segment.
+        mode (str): Segmentation mode.
+        structure (str): Structure to segment.
+        input_path (str): Reference case.
+        threads (int): Intra-op threads used by every preset, all the cores by default.
+    Returns:
+        dict: Preset -> seconds, speedup and Dice against the reference preset, and the settings used.
+    """
+    cache = PredictorCache(models_dir, capacity=2)
+    names = [REFERENCE_PRESET] + [name for name in PRESETS if name != REFERENCE_PRESET]
+
+    preprocessed = properties = roi = None
+    reference = None
+    reference_seconds = None
+    results = {}
+    for name in names:
+        settings = preset_settings(name, threads)
+        loaded = cache.get(animal, mode, structure, settings["folds"])
+        if preprocessed is None:
+            image, properties = read_case(loaded, input_path)
+            image, roi = crop_to_roi(loaded, image, properties, settings)
+            preprocessed = preprocess_case(loaded, image, properties)
+            del image
+
+        start = time.perf_counter()
+        segmentation = paste_segmentation(predict_preprocessed(loaded, preprocessed, settings=settings), roi)
+        seconds = time.perf_counter() - start
+
+        if reference is None:
+            reference, reference_seconds = segmentation, seconds
+        dice = dice_scores(reference, segmentation)
+        results[name] = {
+            "seconds": round(seconds, 2),
+            "speedup": round(reference_seconds / seconds, 2),
+            "dice": round(dice.pop("mean"), 4),
+            "dice_per_label": {label: round(score, 4) for label, score in dice.items()},
+            "settings": settings,
+        }
+        print(f"{name:>10}: {seconds:8.1f} s  speedup x{results[name]['speedup']:.2f}  Dice {results[name]['dice']:.4f}")
+    return results
+
+
+def save_report(models_dir, animal, mode, structure, input_path, results):
+    """
+    Merges the results of a comparison into presets_report.json in the models folder.
+
+    Args:
+        models_dir (str): Directory where the models are stored.
+        animal (str): Animal of the configuration.
+        mode (str): Mode of the configuration.
+        structure (str): Structure of the configuration.
+        input_path (str): Reference case.
+        results (dict): Result of compare_presets.
+    Returns:
+        str: Path of the report.
+    """
+    report_path = os.path.join(models_dir, REPORT_FILE_NAME)
+    report = {}
+    if os.path.exists(report_path):
+        try:
+            with open(report_path, "r") as f:
+                report = json.load(f)
+        except (OSError, ValueError):
+            report = {}
+
+    report[f"{animal}/{mode}/{structure}"] = {
+        "reference_case": os.path.abspath(input_path),
+        "reference_preset": REFERENCE_PRESET,
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "presets": results,
+    }
+    os.makedirs(models_dir, exist_ok=True)
+    tmp_path = report_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(report, f, indent=4)
+    os.replace(tmp_path, report_path)
+    return report_path
+
+
+FORMATS_REPORT_FILE_NAME = "formats_report.json"
+
+
+def read_label_map(path):
+    """
+    Reads a label map (image file or volume header exported by the widget).
+
+    Args:
+        path (str): Path of the label map.
+    Returns:
+        tuple: (label map in (z, y, x) order, geometry in LPS).
+    """
+    if volumeio.is_volume_header(path):
+        array, header = volumeio.map_volume(path)
+        return array, header
+
+    import SimpleITK as sitk
+    image = sitk.ReadImage(path)
+    geometry = {
+        "spacing": list(image.GetSpacing()),
+        "origin": list(image.GetOrigin()),
+        "direction": list(image.GetDirection()),
+    }
+    return sitk.GetArrayFromImage(image), geometry
+
+
+def compare_segmentation_formats(input_path, output_dir):
+    """
+    Saves a label map in every segmentation format and reports the export time and the file size of each.
+
+    Args:
+        input_path (str): Label map (e.g. a prediction of the runner).
+        output_dir (str): Folder receiving the files and formats_report.json.
+    Returns:
+        str: Path of the report.
+    """
+    import numpy as np
+    from LungSegmentationLib import segio
+
+    array, geometry = read_label_map(input_path)
+    labels = [int(label) for label in np.unique(array) if label > 0]
+    colors = np.random.default_rng(0).random((len(labels), 3))
+    segments = [{"id": f"Segment_{label}", "name": f"Segment_{label}", "label": label, "color": tuple(color)}
+                for label, color in zip(labels, colors)]
+
+    results = segio.compare_formats(array, geometry, segments, output_dir)
+    for result in results:
+        print(f"{result['format']:>14}: {result['seconds']:8.2f} s  {result['bytes'] / 1024 ** 2:10.1f} MB")
+
+    report_path = os.path.join(output_dir, FORMATS_REPORT_FILE_NAME)
+    with open(report_path, "w") as f:
+        json.dump({"input": os.path.abspath(input_path), "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                   "formats": results}, f, indent=4)
+    return report_path
@@ -0,0 +1,719 @@
+"""
+Inference engine shared by the different modes of nnunet_runner.py.
+
+It resolves the model of an (animal, mode, structure) configuration through nnUNet_package,
+builds the nnUNetv2 predictor once and keeps it in memory so that several cases can be
+predicted without reloading torch or the checkpoint.
+"""
+import os
+import sys
+import copy
+import json
+import time
+from contextlib import contextmanager
+from collections import OrderedDict
+
+# LungSegmentationLib lives next to LungSegmentation.py, two levels above this script
+MODULE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if MODULE_DIR not in sys.path:
+    sys.path.insert(0, MODULE_DIR)
+
+from LungSegmentationLib import models, volumeio
+from LungSegmentationLib.presets import PREVIEW_DOWNSAMPLING
+from nnunet_roi import crop_case, paste_segmentation
+
+PREDICTION_FILE_NAME = "001.nrrd"
+PREVIEW_FILE_NAME = "preview.nrrd"
+
+# Models registered in the models folder without nnUNet_package (e.g. the stand-in model of the benchmarks):
+# {animal: {mode: {structure: {"model_path": ..., "fold": ...}}}}, model_path relative to the models folder
+LOCAL_MODELS_FILE_NAME = "local_models.json"
+
+# Output formats: an NRRD file, or raw voxels and a JSON header mapped by the widget (see LungSegmentationLib.volumeio)
+OUTPUT_FORMATS = ("nrrd", "raw")
+
+
+def output_file_name(file_name, output_format="nrrd"):
+    """
+    Returns:
+        str: Name of a prediction file in the given output format (001.nrrd or 001.json).
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format} (available: {', '.join(OUTPUT_FORMATS)})")
+    return os.path.splitext(file_name)[0] + (".json" if output_format == "raw" else ".nrrd")
+
+
+############################################################### MODEL RESOLUTION ###############################################################
+
+def resolve_local_model(models_dir, animal, mode, structure):
+    """
+    Resolves a configuration registered in the local_models.json file of the models folder.
+
+    Args:
+        models_dir (str): Directory where the models are stored.
+        animal (str): Animal to segment.
+        mode (str): Segmentation mode.
+        structure (str): Structure to segment.
+    Returns:
+        dict: Same as resolve_model, None if the configuration is not registered.
+    """
+    registry_path = os.path.join(models_dir, LOCAL_MODELS_FILE_NAME)
+    if not os.path.exists(registry_path):
+        return None
+    with open(registry_path, "r") as f:
+        registry = json.load(f)
+    try:
+        model_info = registry[animal][mode][structure]
+    except KeyError:
+        return None
+
+    model_path = os.path.join(models_dir, model_info["model_path"])
+    return {
+        "model_name": os.path.basename(os.path.normpath(model_path)),
+        "model_path": model_path,
+        "fold": model_info.get("fold", 0),
+        "dataset_json_path": os.path.join(model_path, "dataset.json"),
+    }
+
+
+def resolve_model(models_dir, animal, mode, structure):
+    """
+    Resolves (and downloads if needed) the trained model of a configuration.
+    A configuration registered in local_models.json in the models folder is used as is.
+
+    Args:
+        models_dir (str): Directory where the models are stored.
+        animal (str): Animal to segment ("rabbit", "pig", "rat").
+        mode (str): Segmentation mode ("invivo", "exvivo", "axial").
+        structure (str): Structure to segment.
+    Returns:
+        dict: model_name, model_path (trained model folder), fold and dataset_json_path.
+    Raises:
+        ValueError: If the configuration does not exist in the models configuration.
+        FileNotFoundError: If the downloaded model holds no trained model folder.
+    """
+    local = resolve_local_model(models_dir, animal, mode, structure)
+    if local is not None:
+        return local
+
+    import nnUNet_package.predict as nnunet_predict
+
+    os.makedirs(models_dir, exist_ok=True)
+
+    config_path = os.path.join(os.path.dirname(os.path.abspath(nnunet_predict.__file__)), "models.json")
+    config = nnunet_predict.load_model_config(config_path)
+
+    try:
+        model_info = config["models"][animal][mode][structure]
+        base_url = config["global_config"]["base_url"]
+        model_name = model_info["model_name"]
+        model_url = f"{base_url}/{model_name}/{model_name}.zip"
+    except KeyError:
+        raise ValueError(f"Impossible configuration: {animal} > {mode} > {structure}")
+
+    nnunet_predict.download_and_extract_model(model_url, model_name, models_dir)
+    model_path = models.find_trained_model_folder(os.path.join(models_dir, model_name), model_info["fold"])
+
+    return {
+        "model_name": model_name,
+        "model_path": model_path,
+        "fold": model_info["fold"],
+        "dataset_json_path": os.path.join(model_path, "dataset.json"),
+    }
+
+
+def resolve_folds(model_info, folds="configured"):
+    """
+    Folds of a model used for the prediction.
+
+    Args:
+        model_info (dict): Result of resolve_model.
+        folds (str): "configured" for the fold of models.json, "all" for every trained fold found in the model folder.
+    Returns:
+        tuple: The folds, as expected by nnUNetPredictor.initialize_from_trained_model_folder.
+    """
+    return models.resolve_folds(model_info["model_path"], model_info["fold"], folds)
+
+
+_predictor_class = None
+
+
+def get_predictor_class():
+    """
+    Returns the nnUNetPredictor subclass used by the runner. It reports the sliding window tiles to the
+    ProgressReporter set in its progress attribute (None when no progress is requested).
+
+    Args:
+        None
+    Returns:
+        type: The predictor class.
+    """
+    global _predictor_class
+    if _predictor_class is not None:
+        return _predictor_class
+
+    from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+
+    class ProgressPredictor(nnUNetPredictor):
+        progress = None
+
+        def _internal_get_sliding_window_slicers(self, image_size):
+            slicers = super()._internal_get_sliding_window_slicers(image_size)
+            if self.progress is not None:
+                # The tiles are predicted once per fold
+                self.progress.set_total(len(slicers) * len(self.list_of_parameters))
+            return slicers
+
+        def _internal_maybe_mirror_and_predict(self, x):
+            prediction = super()._internal_maybe_mirror_and_predict(x)
+            if self.progress is not None:
+                self.progress.advance()
+            return prediction
+
+    _predictor_class = ProgressPredictor
+    return _predictor_class
+
+
+def create_predictor(model_path, folds, tile_step_size=0.5, use_mirroring=True, verbose=True):
+    """
+    Creates an nnUNetv2 predictor and loads the checkpoint of the given folds.
+
+    Args:
+        model_path (str): Trained model folder (containing the fold_X subfolders).
+        folds (tuple): Folds to load.
+        tile_step_size (float): Sliding window step, as a fraction of the patch size.
+        use_mirroring (bool): Enables test-time mirroring.
+        verbose (bool): Verbose nnUNet output.
+    Returns:
+        nnUNetPredictor: Initialized predictor.
+    """
+    import torch
+
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+
+    predictor = get_predictor_class()(tile_step_size=tile_step_size,
+                                use_gaussian=True,
+                                use_mirroring=use_mirroring,
+                                perform_everything_on_device=True,
+                                device=device,
+                                verbose=verbose)
+    predictor.initialize_from_trained_model_folder(model_path, folds)
+    return predictor
+
+
+def apply_settings(predictor, settings):
+    """
+    Applies the settings of a speed preset (see LungSegmentationLib.presets) to a loaded predictor.
+    The folds are not changed here: they are chosen when the predictor is loaded.
+
+    Args:
+        predictor (nnUNetPredictor): Initialized predictor.
+        settings (dict): Result of preset_settings, None to keep the current settings.
+    Returns:
+        None
+    """
+    if settings is None:
+        return
+    import torch
+
+    predictor.tile_step_size = settings["tile_step_size"]
+    predictor.use_mirroring = settings["use_mirroring"]
+    if settings.get("threads") and torch.get_num_threads() != settings["threads"]:
+        torch.set_num_threads(settings["threads"])
+
+
+############################################################### LOADED MODELS ###############################################################
+
+class LoadedModel:
+    """
+    A predictor ready for inference together with the information on the model it comes from.
+    """
+    def __init__(self, key, model_info, predictor, load_seconds, folds=None):
+        """
+        Args:
+            key (tuple): (animal, mode, structure, folds, fold_parallel) of the model.
+            model_info (dict): Result of resolve_model.
+            predictor (nnUNetPredictor): Initialized predictor.
+            load_seconds (float): Time spent loading the model.
+            folds (tuple): Folds of the ensemble, the configured fold if None. With fold_parallel, the predictor
+                only holds the weights of the first one (see PredictorCache.get).
+        Returns:
+            None
+        """
+        self.key = key
+        self.model_info = model_info
+        self.predictor = predictor
+        self.load_seconds = load_seconds
+        self.folds = tuple(folds) if folds else (model_info["fold"],)
+        self.uses = 0
+
+    @property
+    def fold_parallel(self):
+        """
+        True if the folds are predicted by the processes of nnunet_folds.py, which load their own weights.
+        """
+        return len(self.key) > 4 and self.key[4] and len(self.folds) > 1
+
+    @property
+    def dataset_json_path(self):
+        return self.model_info["dataset_json_path"]
+
+
+class PredictorCache:
+    """
+    LRU cache of loaded predictors keyed by (animal, mode, structure, folds, fold_parallel).
+    """
+    def __init__(self, models_dir, capacity=2):
+        """
+        Args:
+            models_dir (str): Directory where the models are stored.
+            capacity (int): Maximum number of predictors kept in memory.
+        Returns:
+            None
+        """
+        self.models_dir = models_dir
+        self.capacity = max(1, int(capacity))
+        self._models = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, animal, mode, structure, folds="configured", fold_processes=1):
+        """
+        Returns the loaded model of a configuration, loading it on a cache miss.
+
+        Args:
+            animal (str): Animal to segment.
+            mode (str): Segmentation mode.
+            structure (str): Structure to segment.
+            folds (str): Folds to load (see resolve_folds).
+            fold_processes (int): Processes predicting the folds in parallel (see nnunet_folds.py). With more than
+                one, only the first fold is loaded here: the processes load the weights of the ensemble, this
+                predictor gives the plans, the preprocessing and the low-resolution preview.
+        Returns:
+            LoadedModel: The loaded model.
+        """
+        key = (animal, mode, structure, folds, (fold_processes or 1) > 1)
+        loaded = self._models.get(key)
+        if loaded is not None:
+            self.hits += 1
+            self._models.move_to_end(key)
+        else:
+            self.misses += 1
+            start = time.perf_counter()
+            model_info = resolve_model(self.models_dir, animal, mode, structure)
+            ensemble = resolve_folds(model_info, folds)
+            predictor = create_predictor(model_info["model_path"], ensemble[:1] if key[4] else ensemble)
+            loaded = LoadedModel(key, model_info, predictor, time.perf_counter() - start, ensemble)
+            self._models[key] = loaded
+            while len(self._models) > self.capacity:
+                evicted_key, _ = self._models.popitem(last=False)
+                print(f"Evicting model {evicted_key} from the predictor cache")
+        loaded.uses += 1
+        return loaded
+
+    def stats(self):
+        """
+        Returns:
+            dict: Cache capacity, hit/miss counts and the loaded configurations (least recently used first).
+        """
+        return {
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "loaded": [list(key) for key in self._models],
+        }
+
+
+############################################################### PREDICTION ###############################################################
+
+def read_case(loaded, input_path):
+    """
+    Reads an input image with the reader the model was trained with.
+    A volume header exported by the widget (see LungSegmentationLib.volumeio) is mapped instead,
+    without copying or decoding the voxels.
+
+    Args:
+        loaded (LoadedModel): Model to use.
+        input_path (str): Path to the input image or volume header.
+    Returns:
+        tuple: (image array (c, z, y, x), image properties).
+    """
+    if volumeio.is_volume_header(input_path):
+        return read_mapped_case(input_path)
+
+    reader_writer = loaded.predictor.plans_manager.image_reader_writer_class()
+    return reader_writer.read_images([input_path])
+
+
+def read_mapped_case(header_path):
+    """
+    Maps a volume exported by the widget and builds the same properties as the SimpleITK reader of nnUNet.
+
+    Args:
+        header_path (str): Path to the volume header.
+    Returns:
+        tuple: (read-only image array (1, z, y, x), image properties).
+    """
+    array, header = volumeio.map_volume(header_path)
+    properties = {
+        "sitk_stuff": {
+            "spacing": tuple(header["spacing"]),
+            "origin": tuple(header["origin"]),
+            "direction": tuple(header["direction"]),
+        },
+        "spacing": list(header["spacing"])[::-1],
+    }
+    return array[None], properties
+
+
+def preprocess_case(loaded, image, properties):
+    """
+    Crops, normalizes and resamples an image for the model.
+
+    Args:
+        loaded (LoadedModel): Model to use.
+        image (np.ndarray): Image array returned by read_case.
+        properties (dict): Image properties returned by read_case.
+    Returns:
+        dict: "data" (torch.Tensor) and "data_properties" (dict) ready for predict_preprocessed.
+    """
+    import torch
+
+    predictor = loaded.predictor
+    preprocessor = predictor.configuration_manager.preprocessor_class(verbose=False)
+    data, _, data_properties = preprocessor.run_case_npy(image, None, properties,
+                                                         predictor.plans_manager,
+                                                         predictor.configuration_manager,
+                                                         predictor.dataset_json)
+    return {"data": torch.from_numpy(data), "data_properties": data_properties}
+
+
+def predict_logits(loaded, data, progress=None, settings=None, details=None):
+    """
+    Runs the sliding window inference of every fold on a preprocessed case, in parallel processes with
+    settings["fold_processes"] > 1 and several folds (see nnunet_folds.py).
+
+    Args:
+        loaded (LoadedModel): Model to use, with its settings applied.
+        data (torch.Tensor): Preprocessed case (see preprocess_case).
+        progress (ProgressReporter): Receives the steps of the current stage (per tile, or per fold in parallel), optional.
+        settings (dict): Speed preset settings, optional.
+        details (dict): Receives the timings of the folds predicted in parallel ("fold_parallel"), optional.
+    Returns:
+        torch.Tensor: Logits averaged over the folds, at the spacing of the model.
+    """
+    predictor = loaded.predictor
+    fold_processes = (settings or {}).get("fold_processes") or 1
+    if fold_processes > 1 and loaded.fold_parallel:
+        from nnunet_folds import predict_logits_parallel
+        return predict_logits_parallel(loaded, data, loaded.folds, fold_processes, settings.get("threads"), progress,
+                                       details)
+
+    predictor.progress = progress
+    try:
+        return predictor.predict_logits_from_preprocessed_data(data).cpu()
+    finally:
+        predictor.progress = None
+
+
+def predict_preprocessed(loaded, preprocessed, progress=None, settings=None, details=None):
+    """
+    Runs the sliding window inference on a preprocessed case and resamples the result to the input geometry.
+    With several folds and settings["fold_processes"] > 1, the folds run in parallel processes (see nnunet_folds.py).
+
+    Args:
+        loaded (LoadedModel): Model to use.
+        preprocessed (dict): Result of preprocess_case.
+        progress (ProgressReporter): Receives the "predict" (per tile, or per fold in parallel) and "resample" stages, optional.
+        settings (dict): Speed preset settings (see apply_settings), None to keep the current ones.
+        details (dict): Receives the timings of the folds predicted in parallel ("fold_parallel"), optional.
+    Returns:
+        np.ndarray: Label map with the shape of the input image.
+    """
+    from nnunetv2.inference.export_prediction import convert_predicted_logits_to_segmentation_with_correct_shape
+
+    predictor = loaded.predictor
+    apply_settings(predictor, settings)
+    if progress is not None:
+        progress.stage("predict")
+    logits = predict_logits(loaded, preprocessed["data"], progress, settings, details)
+
+    if progress is not None:
+        progress.stage("resample")
+    return convert_predicted_logits_to_segmentation_with_correct_shape(logits,
+                                                                       predictor.plans_manager,
+                                                                       predictor.configuration_manager,
+                                                                       predictor.label_manager,
+                                                                       preprocessed["data_properties"])
+
+
+def prediction_geometry(properties):
+    """
+    Returns:
+        dict: "spacing", "origin" and "direction" (LPS) of an image read by read_case, for LungSegmentationLib.volumeio.
+    """
+    sitk_stuff = properties["sitk_stuff"]
+    return {
+        "spacing": [float(s) for s in sitk_stuff["spacing"]],
+        "origin": [float(o) for o in sitk_stuff["origin"]],
+        "direction": [float(d) for d in sitk_stuff["direction"]],
+    }
+
+
+def write_prediction(loaded, segmentation, properties, output_dir, file_name=PREDICTION_FILE_NAME):
+    """
+    Writes a label map with the geometry of the input image.
+
+    Args:
+        loaded (LoadedModel): Model used for the prediction.
+        segmentation (np.ndarray): Label map.
+        properties (dict): Image properties returned by read_case.
+        output_dir (str): Output folder.
+        file_name (str): Name of the file, 001.nrrd by default. A .json name hands the label map over
+            uncompressed, as raw voxels and a volume header (see output_file_name).
+    Returns:
+        str: Path to the prediction file.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    prediction_path = os.path.join(output_dir, file_name)
+    if file_name.endswith(".json"):
+        import numpy as np
+        dtype = np.uint8 if segmentation.max(initial=0) < 256 else np.uint16
+        return volumeio.export_array(segmentation.astype(dtype, copy=False), prediction_geometry(properties),
+                                     prediction_path)
+
+    reader_writer = loaded.predictor.plans_manager.image_reader_writer_class()
+    reader_writer.write_seg(segmentation, prediction_path, properties)
+    return prediction_path
+
+
+def crop_to_roi(loaded, image, properties, settings=None):
+    """
+    Crops an image to the region of interest of the configuration of the model (see nnunet_roi.py).
+
+    Args:
+        loaded (LoadedModel): Model to use.
+        image (np.ndarray): Image array returned by read_case.
+        properties (dict): Image properties returned by read_case.
+        settings (dict): Preset settings; the image is not cropped if their "crop" is False.
+    Returns:
+        tuple: (cropped image, roi to give to paste_segmentation, None if not cropped)
+    """
+    animal, mode, structure = loaded.key[:3]
+    enabled = settings is None or settings.get("crop", True)
+    return crop_case(image, properties, mode, structure, enabled)
+
+
+def input_details(image, properties):
+    """
+    Returns:
+        dict: "input_shape" (z, y, x) and "input_spacing" (z, y, x) of an image returned by read_case.
+    """
+    spacing = properties.get("spacing")
+    return {
+        "input_shape": [int(n) for n in image.shape[1:]],
+        "input_spacing": [float(s) for s in spacing] if spacing is not None else None,
+    }
+
+
+def runtime_details():
+    """
+    Returns:
+        dict: "torch_threads" (intra-op threads of the inference) and "peak_rss_bytes" (peak resident memory
+            of this process since it started).
+    """
+    import torch
+    from LungSegmentationLib.telemetry import peak_rss_bytes
+
+    return {"torch_threads": torch.get_num_threads(), "peak_rss_bytes": peak_rss_bytes()}
+
+
+def predict_case(loaded, input_path, output_dir, progress=None, settings=None, details=None,
+                 file_name=PREDICTION_FILE_NAME):
+    """
+    Predicts one volume with an already loaded model and writes 001.nrrd in the output folder.
+    The inference runs on the region of interest of the volume, and the label map is pasted back
+    into the full volume. With settings["stream_memory_bytes"] or settings["slice_batch"], the volume is
+    predicted slab by slab within that memory or of that many slices (see nnunet_stream.py).
+
+    Args:
+        loaded (LoadedModel): Model to use.
+        input_path (str): Path to the input image.
+        output_dir (str): Output folder.
+        progress (ProgressReporter): Receives the progress of every stage, optional.
+        settings (dict): Speed preset settings (see LungSegmentationLib.presets), optional.
+        details (dict): Receives the region of interest ("roi"), the shape and spacing of the input and the timings
+            of the folds predicted in parallel, optional.
+        file_name (str): Name of the prediction file.
+    Returns:
+        str: Path to the prediction file.
+    """
+    if (settings or {}).get("stream_memory_bytes") or (settings or {}).get("slice_batch"):
+        from nnunet_stream import predict_case_streamed
+        return predict_case_streamed(loaded, input_path, output_dir, progress, settings, details, file_name)
+
+    if progress is not None:
+        progress.stage("preprocess")
+    image, properties = read_case(loaded, input_path)
+    if details is not None:
+        details.update(input_details(image, properties))
+    image, roi = crop_to_roi(loaded, image, properties, settings)
+    if details is not None:
+        details["roi"] = roi
+    preprocessed = preprocess_case(loaded, image, properties)
+    del image
+
+    segmentation = paste_segmentation(predict_preprocessed(loaded, preprocessed, progress, settings, details), roi)
+    del preprocessed
+
+    if progress is not None:
+        progress.stage("export")
+    prediction_path = write_prediction(loaded, segmentation, properties, output_dir, file_name)
+    if progress is not None:
+        progress.finish()
+    return prediction_path
+
+
+def preprocessing_key(loaded):
+    """
+    Identifies the preprocessing of a model: two models with the same key preprocess an image into the same data.
+
+    Args:
+        loaded (LoadedModel): Model to use.
+    Returns:
+        str: Preprocessor class, target spacing, normalization schemes and intensity properties, and axes order.
+    """
+    predictor = loaded.predictor
+    manager = predictor.configuration_manager
+    plans = predictor.plans_manager
+    return json.dumps({
+        "preprocessor": manager.preprocessor_class.__name__,
+        "spacing": [float(s) for s in manager.spacing],
+        "normalization": list(manager.normalization_schemes),
+        "mask_for_norm": list(manager.use_mask_for_norm),
+        "intensities": plans.foreground_intensity_properties_per_channel,
+        "transpose": list(plans.transpose_forward),
+    }, sort_keys=True)
+
+
+def predict_structures(cache, animal, mode, structures, input_path, output_dir, progress=None, settings=None,
+                       output_format="nrrd", details=None):
+    """
+    Predicts several structures of one volume with their models, one after the other.
+    The volume is read once, and preprocessed once per distinct region of interest and preprocessing
+    (see preprocessing_key): models sharing them run on the same preprocessed data in memory.
+
+    Args:
+        cache (PredictorCache): Cache of loaded predictors.
+        animal (str): Animal to segment.
+        mode (str): Segmentation mode.
+        structures (list): Structures to segment, one model each.
+        input_path (str): Path to the input image.
+        output_dir (str): Output folder, receiving <structure>/001.nrrd.
+        progress (ProgressReporter): Receives the progress, one "predict" step per structure, optional.
+        settings (dict): Speed preset settings (see LungSegmentationLib.presets), optional.
+        output_format (str): "nrrd" or "raw" (see output_file_name).
+        details (dict): Receives the shape and spacing of the input, optional.
+    Returns:
+        dict: Structure -> "prediction", "dataset_json_path", "roi" and "shared_preprocessing" (True if the
+        preprocessed data of a previous structure was reused).
+    """
+    folds = settings["folds"] if settings else "configured"
+    fold_processes = settings.get("fold_processes", 1) if settings else 1
+    image = properties = None
+    preprocessed = {}
+    results = {}
+
+    if progress is not None:
+        progress.stage("preprocess")
+    for index, structure in enumerate(structures):
+        loaded = cache.get(animal, mode, structure, folds, fold_processes)
+        if image is None:
+            image, properties = read_case(loaded, input_path)
+            if details is not None:
+                details.update(input_details(image, properties))
+
+        cropped, roi = crop_to_roi(loaded, image, properties, settings)
+        key = (json.dumps(roi["box"] if roi else None), preprocessing_key(loaded))
+        shared = key in preprocessed
+        if shared:
+            print(f"{structure}: reusing the preprocessed data")
+        else:
+            # run_case_npy adds its own fields to the properties
+            preprocessed[key] = preprocess_case(loaded, cropped, copy.deepcopy(properties))
+        del cropped
+
+        if progress is not None and index == 0:
+            progress.stage("predict", total=len(structures))
+        segmentation = paste_segmentation(predict_preprocessed(loaded, preprocessed[key], None, settings), roi)
+        prediction_path = write_prediction(loaded, segmentation, properties, os.path.join(output_dir, structure),
+                                           output_file_name(PREDICTION_FILE_NAME, output_format))
+        del segmentation
+        results[structure] = {
+            "prediction": prediction_path,
+            "dataset_json_path": loaded.dataset_json_path,
+            "roi": roi,
+            "shared_preprocessing": shared,
+        }
+        if progress is not None:
+            progress.advance()
+
+    print(f"{len(structures)} structures predicted with {len(preprocessed)} preprocessing(s) of the input")
+    if progress is not None:
+        progress.finish()
+    return results
+
+
+@contextmanager
+def preview_predictor(loaded, downsampling):
+    """
+    Makes a loaded predictor work at a coarser spacing than the one of its model, with its first fold only:
+    the case is resampled to downsampling times the target spacing before the inference (about downsampling^3
+    fewer voxels and tiles), and the logits are resampled back to the input grid as usual. The network sees the
+    anatomy smaller than during training, so the result is only good enough for a preview.
+
+    Args:
+        loaded (LoadedModel): Model to use.
+        downsampling (float): Factor applied to the target spacing.
+    Returns:
+        None
+    """
+    predictor = loaded.predictor
+    manager = predictor.configuration_manager
+    parameters = predictor.list_of_parameters
+    folds = loaded.folds
+    coarse = copy.copy(manager)
+    coarse.configuration = dict(manager.configuration, spacing=[float(s) * downsampling for s in manager.spacing])
+    predictor.configuration_manager = coarse
+    predictor.list_of_parameters = parameters[:1]
+    # The preview runs in this process, also in fold-parallel mode
+    loaded.folds = folds[:1]
+    try:
+        yield
+    finally:
+        predictor.configuration_manager = manager
+        predictor.list_of_parameters = parameters
+        loaded.folds = folds
+
+
+def predict_preview(loaded, input_path, output_dir, progress=None, settings=None, details=None, output_format="nrrd"):
+    """
+    Predicts a low-resolution preview of a volume (see preview_predictor) and writes preview.nrrd in the output folder,
+    with the geometry of the input like the full prediction.
+
+    Args:
+        loaded (LoadedModel): Model to use, the one of the full prediction.
+        input_path (str): Path to the input image.
+        output_dir (str): Output folder.
+        progress (ProgressReporter): Receives the "preview" stage, optional.
+        settings (dict): Result of LungSegmentationLib.presets.preview_settings.
+        details (dict): Receives the region of interest ("roi"), optional.
+        output_format (str): "nrrd" or "raw" (see output_file_name).
+    Returns:
+        str: Path to the preview file.
+    """
+    if progress is not None:
+        progress.stage("preview")
+    with preview_predictor(loaded, (settings or {}).get("downsampling", PREVIEW_DOWNSAMPLING)):
+        return predict_case(loaded, input_path, output_dir, None, settings, details,
+                            output_file_name(PREVIEW_FILE_NAME, output_format))
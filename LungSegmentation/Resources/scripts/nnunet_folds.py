@@ -0,0 +1,250 @@
+"""
+Fold-parallel ensemble inference of nnunet_runner.py (--fold_processes).
+
+nnUNetPredictor runs the folds of an ensemble one after the other, each with all the intra-op threads of
+torch, and a single fold does not scale to the cores of a large CPU server. Here the folds run in a pool of
+processes, each with a bounded number of threads (the threads of the preset shared by the processes).
+The preprocessed case is handed to the processes as a memory-mapped .npy file, and every process writes
+the logits of its fold to its own memory-mapped float16 buffer, so that no array is pickled. The parent
+averages the buffers slab by slab, as nnUNet averages the folds, before the usual resampling.
+
+The parent loads the first fold only (see nnunet_engine.PredictorCache.get): it needs the plans, the
+preprocessor and the label manager, not the weights of the ensemble, which are held by the processes alone.
+The pool and the predictors loaded in its processes are kept for the next predictions (e.g. of the worker).
+Every process holds the weights and the full logits of its fold while it predicts: the peak memory grows with
+the number of processes (see LungSegmentationLib.memory.estimate_peak_memory).
+"""
+import os
+import time
+import shutil
+import tempfile
+import warnings
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+# Predictors kept in memory by every process of the pool, keyed by (model path, fold)
+PROCESS_CACHE_SIZE = 5
+# Slices of the logits averaged at once by the parent
+AVERAGE_SLAB = 16
+
+_pool = None
+_pool_key = None
+# Predictors of a process of the pool
+_process_predictors = OrderedDict()
+
+
+def fold_threads(processes, threads=None):
+    """
+    Returns:
+        int: Intra-op threads of every process when threads (all the cores if None) are shared by the processes.
+    """
+    total = threads or os.cpu_count() or 1
+    return max(1, int(total) // max(1, int(processes)))
+
+
+def get_pool(processes, threads):
+    """
+    Returns the pool of fold processes, creating it (or replacing it if its size changed) if needed.
+
+    Args:
+        processes (int): Number of processes.
+        threads (int): Intra-op threads of every process.
+    Returns:
+        ProcessPoolExecutor: The pool.
+    """
+    global _pool, _pool_key
+    if _pool is not None and _pool_key == (processes, threads):
+        return _pool
+    shutdown_pool()
+    # torch is not fork-safe once its thread pools are started
+    context = multiprocessing.get_context("spawn")
+    _pool = ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=_init_process,
+                                initargs=(threads,))
+    _pool_key = (processes, threads)
+    return _pool
+
+
+def shutdown_pool():
+    """
+    Stops the processes of the pool, if any.
+    """
+    global _pool, _pool_key
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+    _pool = _pool_key = None
+
+
+def _init_process(threads):
+    """
+    Initializer of the processes of the pool.
+    """
+    import torch
+
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+
+def _get_process_predictor(model_path, fold):
+    """
+    Returns the predictor of one fold in a process of the pool, loading it if needed.
+
+    Returns:
+        tuple: (nnUNetPredictor, seconds spent loading it, 0 if it was already loaded)
+    """
+    key = (model_path, fold)
+    predictor = _process_predictors.get(key)
+    if predictor is not None:
+        _process_predictors.move_to_end(key)
+        return predictor, 0.0
+
+    from nnunet_engine import create_predictor
+
+    start = time.perf_counter()
+    predictor = create_predictor(model_path, (fold,), verbose=False)
+    _process_predictors[key] = predictor
+    while len(_process_predictors) > PROCESS_CACHE_SIZE:
+        _process_predictors.popitem(last=False)
+    return predictor, time.perf_counter() - start
+
+
+def _predict_fold(model_path, fold, data_path, logits_path, tile_step_size, use_mirroring):
+    """
+    Runs in a process of the pool: predicts the logits of one fold and writes them to a float16 buffer.
+
+    Args:
+        model_path (str): Trained model folder.
+        fold (int or str): Fold to predict with.
+        data_path (str): Memory-mapped .npy file of the preprocessed case.
+        logits_path (str): .npy file receiving the logits of the fold.
+        tile_step_size (float): Sliding window step of the prediction.
+        use_mirroring (bool): Test-time mirroring.
+    Returns:
+        dict: "fold", "pid", "threads", "load_seconds", "predict_seconds" and "write_seconds".
+    """
+    import numpy as np
+    import torch
+
+    predictor, load_seconds = _get_process_predictor(model_path, fold)
+    predictor.tile_step_size = tile_step_size
+    predictor.use_mirroring = use_mirroring
+
+    start = time.perf_counter()
+    with warnings.catch_warnings():
+        # The case is mapped read-only, which torch warns about
+        warnings.simplefilter("ignore", UserWarning)
+        data = torch.from_numpy(np.load(data_path, mmap_mode="r"))
+    logits = predictor.predict_logits_from_preprocessed_data(data).cpu()
+    predict_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    buffer = np.lib.format.open_memmap(logits_path, mode="w+", dtype=np.float16, shape=tuple(logits.shape))
+    buffer[:] = logits.numpy()
+    buffer.flush()
+    del buffer, logits
+    return {
+        "fold": fold,
+        "pid": os.getpid(),
+        "threads": torch.get_num_threads(),
+        "load_seconds": round(load_seconds, 3),
+        "predict_seconds": round(predict_seconds, 3),
+        "write_seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+def average_buffers(paths):
+    """
+    Averages the float16 logits of the folds slab by slab.
+
+    Args:
+        paths (list): .npy files of the logits (c, z, y, x), one per fold.
+    Returns:
+        np.ndarray: Average logits in float32.
+    """
+    import numpy as np
+
+    buffers = [np.load(path, mmap_mode="r") for path in paths]
+    average = np.empty(buffers[0].shape, dtype=np.float32)
+    for z in range(0, average.shape[1], AVERAGE_SLAB):
+        slab = slice(z, z + AVERAGE_SLAB)
+        accumulator = buffers[0][:, slab].astype(np.float32)
+        for buffer in buffers[1:]:
+            accumulator += buffer[:, slab]
+        average[:, slab] = accumulator / len(buffers)
+    return average
+
+
+def predict_logits_parallel(loaded, data, folds, processes, threads=None, progress=None, details=None):
+    """
+    Predicts the logits of a preprocessed case with every fold in its own process, and averages them.
+
+    Args:
+        loaded (LoadedModel): Model to use (its predictor gives the sliding window settings, not the weights).
+        data (torch.Tensor): Preprocessed case (see nnunet_engine.preprocess_case).
+        folds (tuple): Folds of the ensemble.
+        processes (int): Number of processes, at most one per fold.
+        threads (int): Intra-op threads shared by the processes, all the cores if None.
+        progress (ProgressReporter): Receives one "predict" step per fold, optional.
+        details (dict): Receives "fold_parallel": processes, threads per process and the timings of every fold, optional.
+    Returns:
+        torch.Tensor: Average logits, as returned by nnUNetPredictor.predict_logits_from_preprocessed_data.
+    """
+    import numpy as np
+    import torch
+
+    predictor = loaded.predictor
+    processes = max(1, min(int(processes), len(folds)))
+    threads_per_process = fold_threads(processes, threads)
+    start = time.perf_counter()
+    pool = get_pool(processes, threads_per_process)
+    workdir = tempfile.mkdtemp(prefix="nnunet_folds_")
+    try:
+        data_path = os.path.join(workdir, "data.npy")
+        np.save(data_path, data.numpy() if isinstance(data, torch.Tensor) else data)
+        handoff_seconds = time.perf_counter() - start
+
+        logits_paths = {fold: os.path.join(workdir, f"fold_{fold}.npy") for fold in folds}
+        futures = [pool.submit(_predict_fold, loaded.model_info["model_path"], fold, data_path, logits_paths[fold],
+                               predictor.tile_step_size, predictor.use_mirroring) for fold in folds]
+        if progress is not None:
+            progress.set_total(len(folds))
+        timings = []
+        try:
+            for future in as_completed(futures):
+                timing = future.result()
+                timings.append(timing)
+                print(f"Fold {timing['fold']}: predicted in {timing['predict_seconds']:.1f} s "
+                      f"({timing['threads']} threads, loaded in {timing['load_seconds']:.1f} s)")
+                if progress is not None:
+                    progress.advance()
+        except BrokenProcessPool:
+            # A process died (e.g. out of memory): the next prediction starts a new pool
+            shutdown_pool()
+            raise
+        finally:
+            for future in futures:
+                future.cancel()
+
+        average_start = time.perf_counter()
+        logits = torch.from_numpy(average_buffers([logits_paths[fold] for fold in folds]))
+        average_seconds = time.perf_counter() - average_start
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    wall_seconds = time.perf_counter() - start
+    print(f"{len(folds)} folds predicted in {wall_seconds:.1f} s with {processes} processes of "
+          f"{threads_per_process} threads")
+    if details is not None:
+        details["fold_parallel"] = {
+            "processes": processes,
+            "threads_per_process": threads_per_process,
+            "handoff_seconds": round(handoff_seconds, 3),
+            "average_seconds": round(average_seconds, 3),
+            "wall_seconds": round(wall_seconds, 3),
+            "folds": sorted(timings, key=lambda timing: str(timing["fold"])),
+        }
+    return logits
@@ -0,0 +1,165 @@
+"""
+Structured progress events of a prediction.
+
+Every event is a dict such as
+    {"event": "progress", "stage": "predict", "done": 12, "total": 48, "percent": 37.5,
+     "elapsed": 41.2, "eta": 68.7}
+where stage is one of STAGES, done/total count the steps of the stage (sliding window tiles for
+"predict") and percent/eta estimate the progress of the whole prediction. The "preview" stage is only
+reported by the low-resolution preview requests.
+
+A prediction streamed slab by slab (see nnunet_stream.py) also publishes every range of slices whose label
+map is written, so that it can be shown before the end of the prediction:
+    {"event": "slab", "start": 0, "stop": 16, "depth": 240, "prediction": ".../001.json", "dataset_json_path": ...}
+
+The reporter also measures the time spent in every stage (see durations), written to the metrics of the job.
+"""
+import time
+
+# Stages of a prediction and their share of the total time, used to compute the overall percentage
+STAGES = (
+    ("load", 5.0),
+    ("preview", 5.0),
+    ("preprocess", 10.0),
+    ("predict", 70.0),
+    ("resample", 7.0),
+    ("export", 3.0),
+)
+
+# Minimum time in seconds between two events of the same stage
+MIN_INTERVAL = 0.5
+
+
+class ProgressReporter:
+    """
+    Computes the overall progress from the current stage and sends the events through a callback.
+    """
+    def __init__(self, emit):
+        """
+        Args:
+            emit (callable): Function called with every event dict.
+        Returns:
+            None
+        """
+        self.emit = emit
+        self.start_time = time.perf_counter()
+        self.stage_name = None
+        self.done = 0
+        self.total = 1
+        self._last_emit = 0.0
+        self._stage_start = None
+        self._stage_seconds = {}
+
+        self._offsets = {}
+        offset = 0.0
+        for name, weight in STAGES:
+            self._offsets[name] = (offset, weight)
+            offset += weight
+        self._total_weight = offset
+
+    def percent(self):
+        """
+        Returns:
+            float: Estimated progress of the whole prediction, between 0 and 100.
+        """
+        if self.stage_name not in self._offsets:
+            return 0.0
+        offset, weight = self._offsets[self.stage_name]
+        fraction = min(1.0, self.done / self.total) if self.total else 1.0
+        return 100.0 * (offset + weight * fraction) / self._total_weight
+
+    def stage(self, name, total=1):
+        """
+        Starts a stage.
+
+        Args:
+            name (str): Name of the stage (see STAGES).
+            total (int): Number of steps of the stage.
+        Returns:
+            None
+        """
+        self._close_stage()
+        self.stage_name = name
+        self._stage_start = time.perf_counter()
+        self.done = 0
+        self.total = max(1, int(total))
+        self._send(force=True)
+
+    def set_total(self, total):
+        """
+        Changes the number of steps of the current stage (known once the stage has started).
+        """
+        self.total = max(1, int(total))
+
+    def advance(self, steps=1):
+        """
+        Marks steps of the current stage as done. Events are throttled to one every MIN_INTERVAL seconds.
+        """
+        self.done += steps
+        self._send(force=self.done >= self.total)
+
+    def slab(self, start, stop, depth, prediction_path, dataset_json_path=None):
+        """
+        Publishes slices of a streamed prediction whose label map is written (never throttled).
+
+        Args:
+            start (int): First slice (z) of the label map.
+            stop (int): Slice after the last one.
+            depth (int): Number of slices of the label map.
+            prediction_path (str): Label map written in place (volume header, see LungSegmentationLib.volumeio).
+            dataset_json_path (str): dataset.json of the model, giving the names of the labels.
+        Returns:
+            None
+        """
+        self.emit({
+            "event": "slab",
+            "start": int(start),
+            "stop": int(stop),
+            "depth": int(depth),
+            "prediction": prediction_path,
+            "dataset_json_path": dataset_json_path,
+        })
+
+    def finish(self):
+        """
+        Sends the final event (100%).
+        """
+        self._close_stage()
+        self.stage_name = STAGES[-1][0]
+        self.done = self.total = 1
+        self._send(force=True)
+
+    def durations(self):
+        """
+        Returns:
+            dict: Stage -> seconds spent in it so far (a stage started several times is summed).
+        """
+        durations = dict(self._stage_seconds)
+        if self._stage_start is not None:
+            durations[self.stage_name] = durations.get(self.stage_name, 0.0) + time.perf_counter() - self._stage_start
+        return {name: round(seconds, 3) for name, seconds in durations.items()}
+
+    def _close_stage(self):
+        if self._stage_start is not None:
+            seconds = time.perf_counter() - self._stage_start
+            self._stage_seconds[self.stage_name] = self._stage_seconds.get(self.stage_name, 0.0) + seconds
+            self._stage_start = None
+
+    def _send(self, force=False):
+        now = time.perf_counter()
+        if not force and now - self._last_emit < MIN_INTERVAL:
+            return
+        self._last_emit = now
+
+        elapsed = now - self.start_time
+        percent = self.percent()
+        eta = elapsed * (100.0 - percent) / percent if percent > 0 else None
+        self.emit({
+            "event": "progress",
+            "stage": self.stage_name,
+            "done": self.done,
+            "total": self.total,
+            "percent": round(percent, 1),
+            "elapsed": round(elapsed, 1),
+            "eta": round(eta, 1) if eta is not None else None,
+        })
@@ -0,0 +1,199 @@
+"""
+Region of interest cropping before the inference.
+
+In vivo scans contain a lot of air, table and abdomen around the lungs. The thorax is located on a
+downsampled copy of the image with a threshold (-500 HU, or Otsu for other units) and a little morphology: the lungs are the dark
+regions enclosed by the body in their axial slice. The inference runs on the
+bounding box of the lungs plus a margin, and the prediction is pasted back into the full image so that
+the written label map keeps the geometry of the input.
+
+When the model also segments organs outside the thorax (kidneys, liver), the box of the whole body is
+used instead.
+"""
+import numpy as np
+
+# Modes whose cases are cropped: ex vivo lungs lie in air and are not enclosed by a body
+CROP_MODES = ("invivo",)
+# Structures outside the thorax: the body box is used instead of the lungs box
+BODY_STRUCTURE_KEYWORDS = ("kidneys", "liver")
+
+# Lungs and air are below this value in Hounsfield units, soft tissues above
+HU_TISSUE_THRESHOLD = -500.0
+ROI_MARGIN_MM = 15.0
+DOWNSAMPLING = 4
+# Minimum size of a dark enclosed region kept as lung: share of the image, and share of the largest region
+MIN_LUNG_FRACTION = 0.002
+LUNG_SIZE_RATIO = 0.1
+# The crop is not worth it if it removes less than this share of the voxels
+MIN_REDUCTION = 0.10
+
+
+def otsu_threshold(values, bins=256):
+    """
+    Args:
+        values (np.ndarray): Intensities.
+        bins (int): Number of bins of the histogram.
+    Returns:
+        float: Threshold maximizing the between-class variance.
+    """
+    histogram, edges = np.histogram(values, bins=bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    weight_low = np.cumsum(histogram)
+    weight_high = weight_low[-1] - weight_low
+    sum_low = np.cumsum(histogram * centers)
+    mean_low = sum_low / np.maximum(weight_low, 1)
+    mean_high = (sum_low[-1] - sum_low) / np.maximum(weight_high, 1)
+    variance = weight_low * weight_high * (mean_low - mean_high) ** 2
+    return float(centers[np.argmax(variance)])
+
+
+def tissue_threshold(volume):
+    """
+    Threshold between the air/lungs and the soft tissues.
+
+    Args:
+        volume (np.ndarray): Intensities.
+    Returns:
+        float: HU_TISSUE_THRESHOLD for images in Hounsfield units (air around -1000), the Otsu threshold otherwise.
+    """
+    low, high = np.percentile(volume, [1, 99])
+    if low <= -900 and high >= 0:
+        return HU_TISSUE_THRESHOLD
+    return otsu_threshold(volume)
+
+
+def _bounding_box(mask):
+    """
+    Returns:
+        list: [start, stop) of the mask along every axis, None if the mask is empty.
+    """
+    box = []
+    for axis in range(mask.ndim):
+        other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+        indices = np.flatnonzero(mask.any(axis=other_axes))
+        if indices.size == 0:
+            return None
+        box.append([int(indices[0]), int(indices[-1]) + 1])
+    return box
+
+
+def find_roi(volume, spacing, method="lungs", margin_mm=ROI_MARGIN_MM):
+    """
+    Finds the box of the lungs (or of the body) in a volume.
+
+    Args:
+        volume (np.ndarray): Intensities (z, y, x).
+        spacing (sequence): Voxel spacing (z, y, x) in mm.
+        method (str): "lungs" or "body".
+        margin_mm (float): Margin added around the box, in mm.
+    Returns:
+        list: [start, stop) along z, y, x in voxels of the volume, None if nothing was found.
+    """
+    from scipy import ndimage
+
+    step = DOWNSAMPLING
+    small = np.asarray(volume[::step, ::step, ::step], dtype=np.float32)
+    if small.size == 0 or min(small.shape) < 3:
+        return None
+
+    tissue = small > tissue_threshold(small)
+    structure = ndimage.generate_binary_structure(3, 1)
+    # Opening removes the table and the thin structures around the patient
+    body = ndimage.binary_opening(tissue, structure=structure, iterations=1)
+    labels, count = ndimage.label(body)
+    if count == 0:
+        return None
+    sizes = ndimage.sum_labels(body, labels, index=np.arange(1, count + 1))
+    body = labels == (int(np.argmax(sizes)) + 1)
+
+    mask = body
+    if method == "lungs":
+        # Dark regions enclosed by the body in their axial slice (the outside air touches the border of the slice;
+        # labeling the slices separately keeps the lungs apart from the outside air through the trachea)
+        dark = ~tissue
+        in_slice = np.zeros((3, 3, 3), dtype=bool)
+        in_slice[1] = ndimage.generate_binary_structure(2, 1)
+        labels, count = ndimage.label(dark, structure=in_slice)
+        border = np.unique(np.concatenate([
+            labels[:, 0].ravel(), labels[:, -1].ravel(),
+            labels[:, :, 0].ravel(), labels[:, :, -1].ravel(),
+        ]))
+        enclosed = dark & ~np.isin(labels, border)
+
+        # The lungs are the largest enclosed regions; small ones (bowel gas...) are dropped
+        labels, count = ndimage.label(enclosed, structure=structure)
+        if count > 0:
+            sizes = ndimage.sum_labels(enclosed, labels, index=np.arange(1, count + 1))
+            keep = [index + 1 for index, size in enumerate(sizes)
+                    if size >= max(MIN_LUNG_FRACTION * small.size, LUNG_SIZE_RATIO * sizes.max())]
+            if keep:
+                mask = np.isin(labels, keep)
+
+    box = _bounding_box(mask)
+    if box is None:
+        return None
+
+    full_box = []
+    for axis, (start, stop) in enumerate(box):
+        margin = int(np.ceil(margin_mm / float(spacing[axis])))
+        start = max(0, start * step - margin)
+        stop = min(volume.shape[axis], stop * step + margin)
+        full_box.append([start, stop])
+    return full_box
+
+
+def crop_case(image, properties, mode, structure, enabled=True):
+    """
+    Crops an image read by read_case to the region of interest of its configuration.
+
+    Args:
+        image (np.ndarray): Image array (c, z, y, x).
+        properties (dict): Image properties, with "spacing" in (z, y, x) order.
+        mode (str): Segmentation mode.
+        structure (str): Structure to segment.
+        enabled (bool): False to never crop.
+    Returns:
+        tuple: (cropped image, roi) where roi is None if the image is not cropped, else a dict with
+        "box" ([start, stop) along z, y, x), "shape" (full shape) and "kept" (share of the voxels kept).
+    """
+    if not enabled or mode not in CROP_MODES or image.ndim != 4:
+        return image, None
+
+    method = "body" if any(keyword in structure for keyword in BODY_STRUCTURE_KEYWORDS) else "lungs"
+    try:
+        box = find_roi(image[0], properties["spacing"], method)
+    except Exception as e:
+        print(f"ROI crop skipped: {e}")
+        return image, None
+    if box is None:
+        print("ROI crop skipped: no region found")
+        return image, None
+
+    shape = image.shape[1:]
+    kept = float(np.prod([stop - start for start, stop in box])) / float(np.prod(shape))
+    box_text = ", ".join(f"{axis} {start}:{stop}" for axis, (start, stop) in zip("zyx", box))
+    if kept > 1.0 - MIN_REDUCTION:
+        print(f"ROI crop skipped: the {method} box ({box_text}) keeps {kept:.0%} of the voxels")
+        return image, None
+
+    print(f"ROI crop ({method}): {box_text} of {list(shape)}, {kept:.1%} of the voxels kept "
+          f"({1.0 - kept:.1%} reduction)")
+    slices = (slice(None),) + tuple(slice(start, stop) for start, stop in box)
+    return image[slices], {"box": box, "shape": list(shape), "kept": round(kept, 4), "method": method}
+
+
+def paste_segmentation(segmentation, roi):
+    """
+    Pastes the segmentation of a cropped image back into the full image.
+
+    Args:
+        segmentation (np.ndarray): Label map of the cropped image (z, y, x).
+        roi (dict): Region returned by crop_case, None if the image was not cropped.
+    Returns:
+        np.ndarray: Label map with the shape of the full image.
+    """
+    if roi is None:
+        return segmentation
+    full = np.zeros(roi["shape"], dtype=segmentation.dtype)
+    full[tuple(slice(start, stop) for start, stop in roi["box"])] = segmentation
+    return full
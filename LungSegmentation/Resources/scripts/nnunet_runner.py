@@ -1,32 +1,190 @@
-if __name__ == "__main__":
-    import argparse
-    import sys
-    import json
-    from pathlib import Path
-    from nnUNet_package.predict import run_nnunet_prediction
-    from nnUNet_package import GLOBAL_CONTEXT
+import os
+import argparse
+
+
+def parse_args(argv=None):
+    """
+    Parses the command line of the runner.
 
-    parser = argparse.ArgumentParser()
+    Args:
+        argv (list): Arguments, sys.argv by default.
+    Returns:
+        argparse.Namespace: Parsed arguments.
+    """
     parser = argparse.ArgumentParser(description="nnUNetv2 Prediction Script")
     parser.add_argument("--mode", default="invivo", choices=["invivo", "exvivo", "axial"])
-    parser.add_argument("--structure", required=True)
-    parser.add_argument("--input", required=True, help="Input image (.nii, .mha, .nrrd...)")
+    parser.add_argument("--structure", nargs="+",
+                        help="Structure(s) to segment (required for a single prediction); several structures share the "
+                             "preprocessing of the input and are written to <output>/<structure>/001.nrrd")
+    parser.add_argument("--input", help="Input image (.nii, .mha, .nrrd...) (required for a single prediction)")
     parser.add_argument("--output", default="prediction", help="Output directory")
     parser.add_argument("--models_dir", required=True, help="Directory to store models")
     parser.add_argument("--animal", default="rabbit", choices=["rabbit", "pig", "rat"])
     parser.add_argument("--name", default="prediction", help="Final file name")
     parser.add_argument("--tmp_file", default=None, help="Temporary file to store the dataset json path")
-    args = parser.parse_args()
+    parser.add_argument("--worker", action="store_true", help="Run as a long-lived worker reading JSON requests on stdin")
+    parser.add_argument("--cache_size", type=int, default=2, help="Number of models kept in memory by the worker")
+    parser.add_argument("--progress", action="store_true", help="Print JSON progress events on stdout")
+    parser.add_argument("--batch", default=None, help="Folder of images and DICOM series folders, or CSV/JSON manifest of cases to predict")
+    parser.add_argument("--prefetch", type=int, default=2, help="Number of cases preprocessed ahead of the inference in batch mode")
+    parser.add_argument("--no_resume", action="store_true", help="Predict again the cases already done in batch mode")
+    parser.add_argument("--preset", default="accurate", choices=["fast", "balanced", "accurate", "ensemble"],
+                        help="Speed preset: sliding window step, test-time mirroring and folds ('ensemble' predicts every fold)")
+    parser.add_argument("--threads", type=int, default=None, help="Intra-op threads of torch (all the cores by default)")
+    parser.add_argument("--no_crop", action="store_true", help="Run the inference on the whole image instead of the lungs region")
+    parser.add_argument("--fold_processes", type=int, default=1,
+                        help="Predict the folds of the ensemble in this many processes sharing --threads (1: one after the other)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Predict the volume slab by slab with a disk-backed accumulator, for volumes that do not fit in memory")
+    parser.add_argument("--max_memory_gb", type=float, default=None,
+                        help="Memory ceiling of --stream in GiB (the memory budget of the jobs by default)")
+    parser.add_argument("--slice_batch", type=int, default=None,
+                        help="Slices predicted per slab, whose label map is written and published slab by slab "
+                             "(16 by default in axial mode, 0 to predict the whole volume at once)")
+    parser.add_argument("--output_format", default="nrrd", choices=["nrrd", "raw"],
+                        help="Write 001.nrrd, or raw voxels with a JSON header (001.json) for a fast hand-off")
+    parser.add_argument("--preview", action="store_true", help="Write a low-resolution preview.nrrd before the full prediction")
+    parser.add_argument("--compare_presets", action="store_true",
+                        help="Predict --input with every preset and report the speedup and Dice against 'accurate'")
+    parser.add_argument("--compare_formats", action="store_true",
+                        help="Save the label map --input in every segmentation format and report the export time and size")
+    args = parser.parse_args(argv)
+
+    if args.compare_formats:
+        if not args.input:
+            parser.error("--input is required for --compare_formats")
+        return args
+    if not args.worker and not args.batch and (not args.structure or not args.input):
+        parser.error("--structure and --input are required for a single prediction or --compare_presets")
+
+    args.structures = args.structure or []
+    args.structure = args.structures[0] if args.structures else None
+    if len(args.structures) > 1 and (args.batch or args.compare_presets or args.preview):
+        parser.error("Several structures are only supported for a single prediction without --preview")
+    if (args.stream or args.slice_batch) and (args.batch or args.compare_presets or len(args.structures) > 1):
+        parser.error("--stream and --slice_batch are only supported for a single prediction of one structure")
+    return args
+
+
+def main(argv=None):
+    """
+    Entry point of the runner: a single prediction, the worker mode with --worker, the batch mode with --batch
+    the comparison of the speed presets with --compare_presets or of the segmentation formats with --compare_formats.
+
+    Args:
+        argv (list): Arguments, sys.argv by default.
+    Returns:
+        None
+    """
+    args = parse_args(argv)
+
+    if args.worker:
+        from nnunet_worker import serve
+        serve(args.models_dir, cache_size=args.cache_size)
+        return
+
+    import nnunet_engine  # noqa: F401 (puts LungSegmentationLib on sys.path)
+    if args.compare_formats:
+        from nnunet_compare import compare_segmentation_formats
+        print(f"Report saved to {compare_segmentation_formats(args.input, args.output)}")
+        return
+
+    from LungSegmentationLib.presets import preset_settings, DEFAULT_SLICE_BATCH
+    from LungSegmentationLib.memory import GIB
+    stream_memory_bytes = None
+    if args.stream:
+        from nnunet_stream import stream_memory_limit
+        stream_memory_bytes = stream_memory_limit(args.max_memory_gb * GIB if args.max_memory_gb else None)
+    # The 2D axial models publish their label map slab by slab
+    slice_batch = args.slice_batch
+    if slice_batch is None and args.mode == "axial" and not args.batch and len(args.structures) == 1:
+        slice_batch = DEFAULT_SLICE_BATCH
+    settings = preset_settings(args.preset, args.threads, crop=not args.no_crop, fold_processes=args.fold_processes,
+                               stream_memory_bytes=stream_memory_bytes, slice_batch=slice_batch)
+
+    if args.batch:
+        from nnunet_batch import load_manifest, run_batch
+        cases = load_manifest(args.batch, args.animal, args.mode, args.structure)
+        run_batch(cases, args.output, args.models_dir, prefetch=args.prefetch, resume=not args.no_resume, settings=settings)
+        return
 
-    run_nnunet_prediction(
-        mode=args.mode,
-        structure=args.structure,
-        input_path=args.input,
-        output_dir=args.output,
-        models_dir=args.models_dir,
-        animal=args.animal,
-    )
+    if args.compare_presets:
+        from nnunet_compare import compare_presets, save_report
+        results = compare_presets(args.models_dir, args.animal, args.mode, args.structure, args.input, args.threads)
+        print(f"Report saved to {save_report(args.models_dir, args.animal, args.mode, args.structure, args.input, results)}")
+        return
+
+    import json
+    import time
+    from nnunet_engine import (PredictorCache, PREDICTION_FILE_NAME, output_file_name, predict_case, predict_preview,
+                               runtime_details)
+    from nnunet_progress import ProgressReporter
+    from nnunet_worker import write_context
+
+    start = time.perf_counter()
+    # Stages are always timed for the metrics; the events are only printed with --progress
+    progress = ProgressReporter((lambda event: print(json.dumps(event), flush=True)) if args.progress else (lambda event: None))
+    metrics = {"configuration": {"animal": args.animal, "mode": args.mode, "structures": args.structures, "preset": args.preset,
+                                 "crop": not args.no_crop}, "settings": settings, "input": {"path": os.path.abspath(args.input)}}
+
+    if len(args.structures) > 1:
+        from nnunet_engine import predict_structures
+        from nnunet_worker import write_structure_contexts
+        details = {}
+        results = predict_structures(PredictorCache(args.models_dir, capacity=1), args.animal, args.mode, args.structures,
+                                     args.input, args.output, progress, settings, args.output_format, details)
+        write_structure_contexts(args.output, results)
+        metrics["input"].update(details)
+        write_runner_metrics(args.output, metrics, progress, start, runtime_details())
+        return
+
+    progress.stage("load")
+    loaded = PredictorCache(args.models_dir, capacity=1).get(args.animal, args.mode, args.structure, settings["folds"],
+                                                             settings["fold_processes"])
+    if args.preview:
+        from LungSegmentationLib.presets import preview_settings
+        predict_preview(loaded, args.input, args.output, progress, preview_settings(settings), output_format=args.output_format)
+    details = {}
+    predict_case(loaded, args.input, args.output, progress, settings, details,
+                 file_name=output_file_name(PREDICTION_FILE_NAME, args.output_format))
 
     # Save the dataset json path of the model in the temporary file
-    with open(args.tmp_file, "w") as f:
-        json.dump({"dataset_json_path": GLOBAL_CONTEXT.get("dataset_json_path")}, f)
+    write_context(args.tmp_file, loaded.dataset_json_path)
+
+    metrics["input"].update(input_shape=details.get("input_shape"), input_spacing=details.get("input_spacing"))
+    metrics["model"] = {"name": loaded.model_info["model_name"], "folds": loaded.key[3], "fold": loaded.model_info["fold"]}
+    if details.get("fold_parallel"):
+        metrics["fold_parallel"] = details["fold_parallel"]
+    if details.get("stream"):
+        metrics["stream"] = details["stream"]
+    write_runner_metrics(args.output, metrics, progress, start, runtime_details())
+
+
+def write_runner_metrics(output_dir, metrics, progress, start, runtime):
+    """
+    Writes the metrics of a prediction of the command line runner to metrics.json in its output folder.
+
+    Args:
+        output_dir (str): Output folder of the prediction.
+        metrics (dict): Configuration, settings, input and model of the prediction.
+        progress (ProgressReporter): Reporter of the prediction, with the time spent in every stage.
+        start (float): time.perf_counter() at the start of the prediction.
+        runtime (dict): Result of nnunet_engine.runtime_details.
+    Returns:
+        None
+    """
+    import time
+    from LungSegmentationLib.telemetry import thread_count, write_metrics
+
+    metrics.update({
+        "stages": progress.durations(),
+        "total_seconds": round(time.perf_counter() - start, 3),
+        "threads": {"torch": runtime["torch_threads"], "process": thread_count()},
+        "memory": {"peak_rss_bytes": runtime["peak_rss_bytes"]},
+        "end_time": time.time(),
+    })
+    write_metrics(output_dir, metrics)
+
+
+if __name__ == "__main__":
+    main()
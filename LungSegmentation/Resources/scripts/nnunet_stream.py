@@ -0,0 +1,480 @@
+"""
+Out-of-core prediction of very large volumes (nnunet_runner.py --stream).
+
+nnUNet predicts a volume in one piece: the preprocessed volume, the logits of the sliding window and their
+resampling to the input grid are all held in memory, which does not fit for the largest ex vivo scans. Here
+the volume (after the region of interest crop) is cut into slabs along its first axis (z), each extended by a
+margin of half a patch of the model on both sides so that the tiles at its borders see the same context as in
+the whole volume. Every slab goes through the usual pipeline (preprocessing, sliding window, resampling of
+the class probabilities to the input grid) and is blended into a disk-backed float16 accumulator, with
+weights decreasing linearly across the margins. As soon as no later slab reaches a slice, its label map is
+written to the output, a raw volume filled in place: neither the accumulator nor the label map is ever
+held in memory as a whole.
+
+The thickness of the slabs is the largest one whose estimated peak memory (see
+LungSegmentationLib.memory.estimate_peak_memory) fits in the memory ceiling, so the peak memory depends on
+the ceiling and on the size of a slice, not on the number of slices. Volume headers exported by the widget
+are mapped, and only the slab being predicted is read from them. Image files that ITK reads region by region
+(uncompressed .nrrd/.nhdr, .mha/.mhd and .nii) are first copied slab by slab to a raw volume next to the
+output, mapped the same way; other images (e.g. compressed) are read whole, with a warning, and only the
+prediction stays within the ceiling.
+
+The axial models are 2D: they predict every slice separately, so their slabs need no margin and are exact.
+Their slabs hold settings["slice_batch"] slices, and their label map is written as soon as they are predicted.
+Every written range of slices is published as a "slab" event (see nnunet_progress.py), so that the widget shows
+the finished slices while the others are predicted.
+
+The slabs are normalized separately: this is exact for the CT normalization of the models (statistics of
+the training set), approximate for a per-image normalization.
+"""
+import os
+import copy
+import math
+import time
+
+from nnunet_engine import (read_case, read_mapped_case, crop_to_roi, preprocess_case, predict_logits, apply_settings, input_details,
+                           prediction_geometry, PREDICTION_FILE_NAME)
+from LungSegmentationLib import volumeio
+from LungSegmentationLib.memory import estimate_peak_memory, default_memory_budget, GIB
+
+# Ceiling used when none is given and the memory of the machine is unknown
+DEFAULT_STREAM_MEMORY_BYTES = 8 * GIB
+# Slices whose label map is computed at once from the accumulator
+LABEL_SLAB = 8
+ACCUMULATOR_FILE_NAME = "stream_accumulator.raw"
+LABELS_HEADER_NAME = "stream_labels.json"
+INPUT_HEADER_NAME = "stream_input.json"
+# Share of the memory ceiling taken by the slabs of an image file copied to a raw volume
+INPUT_SLAB_FRACTION = 0.25
+
+
+def stream_memory_limit(max_memory_bytes=None):
+    """
+    Returns:
+        int: Memory ceiling of a streamed prediction: max_memory_bytes, else the memory budget of the jobs.
+    """
+    return int(max_memory_bytes or default_memory_budget() or DEFAULT_STREAM_MEMORY_BYTES)
+
+
+def _header_fields(path, separator):
+    """
+    Reads the fields of the text header of a .nrrd/.nhdr or .mha/.mhd file, up to the data.
+    """
+    fields = {}
+    with open(path, "rb") as f:
+        for raw_line in f:
+            line = raw_line.decode("latin-1").strip()
+            if not line:
+                break
+            key, found, value = line.partition(separator)
+            if found and not line.startswith("#"):
+                fields[key.strip().lower()] = value.lstrip("=").strip()
+            if key.strip().lower() == "elementdatafile":
+                break
+    return fields
+
+
+def can_read_slabs(input_path):
+    """
+    Returns:
+        bool: True if ITK reads the regions of the image without decoding the whole file: uncompressed
+            .nrrd/.nhdr, .mha/.mhd and .nii.
+    """
+    lower = input_path.lower()
+    try:
+        if lower.endswith((".nrrd", ".nhdr")):
+            return _header_fields(input_path, ":").get("encoding", "raw") == "raw"
+        if lower.endswith((".mha", ".mhd")):
+            return _header_fields(input_path, "=").get("compresseddata", "false").lower() != "true"
+    except OSError:
+        return False
+    return lower.endswith(".nii")
+
+
+def copy_to_volume(input_path, header_path, memory_limit):
+    """
+    Copies a 3D image file to a raw volume (see LungSegmentationLib.volumeio) slab by slab, with the streaming
+    reader of ITK, so that the image is never held in memory as a whole.
+
+    Args:
+        input_path (str): Image file (see can_read_slabs).
+        header_path (str): Path of the header of the raw volume.
+        memory_limit (int): Memory ceiling of the prediction; the slabs take INPUT_SLAB_FRACTION of it.
+    Returns:
+        str: header_path.
+    Raises:
+        ValueError: If the image is not a 3D scalar image.
+    """
+    import SimpleITK as sitk
+
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(input_path)
+    reader.ReadImageInformation()
+    size = list(reader.GetSize())
+    if len(size) != 3 or reader.GetNumberOfComponents() != 1:
+        raise ValueError(f"Only 3D scalar images can be streamed: {input_path}")
+    geometry = {"spacing": list(reader.GetSpacing()), "origin": list(reader.GetOrigin()),
+                "direction": list(reader.GetDirection())}
+
+    # 8 bytes per voxel at most
+    depth = max(1, int(memory_limit * INPUT_SLAB_FRACTION) // (size[0] * size[1] * 8))
+    raw_path = None
+    for start in range(0, size[2], depth):
+        stop = min(size[2], start + depth)
+        reader.SetExtractIndex([0, 0, start])
+        reader.SetExtractSize([size[0], size[1], stop - start])
+        slab = sitk.GetArrayFromImage(reader.Execute())
+        if raw_path is None:
+            raw_path = volumeio.create_volume(header_path, (size[2], size[1], size[0]), slab.dtype, geometry)
+        rows = volumeio.map_rows(raw_path, slab.dtype, slab.shape[1:], start, stop)
+        rows[:] = slab
+        rows.flush()
+        del rows, slab
+    return header_path
+
+
+def read_streamed_case(loaded, input_path, output_dir, memory_limit):
+    """
+    Reads the input of a streamed prediction without loading it in memory when possible: a volume header is
+    mapped, an image file that ITK reads region by region is copied to a raw volume in output_dir and mapped.
+    Other images are read whole.
+
+    Args:
+        loaded (LoadedModel): Model to use.
+        input_path (str): Path to the input image or volume header.
+        output_dir (str): Output folder, receiving the copied volume.
+        memory_limit (int): Memory ceiling of the prediction.
+    Returns:
+        tuple: (image array (c, z, y, x), image properties, header of the copied volume to remove afterwards or None).
+    """
+    if volumeio.is_volume_header(input_path):
+        return (*read_mapped_case(input_path), None)
+    if can_read_slabs(input_path):
+        os.makedirs(output_dir, exist_ok=True)
+        header_path = copy_to_volume(input_path, os.path.join(output_dir, INPUT_HEADER_NAME), memory_limit)
+        return (*read_mapped_case(header_path), header_path)
+    print(f"Warning: {os.path.basename(input_path)} is compressed or cannot be read region by region: it is read "
+          f"whole, and only the prediction stays within the memory ceiling. Convert it to an uncompressed "
+          f".nrrd, .mha or .nii to stream it.")
+    return (*read_case(loaded, input_path), None)
+
+
+def model_geometry(loaded, properties):
+    """
+    Returns:
+        tuple: (patch size, spacing) of the model along the axes (z, y, x) of the input. A 2D model has a patch
+            of one slice along the axis it slices, at the spacing of the input.
+    """
+    predictor = loaded.predictor
+    manager = predictor.configuration_manager
+    transpose = list(predictor.plans_manager.transpose_forward)
+    patch_size = [int(n) for n in manager.patch_size]
+    spacing = [float(s) for s in manager.spacing]
+    if len(patch_size) == 2:
+        patch_size = [1] + patch_size
+        spacing = [float(properties["spacing"][transpose[0]])] + spacing
+    input_patch_size, input_spacing = [0] * 3, [0.0] * 3
+    for axis, input_axis in enumerate(transpose):
+        input_patch_size[input_axis] = patch_size[axis]
+        input_spacing[input_axis] = spacing[axis]
+    return input_patch_size, input_spacing
+
+
+def stream_margin(loaded, properties):
+    """
+    Returns:
+        int: Slices of the input added on each side of a slab: half a patch of the model along the first axis,
+            none for a 2D model predicting the slices of this axis.
+    """
+    patch_size, spacing = model_geometry(loaded, properties)
+    if patch_size[0] == 1:
+        return 0
+    return int(math.ceil(patch_size[0] / 2.0 * spacing[0] / float(properties["spacing"][0])))
+
+
+def resampling_ratio(loaded, properties):
+    """
+    Returns:
+        float: Number of voxels at the spacing of the model per voxel of the input.
+    """
+    _, spacing = model_geometry(loaded, properties)
+    ratio = 1.0
+    for axis in range(3):
+        ratio *= float(properties["spacing"][axis]) / spacing[axis]
+    return ratio
+
+
+def slab_thickness(shape, margin, num_classes, patch_size, ratio, memory_limit, folds=1, fold_processes=1):
+    """
+    Chooses the thickness of the slabs.
+
+    Args:
+        shape (sequence): Shape (z, y, x) of the volume.
+        margin (int): Slices added on each side of a slab (see stream_margin).
+        num_classes (int): Number of classes of the model, background included.
+        patch_size (sequence): Patch size of the model.
+        ratio (float): Result of resampling_ratio.
+        memory_limit (int): Memory ceiling in bytes.
+        folds (int): Folds of the ensemble.
+        fold_processes (int): Processes predicting the folds in parallel (see nnunet_folds.py).
+    Returns:
+        int: Slices of a slab without its margins: the largest thickness whose estimated peak memory, with its
+            window of the accumulator, fits in the ceiling (at least 1, all the slices if the volume fits).
+    """
+    depth = int(shape[0])
+    slice_voxels = int(shape[1]) * int(shape[2])
+
+    def estimate(core):
+        voxels = min(depth, core + 2 * margin) * slice_voxels
+        return (estimate_peak_memory(voxels, patch_size, num_classes, int(voxels * ratio), folds, fold_processes)
+                + voxels * num_classes * 2)
+
+    if estimate(depth) <= memory_limit:
+        return depth
+    if estimate(1) > memory_limit:
+        print(f"A slab of one slice needs about {estimate(1) / GIB:.1f} GiB, more than the ceiling of "
+              f"{memory_limit / GIB:.1f} GiB")
+        return 1
+    low, high = 1, depth
+    while high - low > 1:
+        middle = (low + high) // 2
+        if estimate(middle) <= memory_limit:
+            low = middle
+        else:
+            high = middle
+    return low
+
+
+def slab_ranges(depth, thickness, margin):
+    """
+    Returns:
+        list: (start, stop) of the slices predicted by every slab, its margins included, in order.
+    """
+    return [(max(0, start - margin), min(depth, start + thickness + margin)) for start in range(0, depth, thickness)]
+
+
+def blend_weights(start, stop, depth, margin):
+    """
+    Returns:
+        np.ndarray: Weight of every slice of a slab: 1 in its core, decreasing linearly across its margins
+            (except at the borders of the volume, where no other slab overlaps it).
+    """
+    import numpy as np
+
+    weights = np.ones(stop - start, dtype=np.float32)
+    ramp = np.arange(1, margin + 1, dtype=np.float32) / (margin + 1)
+    count = min(margin, stop - start)
+    if start > 0:
+        weights[:count] = np.minimum(weights[:count], ramp[:count])
+    if stop < depth:
+        weights[stop - start - count:] = np.minimum(weights[stop - start - count:], ramp[:count][::-1])
+    return weights
+
+
+def write_labels(loaded, accumulator_path, row_shape, weight_sums, labels_path, full_shape, box, start, stop):
+    """
+    Writes the label map of slices of the cropped volume whose probabilities are complete.
+
+    Args:
+        loaded (LoadedModel): Model used for the prediction.
+        accumulator_path (str): Raw float16 file of the accumulated probabilities, rows (z, c, y, x).
+        row_shape (tuple): (c, y, x) of a row of the accumulator.
+        weight_sums (np.ndarray): Sum of the weights of every slice.
+        labels_path (str): Raw file of the label map of the full volume.
+        full_shape (sequence): Shape (z, y, x) of the full volume.
+        box (list): [start, stop) along z, y, x of the cropped volume in the full volume.
+        start (int): First slice, in the cropped volume.
+        stop (int): Slice after the last one.
+    Returns:
+        None
+    """
+    import numpy as np
+
+    label_manager = loaded.predictor.label_manager
+    for first in range(start, stop, LABEL_SLAB):
+        last = min(stop, first + LABEL_SLAB)
+        rows = volumeio.map_rows(accumulator_path, np.float16, row_shape, first, last, mode="r")
+        # Rows (z, c, y, x) to probabilities (c, z, y, x), normalized by the weights of their slices
+        probabilities = np.moveaxis(rows, 1, 0).astype(np.float32) / weight_sums[first:last, None, None]
+        del rows
+        segmentation = np.asarray(label_manager.convert_probabilities_to_segmentation(probabilities))
+        del probabilities
+        write_segmentation(loaded, segmentation, labels_path, full_shape, box, first)
+
+
+def labels_dtype(loaded):
+    """
+    Returns:
+        np.dtype: Type of the label map of a model.
+    """
+    import numpy as np
+
+    return np.dtype(np.uint8 if len(loaded.predictor.label_manager.all_labels) < 256 else np.uint16)
+
+
+def write_segmentation(loaded, segmentation, labels_path, full_shape, box, start):
+    """
+    Writes the label map of slices of the cropped volume into the label map of the full volume.
+
+    Args:
+        loaded (LoadedModel): Model used for the prediction.
+        segmentation (np.ndarray): Label map of the slices (z, y, x).
+        labels_path (str): Raw file of the label map of the full volume.
+        full_shape (sequence): Shape (z, y, x) of the full volume.
+        box (list): [start, stop) along z, y, x of the cropped volume in the full volume.
+        start (int): First slice of the segmentation, in the cropped volume.
+    Returns:
+        None
+    """
+    first = box[0][0] + start
+    labels = volumeio.map_rows(labels_path, labels_dtype(loaded), full_shape[1:], first, first + len(segmentation))
+    labels[:, box[1][0]:box[1][1], box[2][0]:box[2][1]] = segmentation
+    labels.flush()
+    del labels
+
+
+def predict_case_streamed(loaded, input_path, output_dir, progress=None, settings=None, details=None,
+                          file_name=PREDICTION_FILE_NAME):
+    """
+    Predicts one volume slab by slab within the memory ceiling of settings["stream_memory_bytes"], with at most
+    settings["slice_batch"] slices per slab, and writes its label map as predict_case does.
+
+    Args:
+        loaded (LoadedModel): Model to use.
+        input_path (str): Path to the input image or volume header.
+        output_dir (str): Output folder.
+        progress (ProgressReporter): Receives the "preprocess", "predict" (one step per slab) and "export" stages, and
+            the slices whose label map is written ("slab" events), optional.
+        settings (dict): Speed preset settings (see LungSegmentationLib.presets), optional.
+        details (dict): Receives the region of interest ("roi"), the shape and spacing of the input and the slabs
+            with their timings ("stream"), optional.
+        file_name (str): Name of the prediction file; a .json name writes the label map as a raw volume.
+    Returns:
+        str: Path to the prediction file.
+    """
+    import numpy as np
+    from nnunetv2.inference.export_prediction import convert_predicted_logits_to_segmentation_with_correct_shape
+
+    predictor = loaded.predictor
+    apply_settings(predictor, settings)
+    memory_limit = stream_memory_limit((settings or {}).get("stream_memory_bytes"))
+    start_time = time.perf_counter()
+
+    if progress is not None:
+        progress.stage("preprocess")
+    image, properties, input_header = read_streamed_case(loaded, input_path, output_dir, memory_limit)
+    if details is not None:
+        details.update(input_details(image, properties))
+    full_shape = tuple(int(n) for n in image.shape[1:])
+    image, roi = crop_to_roi(loaded, image, properties, settings)
+    if details is not None:
+        details["roi"] = roi
+    box = roi["box"] if roi else [[0, n] for n in full_shape]
+
+    shape = tuple(int(n) for n in image.shape[1:])
+    num_classes = predictor.label_manager.num_segmentation_heads
+    margin = stream_margin(loaded, properties)
+    thickness = slab_thickness(shape, margin, num_classes, predictor.configuration_manager.patch_size,
+                               resampling_ratio(loaded, properties), memory_limit, len(loaded.folds),
+                               (settings or {}).get("fold_processes", 1) if loaded.fold_parallel else 1)
+    if (settings or {}).get("slice_batch"):
+        thickness = min(thickness, int(settings["slice_batch"]))
+    slabs = slab_ranges(shape[0], thickness, margin)
+    print(f"Streaming {shape[0]} slices in {len(slabs)} slab(s) of {thickness} slices plus {margin} on each side "
+          f"(memory ceiling {memory_limit / GIB:.1f} GiB)")
+
+    os.makedirs(output_dir, exist_ok=True)
+    raw_output = file_name.endswith(".json")
+    labels_header = os.path.join(output_dir, file_name if raw_output else LABELS_HEADER_NAME)
+    geometry = prediction_geometry(properties)
+    labels_path = volumeio.create_volume(labels_header, full_shape, labels_dtype(loaded), geometry)
+
+    # Slabs without margins do not overlap: their label map is written directly
+    row_shape = (num_classes,) + shape[1:]
+    accumulator_path = os.path.join(output_dir, ACCUMULATOR_FILE_NAME)
+    accumulator_bytes = shape[0] * int(np.prod(row_shape)) * 2 if margin else 0
+    if margin:
+        with open(accumulator_path, "wb") as f:
+            f.truncate(accumulator_bytes)
+    weight_sums = np.zeros(shape[0], dtype=np.float32)
+    timings = []
+    written = 0
+    try:
+        if progress is not None:
+            progress.stage("predict", total=len(slabs))
+        for index, (start, stop) in enumerate(slabs):
+            timing = {"slices": [start, stop]}
+            step = time.perf_counter()
+            preprocessed = preprocess_case(loaded, np.array(image[:, start:stop]), copy.deepcopy(properties))
+            timing["preprocess_seconds"] = round(time.perf_counter() - step, 3)
+
+            step = time.perf_counter()
+            logits = predict_logits(loaded, preprocessed["data"], None, settings)
+            timing["predict_seconds"] = round(time.perf_counter() - step, 3)
+
+            step = time.perf_counter()
+            resampled = convert_predicted_logits_to_segmentation_with_correct_shape(
+                logits, predictor.plans_manager, predictor.configuration_manager, predictor.label_manager,
+                preprocessed["data_properties"], return_probabilities=bool(margin))
+            del logits, preprocessed
+            timing["resample_seconds"] = round(time.perf_counter() - step, 3)
+
+            step = time.perf_counter()
+            if not margin:
+                write_segmentation(loaded, resampled, labels_path, full_shape, box, start)
+            else:
+                probabilities = resampled[1].numpy() if hasattr(resampled[1], "numpy") else np.asarray(resampled[1])
+                weights = blend_weights(start, stop, shape[0], margin)
+                rows = volumeio.map_rows(accumulator_path, np.float16, row_shape, start, stop)
+                for z in range(stop - start):
+                    rows[z] += (probabilities[:, z] * weights[z]).astype(np.float16)
+                rows.flush()
+                del rows, probabilities
+                weight_sums[start:stop] += weights
+            del resampled
+
+            # Slices before the next slab are complete
+            complete = slabs[index + 1][0] if index + 1 < len(slabs) else shape[0]
+            if complete > written:
+                if margin:
+                    write_labels(loaded, accumulator_path, row_shape, weight_sums, labels_path, full_shape, box,
+                                 written, complete)
+                if progress is not None:
+                    progress.slab(box[0][0] + written, box[0][0] + complete, full_shape[0], labels_header,
+                                  loaded.dataset_json_path)
+                written = complete
+            timing["write_seconds"] = round(time.perf_counter() - step, 3)
+            timings.append(timing)
+            print(f"Slab {index + 1}/{len(slabs)} (slices {start}:{stop}): predicted in {timing['predict_seconds']:.1f} s")
+            if progress is not None:
+                progress.advance()
+    finally:
+        if os.path.exists(accumulator_path):
+            os.remove(accumulator_path)
+        if input_header is not None:
+            # The mapping must be released before the raw file is removed (Windows)
+            image = None
+            volumeio.remove_volume(input_header)
+
+    if progress is not None:
+        progress.stage("export")
+    prediction_path = labels_header
+    if not raw_output:
+        labels, _ = volumeio.map_volume(labels_header)
+        prediction_path = volumeio.write_nrrd(os.path.join(output_dir, file_name), labels, geometry,
+                                              encoding="gzip", threads=(settings or {}).get("threads"))
+        del labels
+        volumeio.remove_volume(labels_header)
+
+    if details is not None:
+        details["stream"] = {
+            "memory_limit_bytes": memory_limit,
+            "slab_slices": thickness,
+            "margin_slices": margin,
+            "accumulator_bytes": accumulator_bytes,
+            "wall_seconds": round(time.perf_counter() - start_time, 3),
+            "slabs": timings,
+        }
+    if progress is not None:
+        progress.finish()
+    return prediction_path
@@ -0,0 +1,734 @@
+"""
+Watch-folder ingest daemon, built on the worker mode of nnunet_runner.py.
+
+The scanners drop their acquisitions in a shared folder. The daemon finds the scans of the folder tree (NRRD,
+NIfTI and MetaImage files, and folders of DICOM files), waits until their files have not changed for --settle
+seconds, and predicts them with a pool of warm inference workers, --workers scans in parallel (see
+LungSegmentationLib.workerclient). The animal, mode and structure of a scan are given by the rules of its
+folder (--rules), and every scan is written to its own output folder, mirroring the watched tree, with its
+context file and metrics.json.
+
+Changes are notified by inotify on Linux (polling elsewhere, or with --watch_method polling). The folder is
+also rescanned every --poll seconds in any case: inotify does not see the files written by other machines
+on a network share.
+
+The state of every scan is kept in watch_manifest.json in the output folder, with a fingerprint of its files
+(names, sizes and modification times): after a restart the scans already processed are skipped, the
+interrupted ones are queued again, and a scan whose files changed is processed again.
+
+Rules file (folders relative to the watched folder; the rules of a folder override the ones of its parents):
+    {"default": {"animal": "rabbit", "mode": "invivo", "structure": "all"},
+     "folders": {"pig": {"animal": "pig"},
+                 "pig/exvivo": {"mode": "exvivo", "preset": "balanced"},
+                 "rat": {"animal": "rat", "structure": ["parenchyma", "airways"]},
+                 "calibration": {"ignore": true}}}
+
+Usage:
+    python nnunet_watch.py --watch /mnt/scanners --output /mnt/results --models_dir models --rules rules.json --workers 2
+"""
+import os
+import sys
+import json
+import time
+import queue
+import struct
+import select
+import signal
+import hashlib
+import argparse
+import threading
+import traceback
+
+# LungSegmentationLib lives next to LungSegmentation.py, two levels above this script
+MODULE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+if MODULE_DIR not in sys.path:
+    sys.path.insert(0, MODULE_DIR)
+
+IMAGE_EXTENSIONS = (".nrrd", ".nii", ".nii.gz", ".mha")
+# Files still being copied by common tools: their folder is not stable yet
+PARTIAL_EXTENSIONS = (".part", ".partial", ".tmp", ".crdownload", ".filepart")
+MANIFEST_FILE_NAME = "watch_manifest.json"
+CONTEXT_FILE_NAME = "nnunet_context.json"
+DEFAULT_SETTLE_SECONDS = 30.0
+DEFAULT_POLL_SECONDS = 10.0
+# Statuses of the manifest of a scan that is not processed again while its files do not change
+FINAL_STATUSES = ("done", "failed", "ignored")
+
+
+def parse_args(argv=None):
+    """
+    Parses the command line of the daemon.
+
+    Args:
+        argv (list): Arguments, sys.argv by default.
+    Returns:
+        argparse.Namespace: Parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Segments the scans dropped in a folder with nnunet_runner.py workers")
+    parser.add_argument("--watch", required=True, help="Folder receiving the scans")
+    parser.add_argument("--output", required=True, help="Output folder, with one folder per scan and the manifest")
+    parser.add_argument("--models_dir", required=True, help="Directory to store models")
+    parser.add_argument("--rules", default=None, help="JSON file of the animal/mode/structure of every folder")
+    parser.add_argument("--animal", default="rabbit", choices=["rabbit", "pig", "rat"], help="Animal when no rule gives it")
+    parser.add_argument("--mode", default="invivo", choices=["invivo", "exvivo", "axial"], help="Mode when no rule gives it")
+    parser.add_argument("--structure", nargs="+", default=["all"], help="Structure(s) when no rule gives them")
+    parser.add_argument("--preset", default=None, choices=["fast", "balanced", "accurate", "ensemble"],
+                        help="Speed preset when no rule gives it")
+    parser.add_argument("--no_crop", action="store_true", help="Run the inference on the whole image instead of the lungs region")
+    parser.add_argument("--workers", type=int, default=1, help="Scans predicted in parallel, each by its own worker")
+    parser.add_argument("--settle", type=float, default=DEFAULT_SETTLE_SECONDS,
+                        help="Seconds without change before a scan is processed")
+    parser.add_argument("--poll", type=float, default=DEFAULT_POLL_SECONDS, help="Seconds between two rescans of the folder")
+    parser.add_argument("--watch_method", default="auto", choices=["auto", "inotify", "polling"],
+                        help="Notification of the changes (inotify on Linux with auto)")
+    parser.add_argument("--retry_failed", action="store_true", help="Process again the scans that failed")
+    parser.add_argument("--once", action="store_true", help="Exit once the scans found are processed instead of watching")
+    parser.add_argument("--dicom_cache_gb", type=float, default=4.0, help="Disk budget of the converted DICOM series")
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    return args
+
+
+############################################################### SCANS ###############################################################
+
+def find_scans(root, exclude=()):
+    """
+    Lists the scans of a folder tree: image files, and folders containing DICOM files (with the DICOM prefix,
+    as written by most scanners without extension, or .dcm/.ima, see dicomseries.is_dicom_file). Other files
+    (README, DICOMDIR...), hidden files and hidden folders are skipped.
+
+    Args:
+        root (str): Watched folder.
+        exclude (sequence): Folders not scanned (e.g. the output folder).
+    Returns:
+        dict: Scan id (path relative to root) -> {"path", "kind" ("image" or "dicom"), "files" (list of
+            [name, size, mtime_ns]) and "partial" (True while a file of the scan is still being copied)}.
+    """
+    from LungSegmentationLib.dicomseries import is_dicom_file
+
+    excluded = {os.path.abspath(path) for path in exclude}
+    scans = {}
+    for directory, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames
+                             if not d.startswith(".") and os.path.abspath(os.path.join(directory, d)) not in excluded)
+        partial = False
+        dicom_files = []
+        for name in sorted(filenames):
+            lower = name.lower()
+            if name.startswith("."):
+                continue
+            if lower.endswith(PARTIAL_EXTENSIONS):
+                partial = True
+                continue
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Removed or renamed since the listing
+                continue
+            entry = [name, stat.st_size, stat.st_mtime_ns]
+            if lower.endswith(IMAGE_EXTENSIONS):
+                scans[os.path.relpath(path, root)] = {"path": path, "kind": "image", "files": [entry], "partial": False}
+            elif is_dicom_file(path):
+                dicom_files.append(entry)
+        if dicom_files:
+            scans[os.path.relpath(directory, root)] = {"path": directory, "kind": "dicom", "files": dicom_files,
+                                                        "partial": partial}
+    return scans
+
+
+def scan_fingerprint(scan):
+    """
+    Returns:
+        str: SHA-1 of the names, sizes and modification times of the files of a scan (see find_scans).
+    """
+    return hashlib.sha1(json.dumps(scan["files"]).encode("utf-8")).hexdigest()
+
+
+def scan_output_name(scan_id):
+    """
+    Returns:
+        str: Output folder of a scan relative to the output root: its path in the watched folder, with the
+            extension of an image file turned into a suffix (scan.nrrd -> scan_nrrd, scan.nii.gz -> scan_nii_gz),
+            so that images of the same name in different formats do not share their folder.
+    """
+    for ext in IMAGE_EXTENSIONS:
+        if scan_id.lower().endswith(ext):
+            return scan_id[:-len(ext)] + ext.replace(".", "_")
+    return scan_id
+
+
+class WatchRules:
+    """
+    Animal, mode, structure and preset of the scans of every folder of the watched tree.
+    """
+    KEYS = ("animal", "mode", "structure", "preset")
+
+    def __init__(self, default=None, folders=None):
+        """
+        Args:
+            default (dict): Configuration of the scans no rule applies to.
+            folders (dict): Folder relative to the watched folder -> rule overriding some KEYS, or {"ignore": true}.
+        Returns:
+            None
+        """
+        self.default = dict(default or {})
+        self.folders = {folder.replace("\\", "/").strip("/"): rule for folder, rule in (folders or {}).items()}
+
+    @classmethod
+    def load(cls, path, default=None):
+        """
+        Reads a rules file (see the docstring of this module).
+
+        Args:
+            path (str): Path of the JSON rules file.
+            default (dict): Configuration overridden by the "default" of the file.
+        Returns:
+            WatchRules: The rules.
+        """
+        with open(path, "r") as f:
+            data = json.load(f)
+        return cls(dict(default or {}, **data.get("default", {})), data.get("folders", {}))
+
+    def resolve(self, scan_id):
+        """
+        Configuration of a scan: the default, overridden by the rules of its folders from the root down.
+
+        Args:
+            scan_id (str): Path of the scan relative to the watched folder.
+        Returns:
+            dict: "animal", "mode", "structure" (str or list) and "preset", None if a folder of the scan is ignored.
+        Raises:
+            ValueError: If the animal, mode or structure of the scan is not given.
+        """
+        parts = scan_id.replace("\\", "/").split("/")
+        config = {key: self.default.get(key) for key in self.KEYS}
+        for depth in range(1, len(parts) + 1):
+            rule = self.folders.get("/".join(parts[:depth]))
+            if not rule:
+                continue
+            if rule.get("ignore"):
+                return None
+            config.update({key: rule[key] for key in self.KEYS if key in rule})
+        missing = [key for key in ("animal", "mode", "structure") if not config.get(key)]
+        if missing:
+            raise ValueError(f"No {', '.join(missing)} given for {scan_id}")
+        return config
+
+
+class WatchManifest:
+    """
+    State of every scan of the watched folder, persisted as JSON after every change.
+    """
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Path of the manifest, loaded if it already exists.
+        Returns:
+            None
+        """
+        self.path = path
+        self.scans = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.scans = json.load(f).get("scans", {})
+
+    def is_processed(self, scan_id, fingerprint, retry_failed=False):
+        """
+        Returns:
+            bool: True if the scan was processed (or ignored) with the same files.
+        """
+        entry = self.scans.get(scan_id, {})
+        statuses = tuple(s for s in FINAL_STATUSES if not (retry_failed and s == "failed"))
+        return entry.get("fingerprint") == fingerprint and entry.get("status") in statuses
+
+    def update(self, scan_id, **fields):
+        """
+        Updates the state of a scan and saves the file.
+
+        Args:
+            scan_id (str): Path of the scan relative to the watched folder.
+            **fields: Fields of the state ("status", "fingerprint", "output", "error", "seconds"...).
+        Returns:
+            None
+        """
+        with self._lock:
+            self.scans.setdefault(scan_id, {}).update(fields, updated=time.strftime("%Y-%m-%dT%H:%M:%S"))
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"scans": self.scans}, f, indent=4)
+            os.replace(tmp_path, self.path)
+
+
+############################################################### WATCHERS ###############################################################
+
+class PollingWatcher:
+    """
+    Waits for the next rescan of the watched folder.
+    """
+    name = "polling"
+
+    def __init__(self, wake=None):
+        """
+        Args:
+            wake (threading.Event): Ends the wait when set (e.g. when the daemon stops), optional.
+        Returns:
+            None
+        """
+        self.wake = wake or threading.Event()
+
+    def wait(self, timeout):
+        """
+        Returns:
+            bool: False (changes are only found by the rescans).
+        """
+        self.wake.wait(timeout)
+        return False
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    Wakes the daemon up as soon as a file of the watched tree is written, moved or deleted (Linux inotify,
+    through ctypes). New folders are watched as they appear.
+    """
+    name = "inotify"
+
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    # struct inotify_event: wd, mask, cookie, len, then the name
+    EVENT = struct.Struct("iIII")
+    # Longest wait before checking the wake event
+    WAKE_SECONDS = 1.0
+
+    def __init__(self, root, exclude=(), wake=None):
+        """
+        Args:
+            root (str): Watched folder.
+            exclude (sequence): Folders not watched.
+            wake (threading.Event): Ends the wait when set (e.g. when the daemon stops), optional.
+        Returns:
+            None
+        Raises:
+            OSError: If inotify is not available.
+        """
+        import ctypes
+        import ctypes.util
+
+        self._ctypes = ctypes
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.exclude = {os.path.abspath(path) for path in exclude}
+        self.wake = wake or threading.Event()
+        self.watches = {}   # Watch descriptor -> folder
+        self.add_tree(root)
+
+    def add_tree(self, root):
+        """
+        Watches a folder and its subfolders.
+        """
+        watched = set(self.watches.values())
+        for directory, dirnames, _ in os.walk(root):
+            dirnames[:] = [d for d in dirnames
+                           if not d.startswith(".") and os.path.abspath(os.path.join(directory, d)) not in self.exclude]
+            if directory in watched:
+                continue
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+            if wd < 0:
+                errno = self._ctypes.get_errno()
+                print(f"Cannot watch {directory} ({os.strerror(errno)}), its changes are found by the rescans")
+                continue
+            self.watches[wd] = directory
+
+    def wait(self, timeout):
+        """
+        Waits for changes in the watched tree.
+
+        Args:
+            timeout (float): Maximum time to wait in seconds.
+        Returns:
+            bool: True if changes were notified.
+        """
+        deadline = time.monotonic() + timeout
+        readable = []
+        while not readable and not self.wake.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            readable, _, _ = select.select([self.fd], [], [], min(remaining, self.WAKE_SECONDS))
+        if not readable:
+            return False
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return False
+        offset = 0
+        while offset + self.EVENT.size <= len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            name = data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b"\0")
+            offset += self.EVENT.size + length
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+            elif mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO) and wd in self.watches:
+                self.add_tree(os.path.join(self.watches[wd], os.fsdecode(name)))
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_watcher(root, method="auto", exclude=(), wake=None):
+    """
+    Creates the watcher of a folder.
+
+    Args:
+        root (str): Watched folder.
+        method (str): "inotify", "polling", or "auto" (inotify on Linux, polling if it is not available).
+        exclude (sequence): Folders not watched.
+        wake (threading.Event): Ends the wait of the watcher when set, optional.
+    Returns:
+        InotifyWatcher or PollingWatcher: The watcher.
+    """
+    if method in ("auto", "inotify") and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(root, exclude, wake)
+        except (OSError, AttributeError) as e:
+            if method == "inotify":
+                raise
+            print(f"inotify is not available ({e}), polling {root}")
+    elif method == "inotify":
+        raise OSError(f"inotify is not available on {sys.platform}")
+    return PollingWatcher(wake)
+
+
+############################################################### PROCESSING ###############################################################
+
+class RunnerProcessor:
+    """
+    Predicts the scans with a pool of warm inference workers (nnunet_runner.py --worker), one per scan
+    predicted in parallel. DICOM series are converted to NRRD first, through a cache.
+    """
+    def __init__(self, models_dir, workers=1, crop=True, dicom_cache_dir=None, dicom_cache_max_bytes=4 * 1024 ** 3,
+                 python_executable=None):
+        """
+        Args:
+            models_dir (str): Directory where the models are stored.
+            workers (int): Number of scans predicted in parallel, sharing the CPU cores.
+            crop (bool): Runs the inference on the region of interest only (see nnunet_roi.py).
+            dicom_cache_dir (str): Cache of the converted DICOM series, in the temporary folder if None.
+            dicom_cache_max_bytes (int): Disk budget of the DICOM cache.
+            python_executable (str): Interpreter of the workers, sys.executable by default.
+        Returns:
+            None
+        """
+        from LungSegmentationLib.presets import default_threads
+        from LungSegmentationLib.workerclient import RunnerWorkerPool
+
+        runner_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "nnunet_runner.py")
+        self.pool = RunnerWorkerPool(runner_path, models_dir, python_executable=python_executable)
+        self.threads = default_threads(workers)
+        self.crop = crop
+        self.dicom_cache_dir = dicom_cache_dir
+        self.dicom_cache_max_bytes = dicom_cache_max_bytes
+        self.dicom_converter = None
+        self._lock = threading.Lock()
+
+    def get_dicom_converter(self):
+        """
+        Returns:
+            DicomSeriesConverter: The converter of the DICOM series, created on the first series.
+        """
+        with self._lock:
+            if self.dicom_converter is None:
+                import tempfile
+                from LungSegmentationLib.dicomseries import DicomSeriesConverter
+                cache_dir = self.dicom_cache_dir or os.path.join(tempfile.gettempdir(), "LungSegmentation", "dicom_cache")
+                self.dicom_converter = DicomSeriesConverter(cache_dir, self.dicom_cache_max_bytes)
+            return self.dicom_converter
+
+    def __call__(self, scan, config, output_dir):
+        """
+        Predicts a scan and writes metrics.json in its output folder.
+
+        Args:
+            scan (dict): Scan returned by find_scans.
+            config (dict): Result of WatchRules.resolve.
+            output_dir (str): Output folder of the scan.
+        Returns:
+            dict: Fields recorded in the manifest: "predictions" (structure -> prediction path) and "stages".
+        """
+        start = time.perf_counter()
+        stages = {}
+        if scan["kind"] != "dicom":
+            return self._predict(scan, config, output_dir, scan["path"], start, stages)
+        # The converted series is pinned, so that the conversions of the other workers do not evict it
+        converter = self.get_dicom_converter()
+        input_path = converter.convert(scan["path"], pin=True)
+        stages["conversion"] = round(time.perf_counter() - start, 3)
+        try:
+            return self._predict(scan, config, output_dir, input_path, start, stages)
+        finally:
+            converter.release(input_path)
+
+    def _predict(self, scan, config, output_dir, input_path, start, stages):
+        """
+        Predicts a scan from its NRRD input and writes metrics.json (see __call__).
+        """
+        from LungSegmentationLib.telemetry import write_metrics
+
+        structures = config["structure"] if isinstance(config["structure"], list) else [config["structure"]]
+        with self.pool.client() as client:
+            if len(structures) > 1:
+                response = client.predict_structures(config["animal"], config["mode"], structures, input_path, output_dir,
+                                                     preset=config.get("preset"), threads=self.threads, crop=self.crop)
+                predictions = {structure: result["prediction"] for structure, result in response["predictions"].items()}
+            else:
+                response = client.predict(config["animal"], config["mode"], structures[0], input_path, output_dir,
+                                          os.path.join(output_dir, CONTEXT_FILE_NAME), preset=config.get("preset"),
+                                          threads=self.threads, crop=self.crop)
+                predictions = {structures[0]: response["prediction"]}
+        stages.update(response.get("stages") or {})
+
+        write_metrics(output_dir, {
+            "status": "done",
+            "configuration": config,
+            "input": {"path": scan["path"], "kind": scan["kind"], "input_shape": response.get("input_shape"),
+                      "input_spacing": response.get("input_spacing")},
+            "settings": response.get("settings"),
+            "stages": stages,
+            "total_seconds": round(time.perf_counter() - start, 3),
+            "memory": {"peak_rss_bytes": response.get("peak_rss_bytes")},
+            "end_time": time.time(),
+        })
+        return {"predictions": predictions, "stages": stages}
+
+    def stop(self):
+        """
+        Stops the workers.
+        """
+        self.pool.stop()
+
+
+############################################################### DAEMON ###############################################################
+
+class WatchDaemon:
+    """
+    Watches a folder and processes its stable scans in parallel threads.
+    """
+    def __init__(self, watch_dir, output_dir, rules, process, workers=1, settle_seconds=DEFAULT_SETTLE_SECONDS,
+                 poll_seconds=DEFAULT_POLL_SECONDS, watch_method="auto", retry_failed=False):
+        """
+        Args:
+            watch_dir (str): Folder receiving the scans.
+            output_dir (str): Output folder, with one folder per scan and the manifest (skipped if inside watch_dir).
+            rules (WatchRules): Configuration of the scans of every folder.
+            process (callable): Called with (scan, configuration, output folder) in a worker thread for every
+                scan (e.g. a RunnerProcessor); returns fields recorded in the manifest, raises on failure.
+            workers (int): Number of scans processed in parallel.
+            settle_seconds (float): Time without change before a scan is processed.
+            poll_seconds (float): Time between two rescans of the folder.
+            watch_method (str): See create_watcher.
+            retry_failed (bool): Processes again the scans that failed before.
+        Returns:
+            None
+        """
+        self.watch_dir = os.path.abspath(watch_dir)
+        self.output_dir = os.path.abspath(output_dir)
+        self.rules = rules
+        self.process = process
+        self.workers = max(1, int(workers))
+        self.settle_seconds = float(settle_seconds)
+        self.poll_seconds = float(poll_seconds)
+        self.watch_method = watch_method
+        self.retry_failed = retry_failed
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.manifest = WatchManifest(os.path.join(self.output_dir, MANIFEST_FILE_NAME))
+
+        self._settling = {}                 # Scan id -> (fingerprint, time it was first seen with it)
+        self._active = set()                # Scans queued or being processed
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def output_folder(self, scan_id):
+        """
+        Returns:
+            str: Output folder of a scan.
+        """
+        return os.path.join(self.output_dir, scan_output_name(scan_id))
+
+    def scan(self):
+        """
+        Scans the watched folder once, and queues the scans whose files did not change for settle_seconds
+        and that were not processed with the same files before.
+
+        Returns:
+            int: Number of scans queued.
+        """
+        now = time.monotonic()
+        scans = find_scans(self.watch_dir, exclude=[self.output_dir])
+        queued = 0
+        for scan_id, scan in scans.items():
+            with self._lock:
+                if scan_id in self._active:
+                    continue
+            fingerprint = scan_fingerprint(scan)
+            if self.manifest.is_processed(scan_id, fingerprint, self.retry_failed):
+                self._settling.pop(scan_id, None)
+                continue
+
+            previous = self._settling.get(scan_id)
+            if previous is None or previous[0] != fingerprint or scan["partial"]:
+                self._settling[scan_id] = (fingerprint, now)
+                continue
+            if now - previous[1] < self.settle_seconds:
+                continue
+            del self._settling[scan_id]
+
+            try:
+                config = self.rules.resolve(scan_id)
+            except ValueError as e:
+                print(f"Watch: {scan_id} skipped: {e}")
+                self.manifest.update(scan_id, status="failed", fingerprint=fingerprint, input=scan["path"], error=str(e))
+                continue
+            if config is None:
+                self.manifest.update(scan_id, status="ignored", fingerprint=fingerprint, input=scan["path"])
+                continue
+
+            self.manifest.update(scan_id, status="queued", fingerprint=fingerprint, input=scan["path"], kind=scan["kind"],
+                                 configuration=config, error=None)
+            with self._lock:
+                self._active.add(scan_id)
+            self._queue.put((scan_id, scan, config))
+            queued += 1
+            print(f"Watch: {scan_id} queued ({config['animal']} | {config['mode']} | {config['structure']})")
+
+        # Scans removed before they settled
+        for scan_id in set(self._settling) - set(scans):
+            del self._settling[scan_id]
+        return queued
+
+    def _work(self):
+        """
+        Worker thread: processes the queued scans until it receives None.
+        """
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            scan_id, scan, config = item
+            output_dir = self.output_folder(scan_id)
+            self.manifest.update(scan_id, status="running", output=output_dir)
+            start = time.perf_counter()
+            try:
+                os.makedirs(output_dir, exist_ok=True)
+                result = self.process(scan, config, output_dir) or {}
+                self.manifest.update(scan_id, status="done", seconds=round(time.perf_counter() - start, 3), **result)
+                print(f"Watch: {scan_id} done in {time.perf_counter() - start:.1f} s")
+            except Exception as e:
+                traceback.print_exc()
+                self.manifest.update(scan_id, status="failed", seconds=round(time.perf_counter() - start, 3), error=str(e))
+            finally:
+                with self._lock:
+                    self._active.discard(scan_id)
+
+    def is_idle(self):
+        """
+        Returns:
+            bool: True if no scan is queued, processed or waiting for its files to settle.
+        """
+        with self._lock:
+            return not self._active and not self._settling
+
+    def run(self, once=False):
+        """
+        Watches the folder until stop() is called, or with once until the scans found are processed.
+
+        Args:
+            once (bool): Returns once every scan found is processed instead of watching.
+        Returns:
+            None
+        """
+        watcher = create_watcher(self.watch_dir, self.watch_method, exclude=[self.output_dir], wake=self._stop)
+        print(f"Watching {self.watch_dir} ({watcher.name}) with {self.workers} worker(s), output in {self.output_dir}")
+        self._threads = [threading.Thread(target=self._work, name=f"watch-worker-{i}", daemon=True)
+                         for i in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+        try:
+            while not self._stop.is_set():
+                self.scan()
+                if once and self.is_idle():
+                    break
+                # Scans waiting for their files to settle are checked again sooner
+                watcher.wait(min(self.poll_seconds, self.settle_seconds) if self._settling else self.poll_seconds)
+        except KeyboardInterrupt:
+            self._stop.set()
+        finally:
+            watcher.close()
+            self._shutdown()
+
+    def stop(self):
+        """
+        Stops the daemon: the scans being processed are finished, the queued ones are processed at the next start.
+        """
+        self._stop.set()
+
+    def _shutdown(self):
+        if self._stop.is_set():
+            # The queued scans stay "queued" in the manifest
+            while True:
+                try:
+                    scan_id = self._queue.get_nowait()[0]
+                except queue.Empty:
+                    break
+                with self._lock:
+                    self._active.discard(scan_id)
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+def main(argv=None):
+    """
+    Entry point of the daemon.
+
+    Args:
+        argv (list): Arguments, sys.argv by default.
+    Returns:
+        None
+    """
+    args = parse_args(argv)
+    default = {"animal": args.animal, "mode": args.mode, "preset": args.preset,
+               "structure": args.structure if len(args.structure) > 1 else args.structure[0]}
+    rules = WatchRules.load(args.rules, default) if args.rules else WatchRules(default)
+    processor = RunnerProcessor(args.models_dir, args.workers, crop=not args.no_crop,
+                                dicom_cache_dir=os.path.join(args.output, ".dicom_cache"),
+                                dicom_cache_max_bytes=int(args.dicom_cache_gb * 1024 ** 3))
+    daemon = WatchDaemon(args.watch, args.output, rules, processor, args.workers, args.settle, args.poll,
+                         args.watch_method, args.retry_failed)
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    try:
+        daemon.run(once=args.once)
+    finally:
+        processor.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+Long-lived worker mode of nnunet_runner.py.
+
+The worker reads one JSON request per line on stdin and answers with one JSON message per line
+on stdout. Everything else written to stdout, by nnUNet, torch or their native code, is redirected to
+stderr so that stdout only carries the protocol (see reserve_stdout).
+
+Requests:
+    {"id": 1, "command": "predict", "animal": ..., "mode": ..., "structure": ..., "input": ..., "output": ..., "tmp_file": ...,
+     "preset": "accurate", "threads": 8, "crop": true, "output_format": "raw", "fold_processes": 1,
+     "stream_memory_bytes": null, "slice_batch": 16}
+    {"id": 2, "command": "preview", ...same fields as predict}
+    {"id": 2, "command": "predict", ..., "structures": ["parenchyma", "lobes"]} (instead of "structure")
+    {"id": 2, "command": "stats"}
+    {"id": 3, "command": "ping"}
+    {"id": 4, "command": "shutdown"}
+
+Responses:
+    {"id": 1, "status": "ok", ...} or {"id": 1, "status": "error", "error": "..."}
+
+While a prediction runs, progress events of the request are sent before its response
+(see nnunet_progress.py), and the slices already written by a prediction streamed slab by slab:
+    {"id": 1, "event": "progress", "stage": "predict", "done": 12, "total": 48, "percent": 37.5, ...}
+    {"id": 1, "event": "slab", "start": 0, "stop": 16, "depth": 240, "prediction": ..., "dataset_json_path": ...}
+"""
+import os
+import sys
+import json
+import time
+import threading
+import traceback
+
+from nnunet_engine import (PredictorCache, PREDICTION_FILE_NAME, output_file_name, predict_case, predict_preview,
+                           predict_structures, runtime_details)
+from LungSegmentationLib.presets import preset_settings, preview_settings
+from nnunet_progress import ProgressReporter
+
+# Context file written next to each prediction of a multi-structure request
+CONTEXT_FILE_NAME = "nnunet_context.json"
+
+
+class ProtocolWriter:
+    """
+    Thread-safe writer of line-delimited JSON messages.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        line = json.dumps(message)
+        with self.lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+
+def write_context(tmp_file, dataset_json_path):
+    """
+    Saves the dataset json path of the model in the temporary context file read by the widget.
+
+    Args:
+        tmp_file (str): Path of the context file, nothing is written if None.
+        dataset_json_path (str): Path to the dataset.json of the model.
+    Returns:
+        None
+    """
+    if not tmp_file:
+        return
+    with open(tmp_file, "w") as f:
+        json.dump({"dataset_json_path": dataset_json_path}, f)
+
+
+def write_structure_contexts(output_dir, results):
+    """
+    Saves a context file next to the prediction of every structure of a multi-structure request.
+
+    Args:
+        output_dir (str): Output folder of the request.
+        results (dict): Result of predict_structures.
+    Returns:
+        None
+    """
+    for structure, result in results.items():
+        write_context(os.path.join(output_dir, structure, CONTEXT_FILE_NAME), result["dataset_json_path"])
+
+
+def handle_predict_structures(cache, request, progress=None):
+    """
+    Runs a prediction request of several structures, sharing the preprocessing of the input (see predict_structures).
+
+    Args:
+        cache (PredictorCache): Cache of loaded predictors.
+        request (dict): The request, with "structures".
+        progress (ProgressReporter): Receives the progress of the predictions, optional.
+    Returns:
+        dict: Fields of the response, "predictions" giving the result of every structure.
+    """
+    start = time.perf_counter()
+    settings = preset_settings(request.get("preset"), request.get("threads"), request.get("crop", True),
+                               request.get("fold_processes", 1))
+    details = {}
+    results = predict_structures(cache, request["animal"], request["mode"], request["structures"],
+                                 request["input"], request["output"], progress, settings, request.get("output_format", "nrrd"),
+                                 details)
+    write_structure_contexts(request["output"], results)
+    return {
+        "predictions": results,
+        "settings": settings,
+        "stages": progress.durations() if progress is not None else None,
+        **details,
+        **runtime_details(),
+        "total_seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+def handle_predict(cache, request, progress=None, preview=False):
+    """
+    Runs a prediction request with a cached predictor.
+
+    Args:
+        cache (PredictorCache): Cache of loaded predictors.
+        request (dict): The request.
+        progress (ProgressReporter): Receives the progress of the prediction, optional.
+        preview (bool): Predicts the low-resolution preview (preview.nrrd) instead, with the predictor
+            of the full prediction so that the model is loaded once for both.
+    Returns:
+        dict: Fields of the response.
+    """
+    start = time.perf_counter()
+    settings = preset_settings(request.get("preset"), request.get("threads"), request.get("crop", True),
+                               request.get("fold_processes", 1), request.get("stream_memory_bytes"),
+                               request.get("slice_batch"))
+    if progress is not None:
+        progress.stage("load")
+    loaded = cache.get(request["animal"], request["mode"], request["structure"], settings["folds"],
+                       settings["fold_processes"])
+    load_seconds = time.perf_counter() - start
+
+    details = {}
+    output_format = request.get("output_format", "nrrd")
+    if preview:
+        settings = preview_settings(settings)
+        prediction_path = predict_preview(loaded, request["input"], request["output"], progress, settings, details,
+                                          output_format)
+    else:
+        prediction_path = predict_case(loaded, request["input"], request["output"], progress, settings, details,
+                                       output_file_name(PREDICTION_FILE_NAME, output_format))
+    write_context(request.get("tmp_file"), loaded.dataset_json_path)
+
+    return {
+        "prediction": prediction_path,
+        "dataset_json_path": loaded.dataset_json_path,
+        "settings": settings,
+        "roi": details.get("roi"),
+        "input_shape": details.get("input_shape"),
+        "input_spacing": details.get("input_spacing"),
+        "fold_parallel": details.get("fold_parallel"),
+        "stream": details.get("stream"),
+        "model": {"name": loaded.model_info["model_name"], "folds": loaded.key[3], "fold": loaded.model_info["fold"]},
+        "stages": progress.durations() if progress is not None else None,
+        **runtime_details(),
+        "model_load_seconds": round(load_seconds, 3),
+        "total_seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+def reserve_stdout():
+    """
+    Reserves the stdout of the process for the protocol: its file descriptor is duplicated for the messages, and
+    descriptor 1 is redirected to stderr, so that what nnUNet or torch print, from Python or from native code,
+    does not corrupt the protocol.
+
+    Returns:
+        file: Text stream writing to the original stdout.
+    """
+    sys.stdout.flush()
+    protocol_fd = os.dup(sys.stdout.fileno())
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+    return os.fdopen(protocol_fd, "w", buffering=1, encoding="utf-8")
+
+
+def serve(models_dir, cache_size=2, instream=None, outstream=None):
+    """
+    Serves requests until a shutdown request or the end of the input stream.
+
+    Args:
+        models_dir (str): Directory where the models are stored.
+        cache_size (int): Maximum number of predictors kept in memory.
+        instream (file): Request stream, stdin by default.
+        outstream (file): Response stream, stdout by default.
+    Returns:
+        None
+    """
+    instream = instream or sys.stdin
+    writer = ProtocolWriter(outstream or reserve_stdout())
+
+    cache = PredictorCache(models_dir, capacity=cache_size)
+    writer.send({"event": "ready", "pid": os.getpid()})
+
+    for line in instream:
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            writer.send({"id": None, "status": "error", "error": f"Invalid request: {e}"})
+            continue
+
+        request_id = request.get("id")
+        command = request.get("command")
+        try:
+            if command in ("predict", "preview"):
+                progress = ProgressReporter(lambda event: writer.send({"id": request_id, **event}))
+                if command == "predict" and request.get("structures"):
+                    result = handle_predict_structures(cache, request, progress)
+                else:
+                    result = handle_predict(cache, request, progress, preview=command == "preview")
+            elif command == "stats":
+                result = {"cache": cache.stats()}
+            elif command == "ping":
+                result = {}
+            elif command == "shutdown":
+                writer.send({"id": request_id, "status": "ok"})
+                break
+            else:
+                raise ValueError(f"Unknown command: {command}")
+            writer.send({"id": request_id, "status": "ok", **result})
+        except Exception as e:
+            traceback.print_exc()
+            writer.send({"id": request_id, "status": "error", "error": str(e)})
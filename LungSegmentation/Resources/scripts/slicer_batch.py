@@ -0,0 +1,166 @@
+"""
+Segmentation of many volumes in a headless Slicer, without the widget.
+
+Every input (image file, .nrrd or DICOM folder) is segmented with LungSegmentationLogic.segment: the
+inference workers stay loaded from one volume to the next, the predictions and converted inputs are cached
+as in the module, and the scene is cleared after every volume. The segmentations and metrics file of each
+input are written to their own folder in --output, and the state of every input to slicer_batch_summary.json.
+
+Usage:
+    Slicer --no-main-window --no-splash --python-script slicer_batch.py --input scan1.nii.gz scan2.mha dicom_dir
+        --output results --animal rabbit --mode invivo --structure parenchyma airways
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+
+# LungSegmentation.py lives two levels above this script, nnunet_watch.py next to it
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+MODULE_DIR = os.path.abspath(os.path.join(SCRIPTS_DIR, "..", ".."))
+for path in (MODULE_DIR, SCRIPTS_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+IMAGE_EXTENSIONS = (".nrrd", ".nii", ".nii.gz", ".mha")
+SUMMARY_FILE_NAME = "slicer_batch_summary.json"
+
+
+def parse_args(argv=None):
+    """
+    Parses the command line of the batch.
+
+    Args:
+        argv (list): Arguments, sys.argv by default.
+    Returns:
+        argparse.Namespace: Parsed arguments.
+    """
+    from LungSegmentationLib.presets import PRESETS
+    from LungSegmentationLib.segio import SEGMENTATION_FORMATS, DEFAULT_SEGMENTATION_FORMAT
+
+    parser = argparse.ArgumentParser(description="Segments volumes in a headless Slicer with LungSegmentationLogic")
+    parser.add_argument("--input", nargs="*", default=[], help="Image files (.nrrd, .nii, .mha) or DICOM folders")
+    parser.add_argument("--input_dir", default=None, help="Folder of image files to segment")
+    parser.add_argument("--output", required=True, help="Output directory, with one folder per input")
+    parser.add_argument("--models_dir", default=None, help="Directory of the models (the models folder of the module by default)")
+    parser.add_argument("--animal", default="rabbit", choices=["rabbit", "pig", "rat"])
+    parser.add_argument("--mode", default="invivo", choices=["invivo", "exvivo", "axial"])
+    parser.add_argument("--structure", nargs="+", default=["all"],
+                        help="Structure(s) to segment; several structures share the preprocessing of the input")
+    parser.add_argument("--preset", default=None, choices=list(PRESETS),
+                        help="Speed preset: sliding window step, test-time mirroring and folds")
+    parser.add_argument("--threads", type=int, default=None, help="Intra-op threads of torch (all the cores by default)")
+    parser.add_argument("--no_crop", action="store_true", help="Run the inference on the whole image instead of the lungs region")
+    parser.add_argument("--bypass_cache", action="store_true", help="Run the model even if the prediction is cached")
+    parser.add_argument("--format", default=DEFAULT_SEGMENTATION_FORMAT, choices=list(SEGMENTATION_FORMATS),
+                        help="Format of the saved segmentations")
+    parser.add_argument("--stop_on_error", action="store_true", help="Stop at the first input that fails")
+    args = parser.parse_args(argv)
+
+    if args.input_dir:
+        args.input += sorted(os.path.join(args.input_dir, f) for f in os.listdir(args.input_dir)
+                             if f.lower().endswith(IMAGE_EXTENSIONS))
+    if not args.input:
+        parser.error("No input: give --input or --input_dir")
+    return args
+
+
+def case_output_names(input_paths):
+    """
+    Returns the output folder of every input of the batch, named as in nnunet_watch.py: the name of an image
+    file with its extension turned into a suffix (scan.nii.gz -> scan_nii_gz), or the name of a DICOM folder.
+    Inputs whose names still collide (series1 in two folders) are prefixed with the name of their parent
+    folder, then suffixed with their position in the batch.
+
+    Args:
+        input_paths (list): Paths to the inputs.
+    Returns:
+        list: Folder name of every input, unique in the batch.
+    """
+    from collections import Counter
+    from nnunet_watch import scan_output_name
+
+    paths = [os.path.normpath(os.path.abspath(path)) for path in input_paths]
+    names = [scan_output_name(os.path.basename(path)) for path in paths]
+    counts = Counter(names)
+    names = [f"{os.path.basename(os.path.dirname(path))}_{name}" if counts[name] > 1 else name
+             for path, name in zip(paths, names)]
+    counts = Counter(names)
+    return [f"{name}_{index + 1}" if counts[name] > 1 else name for index, name in enumerate(names)]
+
+
+def run(args):
+    """
+    Segments every input of the batch, one after the other.
+
+    Args:
+        args (argparse.Namespace): Parsed arguments (see parse_args).
+    Returns:
+        list: One entry per input with "input", "output", "status", "seconds" and "segmentations" or "error".
+    """
+    import slicer
+    from LungSegmentation import LungSegmentationLogic
+
+    logic = LungSegmentationLogic(args.models_dir)
+    structure = args.structure if len(args.structure) > 1 else args.structure[0]
+    os.makedirs(args.output, exist_ok=True)
+    summary = []
+    try:
+        for index, (input_path, name) in enumerate(zip(args.input, case_output_names(args.input))):
+            output_dir = os.path.join(args.output, name)
+            entry = {"input": input_path, "output": output_dir}
+            print(f"[{index + 1}/{len(args.input)}] {input_path}")
+            start = time.perf_counter()
+            try:
+                result = logic.segment(input_path, args.animal, args.mode, structure, output_dir, preset=args.preset,
+                                       crop=not args.no_crop, bypass_cache=args.bypass_cache, load=False,
+                                       segmentation_format=args.format, threads=args.threads)
+                entry["status"] = "done"
+                entry["segmentations"] = list(result.values()) if isinstance(result, dict) else [result]
+            except Exception as e:
+                traceback.print_exc()
+                entry["status"] = "failed"
+                entry["error"] = str(e)
+            finally:
+                entry["seconds"] = round(time.perf_counter() - start, 3)
+                # Loaded inputs and labelmaps are not needed by the next volume
+                slicer.mrmlScene.Clear(0)
+            print(f"  {entry['status']} in {entry['seconds']:.1f} s")
+            summary.append(entry)
+            with open(os.path.join(args.output, SUMMARY_FILE_NAME), "w") as f:
+                json.dump(summary, f, indent=4)
+            if entry["status"] == "failed" and args.stop_on_error:
+                break
+    finally:
+        logic.stop()
+    return summary
+
+
+def main(argv=None):
+    """
+    Entry point of the batch, run by Slicer with --python-script. Slicer exits with status 1 if an input failed.
+
+    Args:
+        argv (list): Arguments, sys.argv by default.
+    Returns:
+        None
+    """
+    import slicer
+
+    status = 1
+    try:
+        summary = run(parse_args(argv))
+        failed = [entry for entry in summary if entry["status"] != "done"]
+        print(f"{len(summary) - len(failed)}/{len(summary)} volume(s) segmented, summary in {SUMMARY_FILE_NAME}")
+        status = 1 if failed else 0
+    except SystemExit as e:
+        # Errors of the command line
+        status = e.code or 0
+    finally:
+        slicer.util.exit(status)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
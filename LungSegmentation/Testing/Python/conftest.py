@@ -0,0 +1,16 @@
+"""
+Unit tests of the parts of the module that run without Slicer, torch or the models.
+
+Run from the repository root with:
+    python -m pytest LungSegmentation/Testing/Python
+"""
+import os
+import sys
+
+MODULE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+SCRIPTS_DIR = os.path.join(MODULE_DIR, "Resources", "scripts")
+
+# LungSegmentationLib and the runner scripts, imported as the runner does
+for path in (MODULE_DIR, SCRIPTS_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
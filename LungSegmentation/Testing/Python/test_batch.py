@@ -0,0 +1,88 @@
+import os
+import json
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from nnunet_batch import BatchStatus, case_id_from_path, load_manifest
+
+
+def touch(path, content=b""):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+    return path
+
+
+def dicom_bytes():
+    return b"\0" * 128 + b"DICM" + b"\0" * 16
+
+
+def test_case_id_from_path(tmp_path):
+    assert case_id_from_path("/data/scan.nii.gz") == "scan"
+    assert case_id_from_path("/data/scan.NRRD") == "scan"
+    series = tmp_path / "series.1"
+    series.mkdir()
+    assert case_id_from_path(str(series)) == "series.1"
+
+
+def test_folder_lists_images_and_dicom_series(tmp_path):
+    touch(str(tmp_path / "b.nii.gz"))
+    touch(str(tmp_path / "a.nrrd"))
+    touch(str(tmp_path / "notes.txt"))
+    touch(str(tmp_path / "series" / "IM0001"), dicom_bytes())
+    touch(str(tmp_path / "docs" / "README"), b"not an image")
+    cases = load_manifest(str(tmp_path), "rabbit", "invivo", "all")
+    assert [case["id"] for case in cases] == ["a", "b", "series"]
+    assert all(case["animal"] == "rabbit" and case["structure"] == "all" for case in cases)
+
+
+def test_csv_manifest_overrides_defaults(tmp_path):
+    manifest = tmp_path / "cases.csv"
+    manifest.write_text("input,id,animal,mode\nscans/a.nrrd,,pig,\n/abs/b.mha,case_b,,exvivo\n")
+    cases = load_manifest(str(manifest), "rabbit", "invivo", "all")
+    assert cases[0] == {"id": "a", "input": os.path.join(str(tmp_path), "scans/a.nrrd"), "animal": "pig",
+                        "mode": "invivo", "structure": "all"}
+    assert cases[1]["id"] == "case_b" and cases[1]["input"] == "/abs/b.mha" and cases[1]["mode"] == "exvivo"
+
+
+def test_json_manifest_accepts_numeric_ids(tmp_path):
+    manifest = tmp_path / "cases.json"
+    manifest.write_text(json.dumps({"cases": [{"input": "a.nrrd", "id": 12}, {"input": "b.nrrd", "id": 13}]}))
+    assert [case["id"] for case in load_manifest(str(manifest), "rabbit", "invivo", "all")] == ["12", "13"]
+
+
+@pytest.mark.parametrize("entries", [[{"input": "a.nrrd", "id": ["x"]}], ["a.nrrd"], [{"input": {"path": "a"}}]])
+def test_json_manifest_rejects_invalid_entries(tmp_path, entries):
+    manifest = tmp_path / "cases.json"
+    manifest.write_text(json.dumps(entries))
+    with pytest.raises(ValueError, match="entry 1"):
+        load_manifest(str(manifest), "rabbit", "invivo", "all")
+
+
+def test_manifest_errors(tmp_path):
+    manifest = tmp_path / "cases.json"
+    manifest.write_text(json.dumps([{"input": "a.nrrd"}, {"input": "other/a.nrrd"}]))
+    with pytest.raises(ValueError, match="Duplicate"):
+        load_manifest(str(manifest), "rabbit", "invivo", "all")
+    with pytest.raises(ValueError, match="No animal"):
+        load_manifest(str(manifest), "", "invivo", "all")
+    manifest.write_text("[]")
+    with pytest.raises(ValueError, match="No case"):
+        load_manifest(str(manifest), "rabbit", "invivo", "all")
+    with pytest.raises(ValueError, match="Unsupported"):
+        load_manifest(str(tmp_path / "cases.txt"), "rabbit", "invivo", "all")
+
+
+def test_batch_status_resumes(tmp_path):
+    path = str(tmp_path / "batch_status.json")
+    prediction = touch(str(tmp_path / "a" / "001.nrrd"))
+    status = BatchStatus(path)
+    status.update("a", status="done", prediction=prediction)
+    status.update("b", status="failed", error="boom")
+
+    reloaded = BatchStatus(path)
+    assert reloaded.is_done("a") and not reloaded.is_done("b")
+    os.remove(prediction)
+    assert not reloaded.is_done("a")
@@ -0,0 +1,70 @@
+import os
+import time
+
+from LungSegmentationLib import dependencies
+from LungSegmentationLib.dependencies import (DependencyManifest, check_dependencies, environment_fingerprint,
+                                              split_requirement, unsatisfied_requirements)
+
+
+def test_split_requirement():
+    assert split_requirement("python-gdcm==3.0.21") == ("python-gdcm", "3.0.21")
+    assert split_requirement("dicom2nifti") == ("dicom2nifti", None)
+
+
+def test_unsatisfied_requirements():
+    requirements = ["a==1.0", "b"]
+    assert unsatisfied_requirements({"a": "1.0", "b": "2.3"}, requirements) == []
+    assert unsatisfied_requirements({"a": "1.1", "b": None}, requirements) == ["a==1.0", "b"]
+
+
+def test_update_check_due(tmp_path):
+    manifest = DependencyManifest(str(tmp_path / "dependencies.json"))
+    assert manifest.update_check_due()
+    manifest.data["last_update_check"] = time.time()
+    assert not manifest.update_check_due()
+
+
+def test_manifest_round_trip(tmp_path):
+    path = str(tmp_path / "settings" / "dependencies.json")
+    manifest = DependencyManifest(path)
+    manifest.data["versions"] = {"a": "1.0"}
+    manifest.save()
+    assert DependencyManifest(path).data["versions"] == {"a": "1.0"}
+
+
+def test_environment_fingerprint_follows_site_packages(tmp_path):
+    site_packages = tmp_path / "site-packages"
+    site_packages.mkdir()
+    paths = [str(site_packages), str(tmp_path)]
+    before = environment_fingerprint(paths)
+    assert environment_fingerprint(paths) == before
+
+    (site_packages / "package-1.0.dist-info").mkdir()
+    os.utime(site_packages, ns=(0, 0))
+    assert environment_fingerprint(paths) != before
+
+
+def test_check_dependencies_uses_the_manifest(tmp_path, monkeypatch):
+    site_packages = tmp_path / "site-packages"
+    site_packages.mkdir()
+    paths = [str(site_packages)]
+    satisfied = {split_requirement(r)[0]: split_requirement(r)[1] or "1.0"
+                 for r in dependencies.REQUIRED_PACKAGES}
+    scans = []
+
+    def installed_versions(requirements=dependencies.REQUIRED_PACKAGES):
+        scans.append(requirements)
+        return dict(satisfied)
+
+    monkeypatch.setattr(dependencies, "installed_versions", installed_versions)
+    manifest = DependencyManifest(str(tmp_path / "dependencies.json"))
+
+    first = check_dependencies(manifest, paths)
+    assert first["changed"] and not first["cached"] and first["unsatisfied"] == []
+    second = check_dependencies(DependencyManifest(manifest.path), paths)
+    assert second["cached"] and len(scans) == 1
+
+    # A package was installed or removed: the versions are read again
+    os.utime(site_packages, ns=(0, 0))
+    third = check_dependencies(DependencyManifest(manifest.path), paths)
+    assert not third["cached"] and not third["changed"] and len(scans) == 2
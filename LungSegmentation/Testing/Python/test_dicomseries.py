@@ -0,0 +1,58 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from LungSegmentationLib import dicomseries
+
+
+def slices(*values, dtype=np.uint16, slope=1.0, intercept=0.0):
+    return [(np.full((2, 2), value, dtype=dtype), slope, intercept) for value in values]
+
+
+def test_rescaled_dtype():
+    assert dicomseries.rescaled_dtype(slices(0, 3000, intercept=-1024.0)) == np.int16
+    # Unsigned 16-bit micro-CT above 32767
+    assert dicomseries.rescaled_dtype(slices(0, 65535)) == np.int32
+    assert dicomseries.rescaled_dtype(slices(0, 100, slope=0.5)) == np.float32
+    assert dicomseries.rescaled_dtype(slices(0, 100, intercept=0.5)) == np.float32
+    assert dicomseries.rescaled_dtype(slices(0, 2 ** 32 - 1, dtype=np.uint32)) == np.float32
+
+
+def test_stack_slices_keeps_large_unsigned_values():
+    volume = dicomseries.stack_slices(slices(40000, 65535))
+    assert volume.dtype == np.int32
+    assert volume[0].min() == 40000 and volume[1].max() == 65535
+
+    volume = dicomseries.stack_slices(slices(0, 2000, dtype=np.int16, intercept=-1024.0))
+    assert volume.dtype == np.int16 and volume[0, 0, 0] == -1024 and volume[1, 0, 0] == 976
+
+    volume = dicomseries.stack_slices(slices(10, dtype=np.int16, slope=0.5, intercept=1.0))
+    assert volume.dtype == np.float32 and volume[0, 0, 0] == 6.0
+
+
+def test_is_dicom_file(tmp_path):
+    dicom = tmp_path / "IM0001"
+    dicom.write_bytes(b"\0" * 128 + b"DICM" + b"\0" * 8)
+    readme = tmp_path / "README"
+    readme.write_text("Acquisition notes")
+    (tmp_path / "slice.dcm").write_bytes(b"")
+    assert dicomseries.is_dicom_file(str(dicom))
+    assert dicomseries.is_dicom_file(str(tmp_path / "slice.dcm"))
+    assert not dicomseries.is_dicom_file(str(readme))
+    assert not dicomseries.is_dicom_file(str(tmp_path / "missing"))
+
+    assert dicomseries.contains_dicom(str(tmp_path))
+    readme_only = tmp_path / "docs"
+    readme_only.mkdir()
+    (readme_only / "README.txt").write_text("index")
+    (readme_only / "DICOMDIR").write_bytes(b"\0" * 128 + b"DICM" + b"\0" * 8)
+    assert not dicomseries.contains_dicom(str(readme_only))
+
+
+def test_series_geometry():
+    headers = [{"position": [0.0, 0.0, z], "orientation": [1.0, 0.0, 0.0, 0.0, 1.0, 0.0],
+                "pixel_spacing": [0.4, 0.3], "slice_thickness": 1.0} for z in (0.0, 2.5, 5.0)]
+    geometry = dicomseries.series_geometry(headers)
+    assert geometry["spacing"] == [0.3, 0.4, 2.5]
+    assert geometry["origin"] == [0.0, 0.0, 0.0]
+    assert geometry["direction"] == [1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0]
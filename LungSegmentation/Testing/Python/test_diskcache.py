@@ -0,0 +1,107 @@
+import os
+import time
+
+from LungSegmentationLib.diskcache import DiskCache
+from LungSegmentationLib.inputcache import ConvertedInputCache
+
+
+def writer(size, name="data.bin"):
+    def write_entry(directory):
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(b"x" * size)
+        return name
+    return write_entry
+
+
+def test_get_or_create_hits_and_misses(tmp_path):
+    cache = DiskCache(str(tmp_path), 1000)
+    path, hit = cache.get_or_create("a", writer(10))
+    assert not hit and os.path.isfile(os.path.join(path, "data.bin"))
+    assert cache.get_or_create("a", writer(10)) == (path, True)
+    stats = cache.stats()
+    assert (stats["entries"], stats["bytes"], stats["hits"], stats["misses"]) == (1, 10, 1, 1)
+
+
+def test_lru_eviction(tmp_path):
+    cache = DiskCache(str(tmp_path), 250)
+    for key in ("a", "b"):
+        cache.store(key, writer(100))
+        time.sleep(0.01)
+    cache.lookup("a")
+    time.sleep(0.01)
+    cache.store("c", writer(100))
+    assert cache.lookup("b") is None
+    assert cache.lookup("a") is not None and cache.lookup("c") is not None
+
+
+def test_oversized_entry_is_kept(tmp_path):
+    cache = DiskCache(str(tmp_path), 50)
+    path = cache.store("big", writer(100))
+    assert os.path.isdir(path) and cache.stats()["entries"] == 1
+
+
+def test_pinned_entries_are_not_evicted(tmp_path):
+    cache = DiskCache(str(tmp_path), 150)
+    path_a, _ = cache.get_or_create("a", writer(100), pin=True)
+    time.sleep(0.01)
+    cache.store("b", writer(100))
+    time.sleep(0.01)
+    cache.store("c", writer(100))
+    # The pinned entry stays even though it is the least recently used
+    assert os.path.isdir(path_a) and cache.is_pinned("a")
+    assert cache.lookup("b") is None
+
+    assert cache.release(os.path.join(path_a, "data.bin"))
+    assert not cache.is_pinned("a")
+    assert not cache.release(path_a)
+    # Released over budget: the least recently used entry goes
+    assert not os.path.isdir(path_a)
+    assert cache.lookup("c") is not None
+
+
+def test_pins_are_counted(tmp_path):
+    cache = DiskCache(str(tmp_path), 10)
+    cache.get_or_create("a", writer(100), pin=True)
+    cache.get_or_create("a", writer(100), pin=True)
+    cache.release("a")
+    assert cache.is_pinned("a")
+    cache.release("a")
+    # Released over budget: evicted at once
+    assert cache.stats()["entries"] == 0
+
+
+def test_store_keeps_an_existing_entry(tmp_path):
+    cache = DiskCache(str(tmp_path), 1000)
+    path = cache.store("a", writer(10), pin=True)
+    assert cache.store("a", writer(20)) == path
+    assert os.path.getsize(os.path.join(path, "data.bin")) == 10
+
+
+def test_key_of(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache"), 1000)
+    assert cache.key_of(os.path.join(cache.directory, "abc", "volume.nrrd")) == "abc"
+    assert cache.key_of(cache.directory) is None
+    assert cache.key_of(str(tmp_path / "other" / "volume.nrrd")) is None
+
+
+def test_index_survives_restart(tmp_path):
+    DiskCache(str(tmp_path), 1000).store("a", writer(10))
+    reopened = DiskCache(str(tmp_path), 1000)
+    assert reopened.lookup("a") is not None and reopened.stats()["bytes"] == 10
+
+
+def test_converted_input_cache(tmp_path):
+    source = tmp_path / "scan.mha"
+    source.write_bytes(b"image")
+    cache = ConvertedInputCache(str(tmp_path / "cache"), 1000)
+    calls = []
+
+    def convert(directory):
+        calls.append(directory)
+        return writer(10, "converted.json")(directory)
+
+    path = cache.get_or_convert(str(source), convert, pin=True)
+    assert os.path.basename(path) == "converted.json"
+    assert cache.get_or_convert(str(source), convert) == path
+    assert len(calls) == 1
+    assert cache.release(path) and not cache.release(path)
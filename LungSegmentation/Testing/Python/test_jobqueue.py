@@ -0,0 +1,137 @@
+import threading
+
+from LungSegmentationLib.jobqueue import MEMORY_LIMIT_MARGIN, JobQueue, SegmentationJob
+
+GIB = 1024 ** 3
+
+
+def make_job(tmp_path, estimated_memory=None):
+    job = SegmentationJob("mouse", "3d", "lungs", str(tmp_path / "input.nrrd"), str(tmp_path / "output"),
+                          str(tmp_path / "jobs" / str(len(list(tmp_path.glob("jobs/*"))))))
+    job.estimated_memory = estimated_memory
+    return job
+
+
+class BlockingRunner:
+    """
+    run_job of the queue: every job waits until it is released, or until it is aborted.
+    """
+    def __init__(self):
+        self.started = {}
+        self.release = {}
+
+    def __call__(self, job):
+        release = self.release.setdefault(job.id, threading.Event())
+        aborted = []
+
+        def abort(reason):
+            aborted.append(reason)
+            release.set()
+
+        job.set_abort(abort)
+        self.started.setdefault(job.id, threading.Event()).set()
+        release.wait(10)
+        job.set_abort(None)
+        if aborted:
+            raise RuntimeError(aborted[0])
+
+    def wait_started(self, job):
+        assert self.started.setdefault(job.id, threading.Event()).wait(10)
+
+    def finish(self, job):
+        self.release.setdefault(job.id, threading.Event()).set()
+
+
+def wait_finished(queue, jobs):
+    for _ in range(1000):
+        if all(job.is_finished() for job in jobs) and queue.is_idle():
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError("The jobs did not finish")
+
+
+def test_jobs_run_in_order_within_the_concurrency(tmp_path):
+    runner = BlockingRunner()
+    queue = JobQueue(runner, max_concurrent=1)
+    first, second = queue.submit(make_job(tmp_path)), queue.submit(make_job(tmp_path))
+    runner.wait_started(first)
+    assert (first.status, second.status) == (SegmentationJob.RUNNING, SegmentationJob.PENDING)
+
+    runner.finish(first)
+    runner.wait_started(second)
+    runner.finish(second)
+    wait_finished(queue, [first, second])
+    assert (first.status, second.status, first.percent) == (SegmentationJob.DONE, SegmentationJob.DONE, 100)
+
+
+def test_memory_admission(tmp_path):
+    runner = BlockingRunner()
+    queue = JobQueue(runner, max_concurrent=3, memory_budget=10 * GIB)
+    too_big = queue.submit(make_job(tmp_path, 11 * GIB))
+    assert too_big.status == SegmentationJob.FAILED and "memory budget" in too_big.error
+
+    first = queue.submit(make_job(tmp_path, 6 * GIB))
+    second = queue.submit(make_job(tmp_path, 6 * GIB))
+    runner.wait_started(first)
+    # The second job does not fit next to the first one
+    assert second.status == SegmentationJob.PENDING and queue.reserved_memory() == 6 * GIB
+    assert first.memory_limit == int(6 * GIB * (1 + MEMORY_LIMIT_MARGIN))
+
+    runner.finish(first)
+    runner.wait_started(second)
+    runner.finish(second)
+    wait_finished(queue, [first, second])
+
+
+def test_memory_limit_is_capped_by_the_free_budget(tmp_path):
+    runner = BlockingRunner()
+    queue = JobQueue(runner, max_concurrent=2, memory_budget=10 * GIB)
+    first = queue.submit(make_job(tmp_path, 4 * GIB))
+    second = queue.submit(make_job(tmp_path, 5 * GIB))
+    runner.wait_started(second)
+    assert first.memory_limit == 5 * GIB
+    assert second.memory_limit == 6 * GIB
+    for job in (first, second):
+        runner.finish(job)
+    wait_finished(queue, [first, second])
+
+
+def test_cancel_pending_and_running_jobs(tmp_path):
+    runner = BlockingRunner()
+    queue = JobQueue(runner, max_concurrent=1)
+    running, pending = queue.submit(make_job(tmp_path)), queue.submit(make_job(tmp_path))
+    runner.wait_started(running)
+
+    assert queue.cancel(pending.id) and pending.status == SegmentationJob.CANCELLED
+    assert queue.cancel(running.id)
+    wait_finished(queue, [running])
+    assert running.status == SegmentationJob.CANCELLED and running.error is None
+    assert not queue.cancel(running.id)
+
+
+def test_cancel_before_the_runner_sets_abort(tmp_path):
+    job = make_job(tmp_path)
+    job.cancel_requested = True
+    reasons = []
+    job.set_abort(reasons.append)
+    assert reasons == ["The job was cancelled."]
+
+    started, proceed = threading.Event(), threading.Event()
+
+    def run_job(job):
+        # Converts the input before reaching the inference worker, which sets the abort function
+        started.set()
+        proceed.wait(10)
+        aborted = []
+        job.set_abort(aborted.append)
+        job.set_abort(None)
+        if aborted:
+            raise RuntimeError(aborted[0])
+
+    queue = JobQueue(run_job, max_concurrent=1)
+    running = queue.submit(make_job(tmp_path))
+    assert started.wait(10)
+    assert queue.cancel(running.id) and running.cancel_requested
+    proceed.set()
+    wait_finished(queue, [running])
+    assert running.status == SegmentationJob.CANCELLED
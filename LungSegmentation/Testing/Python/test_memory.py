@@ -0,0 +1,30 @@
+from LungSegmentationLib.memory import (FOLD_PROCESS_BASE_BYTES, FOLD_WEIGHTS_BYTES, estimate_job_memory,
+                                        estimate_peak_memory)
+
+PATCH = (64, 64, 64)
+
+
+def test_estimate_grows_with_the_volume():
+    assert estimate_peak_memory(2 * 10 ** 7, PATCH, 3) > estimate_peak_memory(10 ** 7, PATCH, 3)
+    assert estimate_peak_memory(10 ** 7, PATCH, 3, 2 * 10 ** 7) > estimate_peak_memory(10 ** 7, PATCH, 3)
+
+
+def test_estimate_counts_the_folds_once():
+    single = estimate_peak_memory(10 ** 7, PATCH, 3)
+    assert estimate_peak_memory(10 ** 7, PATCH, 3, folds=5) == single + 4 * FOLD_WEIGHTS_BYTES
+    # Fold processes hold their own weights and logits; the parent keeps one fold
+    parallel = estimate_peak_memory(10 ** 7, PATCH, 3, folds=5, fold_processes=2)
+    assert parallel > single + 2 * FOLD_PROCESS_BASE_BYTES
+    # No more processes than folds
+    assert estimate_peak_memory(10 ** 7, PATCH, 3, folds=2, fold_processes=8) == \
+        estimate_peak_memory(10 ** 7, PATCH, 3, folds=2, fold_processes=2)
+    assert estimate_peak_memory(10 ** 7, PATCH, 3, folds=1, fold_processes=4) == single
+
+
+def test_estimate_job_memory(tmp_path):
+    header = tmp_path / "input.nrrd"
+    header.write_bytes(b"NRRD0004\ntype: short\ndimension: 3\nsizes: 100 100 50\nspacings: 1 1 2\n\n")
+    estimate = estimate_job_memory(str(header), folds=5, fold_processes=5)
+    assert estimate["voxels"] == 500000
+    assert estimate["bytes"] > estimate_job_memory(str(header), folds=5)["bytes"]
+    assert estimate_job_memory(str(tmp_path / "scan.nii.gz"))["bytes"] is None
@@ -0,0 +1,70 @@
+import os
+import time
+
+import pytest
+
+from LungSegmentationLib import models
+from LungSegmentationLib.resultcache import checkpoints_digest, PredictionResultCache
+
+
+def make_model_folder(root, *parts, folds=(0,)):
+    path = os.path.join(root, *parts)
+    os.makedirs(path)
+    for name in ("plans.json", "dataset.json"):
+        with open(os.path.join(path, name), "w") as f:
+            f.write("{}")
+    for fold in folds:
+        os.makedirs(os.path.join(path, f"fold_{fold}"))
+        with open(models.checkpoint_path(path, fold), "wb") as f:
+            f.write(b"weights")
+    return path
+
+
+def test_find_trained_model_folder_skips_stray_folders(tmp_path):
+    os.makedirs(tmp_path / "Dataset001" / "aaa_stray")
+    expected = make_model_folder(str(tmp_path), "Dataset001", "nnUNetTrainer__nnUNetPlans__3d_fullres")
+    assert models.find_trained_model_folder(str(tmp_path), 0) == expected
+
+
+def test_find_trained_model_folder_uses_the_fold(tmp_path):
+    make_model_folder(str(tmp_path), "Dataset001", "Trainer__Plans__2d", folds=(0,))
+    expected = make_model_folder(str(tmp_path), "Dataset001", "Trainer__Plans__3d_fullres", folds=(3,))
+    assert models.find_trained_model_folder(str(tmp_path), 3) == expected
+    with pytest.raises(ValueError):
+        models.find_trained_model_folder(str(tmp_path))
+
+
+def test_find_trained_model_folder_missing(tmp_path):
+    os.makedirs(tmp_path / "Dataset001" / "Trainer__Plans__3d_fullres")
+    with pytest.raises(FileNotFoundError):
+        models.find_trained_model_folder(str(tmp_path))
+
+
+def test_resolve_folds(tmp_path):
+    path = make_model_folder(str(tmp_path), "model", folds=(0, 1, 2))
+    os.makedirs(os.path.join(path, "fold_4"))
+    assert models.resolve_folds(path, 1) == (1,)
+    assert models.resolve_folds(path, 1, "all") == (0, 1, 2)
+    assert models.resolve_folds(str(tmp_path / "missing"), 1, "all") == (1,)
+
+
+def test_checkpoints_digest_covers_every_fold(tmp_path):
+    path = make_model_folder(str(tmp_path), "model", folds=(0, 1))
+    configured = checkpoints_digest(path, (0,))
+    ensemble = checkpoints_digest(path, (0, 1))
+    assert configured != ensemble
+
+    # Retraining another fold invalidates the ensemble only
+    time.sleep(0.01)
+    with open(models.checkpoint_path(path, 1), "wb") as f:
+        f.write(b"retrained weights")
+    assert checkpoints_digest(path, (0,)) == configured
+    assert checkpoints_digest(path, (0, 1)) != ensemble
+    assert checkpoints_digest(path, (0, 5)) is None
+
+
+def test_result_cache_key_needs_the_checkpoints():
+    params = {"animal": "rabbit", "mode": "invivo", "structure": "all", "preset": "accurate", "crop": True}
+    assert PredictionResultCache.key("input", {"checkpoint": None}, params) is None
+    key = PredictionResultCache.key("input", {"checkpoint": "abc", "folds": ["0"]}, params)
+    assert key and key != PredictionResultCache.key("input", {"checkpoint": "abc", "folds": ["0", "1"]}, params)
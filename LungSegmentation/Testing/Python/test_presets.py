@@ -0,0 +1,34 @@
+import pytest
+
+from LungSegmentationLib.presets import DEFAULT_PRESET, PRESETS, preset_settings, preview_settings
+
+
+def test_default_preset_is_the_reference_setting():
+    settings = preset_settings(None, threads=2)
+    assert settings["preset"] == DEFAULT_PRESET
+    assert (settings["tile_step_size"], settings["use_mirroring"], settings["folds"]) == (0.5, True, "configured")
+
+
+def test_every_fold_only_with_the_ensemble_preset():
+    assert [name for name, preset in PRESETS.items() if preset["folds"] == "all"] == ["ensemble"]
+    assert preset_settings("ensemble")["folds"] == "all"
+
+
+def test_overrides():
+    settings = preset_settings("fast", threads=3, crop=0, fold_processes=0, stream_memory_bytes=1.5e9, slice_batch=0)
+    assert (settings["threads"], settings["crop"], settings["fold_processes"]) == (3, False, 1)
+    assert (settings["stream_memory_bytes"], settings["slice_batch"]) == (1500000000, None)
+    assert preset_settings("fast")["threads"] >= 1
+    assert preset_settings("balanced", slice_batch=8)["slice_batch"] == 8
+
+
+def test_unknown_preset():
+    with pytest.raises(ValueError, match="Unknown speed preset"):
+        preset_settings("slow")
+
+
+def test_preview_keeps_the_predictor_settings():
+    settings = preset_settings("ensemble", threads=4)
+    preview = preview_settings(settings, downsampling=3)
+    assert (preview["folds"], preview["threads"], preview["downsampling"]) == ("all", 4, 3.0)
+    assert (preview["tile_step_size"], preview["use_mirroring"]) == (PRESETS["fast"]["tile_step_size"], False)
@@ -0,0 +1,99 @@
+import gzip
+import json
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from LungSegmentationLib import segio, volumeio
+
+GEOMETRY = {"spacing": [0.5, 0.75, 2.0], "origin": [-10.0, 20.0, 30.0],
+            "direction": [1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0]}
+SEGMENTS = [
+    {"id": "Segment_1", "name": "Left lung", "label": 1, "color": (1.0, 0.0, 0.0)},
+    {"id": "Segment_3", "name": "Trachea", "label": 3, "color": (0.0, 0.5, 1.0)},
+]
+
+
+def label_map():
+    array = np.zeros((3, 4, 5), dtype=np.uint8)
+    array[0, 1:3, 1:4] = 1
+    array[2, :, 4] = 3
+    array[1, 0, 0] = 3
+    return array
+
+
+def read_nrrd(path):
+    with open(path, "rb") as f:
+        content = f.read()
+    header, _, data = content.partition(b"\n\n")
+    fields = {}
+    for line in header.decode("latin-1").splitlines()[1:]:
+        if line.startswith("#"):
+            continue
+        key, separator, value = line.partition(":=")
+        if not separator:
+            key, _, value = line.partition(":")
+        fields[key.strip()] = value.strip()
+    if fields["encoding"] == "gzip":
+        data = gzip.decompress(data)
+    shape = [int(n) for n in fields["sizes"].split()][::-1]
+    return np.frombuffer(data, dtype=np.uint8).reshape(shape), fields
+
+
+@pytest.mark.parametrize("segmentation_format", ["raw", "gzip", "gzip-fast", "gzip-parallel"])
+def test_write_nrrd_formats(tmp_path, segmentation_format):
+    array = label_map()
+    path = segio.segmentation_file_path(str(tmp_path), "lungs", segmentation_format)
+    assert path.endswith("lungs.nrrd")
+    result = segio.write_segmentation(path, array, GEOMETRY, SEGMENTS, segmentation_format)
+    assert (result["path"], result["format"]) == (path, segmentation_format)
+
+    written, fields = read_nrrd(path)
+    np.testing.assert_array_equal(written, array)
+    assert fields["encoding"] == ("raw" if segmentation_format == "raw" else "gzip")
+    assert fields["Segment1_Name"] == "Trachea" and fields["Segment1_LabelValue"] == "3"
+    assert fields["Segment0_Extent"] == "0 4 0 3 0 2"
+
+
+def test_rle_round_trip(tmp_path):
+    array = label_map()
+    path = segio.segmentation_file_path(str(tmp_path), "lungs", "rle")
+    assert path.endswith(segio.RLE_EXTENSION)
+    segio.write_segmentation(path, array, GEOMETRY, SEGMENTS, "rle")
+
+    decoded, header = segio.read_rle(path)
+    np.testing.assert_array_equal(decoded, array)
+    assert decoded.dtype == array.dtype
+    assert header["spacing"] == GEOMETRY["spacing"] and [s["name"] for s in header["segments"]] == ["Left lung", "Trachea"]
+
+    converted = segio.rle_to_nrrd(path)
+    assert converted == str(tmp_path / "lungs.seg.nrrd")
+    np.testing.assert_array_equal(read_nrrd(converted)[0], array)
+
+
+def test_unknown_format(tmp_path):
+    with pytest.raises(ValueError, match="Unknown segmentation format"):
+        segio.write_segmentation(str(tmp_path / "a.nrrd"), label_map(), GEOMETRY, SEGMENTS, "zip")
+
+
+def test_present_labels():
+    assert segio.present_labels(label_map()) == [1, 3]
+    assert segio.present_labels(np.zeros((2, 2), dtype=np.uint8)) == []
+
+
+def test_segmentation_fields():
+    fields = volumeio.segmentation_fields(SEGMENTS, (3, 4, 5))
+    assert fields["Segment0_ID"] == "Segment_1" and fields["Segment0_Color"] == "1.0 0.0 0.0"
+    assert fields["Segment1_Extent"] == "0 4 0 3 0 2"
+    assert fields["Segmentation_MasterRepresentation"] == "Binary labelmap"
+
+
+def test_label_names(tmp_path):
+    dataset_json = tmp_path / "dataset.json"
+    dataset_json.write_text(json.dumps({"labels": {"background": 0, "lung": 1, "trachea": 3}}))
+    context_file = tmp_path / "nnunet_context.json"
+    context_file.write_text(json.dumps({"dataset_json_path": str(dataset_json)}))
+    names = segio.read_label_names(str(context_file))
+    assert names == {1: "lung", 3: "trachea"}
+    assert segio.label_name(names, 2) == "Class_2"
@@ -0,0 +1,17 @@
+import os
+
+from slicer_batch import case_output_names
+
+
+def test_image_formats_get_their_own_folder():
+    assert case_output_names(["/data/scan.nrrd", "/data/scan.nii.gz", "/data/other.NII"]) == \
+        ["scan_nrrd", "scan_nii_gz", "other_nii"]
+
+
+def test_colliding_names_are_made_unique():
+    inputs = [os.path.join("a", "series1"), os.path.join("b", "series1") + os.sep, os.path.join("c", "series2")]
+    assert case_output_names(inputs) == ["a_series1", "b_series1", "series2"]
+    # Same folder name at every level: the position in the batch tells them apart
+    same = [os.path.join("x", "a", "series1"), os.path.join("y", "a", "series1")]
+    names = case_output_names(same)
+    assert names == ["a_series1_1", "a_series1_2"]
@@ -0,0 +1,52 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import nnunet_stream
+from LungSegmentationLib import volumeio
+
+GEOMETRY = {"spacing": [0.5, 0.75, 2.0], "origin": [-10.0, 20.0, 30.0],
+            "direction": [1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0]}
+
+
+def volume():
+    return np.arange(7 * 3 * 4, dtype=np.int16).reshape(7, 3, 4) - 100
+
+
+def test_can_read_slabs(tmp_path):
+    raw = volumeio.write_nrrd(str(tmp_path / "raw.nrrd"), volume(), GEOMETRY)
+    compressed = volumeio.write_nrrd(str(tmp_path / "gzip.nrrd"), volume(), GEOMETRY, encoding="gzip")
+    (tmp_path / "raw.mha").write_text("ObjectType = Image\nCompressedData = False\nElementDataFile = LOCAL\n")
+    (tmp_path / "zip.mha").write_text("ObjectType = Image\nCompressedData = True\nElementDataFile = LOCAL\n")
+    assert nnunet_stream.can_read_slabs(raw) and not nnunet_stream.can_read_slabs(compressed)
+    assert nnunet_stream.can_read_slabs(str(tmp_path / "raw.mha"))
+    assert not nnunet_stream.can_read_slabs(str(tmp_path / "zip.mha"))
+    assert nnunet_stream.can_read_slabs("scan.nii") and not nnunet_stream.can_read_slabs("scan.nii.gz")
+
+
+def test_copy_to_volume_by_slabs(tmp_path):
+    pytest.importorskip("SimpleITK")
+    input_path = volumeio.write_nrrd(str(tmp_path / "scan.nrrd"), volume(), GEOMETRY)
+    output_dir = str(tmp_path / "prediction")
+    # A ceiling of two slices per slab
+    memory_limit = int(2 * 3 * 4 * 8 / nnunet_stream.INPUT_SLAB_FRACTION)
+
+    image, properties, header_path = nnunet_stream.read_streamed_case(None, input_path, output_dir, memory_limit)
+    assert header_path == os.path.join(output_dir, nnunet_stream.INPUT_HEADER_NAME)
+    assert image.shape == (1, 7, 3, 4) and image.dtype == np.int16
+    np.testing.assert_array_equal(image[0], volume())
+    assert properties["spacing"] == GEOMETRY["spacing"][::-1]
+    assert list(properties["sitk_stuff"]["origin"]) == GEOMETRY["origin"]
+
+    del image
+    volumeio.remove_volume(header_path)
+    assert os.listdir(output_dir) == []
+
+
+def test_volume_headers_are_mapped(tmp_path):
+    header_path = volumeio.export_array(volume(), GEOMETRY, str(tmp_path / "input_volume.json"))
+    image, _, copied = nnunet_stream.read_streamed_case(None, header_path, str(tmp_path / "prediction"), 1)
+    assert copied is None and not os.path.exists(tmp_path / "prediction")
+    np.testing.assert_array_equal(image[0], volume())
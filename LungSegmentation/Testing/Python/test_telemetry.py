@@ -0,0 +1,54 @@
+import os
+import json
+import threading
+
+from LungSegmentationLib.telemetry import PrometheusAggregate, job_metrics_name, write_metrics
+
+
+def test_job_metrics_names_are_unique_per_job():
+    first = job_metrics_name("scan 1.nii.gz", "parenchyma+airways", 1, 0)
+    second = job_metrics_name("scan 1.nii.gz", "parenchyma+airways", 2, 0)
+    assert first != second
+    assert first.startswith("scan_1.nii.gz_parenchyma+airways_") and first.endswith("_job1")
+
+
+def test_jobs_sharing_an_output_folder_keep_their_metrics(tmp_path):
+    paths = [write_metrics(str(tmp_path), {"job": job_id}, job_metrics_name("scan.nrrd", "lungs", job_id, 0))
+             for job_id in (1, 2)]
+    assert len(set(paths)) == 2
+    for job_id, path in zip((1, 2), paths):
+        with open(path, "r") as f:
+            assert json.load(f)["job"] == job_id
+    assert write_metrics(str(tmp_path / "scan"), {}) == str(tmp_path / "scan" / "metrics.json")
+
+
+def test_concurrent_writes_of_the_same_file(tmp_path):
+    errors = []
+
+    def write(job_id):
+        try:
+            for _ in range(50):
+                write_metrics(str(tmp_path), {"job": job_id}, "shared")
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(job_id,)) for job_id in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert os.listdir(str(tmp_path)) == ["shared.metrics.json"]
+
+
+def test_prometheus_aggregate(tmp_path):
+    aggregate = PrometheusAggregate(str(tmp_path / "metrics" / "lungsegmentation.prom"))
+    aggregate.update({"status": "done", "stages": {"predict": 2.0, "export": None}, "total_seconds": 3.0,
+                      "cache_hit": True, "memory": {"peak_rss_bytes": 100}, "end_time": 10.0})
+    aggregate.update({"status": "failed", "stages": {"predict": 1.0}, "total_seconds": 1.0})
+    with open(aggregate.path, "r") as f:
+        text = f.read()
+    assert 'lungsegmentation_jobs_total{status="done"} 1' in text
+    assert 'lungsegmentation_stage_seconds_count{stage="predict"} 2' in text
+    assert "lungsegmentation_result_cache_hits_total 1" in text
+    assert "lungsegmentation_job_peak_rss_bytes_max 100" in text
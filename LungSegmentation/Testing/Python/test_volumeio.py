@@ -0,0 +1,52 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from LungSegmentationLib import volumeio
+
+GEOMETRY = {"spacing": [0.5, 0.75, 2.0], "origin": [-10.0, 20.0, 30.0],
+            "direction": [0.0, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0]}
+
+
+def test_ras_lps_round_trip():
+    directions = [[0.0, -1.0, 0.0], [1.0, 0.0, 0.0], [0.0, 0.0, 1.0]]
+    lps = volumeio.ras_to_lps_geometry([1.0, 2.0, 3.0], [0.5, 0.5, 1.0], directions)
+    assert lps["origin"] == [-1.0, -2.0, 3.0]
+    ras = volumeio.lps_to_ras_geometry(lps)
+    assert ras["origin"] == [1.0, 2.0, 3.0]
+    assert ras["directions"] == directions
+    assert ras["spacing"] == [0.5, 0.5, 1.0]
+
+
+@pytest.mark.parametrize("use_shared_memory", [False, True])
+def test_export_map_remove(tmp_path, use_shared_memory):
+    array = np.arange(2 * 3 * 4, dtype=np.int16).reshape(2, 3, 4)
+    header_path = volumeio.export_array(array, GEOMETRY, str(tmp_path / "input_volume.json"), use_shared_memory)
+    assert volumeio.is_volume_header(header_path)
+
+    mapped, header = volumeio.map_volume(header_path)
+    assert header["shape"] == [2, 3, 4] and header["spacing"] == GEOMETRY["spacing"]
+    assert mapped.dtype == np.int16 and not mapped.flags.writeable
+    np.testing.assert_array_equal(mapped, array)
+    del mapped
+
+    volumeio.remove_volume(header_path)
+    assert os.listdir(tmp_path) == []
+
+
+def test_create_volume_and_map_rows(tmp_path):
+    header_path = str(tmp_path / "labels.json")
+    raw_path = volumeio.create_volume(header_path, (5, 3, 2), np.uint8, GEOMETRY)
+    assert os.path.getsize(raw_path) == 5 * 3 * 2
+
+    rows = volumeio.map_rows(raw_path, np.uint8, (3, 2), 2, 4)
+    rows[:] = 7
+    rows.flush()
+    del rows
+
+    volume, header = volumeio.map_volume(header_path)
+    assert header["dtype"] == np.dtype(np.uint8).str
+    assert volume[2:4].min() == 7 and volume[:2].max() == 0 and volume[4:].max() == 0
+    np.testing.assert_array_equal(volumeio.map_rows(raw_path, np.uint8, (3, 2), 3, 5, mode="r")[0], 7)
@@ -0,0 +1,197 @@
+import os
+import json
+import threading
+
+import pytest
+
+import nnunet_watch
+from nnunet_watch import WatchDaemon, WatchManifest, WatchRules, find_scans, scan_fingerprint, scan_output_name
+
+DEFAULT = {"animal": "rabbit", "mode": "invivo", "structure": "all", "preset": None}
+
+
+def write_dicom(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"\0" * 128 + b"DICM" + b"\0" * 16)
+
+
+def write_image(path, content=b"image"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+class FakeProcessor:
+    """
+    process callable of the daemon: records the scans and writes a file in their output folder.
+    """
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, scan, config, output_dir):
+        with self._lock:
+            self.calls.append((scan["path"], config, output_dir))
+        if os.path.basename(scan["path"]) in self.fail:
+            raise RuntimeError("prediction failed")
+        with open(os.path.join(output_dir, "001.nrrd"), "w") as f:
+            f.write("labels")
+        return {"predictions": {config["structure"]: os.path.join(output_dir, "001.nrrd")}}
+
+
+def run_daemon(watch_dir, output_dir, process, rules=None, **options):
+    daemon = WatchDaemon(str(watch_dir), str(output_dir), rules or WatchRules(DEFAULT), process, settle_seconds=0,
+                         poll_seconds=0.01, watch_method="polling", **options)
+    daemon.run(once=True)
+    return daemon
+
+
+def read_manifest(output_dir):
+    with open(os.path.join(output_dir, nnunet_watch.MANIFEST_FILE_NAME), "r") as f:
+        return json.load(f)["scans"]
+
+
+def test_find_scans(tmp_path):
+    write_image(str(tmp_path / "a.nrrd"))
+    write_image(str(tmp_path / "README"), b"Scans of the week")
+    write_dicom(str(tmp_path / "DICOMDIR"))
+    write_dicom(str(tmp_path / "series" / "IM0001"))
+    write_dicom(str(tmp_path / "series" / "IM0002"))
+    write_image(str(tmp_path / "series" / "notes.txt"))
+    write_image(str(tmp_path / "copying" / "IM0001.part"))
+    write_dicom(str(tmp_path / "copying" / "IM0002.dcm"))
+    write_image(str(tmp_path / ".hidden" / "b.nrrd"))
+    write_image(str(tmp_path / "output" / "c.nrrd"))
+
+    scans = find_scans(str(tmp_path), exclude=[str(tmp_path / "output")])
+    assert sorted(scans) == ["a.nrrd", "copying", "series"]
+    assert scans["a.nrrd"]["kind"] == "image"
+    assert scans["series"]["kind"] == "dicom" and [f[0] for f in scans["series"]["files"]] == ["IM0001", "IM0002"]
+    assert scans["copying"]["partial"] and not scans["series"]["partial"]
+
+
+def test_scan_output_name():
+    assert scan_output_name(os.path.join("pig", "a.nrrd")) == os.path.join("pig", "a_nrrd")
+    assert scan_output_name("a.nii.gz") == "a_nii_gz" and scan_output_name("a.nii") == "a_nii"
+    assert scan_output_name(os.path.join("pig", "series")) == os.path.join("pig", "series")
+
+
+def test_rules():
+    rules = WatchRules(DEFAULT, {"pig": {"animal": "pig"}, "pig/exvivo/": {"mode": "exvivo", "preset": "fast"},
+                                 "pig/calibration": {"ignore": True}})
+    assert rules.resolve("a.nrrd") == DEFAULT
+    assert rules.resolve("pig/a.nrrd")["animal"] == "pig"
+    assert rules.resolve("pig/exvivo/series") == {"animal": "pig", "mode": "exvivo", "structure": "all", "preset": "fast"}
+    assert rules.resolve("pig/calibration/phantom.nrrd") is None
+    with pytest.raises(ValueError, match="animal"):
+        WatchRules({"mode": "invivo", "structure": "all"}).resolve("a.nrrd")
+
+
+def test_rules_file(tmp_path):
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps({"default": {"structure": ["parenchyma", "airways"]}, "folders": {"rat": {"animal": "rat"}}}))
+    rules = WatchRules.load(str(path), DEFAULT)
+    assert rules.resolve("rat/a.nrrd") == {"animal": "rat", "mode": "invivo", "structure": ["parenchyma", "airways"],
+                                           "preset": None}
+
+
+def test_manifest(tmp_path):
+    path = str(tmp_path / nnunet_watch.MANIFEST_FILE_NAME)
+    manifest = WatchManifest(path)
+    manifest.update("a.nrrd", status="failed", fingerprint="f1", error="no model")
+    reloaded = WatchManifest(path)
+    assert reloaded.scans["a.nrrd"]["error"] == "no model"
+    assert reloaded.is_processed("a.nrrd", "f1") and not reloaded.is_processed("a.nrrd", "f2")
+    assert not reloaded.is_processed("a.nrrd", "f1", retry_failed=True)
+    reloaded.update("a.nrrd", status="running")
+    assert not WatchManifest(path).is_processed("a.nrrd", "f1")
+
+
+def test_scans_wait_until_settled(tmp_path):
+    watch_dir, output_dir = tmp_path / "watch", tmp_path / "output"
+    write_image(str(watch_dir / "a.nrrd"))
+    write_dicom(str(watch_dir / "series" / "IM0001"))
+    write_image(str(watch_dir / "series" / "IM0002.part"))
+
+    daemon = WatchDaemon(str(watch_dir), str(output_dir), WatchRules(DEFAULT), FakeProcessor(), settle_seconds=0)
+    # First seen: settling
+    assert daemon.scan() == 0
+    # Unchanged: queued, except the folder still being copied
+    assert daemon.scan() == 1 and not daemon.is_idle()
+    assert daemon.scan() == 0
+
+    os.rename(watch_dir / "series" / "IM0002.part", watch_dir / "series" / "IM0002")
+    write_dicom(str(watch_dir / "series" / "IM0002"))
+    assert daemon.scan() == 0
+    assert daemon.scan() == 1
+    assert sorted(read_manifest(str(output_dir))) == ["a.nrrd", "series"]
+
+    slow = WatchDaemon(str(watch_dir), str(tmp_path / "slow"), WatchRules(DEFAULT), FakeProcessor(), settle_seconds=60)
+    assert slow.scan() == 0 and slow.scan() == 0
+
+
+def test_daemon_processes_and_skips_on_restart(tmp_path):
+    watch_dir, output_dir = tmp_path / "watch", tmp_path / "output"
+    write_image(str(watch_dir / "a.nrrd"))
+    write_image(str(watch_dir / "a.nii.gz"))
+    write_dicom(str(watch_dir / "pig" / "series" / "IM0001"))
+    rules = WatchRules(DEFAULT, {"pig": {"animal": "pig"}})
+
+    processor = FakeProcessor()
+    run_daemon(watch_dir, output_dir, processor, rules, workers=2)
+    assert len(processor.calls) == 3
+    outputs = {os.path.relpath(output, str(output_dir)) for _, _, output in processor.calls}
+    assert outputs == {"a_nrrd", "a_nii_gz", os.path.join("pig", "series")}
+    assert {path: config["animal"] for path, config, _ in processor.calls}[str(watch_dir / "pig" / "series")] == "pig"
+    assert {entry["status"] for entry in read_manifest(str(output_dir)).values()} == {"done"}
+
+    # Restart: the processed scans are skipped, a changed scan is processed again
+    restarted = FakeProcessor()
+    run_daemon(watch_dir, output_dir, restarted, rules)
+    assert restarted.calls == []
+    write_image(str(watch_dir / "a.nrrd"), b"new acquisition")
+    run_daemon(watch_dir, output_dir, restarted, rules)
+    assert [os.path.basename(path) for path, _, _ in restarted.calls] == ["a.nrrd"]
+
+
+def test_interrupted_scans_are_queued_again(tmp_path):
+    watch_dir, output_dir = tmp_path / "watch", tmp_path / "output"
+    write_image(str(watch_dir / "a.nrrd"))
+    write_image(str(watch_dir / "b.nrrd"))
+    write_image(str(watch_dir / "c.nrrd"))
+    scans = find_scans(str(watch_dir))
+    os.makedirs(output_dir)
+    manifest = WatchManifest(os.path.join(str(output_dir), nnunet_watch.MANIFEST_FILE_NAME))
+    for scan_id, status in (("a.nrrd", "queued"), ("b.nrrd", "running"), ("c.nrrd", "done")):
+        manifest.update(scan_id, status=status, fingerprint=scan_fingerprint(scans[scan_id]))
+
+    processor = FakeProcessor()
+    run_daemon(watch_dir, output_dir, processor)
+    assert sorted(os.path.basename(path) for path, _, _ in processor.calls) == ["a.nrrd", "b.nrrd"]
+    assert {entry["status"] for entry in read_manifest(str(output_dir)).values()} == {"done"}
+
+
+def test_ignored_and_failed_scans(tmp_path):
+    watch_dir, output_dir = tmp_path / "watch", tmp_path / "output"
+    write_image(str(watch_dir / "calibration" / "phantom.nrrd"))
+    write_image(str(watch_dir / "unknown" / "a.nrrd"))
+    write_image(str(watch_dir / "b.nrrd"))
+    rules = WatchRules(DEFAULT, {"calibration": {"ignore": True}, "unknown": {"animal": ""}})
+
+    processor = FakeProcessor(fail=["b.nrrd"])
+    run_daemon(watch_dir, output_dir, processor, rules)
+    scans = read_manifest(str(output_dir))
+    assert scans[os.path.join("calibration", "phantom.nrrd")]["status"] == "ignored"
+    assert scans[os.path.join("unknown", "a.nrrd")]["status"] == "failed"
+    assert scans["b.nrrd"]["status"] == "failed" and scans["b.nrrd"]["error"] == "prediction failed"
+    assert [os.path.basename(path) for path, _, _ in processor.calls] == ["b.nrrd"]
+
+    # Failed scans are only processed again on request
+    run_daemon(watch_dir, output_dir, processor, rules)
+    assert len(processor.calls) == 1
+    run_daemon(watch_dir, output_dir, FakeProcessor(), rules, retry_failed=True)
+    scans = read_manifest(str(output_dir))
+    assert scans["b.nrrd"]["status"] == "done"
+    assert scans[os.path.join("calibration", "phantom.nrrd")]["status"] == "ignored"
@@ -0,0 +1,77 @@
+import io
+import os
+import sys
+import json
+import subprocess
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("numpy")
+
+import nnunet_engine
+import nnunet_worker
+
+
+def test_resolve_local_model_dataset_json(tmp_path):
+    with open(tmp_path / nnunet_engine.LOCAL_MODELS_FILE_NAME, "w") as f:
+        json.dump({"rabbit": {"invivo": {"all": {"model_path": "standin", "fold": 1}}}}, f)
+    model = nnunet_engine.resolve_local_model(str(tmp_path), "rabbit", "invivo", "all")
+    assert model["fold"] == 1
+    assert model["dataset_json_path"] == os.path.join(str(tmp_path), "standin", "dataset.json")
+    assert nnunet_engine.resolve_local_model(str(tmp_path), "pig", "invivo", "all") is None
+
+
+def test_serve_protocol(tmp_path):
+    requests = [json.dumps({"id": 1, "command": "ping"}), "not json", json.dumps({"id": 2, "command": "unknown"}),
+                json.dumps({"id": 3, "command": "stats"}), json.dumps({"id": 4, "command": "shutdown"})]
+    outstream = io.StringIO()
+    nnunet_worker.serve(str(tmp_path), instream=io.StringIO("\n".join(requests) + "\n"), outstream=outstream)
+    messages = [json.loads(line) for line in outstream.getvalue().splitlines()]
+    assert messages[0]["event"] == "ready"
+    assert messages[1] == {"id": 1, "status": "ok"}
+    assert messages[2]["id"] is None and messages[2]["status"] == "error"
+    assert messages[3]["id"] == 2 and messages[3]["status"] == "error"
+    assert messages[4]["id"] == 3 and "cache" in messages[4]
+    assert messages[5] == {"id": 4, "status": "ok"}
+
+
+def test_reserve_stdout_keeps_native_output_off_the_protocol():
+    script = ("import os, nnunet_worker\n"
+              "stream = nnunet_worker.reserve_stdout()\n"
+              "print('python output')\n"
+              "os.write(1, b'native output\\n')\n"
+              "stream.write('{\"event\": \"ready\"}\\n')\n")
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True,
+                            env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+    assert result.stdout == '{"event": "ready"}\n'
+    assert "python output" in result.stderr and "native output" in result.stderr
+
+
+
+def test_fold_parallel_predictor_loads_one_fold(tmp_path, monkeypatch):
+    for fold in range(3):
+        os.makedirs(tmp_path / "standin" / f"fold_{fold}")
+        (tmp_path / "standin" / f"fold_{fold}" / "checkpoint_final.pth").write_bytes(b"weights")
+    with open(tmp_path / nnunet_engine.LOCAL_MODELS_FILE_NAME, "w") as f:
+        json.dump({"rabbit": {"invivo": {"all": {"model_path": "standin", "fold": 0}}}}, f)
+
+    def create_predictor(model_path, folds):
+        manager = SimpleNamespace(configuration={"spacing": [1.0, 1.0, 1.0]}, spacing=[1.0, 1.0, 1.0])
+        return SimpleNamespace(folds=tuple(folds), configuration_manager=manager,
+                               list_of_parameters=[f"weights of fold {fold}" for fold in folds])
+
+    monkeypatch.setattr(nnunet_engine, "create_predictor", create_predictor)
+    cache = nnunet_engine.PredictorCache(str(tmp_path), capacity=2)
+    sequential = cache.get("rabbit", "invivo", "all", "all")
+    parallel = cache.get("rabbit", "invivo", "all", "all", fold_processes=3)
+    # The processes of nnunet_folds.py load the weights of the ensemble: the parent loads the first fold only
+    assert (sequential.predictor.folds, parallel.predictor.folds) == ((0, 1, 2), (0,))
+    assert sequential.folds == parallel.folds == (0, 1, 2)
+    assert not sequential.fold_parallel and parallel.fold_parallel
+    assert cache.get("rabbit", "invivo", "all", "all", fold_processes=2) is parallel
+
+    # The preview runs in the parent with its fold
+    with nnunet_engine.preview_predictor(parallel, 2.0):
+        assert not parallel.fold_parallel and parallel.predictor.configuration_manager.configuration["spacing"] == [2.0] * 3
+    assert parallel.fold_parallel and parallel.predictor.list_of_parameters == ["weights of fold 0"]